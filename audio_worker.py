@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Воркеры аудио-пайплайна Telegram бота (режим AUDIO_EXTERNAL_WORKERS=true).
+
+В этом режиме main.py только принимает файлы и записывает задачи в audio_jobs,
+а скачивание, ffmpeg/pydub, STT, LLM и документы выполняют процессы этого модуля —
+на той же машине или на других, с доступом к той же базе и Bot API. Пропускная
+способность растёт с числом ядер и машин.
+
+Каждый процесс держит --concurrency слотов; слот забирает задачу через
+claim_next_audio_job (SELECT ... FOR UPDATE SKIP LOCKED, файлы одного пользователя
+по очереди), восстанавливает Message/FSMContext/i18n и выполняет ту же обработку,
+что и бот (_process_audio_internal). Прогресс пользователь видит напрямую через
+Bot API, статус задачи — в audio_jobs. Аренда задач продлевается, пока процесс жив;
+при остановке незавершённые задачи сразу отпускаются другим воркерам.
+
+Лимиты стадий (AUDIO_STAGE_LIMIT_*) действуют на каждый процесс.
+
+Использование:
+    python audio_worker.py                          # процессов по числу ядер
+    python audio_worker.py --processes 4 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+
+# Добавляем путь к проекту
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+logger = logging.getLogger(__name__)
+
+AUDIO_WORKER_CONCURRENCY = int(os.environ.get('AUDIO_WORKER_CONCURRENCY', '4'))
+AUDIO_WORKER_POLL_SECONDS = float(os.environ.get('AUDIO_WORKER_POLL_SECONDS', '1'))
+# Сколько ждать выполняющиеся задачи при остановке, прежде чем отпустить их другим воркерам
+AUDIO_WORKER_SHUTDOWN_GRACE_SECONDS = float(os.environ.get('AUDIO_WORKER_SHUTDOWN_GRACE_SECONDS', '30'))
+
+
+async def _worker_slot(slot: int, stop: asyncio.Event):
+    from models.orm import claim_next_audio_job
+    from services.audio_queue_core import AUDIO_WORKER_ID
+    from services.audio_queue_service import audio_queue_manager
+
+    platform = audio_queue_manager.adapter.platform
+    while not stop.is_set():
+        job = await claim_next_audio_job(platform, AUDIO_WORKER_ID)
+        if job is None:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=AUDIO_WORKER_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        logger.info(f"Slot {slot} took audio job {job['id']} (user {job['user_id']}, attempt {job['attempts']})")
+        await audio_queue_manager.run_job(job)
+
+
+async def _renew_leases(stop: asyncio.Event):
+    from models.orm import renew_audio_job_leases, AUDIO_JOB_LEASE_SECONDS
+    from services.audio_queue_core import AUDIO_WORKER_ID
+
+    interval = max(AUDIO_JOB_LEASE_SECONDS // 3, 10)
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            await renew_audio_job_leases(AUDIO_WORKER_ID)
+
+
+async def worker_main(concurrency: int):
+    from aiogram import Dispatcher
+
+    from models.orm import init_background_logging, shutdown_background_logging, release_audio_jobs
+    from services.audio_queue_core import AUDIO_WORKER_ID
+    from services.audio_queue_service import audio_queue_manager
+    from services.bot_provider import register_bot
+    from services.fsm_storage import FSM_STORAGE, create_fsm_storage
+    from services.http_clients import close_http_clients
+    from services.init_bot import bot
+    from utils.i18n import create_translator_hub
+
+    if not audio_queue_manager.adapter.supports_external_workers:
+        # MemoryStorage у воркера пустой и отдельный от бота: состояние пользователей не дойдёт
+        raise SystemExit(f"audio_worker.py needs a shared FSM storage (postgres or redis), FSM_STORAGE={FSM_STORAGE}")
+
+    register_bot('telegram', bot)
+    await init_background_logging()
+
+    # Диспетчер нужен только как владелец FSM-хранилища: обновления воркер не получает
+    dispatcher = Dispatcher(storage=create_fsm_storage(bot))
+    audio_queue_manager.adapter.bind(dispatcher, create_translator_hub())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    logger.info(f"Audio worker {AUDIO_WORKER_ID} started with {concurrency} slots")
+    lease_task = asyncio.create_task(_renew_leases(stop))
+    slots = [asyncio.create_task(_worker_slot(slot, stop)) for slot in range(concurrency)]
+
+    await stop.wait()
+    logger.info(f"Audio worker {AUDIO_WORKER_ID} stopping")
+
+    # Новые задачи слоты уже не берут; выполняющиеся дорабатывают в пределах grace
+    done, pending = await asyncio.wait(slots, timeout=AUDIO_WORKER_SHUTDOWN_GRACE_SECONDS)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    lease_task.cancel()
+
+    await release_audio_jobs(AUDIO_WORKER_ID)
+    await shutdown_background_logging()
+    await close_http_clients()
+    await dispatcher.storage.close()
+    await bot.session.close()
+
+
+def run_worker_process(concurrency: int):
+    logging.basicConfig(
+        level=logging.INFO,
+        format=u'%(filename)s:%(lineno)d #%(levelname)-8s '
+               u'[%(asctime)s] - %(name)s - %(processName)s - %(message)s',
+        stream=sys.stdout
+    )
+    try:
+        asyncio.run(worker_main(concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Audio pipeline worker processes')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help='число процессов-воркеров (по умолчанию — число ядер)')
+    parser.add_argument('--concurrency', type=int, default=AUDIO_WORKER_CONCURRENCY,
+                        help='задач одновременно в одном процессе')
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_worker_process(args.concurrency)
+        return
+
+    # spawn: каждый процесс заново импортирует модули и получает свой AUDIO_WORKER_ID и пулы соединений
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=run_worker_process, args=(args.concurrency,), name=f'audio-worker-{index}')
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    # SIGTERM родителю — пересылаем детям, они дорабатывают и отпускают задачи
+    def _forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGTERM, _forward)
+    signal.signal(signal.SIGINT, _forward)
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Проверка использования индексов горячими запросами (EXPLAIN ANALYZE).
+
+Запросы повторяют фильтры из models/orm.py; для каждого печатается план
+и проверяется, что в нём встречается ожидаемый индекс из миграции
+migrations/versions/*_hot_path_indexes.py.
+
+Использование:
+    python explain_hot_queries.py            # планы как есть
+    python explain_hot_queries.py --no-seqscan  # для маленьких dev-баз, где планировщик
+                                                # предпочитает seq scan из-за размера таблиц
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+# Добавляем путь к проекту
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import exists, func, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from config_data.config import load_config
+from models.model import FileDownload, LLMRequest, Payment, ProcessingSession, User, UserAction
+
+
+async def _sample_values(conn) -> dict:
+    """Берём реальные значения из базы, чтобы планы были репрезентативными"""
+    telegram_id = (await conn.execute(select(User.telegram_id).limit(1))).scalar() or '0'
+    user_id = (await conn.execute(select(User.id).limit(1))).scalar() or 0
+    session_id = (await conn.execute(select(LLMRequest.session_id).where(
+        LLMRequest.session_id.isnot(None)).limit(1))).scalar() or '00000000-0000-0000-0000-000000000000'
+    return {'telegram_id': telegram_id, 'user_id': user_id, 'session_id': session_id}
+
+
+def _hot_queries(sample: dict) -> list[tuple[str, str, object]]:
+    """(описание, ожидаемый индекс, запрос)"""
+    now = datetime.utcnow()
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    return [
+        ('get_user / change_user_setting / add_voice_use', 'ix_users_telegram_id',
+         select(User).where(User.telegram_id == sample['telegram_id'])),
+
+        ('get_statistics: active sessions', 'ix_processing_sessions_active',
+         select(func.count(ProcessingSession.id)).where(ProcessingSession.final_status.is_(None))),
+
+        ('get_users_for_first_upload_reminder: first successful session', 'ix_processing_sessions_success_user_completed',
+         select(ProcessingSession.user_id, func.min(ProcessingSession.completed_at))
+         .where(ProcessingSession.final_status == 'success',
+                ProcessingSession.user_id == sample['user_id'])
+         .group_by(ProcessingSession.user_id)),
+
+        ('count_user_chat_requests_by_session', 'ix_llm_requests_session_id_request_type',
+         select(func.count(LLMRequest.id)).where(
+             LLMRequest.user_id == sample['user_id'],
+             LLMRequest.session_id == sample['session_id'],
+             LLMRequest.request_type == 'chat')),
+
+        ('file downloads by session', 'ix_file_downloads_session_id',
+         select(FileDownload.id).where(FileDownload.session_id == sample['session_id'])),
+
+        ('get_users_for_first_reminder: conversion window', 'ix_user_actions_conversion_created_at',
+         select(UserAction.user_id, func.min(UserAction.created_at))
+         .where(UserAction.action_category == 'conversion',
+                UserAction.created_at >= now - timedelta(hours=3),
+                UserAction.created_at <= now - timedelta(hours=2))
+         .group_by(UserAction.user_id)),
+
+        ('reminders: "already sent" probe', 'ix_user_actions_user_id_action_type',
+         select(exists().where(
+             UserAction.user_id == sample['user_id'],
+             UserAction.action_type.in_(['conversion_reminder_first_sent', 'conversion_reminder_first_failed'])))),
+
+        ('reminders: "never paid" probe', 'ix_payments_user_id_status',
+         select(exists().where(
+             Payment.user_id == sample['user_id'],
+             Payment.status.in_(['completed', 'success'])))),
+
+        ('get_users_for_onboarding_day1: registration window', 'ix_users_created_at',
+         select(User.id).where(User.created_at >= today_start - timedelta(days=1),
+                               User.created_at < today_start)),
+    ]
+
+
+async def _index_names(conn, index_name: str) -> set[str]:
+    """Индекс и его копии на партициях: у партиционированных таблиц план ссылается на индексы партиций"""
+    result = await conn.execute(
+        text('SELECT relid::regclass::text FROM pg_partition_tree(CAST(:name AS regclass))'), {'name': index_name}
+    )
+    return {row[0] for row in result} or {index_name}
+
+
+def _compile(stmt) -> str:
+    return str(stmt.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+
+async def main(no_seqscan: bool) -> int:
+    config = load_config('.env')
+    db_host = os.environ.get('DB_HOST', 'localhost')
+    engine = create_async_engine(
+        f'postgresql+asyncpg://{config.db.user}:{config.db.password}@{db_host}:5432/{config.db.database}'
+    )
+
+    failed = 0
+    async with engine.connect() as conn:
+        if no_seqscan:
+            await conn.execute(text('SET enable_seqscan = off'))
+        sample = await _sample_values(conn)
+
+        for title, index_name, stmt in _hot_queries(sample):
+            result = await conn.execute(text(f'EXPLAIN (ANALYZE, BUFFERS) {_compile(stmt)}'))
+            plan = '\n'.join(row[0] for row in result)
+            uses_index = any(name in plan for name in await _index_names(conn, index_name))
+            failed += not uses_index
+
+            print('=' * 80)
+            print(f"{'✅' if uses_index else '❌'} {title} -> {index_name}")
+            print(plan)
+
+    await engine.dispose()
+
+    print('=' * 80)
+    print(f"Index not used: {failed} query(ies)" if failed else "All hot queries use their indexes")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='EXPLAIN ANALYZE hot ORM queries')
+    parser.add_argument('--no-seqscan', action='store_true',
+                        help='SET enable_seqscan = off (useful on small dev databases)')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.no_seqscan)))
@@ -17,9 +17,9 @@ from config_data.config import get_config
 from keyboards.admin_keyboards import admin_menu, confirm_spam_keyboard, spam_menu, statistic_source_menu, \
     cancel_subscription_keyboard, sub_type_menu, time_period_menu, data_export_menu, statistic_source_menu_paginated, \
     logs_time_menu, confirm_give_subscription_keyboard
-from models.orm import get_payments_sources, get_sources_with_subscription, get_users, is_admin, get_statistics, get_sources, give_subscription, get_user_id_range, update_user_blocked_status, engine, get_users_to_exclude_from_broadcast, get_user
+from models.orm import get_payments_sources, get_sources_with_subscription, iter_users, iter_user_batches, count_users, is_admin, get_statistics, get_statistics_refreshed_at, get_sources, use_replica, give_subscription, get_user_id_range, update_user_blocked_status, engine, get_users_to_exclude_from_broadcast, get_user
 from services.init_bot import bot
-from services.services import sources_to_str, split_long_message, sources_to_str_paginated
+from services.services import sources_to_str, split_long_message, sources_to_str_paginated, spam_target_filters, statistics_refreshed_str
 from states.states import AdminSpamSession, AdminGiveSubscription
 from services.telegram_alerts import send_alert
 
@@ -256,6 +256,7 @@ async def process_statistics_command(message: Message, state: FSMContext, i18n:
                                 annual_subs=usage_data['annual_subs'],
                                 manual_subs=usage_data['manual_subs'],
                                 unblocked_users_count=usage_data['unblocked_users_count'])
+    text += statistics_refreshed_str(usage_data['refreshed_at'], i18n)
     if type(message) is CallbackQuery:
         await message.message.edit_text(text=text,
                                         reply_markup=admin_menu(i18n))
@@ -478,43 +479,29 @@ async def process_spam_selection(callback: CallbackQuery, state: FSMContext, i18
     
     spam_type = callback.data
     state_data = await state.get_data()
-    start_id: int | None = state_data.get('start_id', None)
-    end_id: int | None = state_data.get('end_id', None)
-    
-    users: list[dict] = await get_users()
-    
-    # Filter users based on start_id
-
-    if start_id and end_id:
-        users = [user for user in users if start_id <= int(user['id']) <= end_id]
-    elif start_id:
-        users = [user for user in users if start_id <= int(user['id'])]
-    elif end_id:
-        users = [user for user in users if end_id >= int(user['id'])]
-    
-    # Фильтруем пользователей, которые заблокировали бота
-    users = [user for user in users if not user.get('is_bot_blocked', False)]
-    
-    if spam_type == 'spam_subscribed':
-        users = [user for user in users if user['subscription'] == 'True']
-    elif spam_type == 'spam_unsubscribed':
-        users = [user for user in users if user['subscription'] != 'True']
-    # spam_all uses all filtered users
-    
-    # Получаем пользователей для исключения из рассылки (получали/получат напоминания)
+    # Новый выбор аудитории сбрасывает исключения из файла, как и раньше
+    state_data.update(spam_type=spam_type, exclude_ids=[], exclusion_reference_time=None)
+
+    # Диапазон id, заблокировавшие бота и подписка фильтруются в SQL;
+    # сам список получателей в состоянии не храним — он читается потоково при отправке
+    users_before_exclusion = await count_users(**spam_target_filters(state_data))
+
+    # Исключаем из рассылки тех, кто получал/получит напоминания (anti-join в SQL)
     exclusion_data = await get_users_to_exclude_from_broadcast()
-    excluded_user_ids = exclusion_data['user_ids']
+    exclusion_reference_time = exclusion_data['reference_time'].isoformat()
     exclusion_stats = exclusion_data['stats']
+    state_data['exclusion_reference_time'] = exclusion_reference_time
 
     # Подсчитываем, сколько пользователей будет исключено
-    users_before_exclusion = len(users)
-    users = [user for user in users if int(user['id']) not in excluded_user_ids]
-    users_excluded_count = users_before_exclusion - len(users)
+    users_num = await count_users(**spam_target_filters(state_data))
+    users_excluded_count = users_before_exclusion - users_num
 
     # Сохраняем статистику в состоянии для отображения при подтверждении
     await state.update_data(
         spam_type=spam_type,
-        target_users=users,
+        exclude_ids=[],
+        exclusion_reference_time=exclusion_reference_time,
+        target_users_count=users_num,
         exclusion_stats={
             'excluded_count': users_excluded_count,
             'recent_reminders': exclusion_stats['recent_reminders'],
@@ -532,7 +519,7 @@ async def process_spam_selection(callback: CallbackQuery, state: FSMContext, i18
 
     try:
         await callback.message.edit_text(
-            text=i18n.spam_menu(users_num=len(users)) + detail_text,
+            text=i18n.spam_menu(users_num=users_num) + detail_text,
             reply_markup=spam_menu(i18n, show_exclude_button=True),
             parse_mode='HTML'
         )
@@ -549,14 +536,14 @@ async def process_spam_message(message: Message, state: FSMContext, i18n: Transl
         return
 
     state_data = await state.get_data()
-    target_users = state_data.get('target_users', [])
+    target_users_count = state_data.get('target_users_count', 0)
     exclusion_stats = state_data.get('exclusion_stats', {})
 
     await state.update_data(spam_message=message)
 
     # Формируем сообщение с подтверждением
     confirmation_text = i18n.spam_confirmation()
-    confirmation_text += f"\n\n📊 <b>Итого для рассылки:</b> {len(target_users)} чел."
+    confirmation_text += f"\n\n📊 <b>Итого для рассылки:</b> {target_users_count} чел."
 
     if exclusion_stats:
         total_excluded = exclusion_stats.get('excluded_count', 0) + exclusion_stats.get('manual_excluded', 0)
@@ -579,7 +566,7 @@ async def process_confirm_spam(callback: CallbackQuery, state: FSMContext, i18n:
         return
     
     state_data = await state.get_data()
-    target_users = state_data.get('target_users', [])
+    target_users_count = state_data.get('target_users_count', 0)
     message_to_spam = state_data.get('spam_message')
     exclusion_stats = state_data.get('exclusion_stats', {})
 
@@ -591,13 +578,14 @@ async def process_confirm_spam(callback: CallbackQuery, state: FSMContext, i18n:
     
     await callback.message.edit_text(text=i18n.spam_start())
 
-    # Create batches of 20 users
+    # Получатели читаются из БД потоково пачками по batch_size
     batch_size = 15
-    user_batches = [target_users[i:i + batch_size] for i in range(0, len(target_users), batch_size)]
+    batches_count = (target_users_count + batch_size - 1) // batch_size
     
     total_sent = 0
+    total_targeted = 0
     spam_logger.info(f"Starting spam campaign {campaign_id}")
-    spam_logger.info(f"Target users count: {len(target_users)}")
+    spam_logger.info(f"Target users count: {target_users_count}")
     spam_logger.info(f"Admin ID: {callback.from_user.id}")
     spam_logger.info(f"Message type: {message_to_spam.content_type}")
 
@@ -610,7 +598,7 @@ async def process_confirm_spam(callback: CallbackQuery, state: FSMContext, i18n:
             spam_logger.info(f"  - Breakdown: {exclusion_stats['breakdown']}")
 
     try:
-        alert_text = f"<b>Starting spam campaign</b> {campaign_id}.\n<b>Target users count:</b> {len(target_users)}.\n<b>Admin ID:</b> {callback.from_user.username}"
+        alert_text = f"<b>Starting spam campaign</b> {campaign_id}.\n<b>Target users count:</b> {target_users_count}.\n<b>Admin ID:</b> {callback.from_user.username}"
         if exclusion_stats and exclusion_stats.get('excluded_count', 0) > 0:
             alert_text += f"\n<b>Excluded (reminders):</b> {exclusion_stats['excluded_count']}"
 
@@ -622,19 +610,22 @@ async def process_confirm_spam(callback: CallbackQuery, state: FSMContext, i18n:
 
 
     
-    for batch_index, batch in enumerate(user_batches):
-        spam_logger.info(f"Processing batch {batch_index+1}/{len(user_batches)}")
+    batch_index = 0
+    async for batch in iter_user_batches(batch_size, **spam_target_filters(state_data)):
+        spam_logger.info(f"Processing batch {batch_index+1}/{batches_count}")
+        total_targeted += len(batch)
         coros = [spam_gather(message_to_spam, int(user['telegram_id']), i18n, user) for user in batch]
         results = await asyncio.gather(*coros)
         successful_sends = sum(1 for result in results if result)
         total_sent += successful_sends
         
         spam_logger.info(f"Batch {batch_index+1} completed: {successful_sends}/{len(batch)} successful")
+        batch_index += 1
         
         # Wait for 1 second before the next batch
         await asyncio.sleep(1)
 
-    spam_logger.info(f"Spam campaign completed. Total sent: {total_sent}/{len(target_users)}")
+    spam_logger.info(f"Spam campaign completed. Total sent: {total_sent}/{total_targeted}")
 
     # Формируем детальное сообщение о результатах
     result_text = i18n.spam_success(total_sent=total_sent)
@@ -661,7 +652,7 @@ async def process_confirm_spam(callback: CallbackQuery, state: FSMContext, i18n:
                     result_text += f"\n  • {reminder_name}: {count}"
 
     try:
-        alert_text = f"<b>Spam campaign</b> {campaign_id} completed.\n<b>Total sent:</b> {total_sent}/{len(target_users)}.\n<b>Admin ID:</b> {callback.from_user.username}"
+        alert_text = f"<b>Spam campaign</b> {campaign_id} completed.\n<b>Total sent:</b> {total_sent}/{total_targeted}.\n<b>Admin ID:</b> {callback.from_user.username}"
         if exclusion_stats and exclusion_stats.get('excluded_count', 0) > 0:
             alert_text += f"\n<b>Excluded (reminders):</b> {exclusion_stats['excluded_count']}"
 
@@ -681,10 +672,10 @@ async def process_continue_to_message(callback: CallbackQuery, state: FSMContext
         return
 
     state_data = await state.get_data()
-    target_users = state_data.get('target_users', [])
+    target_users_count = state_data.get('target_users_count', 0)
     exclusion_stats = state_data.get('exclusion_stats', {})
 
-    msg_text = f"👥 Выбрано пользователей для рассылки: {len(target_users)}\n"
+    msg_text = f"👥 Выбрано пользователей для рассылки: {target_users_count}\n"
 
     # Добавляем статистику исключений если есть
     if exclusion_stats:
@@ -823,20 +814,14 @@ async def process_exclude_file(message: Message, state: FSMContext, i18n: Transl
 
         # Получаем текущие данные состояния
         state_data = await state.get_data()
-        target_users = state_data.get('target_users', [])
         exclusion_stats = state_data.get('exclusion_stats', {})
 
-        # Фильтруем пользователей, исключая указанные ID
-        original_count = len(target_users)
-        filtered_users = []
-
-        for user in target_users:
-            user_internal_id = int(user['id'])  # Используем внутренний ID базы данных
-            if user_internal_id not in exclude_ids:
-                filtered_users.append(user)
+        # Пересчитываем аудиторию в SQL с учётом исключений из файла (внутренние ID базы данных)
+        original_count = state_data.get('target_users_count', 0)
+        filtered_count = await count_users(**spam_target_filters(state_data)) if state_data.get('spam_type') else 0
 
-        # Обновляем список пользователей, сохраняя статистику исключений
-        excluded_count = original_count - len(filtered_users)
+        # Обновляем количество получателей, сохраняя статистику исключений
+        excluded_count = original_count - filtered_count
 
         # Обновляем статистику: добавляем к уже существующим исключениям
         if exclusion_stats:
@@ -853,7 +838,7 @@ async def process_exclude_file(message: Message, state: FSMContext, i18n: Transl
             }
             total_excluded = excluded_count
 
-        await state.update_data(target_users=filtered_users, exclusion_stats=exclusion_stats)
+        await state.update_data(target_users_count=filtered_count, exclusion_stats=exclusion_stats)
 
         # Формируем детальное сообщение
         stats_msg = f"✅ Файл обработан успешно!\n\n"
@@ -866,7 +851,7 @@ async def process_exclude_file(message: Message, state: FSMContext, i18n: Transl
             stats_msg += f"  ├ Получили (24ч): {exclusion_stats['recent_reminders']}\n"
             stats_msg += f"  └ Получат (24ч): {exclusion_stats['upcoming_reminders']}\n"
 
-        stats_msg += f"• <b>Итоговое количество для рассылки: {len(filtered_users)}</b>\n\n"
+        stats_msg += f"• <b>Итоговое количество для рассылки: {filtered_count}</b>\n\n"
         stats_msg += f"Выберите дальнейшее действие:"
 
         await message.answer(
@@ -1217,7 +1202,8 @@ async def display_sources_paginated(callback: CallbackQuery, source_data: list,
         )
     else:
         full_text = list_text
-    
+    full_text += statistics_refreshed_str(await get_statistics_refreshed_at(), i18n)
+
     # Создаем клавиатуру с пагинацией
     # Фильтруем kwargs для избежания превышения лимита callback_data
     keyboard_kwargs = {k: v for k, v in kwargs.items() if k not in ['period_text', 'subscription_text']}
@@ -1259,11 +1245,9 @@ async def process_export_telegram_ids(callback: CallbackQuery, state: FSMContext
     
     try:
         await callback.message.edit_text(text=i18n.export_preparing())
-        # Получаем всех пользователей
-        users = await get_users()
-        
-        # Создаем файл с telegram_id
-        telegram_ids = [user['telegram_id'] for user in users]
+        # Создаем файл с telegram_id (читаем только эту колонку, потоково)
+        with use_replica():
+            telegram_ids = [user['telegram_id'] async for user in iter_users(columns=('telegram_id',))]
         file_content = '\n'.join(telegram_ids)
         
         # Создаем файл в памяти
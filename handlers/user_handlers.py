@@ -13,22 +13,21 @@ from aiogram.types import CallbackQuery, Message, BufferedInputFile, LinkPreview
     InlineKeyboardButton, FSInputFile, InputMediaAnimation
 from fluentogram import TranslatorRunner
 import pytz
-from models.orm import get_transcript_by_chat_session
 from handlers.balance_hanlders import process_subscription
 from keyboards.user_keyboards import continue_without_language, inline_change_model_menu, \
     inline_change_specify_language_menu, inline_main_menu, inline_new_session, inline_cancel, \
     bill_keyboard, inline_user_settings, subscription_menu, subscription_forward, main_menu_keyboard, \
     inline_download_file, transcription_no_summary_keyboard, notetaker_menu_keyboard
-from models.orm import (change_user_setting, get_transcription_data, get_user, create_new_user, add_gpt_use, add_voice_use,
-                        renew_subscription_db, update_user_blocked_status, update_audio_log,
-                        create_processing_session, update_processing_session, create_audio_log_with_session,
+from models.orm import (change_user_setting, get_transcription_data, get_user, create_new_user, add_gpt_use,
+                        renew_subscription_db, update_user_blocked_status, ProcessingSessionWriter, update_processing_session,
                         increment_download_attempts, log_anonymous_chat_message, count_user_chat_requests_by_session,
                         get_processing_session_by_id, find_cached_transcription, find_cached_summary,
-                        find_cached_transcription_by_file_path, log_user_action_async)
+                        find_cached_transcription_by_file_path, load_cached_transcription_texts, log_user_action_async)
 from services.cache_normalization import generate_prompt_hash, generate_file_hash_async
 from services.content_downloaders.file_handling import download_file, identify_url_source
 from services.fedor_api import convert_file_fedor_api, download_file_fedor_api, process_audio_fedor_api
 from services.general_functions import process_chat_request, process_audio, summarise_text, generate_title
+from services.dialogue_context import build_dialogue_context, dialogue_transcript_ref, load_dialogue_transcript
 from services.dynamic_progress_manager import DynamicProgressManager, create_progress_manager, ProgressPhase
 from services.google_docs_service_lite import create_two_google_docs_lite
 from services.init_bot import bot, config
@@ -203,7 +202,6 @@ async def _process_audio_internal(message: Message, state: FSMContext, i18n: Tra
     await state.set_state(UserAudioSession.user_wait)
     
     # === ТОЧКА 1: Создание ProcessingSession ===
-    start_time = time.time()
     source_type = 'url' if is_link else 'telegram'
     original_identifier = url if is_link else audio.file_id
 
@@ -212,8 +210,9 @@ async def _process_audio_internal(message: Message, state: FSMContext, i18n: Tra
     else:
         specific_source = None
     
-    # Создаем новую сессию обработки
-    session_id = await create_processing_session(
+    # Создаем новую сессию обработки и аудио лог; промежуточные обновления
+    # сессии копятся в writer'е и пишутся в контрольных точках
+    session_writer = ProcessingSessionWriter(
         user_id=user['id'],
         original_identifier=original_identifier,
         source_type=source_type,
@@ -221,19 +220,15 @@ async def _process_audio_internal(message: Message, state: FSMContext, i18n: Tra
         waiting_message_id=waiting_message.message_id,
         user_original_message_id=message.message_id
     )
+    session_id = session_writer.session_id
 
     logger.info(f'Starting processing session {session_id} for user {user["id"]}')
 
-    if not session_id:
+    if not await session_writer.start():
         await waiting_message.edit_text(text=i18n.something_went_wrong())
         return
 
     await state.update_data(session_id=session_id)
-    # Создаем запись аудио лога для сессии
-    audio_log_id = await create_audio_log_with_session(
-        session_id=session_id,
-        user_id=user['id']
-    )
     try:
 
         # === ПРОВЕРКА КЭША ТРАНСКРИПЦИИ ===
@@ -290,19 +285,25 @@ async def _process_audio_internal(message: Message, state: FSMContext, i18n: Tra
         else:
             raise ValueError(f'Result is empty. Result of _process_cached_transcription or _process_uncached_transcription in _process_audio_internal is empty or None')
 
+        # Транскрипция готова: сохраняем transcription_id, размер и попытки загрузки
+        await session_writer.checkpoint()
+
         try:
             # Start finalization phase
             await progress_manager.start_phase(ProgressPhase.FINALIZING, 95)
         except Exception as e:
             pass
 
-        await state.update_data(transcript=raw_transcript)
-        await state.update_data(context=[
-            {'role': 'user', 'content': f"{i18n.audio_text_prefix()} {raw_transcript}"}])
-        
         # Создаем анонимную сессию чата для маркетингового анализа
         anonymous_chat_session = str(uuid.uuid4())
-        await state.update_data(anonymous_chat_session=anonymous_chat_session)
+
+        # В состоянии только ссылка на транскрипт и реплики чата, текст подгружается при вопросе
+        await state.update_data(
+            context=[],
+            transcript_ref=dialogue_transcript_ref(transcription_id=transcription_id, session_id=session_id,
+                                                   chat_session=anonymous_chat_session),
+            anonymous_chat_session=anonymous_chat_session
+        )
         
         # Логируем первое сообщение (аудио текст) в анонимный чат
         try:
@@ -341,30 +342,13 @@ async def _process_audio_internal(message: Message, state: FSMContext, i18n: Tra
             # Отправляем резюме
             await send_summary(message=message, state=state, i18n=i18n, summary=voice_summary, is_link=is_link,
                                chat_session=anonymous_chat_session, session_id=session_id)
-        await add_voice_use(message.from_user.id)
-        
         # === ТОЧКА 2A: Успешное завершение всей сессии ===
-        try:
-            # Обновляем аудио лог
-            if audio_log_id:
-                await update_audio_log(
-                    audio_log_id=audio_log_id,
-                    length=audio_duration,
-                    file_size_bytes=original_file_size,
-                    processing_duration=time.time() - start_time,
-                    success=True
-                )
-        except Exception as log_error:
-            logger.warning(f"Failed to update session logs {session_id}: {log_error}")
-
-
-
-        # Обновляем сессию с успешным завершением
-        await update_processing_session(
-            session_id=session_id,
-            completed_at=datetime.utcnow(),
-            total_duration=time.time() - start_time,
+        # Сессия, аудио лог и счётчик использований — одной транзакцией
+        await session_writer.finish(
             final_status='success',
+            audio_length=audio_duration,
+            file_size_bytes=original_file_size,
+            voice_use_telegram_id=message.from_user.id
         )
         logger.info(f"Processing session {session_id} for user {message.from_user.id} completed successfully")
         await state.set_state(UserAudioSession.dialogue)
@@ -395,20 +379,8 @@ async def _process_audio_internal(message: Message, state: FSMContext, i18n: Tra
             if 'voice_summary' in locals():
                 error_stage = 'summary'
             
-            # Обновляем аудио лог с ошибкой
-            if audio_log_id:
-                await update_audio_log(
-                    audio_log_id=audio_log_id,
-                    processing_duration=time.time() - start_time,
-                    success=False,
-                    error_message=str(e)
-                )
-            
-            # Обновляем сессию с ошибкой
-            await update_processing_session(
-                session_id=session_id,
-                completed_at=datetime.utcnow(),
-                total_duration=time.time() - start_time,
+            # Обновляем сессию и аудио лог с ошибкой
+            await session_writer.finish(
                 final_status='failed',
                 error_stage=error_stage,
                 error_message=str(e)
@@ -423,6 +395,9 @@ async def _process_audio_internal(message: Message, state: FSMContext, i18n: Tra
             # Игнорируем ошибку "message is not modified" и другие ошибки редактирования
             if "message is not modified" not in str(edit_error):
                 logger.warning(f"Failed to edit waiting message: {edit_error}")
+    finally:
+        # В том числе при CancelledError, когда finish() не вызывается
+        session_writer.close()
 
 
 async def _extract_audio_message(
@@ -514,7 +489,15 @@ async def _prepare_and_process_audio(
     if media_data is None:
         return
 
-    # 4. Добавление в очередь или обработка
+    # 4. Удаление сообщения (если нужно) — до допуска: add_to_queue занимает глобальный слот,
+    # и исключение до run_admitted оставило бы его занятым
+    if delete_message:
+        try:
+            await delete_message.delete()
+        except Exception as e:
+            logger.warning(f"Failed to delete language prompt for user {audio_message.from_user.id}: {e}")
+
+    # 5. Добавление в очередь или обработка
     is_queued, queue_message = await audio_queue_manager.add_to_queue(
         user_id=audio_message.from_user.id,
         message=audio_message,
@@ -523,20 +506,16 @@ async def _prepare_and_process_audio(
         language_code=language_code
     )
 
-    # 5. Удаление сообщения (если нужно)
-    if delete_message:
-        await delete_message.delete()
-
-    # 6. Обработка если не в очереди
+    # 6. Обработка если не в очереди (слот глобального допуска освобождается по завершении)
     if not is_queued:
-        await _process_audio_internal(
+        await audio_queue_manager.run_admitted(audio_message.from_user.id, _process_audio_internal(
             message=audio_message,
             state=state,
             i18n=i18n,
             language_code=language_code,
             queue_message=queue_message,
             media_data=media_data
-        )
+        ))
 
 
 @router.message(StateFilter(UserAudioSession.waiting_user_audio))
@@ -659,6 +638,7 @@ async def process_dialogue(message: Message, state: FSMContext, user: dict, i18n
         return
 
     data = await state.get_data()
+    # Реплики диалога без транскрипта (он подгружается в build_dialogue_context)
     context = data['context']
     anonymous_chat_session = data.get('anonymous_chat_session')
     session_id = data.get('session_id')
@@ -673,8 +653,8 @@ async def process_dialogue(message: Message, state: FSMContext, user: dict, i18n
             await state.set_state(None)
             return
 
-    # Определяем номер сообщения (текущая длина контекста + 1)
-    message_order = len(context) + 1
+    # Определяем номер сообщения (транскрипт + реплики + 1)
+    message_order = len(context) + 2
     
     # Логируем вопрос пользователя в анонимный чат
     if anonymous_chat_session:
@@ -714,7 +694,11 @@ async def process_dialogue(message: Message, state: FSMContext, user: dict, i18n
     animation_task = asyncio.create_task(animate_dots())
 
     try:
-        model_answer: str = await process_chat_request(context=context, user=user, i18n=i18n, session_id=data['session_id'])
+        dialogue_context = await build_dialogue_context({**data, 'context': context}, i18n)
+        if dialogue_context is None:
+            model_answer = False
+        else:
+            model_answer: str = await process_chat_request(context=dialogue_context, user=user, i18n=i18n, session_id=data['session_id'])
     finally:
         animation_running = False
         animation_task.cancel()
@@ -807,16 +791,14 @@ async def process_you_can_ask(callback: CallbackQuery, state: FSMContext, i18n:
     # await callback.message.edit_reply_markup(reply_markup=reply_markup)
 
     if chat_session:
-        # Загружаем транскрипт из базы данных
-        transcript = await get_transcript_by_chat_session(chat_session)
+        # Проверяем, что транскрипт есть в базе (заодно он попадает в кэш диалога)
+        transcript = await load_dialogue_transcript(dialogue_transcript_ref(chat_session=chat_session))
 
         if transcript:
-            # Создаем новый контекст с транскриптом
-            new_context = [{'role': 'user', 'content': f"{i18n.audio_text_prefix()} {transcript}"}]
-
-            # Обновляем состояние с новым контекстом и chat_session
+            # Обновляем состояние: пустой диалог со ссылкой на транскрипт и chat_session
             await state.update_data(
-                context=new_context,
+                context=[],
+                transcript_ref=dialogue_transcript_ref(chat_session=chat_session),
                 anonymous_chat_session=chat_session,
                 session_id=None  # Сбрасываем session_id так как переключаемся на другую сессию
             )
@@ -1465,9 +1447,11 @@ async def send_transcription(message: Message,
 
 @router.callback_query(F.data.startswith('cancel_queue|'))
 async def process_cancel_queue(callback: CallbackQuery, state: FSMContext, i18n: TranslatorRunner):
-    await callback.answer()
     message_id = int(callback.data.replace('cancel_queue|', ''))
-    await audio_queue_manager.remove_from_queue(user_id=callback.from_user.id, message_id=message_id)
+    if not await audio_queue_manager.remove_from_queue(user_id=callback.from_user.id, message_id=message_id):
+        # Файл уже забран в обработку
+        await callback.answer(text=i18n.queue_cancel_too_late(), show_alert=True)
+        return
     await audio_queue_manager.update_queue_count_in_messages(user_id=callback.from_user.id, i18n=i18n)
     await callback.message.delete()
     await callback.answer(text=i18n.queue_cancelled())
@@ -1605,8 +1589,12 @@ async def _process_cached_transcription(cached_transcription: dict, user: dict,
     Возвращаем dict с результатами обработки: raw_transcript, timecoded_transcript, summary, file_name
     """
     logger.info(f"Cache HIT for transcription: session={session_id}, transcription_id={cached_transcription['id']}")
-    raw_transcript = cached_transcription['transcript_raw']
-    timecoded_transcript = cached_transcription['transcript_timecoded']
+    # find_cached_transcription* отдают только метаданные, тексты грузим сейчас, когда кэш точно используется
+    cached_texts = await load_cached_transcription_texts(cached_transcription['id'])
+    if not cached_texts:
+        raise ValueError(f"Cached transcription {cached_transcription['id']} texts could not be loaded")
+    raw_transcript = cached_texts['transcript_raw']
+    timecoded_transcript = cached_texts['transcript_timecoded']
     transcription_id = cached_transcription['id']
     audio_duration = cached_transcription.get('audio_duration')
     original_file_size = cached_transcription.get('file_size_bytes', 0)
@@ -113,6 +113,8 @@ statistics_menu =
     <b>Uploaded audios:</b> { $audios_num }
     <b>Requests to GPT:</b> { $gpts_num }
 
+statistics_refreshed_at = <i>Data refreshed: { $refreshed_at } UTC</i>
+
 free_audio_limit_exceeded =
     <b>Your free trial has ended</b> 😥
 
@@ -830,6 +832,12 @@ queue_cleared =
     
     All pending files have been removed from the queue.
 
+queue_cancelled =
+    File removed from the queue.
+
+queue_cancel_too_late =
+    The file is already being processed and can no longer be cancelled.
+
 restart_notification = 😢 An error occurred on the server side. Please upload your file again.
 
 no_playlists_please =
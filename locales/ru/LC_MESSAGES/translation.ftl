@@ -110,6 +110,8 @@ statistics_menu =
     <b>Загружено аудио:</b> { $audios_num }
     <b>Запросов к GPT:</b> { $gpts_num }
 
+statistics_refreshed_at = <i>Данные обновлены: { $refreshed_at } UTC</i>
+
 free_audio_limit_exceeded =
     <b>Бесплатный лимит исчерпан</b> 😥
 
@@ -816,6 +818,9 @@ queue_cleared =
 queue_cancelled = 
     Файл удален из очереди.
 
+queue_cancel_too_late =
+    Файл уже обрабатывается, отменить его нельзя.
+
 
 restart_notification = 😢 Произошла ошибка на стороне сервера. Пожалуйста, загрузите свой файл еще раз
 
@@ -12,9 +12,15 @@ from handlers import balance_hanlders, commands_handlers, settings_handlers, use
     test_handlers, referral_handlers
 from keyboards.set_menu import set_main_menu
 from middlewares.check_user import UserMiddleware
-from models.orm import check_subscriptions, init_models, mark_sessions_interrupted_on_shutdown, \
-    startup_handle_interrupted_sessions, init_background_logging
+from models.orm import check_subscriptions, SUBSCRIPTION_EXPIRY_TICK_MINUTES, init_models, mark_sessions_interrupted_on_shutdown, \
+    startup_handle_interrupted_sessions, init_background_logging, shutdown_background_logging, purge_expired_fsm_states, \
+    maintain_partitions, refresh_statistics_rollups, STATISTICS_ROLLUP_REFRESH_MINUTES, renew_audio_job_leases, \
+    release_audio_jobs, purge_finished_audio_jobs, AUDIO_JOB_LEASE_SECONDS
+from services.audio_queue_core import AUDIO_WORKER_ID
+from services.audio_queue_service import audio_queue_manager
 from services.init_bot import config, bot
+from services.fsm_storage import create_fsm_storage
+from services.http_clients import close_http_clients
 from services.scheduler import scheduler
 from services.telegram_alerts import init_telegram_logger, send_alert, get_telegram_logger
 from services.payment_reminders import send_first_payment_reminder, send_second_payment_reminder
@@ -36,7 +42,7 @@ WEBHOOK_PATH = "/webhook"
 BASE_WEBHOOK_URL = "http://localhost:3000"
 
 
-async def on_startup() -> None:
+async def on_startup(dispatcher: Dispatcher, _translator_hub: TranslatorHub) -> None:
     """Startup hook для инициализации всех сервисов"""
     logger.info('Starting bot initialization')
 
@@ -61,19 +67,15 @@ async def on_startup() -> None:
 
     # Запускаем scheduler
     scheduler.start()
-    # Не блокируем стартап: запускаем проверку подписок в фоне сразу после старта
+    # Тик истечения подписок Telegram-пользователей: первый запуск сразу после старта (в фоне), дальше каждые N минут
     scheduler.add_job(
         func=check_subscriptions,
-        trigger='date',
-        run_date=datetime.now(pytz.UTC),
-        args=[scheduler]
-    )
-
-    # Запускаем проверку подписок каждый день в полночь по UTC
-    scheduler.add_job(
-        func=check_subscriptions,
-        trigger=CronTrigger(hour=0, minute=0, timezone=pytz.UTC),
-        args=[scheduler]
+        args=['telegram'],
+        trigger='interval',
+        minutes=SUBSCRIPTION_EXPIRY_TICK_MINUTES,
+        next_run_time=datetime.now(pytz.UTC),
+        id='subscription_expiry',
+        replace_existing=True
     )
 
     # Запускаем отправку онбординг-напоминаний каждый день в 12:00 MSK (09:00 UTC)
@@ -84,6 +86,32 @@ async def on_startup() -> None:
         replace_existing=True
     )
 
+    # Удаляем истекшие состояния FSM (TTL вытеснение idle-пользователей)
+    scheduler.add_job(
+        func=purge_expired_fsm_states,
+        trigger='interval',
+        hours=1,
+        id='fsm_states_purge',
+        replace_existing=True
+    )
+
+    # Материализованная статистика для админки (/statistics, источники)
+    scheduler.add_job(
+        func=refresh_statistics_rollups,
+        trigger='interval',
+        minutes=STATISTICS_ROLLUP_REFRESH_MINUTES,
+        id='statistics_rollups_refresh',
+        replace_existing=True
+    )
+
+    # Партиции append-only таблиц: создаём на следующие месяцы, старые архивируем (04:00 UTC)
+    scheduler.add_job(
+        func=maintain_partitions,
+        trigger=CronTrigger(hour=4, minute=0, timezone=pytz.UTC),
+        id='partition_maintenance',
+        replace_existing=True
+    )
+
     # # Запускаем проверку напоминаний о незавершенных платежах каждые 15 минут
     # # Первое напоминание (по умолчанию через 2 часа после первого действия конверсии)
     scheduler.add_job(
@@ -103,11 +131,39 @@ async def on_startup() -> None:
     #     replace_existing=True
     # )
 
+    # Персистентная очередь аудио: продлеваем аренду своих задач, подбираем осиротевшие
+    audio_queue_manager.adapter.bind(dispatcher, _translator_hub)
+    scheduler.add_job(
+        func=renew_audio_job_leases,
+        args=[AUDIO_WORKER_ID],
+        trigger='interval',
+        seconds=max(AUDIO_JOB_LEASE_SECONDS // 3, 10),
+        id='audio_jobs_lease',
+        replace_existing=True
+    )
+    scheduler.add_job(
+        func=audio_queue_manager.resume_jobs,
+        trigger='interval',
+        minutes=1,
+        id='audio_jobs_adopt',
+        replace_existing=True
+    )
+    scheduler.add_job(
+        func=purge_finished_audio_jobs,
+        trigger='interval',
+        hours=6,
+        id='audio_jobs_purge',
+        replace_existing=True
+    )
+
     scheduler.print_jobs()
 
     # Обрабатываем прерванные сессии
     await startup_handle_interrupted_sessions()
 
+    # Возвращаем в очередь файлы, принятые до рестарта
+    await audio_queue_manager.resume_jobs()
+
     # Устанавливаем webhook
     await bot.set_webhook(f"{BASE_WEBHOOK_URL}{WEBHOOK_PATH}", drop_pending_updates=True)
 
@@ -121,6 +177,15 @@ async def on_shutdown() -> None:
 
     await mark_sessions_interrupted_on_shutdown()
 
+    # Незавершённые аудио-задачи сразу доступны следующему процессу
+    await release_audio_jobs(AUDIO_WORKER_ID)
+
+    # Дописываем в БД всё, что осталось в очереди фонового логирования
+    await shutdown_background_logging()
+
+    # Закрываем общие HTTP-пулы (services/http_clients.py)
+    await close_http_clients()
+
     # Graceful shutdown telegram logger
     telegram_logger = get_telegram_logger()
     if telegram_logger:
@@ -133,7 +198,8 @@ async def on_shutdown() -> None:
 
 def main() -> None:
     # Инициализируем диспетчер
-    dp: Dispatcher = Dispatcher()
+    # FSM хранится вне памяти процесса (см. services/fsm_storage.py) и переживает рестарт
+    dp: Dispatcher = Dispatcher(storage=create_fsm_storage(bot))
 
     # Создаем translator hub
     translator_hub: TranslatorHub = create_translator_hub()
@@ -26,12 +26,12 @@ from max_keyboards.admin_keyboards import (
     _kb,
 )
 from models.orm import (
-    get_payments_sources, get_sources_with_subscription, get_users, is_admin,
-    get_statistics, get_sources, give_subscription, get_user_id_range,
+    get_payments_sources, get_sources_with_subscription, iter_users, iter_user_batches, count_users, is_admin,
+    get_statistics, get_statistics_refreshed_at, get_sources, use_replica, give_subscription, get_user_id_range,
     update_user_blocked_status, engine, get_users_to_exclude_from_broadcast, get_user,
 )
 from services.init_max_bot import max_bot
-from services.services import sources_to_str, split_long_message, sources_to_str_paginated
+from services.services import sources_to_str, split_long_message, sources_to_str_paginated, spam_target_filters, statistics_refreshed_str
 from max_states.states import AdminSpamSession, AdminGiveSubscription
 from services.telegram_alerts import send_alert
 
@@ -250,6 +250,7 @@ async def _show_statistics(user_id: int, message, i18n: TranslatorRunner, is_edi
         manual_subs=usage_data['manual_subs'],
         unblocked_users_count=usage_data['unblocked_users_count'],
     )
+    text += statistics_refreshed_str(usage_data['refreshed_at'], i18n)
     if is_edit:
         await message.edit(text=text, attachments=[admin_menu(i18n)])
     else:
@@ -503,36 +504,24 @@ async def process_spam_selection(event: MessageCallback, context: MemoryContext,
 
     spam_type = event.callback.payload
     state_data = await context.get_data()
-    start_id = state_data.get('start_id', None)
-    end_id = state_data.get('end_id', None)
+    # New audience selection resets file exclusions; recipients are streamed from the DB at send time
+    state_data.update(spam_type=spam_type, exclude_ids=[], exclusion_reference_time=None)
 
-    users = await get_users()
-
-    if start_id and end_id:
-        users = [user for user in users if start_id <= int(user['id']) <= end_id]
-    elif start_id:
-        users = [user for user in users if start_id <= int(user['id'])]
-    elif end_id:
-        users = [user for user in users if end_id >= int(user['id'])]
-
-    users = [user for user in users if not user.get('is_bot_blocked', False)]
-
-    if spam_type == 'spam_subscribed':
-        users = [user for user in users if user['subscription'] == 'True']
-    elif spam_type == 'spam_unsubscribed':
-        users = [user for user in users if user['subscription'] != 'True']
+    users_before_exclusion = await count_users(**spam_target_filters(state_data))
 
     exclusion_data = await get_users_to_exclude_from_broadcast()
-    excluded_user_ids = exclusion_data['user_ids']
+    exclusion_reference_time = exclusion_data['reference_time'].isoformat()
     exclusion_stats = exclusion_data['stats']
+    state_data['exclusion_reference_time'] = exclusion_reference_time
 
-    users_before_exclusion = len(users)
-    users = [user for user in users if int(user['id']) not in excluded_user_ids]
-    users_excluded_count = users_before_exclusion - len(users)
+    users_num = await count_users(**spam_target_filters(state_data))
+    users_excluded_count = users_before_exclusion - users_num
 
     await context.update_data(
         spam_type=spam_type,
-        target_users=users,
+        exclude_ids=[],
+        exclusion_reference_time=exclusion_reference_time,
+        target_users_count=users_num,
         exclusion_stats={
             'excluded_count': users_excluded_count,
             'recent_reminders': exclusion_stats['recent_reminders'],
@@ -549,7 +538,7 @@ async def process_spam_selection(event: MessageCallback, context: MemoryContext,
 
     try:
         await event.message.edit(
-            text=i18n.spam_menu(users_num=len(users)) + detail_text,
+            text=i18n.spam_menu(users_num=users_num) + detail_text,
             attachments=[spam_menu(i18n, show_exclude_button=True)],
             parse_mode=ParseMode.HTML,
         )
@@ -567,7 +556,7 @@ async def process_spam_message(event: MessageCreated, context: MemoryContext, i1
         return
 
     state_data = await context.get_data()
-    target_users = state_data.get('target_users', [])
+    target_users_count = state_data.get('target_users_count', 0)
     exclusion_stats = state_data.get('exclusion_stats', {})
 
     # Store the message text for broadcasting (Max doesn't have copy_message)
@@ -575,7 +564,7 @@ async def process_spam_message(event: MessageCreated, context: MemoryContext, i1
     await context.update_data(spam_message_text=spam_text)
 
     confirmation_text = i18n.spam_confirmation()
-    confirmation_text += f"\n\n📊 <b>Итого для рассылки:</b> {len(target_users)} чел."
+    confirmation_text += f"\n\n📊 <b>Итого для рассылки:</b> {target_users_count} чел."
 
     if exclusion_stats:
         total_excluded = exclusion_stats.get('excluded_count', 0) + exclusion_stats.get('manual_excluded', 0)
@@ -599,7 +588,7 @@ async def process_confirm_spam(event: MessageCallback, context: MemoryContext, i
         return
 
     state_data = await context.get_data()
-    target_users = state_data.get('target_users', [])
+    target_users_count = state_data.get('target_users_count', 0)
     spam_text = state_data.get('spam_message_text', '')
     exclusion_stats = state_data.get('exclusion_stats', {})
 
@@ -609,11 +598,12 @@ async def process_confirm_spam(event: MessageCallback, context: MemoryContext, i
     await event.message.edit(text=i18n.spam_start())
 
     batch_size = 15
-    user_batches = [target_users[i:i + batch_size] for i in range(0, len(target_users), batch_size)]
+    batches_count = (target_users_count + batch_size - 1) // batch_size
 
     total_sent = 0
+    total_targeted = 0
     spam_logger.info(f"Starting spam campaign {campaign_id}")
-    spam_logger.info(f"Target users count: {len(target_users)}")
+    spam_logger.info(f"Target users count: {target_users_count}")
     spam_logger.info(f"Admin ID: {event.callback.user.user_id}")
     spam_logger.info(f"Message type: text")
 
@@ -623,7 +613,7 @@ async def process_confirm_spam(event: MessageCallback, context: MemoryContext, i
     try:
         alert_text = (
             f"<b>Starting spam campaign</b> {campaign_id}.\n"
-            f"<b>Target users count:</b> {len(target_users)}.\n"
+            f"<b>Target users count:</b> {target_users_count}.\n"
             f"<b>Admin ID:</b> {event.callback.user.user_id}"
         )
         if exclusion_stats and exclusion_stats.get('excluded_count', 0) > 0:
@@ -632,17 +622,20 @@ async def process_confirm_spam(event: MessageCallback, context: MemoryContext, i
     except Exception as e:
         spam_logger.error(f"Failed to send alert: {e}")
 
-    for batch_index, batch in enumerate(user_batches):
-        spam_logger.info(f"Processing batch {batch_index + 1}/{len(user_batches)}")
+    batch_index = 0
+    async for batch in iter_user_batches(batch_size, **spam_target_filters(state_data)):
+        spam_logger.info(f"Processing batch {batch_index + 1}/{batches_count}")
+        total_targeted += len(batch)
         coros = [spam_gather(spam_text, int(user['telegram_id']), user) for user in batch]
         results = await asyncio.gather(*coros)
         successful_sends = sum(1 for result in results if result)
         total_sent += successful_sends
 
         spam_logger.info(f"Batch {batch_index + 1} completed: {successful_sends}/{len(batch)} successful")
+        batch_index += 1
         await asyncio.sleep(1)
 
-    spam_logger.info(f"Spam campaign completed. Total sent: {total_sent}/{len(target_users)}")
+    spam_logger.info(f"Spam campaign completed. Total sent: {total_sent}/{total_targeted}")
 
     result_text = i18n.spam_success(total_sent=total_sent)
 
@@ -668,7 +661,7 @@ async def process_confirm_spam(event: MessageCallback, context: MemoryContext, i
     try:
         alert_text = (
             f"<b>Spam campaign</b> {campaign_id} completed.\n"
-            f"<b>Total sent:</b> {total_sent}/{len(target_users)}.\n"
+            f"<b>Total sent:</b> {total_sent}/{total_targeted}.\n"
             f"<b>Admin ID:</b> {event.callback.user.user_id}"
         )
         await send_alert(text=alert_text, topic="SPAM", level="INFO", fingerprint=f"spam_campaign_{campaign_id}")
@@ -685,10 +678,10 @@ async def process_continue_to_message(event: MessageCallback, context: MemoryCon
         return
 
     state_data = await context.get_data()
-    target_users = state_data.get('target_users', [])
+    target_users_count = state_data.get('target_users_count', 0)
     exclusion_stats = state_data.get('exclusion_stats', {})
 
-    msg_text = f"👥 Выбрано пользователей для рассылки: {len(target_users)}\n"
+    msg_text = f"👥 Выбрано пользователей для рассылки: {target_users_count}\n"
     if exclusion_stats:
         if exclusion_stats.get('excluded_count', 0) > 0:
             msg_text += f"\n🔔 Исключено (напоминания): {exclusion_stats['excluded_count']}"
@@ -785,12 +778,11 @@ async def process_exclude_file(event: MessageCreated, context: MemoryContext, i1
         await context.update_data(exclude_ids=exclude_ids)
 
         state_data = await context.get_data()
-        target_users = state_data.get('target_users', [])
         exclusion_stats = state_data.get('exclusion_stats', {})
 
-        original_count = len(target_users)
-        filtered_users = [user for user in target_users if int(user['id']) not in exclude_ids]
-        excluded_count = original_count - len(filtered_users)
+        original_count = state_data.get('target_users_count', 0)
+        filtered_count = await count_users(**spam_target_filters(state_data)) if state_data.get('spam_type') else 0
+        excluded_count = original_count - filtered_count
 
         if exclusion_stats:
             exclusion_stats['manual_excluded'] = excluded_count
@@ -803,7 +795,7 @@ async def process_exclude_file(event: MessageCreated, context: MemoryContext, i1
                 'breakdown': {'recent': {}, 'upcoming': {}},
             }
 
-        await context.update_data(target_users=filtered_users, exclusion_stats=exclusion_stats)
+        await context.update_data(target_users_count=filtered_count, exclusion_stats=exclusion_stats)
 
         stats_msg = "✅ Файл обработан успешно!\n\n"
         stats_msg += "📊 Статистика:\n"
@@ -813,7 +805,7 @@ async def process_exclude_file(event: MessageCreated, context: MemoryContext, i1
         if exclusion_stats.get('excluded_count', 0) > 0:
             stats_msg += f"• Исключено (напоминания): {exclusion_stats['excluded_count']}\n"
 
-        stats_msg += f"• <b>Итоговое количество для рассылки: {len(filtered_users)}</b>\n\n"
+        stats_msg += f"• <b>Итоговое количество для рассылки: {filtered_count}</b>\n\n"
         stats_msg += "Выберите дальнейшее действие:"
 
         await event.message.answer(
@@ -1035,9 +1027,8 @@ async def process_export_telegram_ids(event: MessageCallback, context: MemoryCon
 
     try:
         await event.message.edit(text=i18n.export_preparing())
-        users = await get_users()
-
-        telegram_ids = [user['telegram_id'] for user in users]
+        with use_replica():
+            telegram_ids = [user['telegram_id'] async for user in iter_users(columns=('telegram_id',))]
         file_content = '\n'.join(str(tid) for tid in telegram_ids)
         file_bytes = file_content.encode('utf-8')
 
@@ -1238,6 +1229,7 @@ async def display_sources_paginated(event: MessageCallback, source_data: list, d
         )
     else:
         full_text = list_text
+    full_text += statistics_refreshed_str(await get_statistics_refreshed_at(), i18n)
 
     keyboard_kwargs = {k: v for k, v in kwargs.items() if k not in ['period_text', 'subscription_text']}
     reply_markup = statistic_source_menu_paginated(
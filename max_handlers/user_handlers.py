@@ -18,7 +18,6 @@ from maxapi.enums.parse_mode import ParseMode
 from fluentogram import TranslatorRunner
 import pytz
 
-from models.orm import get_transcript_by_chat_session
 from max_keyboards.user_keyboards import (
     continue_without_language, inline_change_model_menu,
     inline_change_specify_language_menu, inline_main_menu, inline_new_session, inline_cancel,
@@ -27,17 +26,17 @@ from max_keyboards.user_keyboards import (
     inline_cancel_queue,
 )
 from models.orm import (
-    change_user_setting, get_transcription_data, get_user, create_new_user, add_gpt_use, add_voice_use,
-    renew_subscription_db, update_user_blocked_status, update_audio_log,
-    create_processing_session, update_processing_session, create_audio_log_with_session,
+    change_user_setting, get_transcription_data, get_user, create_new_user, add_gpt_use,
+    renew_subscription_db, update_user_blocked_status, ProcessingSessionWriter, update_processing_session,
     increment_download_attempts, log_anonymous_chat_message, count_user_chat_requests_by_session,
     get_processing_session_by_id, find_cached_transcription, find_cached_summary,
-    find_cached_transcription_by_file_path, log_user_action_async,
+    find_cached_transcription_by_file_path, load_cached_transcription_texts, log_user_action_async,
 )
 from services.cache_normalization import generate_prompt_hash, generate_file_hash_async
 from services.content_downloaders.file_handling import download_file, identify_url_source
 from services.fedor_api import convert_file_fedor_api, download_file_fedor_api, process_audio_fedor_api
 from services.general_functions import process_chat_request, process_audio, summarise_text, generate_title
+from services.dialogue_context import build_dialogue_context, dialogue_transcript_ref, load_dialogue_transcript
 from services.dynamic_progress_manager import DynamicProgressManager, create_progress_manager, ProgressPhase
 from services.google_docs_service_lite import create_two_google_docs_lite
 from services.init_max_bot import max_bot, config
@@ -418,7 +417,6 @@ async def _process_audio_internal(
     await context.set_state(UserAudioSession.user_wait)
 
     # === POINT 1: Create ProcessingSession ===
-    start_time = time.time()
     # For Max, non-link files use 'url' source_type since we download via attachment URL
     source_type = 'url' if is_link else 'max'
     original_identifier = url if url else 'unknown'
@@ -428,7 +426,9 @@ async def _process_audio_internal(
     else:
         specific_source = 'max_attachment'
 
-    session_id = await create_processing_session(
+    # Session row and audio log are created together; intermediate session updates
+    # are buffered in the writer and persisted at checkpoints
+    session_writer = ProcessingSessionWriter(
         user_id=user['id'],
         original_identifier=original_identifier,
         source_type=source_type,
@@ -436,19 +436,15 @@ async def _process_audio_internal(
         waiting_message_id=None,         # Max message IDs are strings; DB column is BIGINT
         user_original_message_id=None,  # Max message IDs are strings; DB column is BIGINT
     )
+    session_id = session_writer.session_id
 
     logger.info(f'Starting processing session {session_id} for user {user["id"]}')
-    await context.update_data(session_id=session_id)
 
-    if not session_id:
+    if not await session_writer.start():
         await waiting_message.edit(text=i18n.something_went_wrong())
         return
 
     await context.update_data(session_id=session_id)
-    audio_log_id = await create_audio_log_with_session(
-        session_id=session_id,
-        user_id=user['id'],
-    )
 
     try:
         # === CHECK TRANSCRIPTION CACHE ===
@@ -514,18 +510,23 @@ async def _process_audio_internal(
         else:
             raise ValueError('Result is empty from _process_cached/_process_uncached')
 
+        # Transcript is ready: persist transcription_id, file size and download attempts
+        await session_writer.checkpoint()
+
         try:
             await progress_manager.start_phase(ProgressPhase.FINALIZING, 95)
         except Exception:
             pass
 
-        await context.update_data(transcript=raw_transcript)
-        await context.update_data(context=[
-            {'role': 'user', 'content': f"{i18n.audio_text_prefix()} {raw_transcript}"}
-        ])
-
         anonymous_chat_session = str(uuid.uuid4())
-        await context.update_data(anonymous_chat_session=anonymous_chat_session)
+
+        # Only a transcript reference plus chat turns live in the FSM; the text is loaded per question
+        await context.update_data(
+            context=[],
+            transcript_ref=dialogue_transcript_ref(transcription_id=transcription_id, session_id=session_id,
+                                                   chat_session=anonymous_chat_session),
+            anonymous_chat_session=anonymous_chat_session,
+        )
 
         try:
             await log_anonymous_chat_message(
@@ -569,26 +570,13 @@ async def _process_audio_internal(
                 is_link=is_link, chat_session=anonymous_chat_session, session_id=session_id,
             )
 
-        await add_voice_use(message.sender.user_id)
-
         # === POINT 2A: Successful completion ===
-        try:
-            if audio_log_id:
-                await update_audio_log(
-                    audio_log_id=audio_log_id,
-                    length=audio_duration,
-                    file_size_bytes=original_file_size,
-                    processing_duration=time.time() - start_time,
-                    success=True,
-                )
-        except Exception as log_error:
-            logger.warning(f"Failed to update session logs {session_id}: {log_error}")
-
-        await update_processing_session(
-            session_id=session_id,
-            completed_at=datetime.utcnow(),
-            total_duration=time.time() - start_time,
+        # Session, audio log and usage counter in one transaction
+        await session_writer.finish(
             final_status='success',
+            audio_length=audio_duration,
+            file_size_bytes=original_file_size,
+            voice_use_telegram_id=message.sender.user_id,
         )
         logger.info(f"Processing session {session_id} for user {message.sender.user_id} completed successfully")
         await context.set_state(UserAudioSession.dialogue)
@@ -620,18 +608,7 @@ async def _process_audio_internal(
             if 'voice_summary' in locals() and voice_summary:
                 error_stage = 'summary'
 
-            if audio_log_id:
-                await update_audio_log(
-                    audio_log_id=audio_log_id,
-                    processing_duration=time.time() - start_time,
-                    success=False,
-                    error_message=str(e),
-                )
-
-            await update_processing_session(
-                session_id=session_id,
-                completed_at=datetime.utcnow(),
-                total_duration=time.time() - start_time,
+            await session_writer.finish(
                 final_status='failed',
                 error_stage=error_stage,
                 error_message=str(e),
@@ -644,6 +621,9 @@ async def _process_audio_internal(
         except Exception as edit_error:
             if "message is not modified" not in str(edit_error):
                 logger.warning(f"Failed to edit waiting message: {edit_error}")
+    finally:
+        # Also on CancelledError, which skips both finish() calls
+        session_writer.close()
 
 
 # ---------------------------------------------------------------------------
@@ -715,7 +695,7 @@ async def _prepare_and_process_audio(
     is_queued, queue_message = await max_audio_queue_manager.add_to_queue(
         user_id=audio_message.sender.user_id,
         message=audio_message,
-        context=context,
+        state=context,
         i18n=i18n,
         language_code=language_code,
         media_data=media_data,
@@ -731,15 +711,16 @@ async def _prepare_and_process_audio(
         except Exception:
             pass
 
-    # 6. Process directly (as background task so dispatcher can handle next events)
-    asyncio.create_task(_process_audio_internal(
+    # 6. Process directly (as background task so dispatcher can handle next events);
+    # run_admitted releases the global admission slot when done
+    asyncio.create_task(max_audio_queue_manager.run_admitted(audio_message.sender.user_id, _process_audio_internal(
         message=audio_message,
         context=context,
         i18n=i18n,
         language_code=language_code,
         queue_message=None,
         media_data=media_data,
-    ))
+    )))
 
 
 # ---------------------------------------------------------------------------
@@ -935,8 +916,9 @@ async def _handle_dialogue(message: Message, context: MemoryContext, user: dict,
     text = message.body.text
 
     data = await context.get_data()
+    # Chat turns only; the transcript message is rebuilt by build_dialogue_context
     ctx = data.get('context')
-    if not ctx:
+    if ctx is None or not data.get('transcript_ref'):
         logger.warning(f"_handle_dialogue: no 'context' in FSM data for user {message.sender.user_id} — sending unsupported format")
         await message.answer(text=i18n.please_send_audio_or_video())
         return
@@ -951,7 +933,7 @@ async def _handle_dialogue(message: Message, context: MemoryContext, user: dict,
             await context.set_state(None)
             return
 
-    message_order = len(ctx) + 1
+    message_order = len(ctx) + 2  # transcript is message 1
 
     # Log user question
     if anonymous_chat_session:
@@ -992,7 +974,11 @@ async def _handle_dialogue(message: Message, context: MemoryContext, user: dict,
     animation_task = asyncio.create_task(animate_dots())
 
     try:
-        model_answer: str = await process_chat_request(context=ctx, user=user, i18n=i18n, session_id=data.get('session_id'))
+        dialogue_context = await build_dialogue_context({**data, 'context': ctx}, i18n)
+        if dialogue_context is None:
+            model_answer = False
+        else:
+            model_answer: str = await process_chat_request(context=dialogue_context, user=user, i18n=i18n, session_id=data.get('session_id'))
     finally:
         animation_running = False
         animation_task.cancel()
@@ -1078,11 +1064,11 @@ async def process_you_can_ask(event: MessageCallback, context: MemoryContext, i1
     await event.answer()
 
     if chat_session:
-        transcript = await get_transcript_by_chat_session(chat_session)
+        transcript = await load_dialogue_transcript(dialogue_transcript_ref(chat_session=chat_session))
         if transcript:
-            new_context = [{'role': 'user', 'content': f"{i18n.audio_text_prefix()} {transcript}"}]
             await context.update_data(
-                context=new_context,
+                context=[],
+                transcript_ref=dialogue_transcript_ref(chat_session=chat_session),
                 anonymous_chat_session=chat_session,
                 session_id=None,
             )
@@ -1434,12 +1420,14 @@ async def process_get_summary(event: MessageCallback, context: MemoryContext, i1
 
 @router.message_callback(F.callback.payload.startswith('cancel_queue|'))
 async def process_cancel_queue(event: MessageCallback, context: MemoryContext, i18n: TranslatorRunner):
-    await event.answer()
     message_id = event.callback.payload.replace('cancel_queue|', '')
-    await max_audio_queue_manager.remove_from_queue(user_id=event.callback.user.user_id, message_id=message_id)
+    if not await max_audio_queue_manager.remove_from_queue(user_id=event.callback.user.user_id, message_id=message_id):
+        # The file has already been taken for processing
+        await event.answer(notification=i18n.queue_cancel_too_late())
+        return
     await max_audio_queue_manager.update_queue_count_in_messages(user_id=event.callback.user.user_id, i18n=i18n)
     await event.message.delete()
-    await event.answer(text=i18n.queue_cancelled())
+    await event.answer(notification=i18n.queue_cancelled())
 
 
 # ---------------------------------------------------------------------------
@@ -1728,8 +1716,12 @@ async def _process_cached_transcription(
     LLM_TIMEOUT = 120  # seconds — prevents 53-minute OS-level TCP timeouts
 
     logger.info(f"Cache HIT for transcription: session={session_id}, transcription_id={cached_transcription['id']}")
-    raw_transcript = cached_transcription['transcript_raw']
-    timecoded_transcript = cached_transcription['transcript_timecoded']
+    # find_cached_transcription* отдают только метаданные, тексты грузим сейчас, когда кэш точно используется
+    cached_texts = await load_cached_transcription_texts(cached_transcription['id'])
+    if not cached_texts:
+        raise ValueError(f"Cached transcription {cached_transcription['id']} texts could not be loaded")
+    raw_transcript = cached_texts['transcript_raw']
+    timecoded_transcript = cached_texts['transcript_timecoded']
     transcription_id = cached_transcription['id']
     audio_duration = cached_transcription.get('audio_duration')
     original_file_size = cached_transcription.get('file_size_bytes', 0)
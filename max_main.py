@@ -103,11 +103,16 @@ from max_handlers import (
     balance_handlers, admin_handlers, referral_handlers, test_handlers,
 )
 from max_middlewares.check_user import UserMiddleware
-from models.orm import check_subscriptions, init_models, mark_sessions_interrupted_on_shutdown, \
-    startup_handle_interrupted_sessions, init_background_logging
+from models.orm import check_subscriptions, SUBSCRIPTION_EXPIRY_TICK_MINUTES, init_models, mark_sessions_interrupted_on_shutdown, \
+    startup_handle_interrupted_sessions, init_background_logging, shutdown_background_logging, \
+    refresh_statistics_rollups, STATISTICS_ROLLUP_REFRESH_MINUTES, renew_audio_job_leases, release_audio_jobs, \
+    AUDIO_JOB_LEASE_SECONDS, maintain_partitions
+from services.audio_queue_core import AUDIO_WORKER_ID
+from services.max_audio_queue_service import max_audio_queue_manager
 from services.init_max_bot import max_bot, config
 from services.bot_provider import register_bot
 from services.scheduler import scheduler
+from services.http_clients import close_http_clients
 from services.telegram_alerts import init_telegram_logger, send_alert, get_telegram_logger
 from utils.i18n import create_translator_hub
 
@@ -156,16 +161,47 @@ async def main() -> None:
             await send_alert("🟢 Max bot started successfully", "INFO", "SYSTEM")
 
         scheduler.start()
+        # Subscription expiry for Max users; main.py runs the same tick for Telegram users
         scheduler.add_job(
             func=check_subscriptions,
-            trigger='date',
-            run_date=datetime.now(pytz.UTC),
-            args=[scheduler]
+            args=['max'],
+            trigger='interval',
+            minutes=SUBSCRIPTION_EXPIRY_TICK_MINUTES,
+            next_run_time=datetime.now(pytz.UTC),
+            id='subscription_expiry',
+            replace_existing=True
         )
+        # Admin statistics read materialized rollups; both bots refresh them (advisory lock dedupes)
         scheduler.add_job(
-            func=check_subscriptions,
-            trigger=CronTrigger(hour=0, minute=0, timezone=pytz.UTC),
-            args=[scheduler]
+            func=refresh_statistics_rollups,
+            trigger='interval',
+            minutes=STATISTICS_ROLLUP_REFRESH_MINUTES,
+            id='statistics_rollups_refresh',
+            replace_existing=True
+        )
+        # Monthly partitions: create upcoming months, archive old ones (04:00 UTC; advisory lock dedupes)
+        scheduler.add_job(
+            func=maintain_partitions,
+            trigger=CronTrigger(hour=4, minute=0, timezone=pytz.UTC),
+            id='partition_maintenance',
+            replace_existing=True
+        )
+        # Durable audio queue: renew leases on our jobs, adopt orphaned Max jobs
+        max_audio_queue_manager.adapter.bind(dp, translator_hub)
+        scheduler.add_job(
+            func=renew_audio_job_leases,
+            args=[AUDIO_WORKER_ID],
+            trigger='interval',
+            seconds=max(AUDIO_JOB_LEASE_SECONDS // 3, 10),
+            id='audio_jobs_lease',
+            replace_existing=True
+        )
+        scheduler.add_job(
+            func=max_audio_queue_manager.resume_jobs,
+            trigger='interval',
+            minutes=1,
+            id='audio_jobs_adopt',
+            replace_existing=True
         )
         # Note: onboarding_reminders and payment_reminders are NOT scheduled here.
         # Those are Telegram-specific and run in the Telegram bot process (main.py).
@@ -174,6 +210,9 @@ async def main() -> None:
 
         await startup_handle_interrupted_sessions()
 
+        # Re-queue files accepted before the restart
+        await max_audio_queue_manager.resume_jobs()
+
         await max_bot.set_my_commands(
             BotCommand(name='start', description='Главное меню | Home'),
             BotCommand(name='subscription', description='Купить подписку | Get subscription'),
@@ -206,6 +245,9 @@ async def main() -> None:
             await send_alert("🔴 Max bot stopped", "INFO", "SYSTEM")
             await telegram_logger.stop()
         await mark_sessions_interrupted_on_shutdown()
+        await release_audio_jobs(AUDIO_WORKER_ID)
+        await shutdown_background_logging()
+        await close_http_clients()
 
 
 if __name__ == '__main__':
@@ -8,7 +8,7 @@ from maxapi.types.updates.bot_started import BotStarted
 from maxapi.types.users import User as MaxUser
 from fluentogram import TranslatorHub
 
-from models.orm import get_user, create_new_user
+from models.orm import get_user, create_new_user, set_user_platform
 from services.init_max_bot import config
 
 logger = logging.getLogger(__name__)
@@ -65,6 +65,10 @@ class UserMiddleware(BaseMiddleware):
             user = await create_new_user(max_user=max_user)
         elif user['subscription_id'] is not None and user['created_at'] is None:
             user = await create_new_user(max_user=max_user, active_sub=True)
+        elif user.get('platform') is None:
+            # Users created before the platform column: subscription expiry picks the bot by it
+            await set_user_platform(max_user.user_id, 'max')
+            user['platform'] = 'max'
         data['user'] = user
         data['user']['new_user'] = new_user
 
@@ -6,7 +6,7 @@ from aiogram.types import TelegramObject, User
 from fluentogram import TranslatorHub
 
 
-from models.orm import get_user, create_new_user
+from models.orm import get_user, create_new_user, set_user_platform
 
 logger = logging.getLogger(__name__)
 from services.init_bot import config
@@ -49,6 +49,10 @@ class UserMiddleware(BaseMiddleware):
             user = await create_new_user(telegram_user=telegram_user)
         elif user['subscription_id'] is not None and user['created_at'] is None:
             user = await create_new_user(telegram_user=telegram_user, active_sub=True)
+        elif user.get('platform') is None:
+            # Пользователи, созданные до колонки platform: по ней тик истечения подписок выбирает бота
+            await set_user_platform(telegram_user.id, 'telegram')
+            user['platform'] = 'telegram'
         data['user']: dict = user
         data['user']['new_user'] = new_user
 
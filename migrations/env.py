@@ -0,0 +1,65 @@
+"""
+Alembic environment для общей PostgreSQL базы обоих ботов.
+
+URL подключения собирается из .env так же, как в models/orm.py,
+поэтому миграции запускаются той же конфигурацией, что и бот:
+
+    alembic upgrade head
+"""
+import asyncio
+import os
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from config_data.config import load_config
+from models.model import Base
+
+alembic_config = context.config
+
+if alembic_config.config_file_name is not None:
+    fileConfig(alembic_config.config_file_name)
+
+target_metadata = Base.metadata
+
+
+def _database_url() -> str:
+    config = load_config('.env')
+    db_host = os.environ.get('DB_HOST', 'localhost')
+    return f'postgresql+asyncpg://{config.db.user}:{config.db.password}@{db_host}:5432/{config.db.database}'
+
+
+def run_migrations_offline() -> None:
+    """Генерирует SQL без подключения к БД (alembic upgrade head --sql)"""
+    context.configure(
+        url=_database_url(),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def _do_run_migrations(connection) -> None:
+    context.configure(connection=connection, target_metadata=target_metadata)
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_migrations_online() -> None:
+    engine = create_async_engine(_database_url())
+
+    async with engine.connect() as connection:
+        await connection.run_sync(_do_run_migrations)
+
+    await engine.dispose()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    asyncio.run(run_migrations_online())
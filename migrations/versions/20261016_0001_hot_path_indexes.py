@@ -0,0 +1,80 @@
+"""hot path indexes
+
+Индексы под самые частые фильтры ORM-хелперов:
+- users.telegram_id: get_user, change_user_setting, add_voice_use, add_gpt_use, платежи
+- processing_sessions: активные сессии (final_status IS NULL) и успешные по user_id
+- payments(user_id, status): NOT EXISTS "никогда не оплачивал" в напоминаниях
+- llm_requests(session_id, request_type): count_user_chat_requests_by_session
+- file_downloads.session_id
+- user_actions: окно conversion-действий и проверки "напоминание уже отправлено"
+
+Все индексы создаются CONCURRENTLY, чтобы не блокировать запись в рабочей базе.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-16 12:00:00
+
+"""
+import logging
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+# (name, table, columns, unique, where)
+INDEXES = [
+    ('ix_users_created_at', 'users', ['created_at'], False, None),
+    ('ix_processing_sessions_active', 'processing_sessions', ['id'], False,
+     "final_status IS NULL"),
+    ('ix_processing_sessions_success_user_completed', 'processing_sessions', ['user_id', 'completed_at'], False,
+     "final_status = 'success'"),
+    ('ix_payments_user_id_status', 'payments', ['user_id', 'status'], False, None),
+    ('ix_llm_requests_session_id_request_type', 'llm_requests', ['session_id', 'request_type'], False, None),
+    ('ix_file_downloads_session_id', 'file_downloads', ['session_id'], False, None),
+    ('ix_user_actions_conversion_created_at', 'user_actions', ['created_at', 'user_id'], False,
+     "action_category = 'conversion'"),
+    ('ix_user_actions_user_id_action_type', 'user_actions', ['user_id', 'action_type'], False, None),
+]
+
+
+def _has_duplicate_telegram_ids() -> bool:
+    result = op.get_bind().execute(sa.text(
+        "SELECT 1 FROM users GROUP BY telegram_id HAVING count(*) > 1 LIMIT 1"
+    ))
+    return result.first() is not None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        # update_user_blocked_status исторически допускал несколько строк на один telegram_id.
+        # Уникальный индекс создаем только если дублей нет, иначе — обычный, чтобы не сорвать деплой.
+        unique = not _has_duplicate_telegram_ids()
+        if not unique:
+            logger.warning("Duplicate users.telegram_id found: creating non-unique ix_users_telegram_id. "
+                           "Deduplicate users and re-run this revision to enforce uniqueness.")
+        op.create_index('ix_users_telegram_id', 'users', ['telegram_id'], unique=unique,
+                        postgresql_concurrently=True, if_not_exists=True)
+
+        for name, table, columns, is_unique, where in INDEXES:
+            op.create_index(
+                name, table, columns, unique=is_unique,
+                postgresql_where=sa.text(where) if where else None,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+        op.drop_index('ix_users_telegram_id', table_name='users', postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,42 @@
+"""fsm states
+
+Таблица персистентного FSM-хранилища Telegram бота (services/fsm_storage.py).
+На свежей базе её также создаёт init_models(), поэтому создаём только если её нет.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-16 13:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    if sa.inspect(op.get_bind()).has_table('fsm_states'):
+        return
+
+    op.create_table(
+        'fsm_states',
+        sa.Column('key', sa.String(length=255), primary_key=True),
+        sa.Column('state', sa.String(length=255), nullable=True),
+        sa.Column('data', postgresql.JSONB(astext_type=sa.Text()), nullable=False, server_default=sa.text("'{}'::jsonb")),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+    )
+    op.create_index('ix_fsm_states_expires_at', 'fsm_states', ['expires_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_fsm_states_expires_at', table_name='fsm_states', if_exists=True)
+    op.drop_table('fsm_states')
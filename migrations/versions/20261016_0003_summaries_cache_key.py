@@ -0,0 +1,52 @@
+"""summaries cache key
+
+Уникальный индекс на ключ кэша саммари (transcription_id, language_code, llm_model,
+system_prompt_hash): save_summary_cache пишет через INSERT ... ON CONFLICT по этим колонкам.
+Раньше уникальность держалась только на предварительном SELECT, поэтому при гонках
+могли появиться дубли — перед созданием индекса оставляем самую свежую запись каждого ключа.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-16 14:00:00
+
+"""
+import logging
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+INDEX_NAME = 'uq_summaries_cache_key'
+INDEX_COLUMNS = ['transcription_id', 'language_code', 'llm_model', 'system_prompt_hash']
+
+
+def upgrade() -> None:
+    result = op.get_bind().execute(sa.text("""
+        DELETE FROM summaries s
+        USING summaries newer
+        WHERE s.transcription_id = newer.transcription_id
+          AND s.language_code = newer.language_code
+          AND s.llm_model = newer.llm_model
+          AND s.system_prompt_hash = newer.system_prompt_hash
+          AND s.id < newer.id
+    """))
+    if result.rowcount:
+        logger.warning("Removed %s duplicate summaries before creating %s", result.rowcount, INDEX_NAME)
+
+    with op.get_context().autocommit_block():
+        op.create_index(INDEX_NAME, 'summaries', INDEX_COLUMNS, unique=True,
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(INDEX_NAME, table_name='summaries', postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,159 @@
+"""monthly partitions
+
+Помесячное range-партиционирование append-only таблиц (models/partitioning.py):
+user_actions, llm_requests, anonymous_chat_messages, file_downloads, bot_health_checks.
+
+Данные не копируются: исходная таблица переименовывается в <table>_legacy и
+подключается к новой партиционированной таблице как партиция "всё до начала
+следующего месяца". Дальше строки пишутся в помесячные партиции, а старые
+партиции (включая legacy) архивирует и удаляет archive_old_partitions().
+
+PRIMARY KEY становится (id, <ключ партиции>) — так требует PostgreSQL. Поэтому
+внешние ключи, ссылающиеся на эти таблицы (summaries.llm_request_id), удаляются.
+
+ATTACH строит уникальный индекс (id, ключ) на legacy-партиции под блокировкой —
+на больших таблицах применять в окно обслуживания.
+
+Downgrade копирует строки всех оставшихся партиций в обычную таблицу (полная
+перезапись, тоже в окно обслуживания) и возвращает PRIMARY KEY (id), индексы и
+внешние ключи самой таблицы. Уже архивированные и удалённые партиции не
+возвращаются; удалённые upgrade внешние ключи на эти таблицы и пропущенные
+уникальные индексы не восстанавливаются.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-16 15:00:00
+
+"""
+import logging
+from datetime import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from models.partitioning import PARTITIONED_TABLES, add_months, ensure_partitions, is_partitioned, month_start
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+
+def _legacy_name(name: str) -> str:
+    # Имена объектов PostgreSQL ограничены 63 символами
+    return f'{name[:56]}_legacy'
+
+
+def _partition_table(conn, table: str, key: str, boundary: str) -> None:
+    legacy = f'{table}_legacy'
+
+    # Внешние ключи на таблицу: на партиционированную таблицу без уникального (id) не сослаться
+    referencing = conn.execute(sa.text("""
+        SELECT conrelid::regclass::text AS source, conname
+        FROM pg_constraint WHERE contype = 'f' AND confrelid = CAST(:table AS regclass)
+    """), {'table': table}).all()
+    for row in referencing:
+        logger.warning("Dropping foreign key %s on %s: %s becomes partitioned", row.conname, row.source, table)
+        op.execute(f'ALTER TABLE {row.source} DROP CONSTRAINT {row.conname}')
+
+    indexes = conn.execute(sa.text("""
+        SELECT i.relname AS name, pg_get_indexdef(ix.indexrelid) AS definition,
+               ix.indisprimary AS is_primary, ix.indisunique AS is_unique
+        FROM pg_index ix JOIN pg_class i ON i.oid = ix.indexrelid
+        WHERE ix.indrelid = CAST(:table AS regclass)
+    """), {'table': table}).all()
+    foreign_keys = conn.execute(sa.text("""
+        SELECT conname, pg_get_constraintdef(oid) AS definition
+        FROM pg_constraint WHERE contype = 'f' AND conrelid = CAST(:table AS regclass)
+    """), {'table': table}).all()
+    sequence = conn.execute(sa.text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': table}).scalar()
+
+    op.execute(f'ALTER TABLE {table} RENAME TO {legacy}')
+    for index in indexes:
+        op.execute(f'ALTER INDEX {index.name} RENAME TO {_legacy_name(index.name)}')
+
+    op.execute(
+        f'CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE) '
+        f'PARTITION BY RANGE ({key})'
+    )
+    op.execute(f'ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id, {key})')
+    if sequence:
+        # Иначе последовательность удалится вместе с legacy-партицией при архивации
+        op.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table}.id')
+
+    for fk in foreign_keys:
+        op.execute(f'ALTER TABLE {table} ADD CONSTRAINT {fk.conname} {fk.definition}')
+    for index in indexes:
+        if index.is_primary:
+            continue
+        if index.is_unique:
+            logger.warning("Skipping unique index %s: not allowed on partitioned %s without %s",
+                           index.name, table, key)
+            continue
+        # Определение снято до переименования: CREATE INDEX <имя> ON public.<table> ...
+        op.execute(index.definition)
+
+    # Совпадающие по определению индексы legacy подключаются к индексам родителя без пересборки
+    op.execute(
+        f"ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ('{boundary}')"
+    )
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+    boundary = add_months(month_start(datetime.utcnow()), 1).isoformat()
+
+    for table, key in PARTITIONED_TABLES.items():
+        if is_partitioned(conn, table):
+            continue
+        logger.info("Partitioning %s by RANGE (%s), legacy partition up to %s", table, key, boundary)
+        _partition_table(conn, table, key, boundary)
+
+    ensure_partitions(conn)
+
+
+def _unpartition_table(conn, table: str) -> None:
+    plain = f'{table}_unpartitioned'
+
+    indexes = conn.execute(sa.text("""
+        SELECT pg_get_indexdef(ix.indexrelid) AS definition
+        FROM pg_index ix
+        WHERE ix.indrelid = CAST(:table AS regclass) AND NOT ix.indisprimary
+    """), {'table': table}).all()
+    foreign_keys = conn.execute(sa.text("""
+        SELECT conname, pg_get_constraintdef(oid) AS definition
+        FROM pg_constraint WHERE contype = 'f' AND conrelid = CAST(:table AS regclass)
+    """), {'table': table}).all()
+    sequence = conn.execute(sa.text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': table}).scalar()
+
+    op.execute(f'CREATE TABLE {plain} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)')
+    op.execute(f'INSERT INTO {plain} SELECT * FROM {table}')
+    if sequence:
+        # Иначе последовательность удалится вместе с партиционированной таблицей
+        op.execute(f'ALTER SEQUENCE {sequence} OWNED BY NONE')
+    op.execute(f'DROP TABLE {table}')
+    op.execute(f'ALTER TABLE {plain} RENAME TO {table}')
+    op.execute(f'ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY (id)')
+    if sequence:
+        op.execute(f'ALTER SEQUENCE {sequence} OWNED BY {table}.id')
+
+    for fk in foreign_keys:
+        op.execute(f'ALTER TABLE {table} ADD CONSTRAINT {fk.conname} {fk.definition}')
+    for index in indexes:
+        # Индекс партиционированной таблицы определён как ON ONLY <table>
+        op.execute(index.definition.replace(' ON ONLY ', ' ON ', 1))
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(conn, table):
+            continue
+        logger.info("Copying partitions of %s back into a plain table", table)
+        _unpartition_table(conn, table)
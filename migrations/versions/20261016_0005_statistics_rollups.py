@@ -0,0 +1,39 @@
+"""statistics rollups
+
+Материализованные представления для админской статистики (/statistics и источники):
+вместо агрегатов по всем users и payments на каждое открытие меню хендлеры читают
+готовые строки, а refresh_statistics_rollups() обновляет их по расписанию.
+
+- stats_users_snapshot: одна строка с итогами по users и временем обновления (refreshed_at)
+- stats_user_sources: пользователи по (source, subscription, subscription_type)
+- stats_payment_sources_hourly: платежи по часу, источнику, тарифу (по сумме) и признаку
+  первого платежа пользователя — period_days и unique=True сводятся к сумме по бакетам
+
+Уникальные индексы нужны для REFRESH MATERIALIZED VIEW CONCURRENTLY (чтение не блокируется).
+Определения лежат в models.statistics_rollups: их же создаёт init_models() на базах без Alembic.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-16 16:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+from models.statistics_rollups import drop_statistics_rollups, ensure_statistics_rollups
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0005'
+down_revision: Union[str, None] = '0004'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    ensure_statistics_rollups(op.get_bind())
+
+
+def downgrade() -> None:
+    drop_statistics_rollups(op.get_bind())
@@ -0,0 +1,65 @@
+"""audio jobs
+
+Персистентная очередь аудио-обработки (models.model.AudioJob): принятые файлы
+переживают рестарт и деплой, процессы забирают осиротевшие задачи через
+SELECT ... FOR UPDATE SKIP LOCKED. На свежей базе таблицу создаёт init_models(),
+поэтому создаём только если её нет.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-16 17:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0006'
+down_revision: Union[str, None] = '0005'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    if sa.inspect(op.get_bind()).has_table('audio_jobs'):
+        return
+
+    op.create_table(
+        'audio_jobs',
+        sa.Column('id', sa.BigInteger(), primary_key=True, autoincrement=True),
+        sa.Column('platform', sa.String(length=16), nullable=False),
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('chat_id', sa.BigInteger(), nullable=True),
+        sa.Column('message_id', sa.String(length=64), nullable=True),
+        sa.Column('queue_message_id', sa.String(length=64), nullable=True),
+        sa.Column('file_id', sa.String(), nullable=True),
+        sa.Column('url', sa.Text(), nullable=True),
+        sa.Column('language_code', sa.String(length=16), nullable=True),
+        sa.Column('queue_order', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('paid', sa.Boolean(), nullable=False, server_default=sa.false()),
+        sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False, server_default=sa.text("'{}'::jsonb")),
+        sa.Column('status', sa.String(length=16), nullable=False, server_default='queued'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('owner', sa.String(length=128), nullable=True),
+        sa.Column('lease_until', sa.DateTime(), nullable=True),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.text("(now() AT TIME ZONE 'utc')")),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+    )
+    op.create_index('ix_audio_jobs_pending', 'audio_jobs', ['platform', 'lease_until', 'id'],
+                    postgresql_where=sa.text("status IN ('queued', 'running')"))
+    op.create_index('ix_audio_jobs_owner', 'audio_jobs', ['owner'],
+                    postgresql_where=sa.text("status IN ('queued', 'running')"))
+    op.create_index('ix_audio_jobs_finished_at', 'audio_jobs', ['finished_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_audio_jobs_finished_at', table_name='audio_jobs', if_exists=True)
+    op.drop_index('ix_audio_jobs_owner', table_name='audio_jobs', if_exists=True)
+    op.drop_index('ix_audio_jobs_pending', table_name='audio_jobs', if_exists=True)
+    op.drop_table('audio_jobs')
@@ -0,0 +1,40 @@
+"""user platform
+
+Колонка users.platform ('telegram' | 'max'): тик истечения подписок идёт в обоих ботах,
+и каждый процесс забирает только пользователей своей платформы, чтобы уведомление ушло
+через нужного бота. Известных Max-пользователей размечаем по audio_jobs; остальные
+остаются NULL (считаются telegram) и размечаются middleware при следующем обращении.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-16 21:00:00
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007'
+down_revision: Union[str, None] = '0006'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS platform VARCHAR(16)")
+    op.execute("""
+        UPDATE users u
+        SET platform = 'max'
+        WHERE u.platform IS NULL
+          AND EXISTS (
+              SELECT 1 FROM audio_jobs j
+              WHERE j.platform = 'max' AND j.user_id::text = u.telegram_id
+          )
+    """)
+
+
+def downgrade() -> None:
+    op.drop_column('users', 'platform')
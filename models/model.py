@@ -1,7 +1,7 @@
 import enum
 from datetime import datetime, timedelta
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Enum as DBEnum, DateTime, Boolean, Date, BigInteger, Float, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, Enum as DBEnum, DateTime, Boolean, Date, BigInteger, Float, Text, Index, text
 from sqlalchemy.dialects.postgresql import ENUM, JSONB
 from sqlalchemy.orm import relationship, declarative_base
 
@@ -11,7 +11,7 @@ Base = declarative_base()
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    telegram_id = Column(String, nullable=False)
+    telegram_id = Column(String, nullable=False, unique=True, index=True)
     username = Column(String)
     first_name = Column(String)
     last_name = Column(String)
@@ -23,7 +23,7 @@ class User(Base):
     end_date = Column(DateTime, default=lambda: datetime.utcnow() + timedelta(days=3))
     audio_uses = Column(Integer, default=0)
     gpt_uses = Column(Integer, default=0)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
     source = Column(String)
     subscription_type = Column(String, default=None)
     subscription_autopay = Column(Boolean, default=False)
@@ -34,6 +34,8 @@ class User(Base):
     download_video = Column(Boolean, default=True)
     transcription_format = Column(String, default='docx')
     is_bot_blocked = Column(Boolean, default=False)
+    # Платформа, через которую пользователь пишет боту: 'telegram' | 'max' (NULL — не определена, считаем telegram)
+    platform = Column(String(16), default=None)
 
     # Referral system fields
     referral_registered = Column(Integer, default=0)  # Количество заработанных недель
@@ -74,6 +76,13 @@ class RecoveryStatusEnum(enum.Enum):
 class ProcessingSession(Base):
     """Сводная таблица для отслеживания полного цикла обработки файла"""
     __tablename__ = 'processing_sessions'
+    __table_args__ = (
+        # Активные сессии: get_statistics, mark_sessions_interrupted_*
+        Index('ix_processing_sessions_active', 'id', postgresql_where=text('final_status IS NULL')),
+        # Первая/последняя успешная сессия пользователя в напоминаниях
+        Index('ix_processing_sessions_success_user_completed', 'user_id', 'completed_at',
+              postgresql_where=text("final_status = 'success'")),
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     session_id = Column(String, unique=True, nullable=False, index=True)  # UUID
@@ -150,6 +159,9 @@ class Audio(Base):
 
 class Payment(Base):
     __tablename__ = 'payments'
+    __table_args__ = (
+        Index('ix_payments_user_id_status', 'user_id', 'status'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     source = Column(String)
@@ -173,6 +185,11 @@ class DownloadStatus(enum.Enum):
 
 class LLMRequest(Base):
     __tablename__ = 'llm_requests'
+    __table_args__ = (
+        Index('ix_llm_requests_session_id_request_type', 'session_id', 'request_type'),
+        # Помесячные партиции (models/partitioning.py, миграция 0004)
+        {'postgresql_partition_by': 'RANGE (started_at)'},
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     session_id = Column(String(36), ForeignKey('processing_sessions.session_id'), nullable=True)  # Связь с ProcessingSession
@@ -194,7 +211,7 @@ class LLMRequest(Base):
     total_tokens = Column(Integer, nullable=True)
     
     # Время выполнения
-    started_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, default=datetime.utcnow, nullable=False, primary_key=True)  # ключ партиции
     completed_at = Column(DateTime, nullable=True)
     processing_duration = Column(Float, nullable=True)  # В секундах
     
@@ -216,6 +233,8 @@ class AnonymousChatMessage(Base):
     Полностью отделена от пользователей - только текст и структура диалогов.
     """
     __tablename__ = 'anonymous_chat_messages'
+    # Помесячные партиции (models/partitioning.py, миграция 0004)
+    __table_args__ = {'postgresql_partition_by': 'RANGE (created_at)'}
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     
@@ -231,8 +250,8 @@ class AnonymousChatMessage(Base):
     # Порядковый номер сообщения в диалоге (для восстановления последовательности)
     message_order = Column(Integer, nullable=False)
     
-    # Временная метка (без связи с конкретным пользователем)
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # Временная метка (без связи с конкретным пользователем), ключ партиции
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, primary_key=True)
     
     # Мета-информация (опционально)
     message_length = Column(Integer, nullable=True)  # Длина сообщения
@@ -283,6 +302,11 @@ class Transcription(Base):
 class Summary(Base):
     """Кэш саммари для разных языков и моделей"""
     __tablename__ = 'summaries'
+    __table_args__ = (
+        # Ключ кэша: save_summary_cache делает ON CONFLICT по этим колонкам
+        Index('uq_summaries_cache_key', 'transcription_id', 'language_code', 'llm_model', 'system_prompt_hash',
+              unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
@@ -299,8 +323,8 @@ class Summary(Base):
     summary_text = Column(Text, nullable=False)
     generated_title = Column(Text)
 
-    # Связь с LLM запросом
-    llm_request_id = Column(Integer, ForeignKey('llm_requests.id'))
+    # Связь с LLM запросом (без FK: llm_requests партиционирована, уникален только (id, started_at))
+    llm_request_id = Column(Integer)
 
     # Связь с первой сессией
     created_by_session_id = Column(String(36), ForeignKey('processing_sessions.session_id'))
@@ -312,21 +336,24 @@ class Summary(Base):
 
     # Relationships
     transcription = relationship("Transcription", back_populates="summaries")
-    llm_request = relationship("LLMRequest")
+    llm_request = relationship("LLMRequest", primaryjoin="foreign(Summary.llm_request_id) == LLMRequest.id",
+                               viewonly=True)
     created_by_session = relationship("ProcessingSession", foreign_keys=[created_by_session_id])
 
 
 class FileDownload(Base):
     __tablename__ = 'file_downloads'
+    # Помесячные партиции (models/partitioning.py, миграция 0004)
+    __table_args__ = {'postgresql_partition_by': 'RANGE (created_at)'}
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     # Связь с пользователем
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     # Связь с сессией обработки
-    session_id = Column(String, ForeignKey('processing_sessions.session_id'), nullable=True)
+    session_id = Column(String, ForeignKey('processing_sessions.session_id'), nullable=True, index=True)
     
-    # Время записи в БД (начало операции)
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # Время записи в БД (начало операции), ключ партиции
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, primary_key=True)
     
     # Детали попытки загрузки
     attempt_number = Column(Integer, default=1)  # номер попытки в рамках сессии
@@ -359,13 +386,15 @@ class FileDownload(Base):
 class BotHealthCheck(Base):
     """Health checks monitoring table"""
     __tablename__ = 'bot_health_checks'
+    # Monthly partitions (models/partitioning.py, migration 0004)
+    __table_args__ = {'postgresql_partition_by': 'RANGE (started_at)'}
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     check_type = Column(String(50), nullable=False)  # 'command', 'audio_processing', etc.
     check_command = Column(String(100))  # '/settings', '/start', etc.
 
-    # Timing
-    started_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    # Timing (partition key)
+    started_at = Column(DateTime, default=datetime.utcnow, nullable=False, primary_key=True)
     completed_at = Column(DateTime)
     response_time_ms = Column(Integer)  # время ответа в миллисекундах
 
@@ -399,6 +428,15 @@ class UserAction(Base):
     - Административных действий
     """
     __tablename__ = 'user_actions'
+    __table_args__ = (
+        # Окно conversion-действий в get_users_for_first_reminder
+        Index('ix_user_actions_conversion_created_at', 'created_at', 'user_id',
+              postgresql_where=text("action_category = 'conversion'")),
+        # NOT EXISTS проверки "напоминание уже отправлено"
+        Index('ix_user_actions_user_id_action_type', 'user_id', 'action_type'),
+        # Помесячные партиции (models/partitioning.py, миграция 0004)
+        {'postgresql_partition_by': 'RANGE (created_at)'},
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
@@ -415,11 +453,75 @@ class UserAction(Base):
     payment_id = Column(Integer, ForeignKey('payments.id'), nullable=True)
     referral_id = Column(Integer, ForeignKey('referrals.id'), nullable=True)
 
-    # Временная метка
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    # Временная метка, ключ партиции
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True, primary_key=True)
 
     # Relationships
     user = relationship("User")
     session = relationship("ProcessingSession")
     payment = relationship("Payment")
     referral = relationship("Referral")
+
+
+class FsmState(Base):
+    """
+    Персистентное FSM-хранилище Telegram бота (services/fsm_storage.py).
+
+    Одна строка на ключ FSM (bot_id:chat_id:user_id:thread_id:destiny).
+    Записи старше expires_at считаются пустыми и периодически удаляются.
+    """
+    __tablename__ = 'fsm_states'
+
+    key = Column(String(255), primary_key=True)
+    state = Column(String(255), nullable=True)
+    data = Column(JSONB, default={}, nullable=False)
+
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class AudioJob(Base):
+    """
+    Персистентная очередь аудио-обработки (services/audio_queue_core.py).
+
+    Строка — сериализуемое описание принятого файла: платформа, пользователь, чат,
+    сообщение (payload — сам Message в JSON), file_id или URL, язык и порядок в
+    очереди пользователя. Процесс-владелец (owner) продлевает lease_until, пока жив;
+    задачи с истёкшей арендой забирает другой процесс (или этот же после рестарта)
+    через SELECT ... FOR UPDATE SKIP LOCKED.
+
+    Статусы: queued -> running -> done | failed; cancelled — отменена пользователем.
+    """
+    __tablename__ = 'audio_jobs'
+    __table_args__ = (
+        # Осиротевшие задачи: adopt_audio_jobs
+        Index('ix_audio_jobs_pending', 'platform', 'lease_until', 'id',
+              postgresql_where=text("status IN ('queued', 'running')")),
+        # Задачи владельца: продление аренды, освобождение при остановке
+        Index('ix_audio_jobs_owner', 'owner', postgresql_where=text("status IN ('queued', 'running')")),
+        # Очистка завершённых
+        Index('ix_audio_jobs_finished_at', 'finished_at'),
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    platform = Column(String(16), nullable=False)  # 'telegram', 'max'
+    user_id = Column(BigInteger, nullable=False)   # telegram_id / Max user_id
+    chat_id = Column(BigInteger)
+    message_id = Column(String(64))                # Telegram message_id / Max body.mid
+    queue_message_id = Column(String(64))          # сообщение "в очереди" с кнопкой отмены
+    file_id = Column(String)
+    url = Column(Text)
+    language_code = Column(String(16))
+    queue_order = Column(Integer, nullable=False, default=0)
+    paid = Column(Boolean, nullable=False, default=False)
+    payload = Column(JSONB, nullable=False, default={})
+
+    status = Column(String(16), nullable=False, default='queued')
+    attempts = Column(Integer, nullable=False, default=0)
+    owner = Column(String(128))
+    lease_until = Column(DateTime)
+    error = Column(String)
+
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
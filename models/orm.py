@@ -1,19 +1,26 @@
+import contextvars
 import traceback
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import wraps
 from itertools import groupby
 import pytz
 
 from fluentogram import TranslatorRunner, TranslatorHub
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import aliased, sessionmaker
 from sqlalchemy.sql.functions import count
 import sqlalchemy
-from sqlalchemy import RowMapping, select, update
+from sqlalchemy import RowMapping, func, select, update
+from sqlalchemy.dialects.postgresql import JSONB
 
-from models.model import Base, Payment, Referral, User, FileDownload, DownloadStatus, Audio, ProcessingSession, LLMRequest, AnonymousChatMessage, NotificationStatusEnum, RecoveryStatusEnum, Transcription, Summary, UserAction
+from models.model import Base, Payment, Referral, User, FileDownload, DownloadStatus, Audio, ProcessingSession, LLMRequest, AnonymousChatMessage, NotificationStatusEnum, RecoveryStatusEnum, Transcription, Summary, UserAction, FsmState, AudioJob
 from services.bot_provider import get_bot
-from services.scheduler import scheduler
+from models.partitioning import PARTITIONED_TABLES, ensure_partitions, list_partitions, add_months, month_start
+from models.statistics_rollups import STATISTICS_ROLLUP_VIEWS, ensure_statistics_rollups
+from services.db_telemetry import InstrumentedAsyncPool, instrument_engine
 from services.telegram_alerts import send_alert
+from services.user_cache import user_cache, invalidate_user
 from utils.i18n import create_translator_hub
 
 import os
@@ -33,8 +40,12 @@ engine = create_async_engine(
     pool_timeout=10,
     pool_use_lifo=True,
     pool_recycle=3600,
-    pool_pre_ping=True
+    pool_pre_ping=True,
+    # Пул с замером времени ожидания соединения (services/db_telemetry.py)
+    poolclass=InstrumentedAsyncPool
 )
+# Латентность запросов, медленные запросы и удержание соединений -> /metrics
+instrument_engine(engine)
 
 # Создаем фабрику асинхронных сессий
 async_session = sessionmaker(
@@ -43,6 +54,65 @@ async_session = sessionmaker(
     expire_on_commit=False
 )
 
+# Реплика только для чтения: аналитика, выгрузки, сверки и сканы напоминаний.
+# Без DB_REPLICA_HOST replica_session — тот же async_session (primary)
+db_replica_host = os.environ.get('DB_REPLICA_HOST')
+db_replica_port = int(os.environ.get('DB_REPLICA_PORT', '5432'))
+DB_REPLICA_POOL_SIZE = int(os.environ.get('DB_REPLICA_POOL_SIZE', '5'))
+
+if db_replica_host:
+    replica_engine = create_async_engine(
+        f'postgresql+asyncpg://{user_name}:{password}@{db_replica_host}:{db_replica_port}/{db_name}',
+        echo=False,
+        pool_size=DB_REPLICA_POOL_SIZE,
+        max_overflow=DB_REPLICA_POOL_SIZE,
+        pool_timeout=30,
+        pool_recycle=3600,
+        pool_pre_ping=True,
+        # Защита от случайной записи: реплика и так её отвергнет, но ошибка будет понятнее
+        connect_args={'server_settings': {'default_transaction_read_only': 'on'}}
+    )
+    instrument_engine(replica_engine, replica=True)
+    replica_session = sessionmaker(
+        replica_engine,
+        class_=AsyncSession,
+        expire_on_commit=False
+    )
+else:
+    replica_engine = engine
+    replica_session = async_session
+
+# Включается use_replica() / @on_replica на время отчёта; читается в read_session()
+_replica_routing: contextvars.ContextVar[bool] = contextvars.ContextVar('replica_routing', default=False)
+
+
+@contextmanager
+def use_replica():
+    """Чтения через read_session() внутри блока идут на реплику (запись — всегда primary)"""
+    token = _replica_routing.set(True)
+    try:
+        yield
+    finally:
+        _replica_routing.reset(token)
+
+
+def on_replica(func):
+    """Декоратор для отчётных/пакетных корутин: выполняет func внутри use_replica()"""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        with use_replica():
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+def read_session() -> AsyncSession:
+    """
+    Сессия для чтения, допускающего отставание реплики.
+    Внутри use_replica()/@on_replica — реплика (если настроена), иначе primary.
+    """
+    return replica_session() if _replica_routing.get() else async_session()
+
+
 import logging
 logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
 
@@ -64,6 +134,12 @@ async def init_models():
             END $$;
         """))
         await conn.run_sync(Base.metadata.create_all)
+        # create_all не добавляет колонки в существующие таблицы (миграция 0007 для баз без Alembic)
+        await conn.execute(sqlalchemy.text("ALTER TABLE users ADD COLUMN IF NOT EXISTS platform VARCHAR(16)"))
+        # Партиционированные таблицы без партиций не принимают INSERT
+        await conn.run_sync(ensure_partitions)
+        # Представления статистики (миграция 0005) — и для баз, созданных через create_all
+        await conn.run_sync(ensure_statistics_rollups)
 
 async def monitor_connection_pool():
     """Мониторинг состояния connection pool для AsyncEngine"""
@@ -99,105 +175,323 @@ async def monitor_connection_pool():
 
 # === АСИНХРОННОЕ ЛОГИРОВАНИЕ ===
 import asyncio
+import time
 from asyncio import Queue
-from dataclasses import dataclass
-from typing import Dict, Any
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, Any, Iterable, Sequence
+
+from sqlalchemy import insert
 
 # Очередь для фоновых задач логирования
 _background_logging_queue: Queue = None
+_background_logging_worker_task: asyncio.Task = None
+_background_logging_accepting = False
+
+BACKGROUND_LOG_QUEUE_SIZE = 10000  # Буфер на 10k задач
+# Пачка сбрасывается при наборе N задач или через T мс после первой задачи в пачке
+BACKGROUND_LOG_BATCH_SIZE = int(os.environ.get('BACKGROUND_LOG_BATCH_SIZE', 200))
+BACKGROUND_LOG_FLUSH_INTERVAL_MS = int(os.environ.get('BACKGROUND_LOG_FLUSH_INTERVAL_MS', 500))
+# Сколько продюсер готов ждать места в переполненной очереди, прежде чем задача будет потеряна
+BACKGROUND_LOG_PUT_TIMEOUT_SEC = 1.0
+
+# Поля, которые update_llm_request умеет обновлять
+_LLM_UPDATE_FIELDS = {
+    'response_length', 'prompt_tokens', 'completion_tokens', 'total_tokens', 'processing_duration',
+    'success', 'error_message', 'estimated_cost_usd', 'model_provider', 'model_name',
+}
 
 @dataclass
 class BackgroundLogTask:
     task_type: str
     data: Dict[str, Any]
+    # Время постановки в очередь: created_at/completed_at берутся отсюда, а не из момента сброса пачки
+    queued_at: datetime = field(default_factory=datetime.utcnow)
+
+
+@dataclass
+class BackgroundLoggingStats:
+    """Метрики back-pressure фонового логирования"""
+    enqueued: int = 0
+    dropped: int = 0
+    waited_for_space: int = 0
+    flushed_batches: int = 0
+    flushed_tasks: int = 0
+    failed_rows: int = 0
+    coalesced_llm_updates: int = 0
+    last_batch_size: int = 0
+    max_batch_size: int = 0
+    last_flush_ms: float = 0.0
+    max_flush_ms: float = 0.0
+    total_flush_ms: float = 0.0
+
+
+_background_logging_stats = BackgroundLoggingStats()
+
 
 async def init_background_logging():
     """Инициализация системы фонового логирования"""
-    global _background_logging_queue
-    _background_logging_queue = Queue(maxsize=10000)  # Буфер на 10k задач
-    
-    # Запускаем 3 воркера для обработки очереди
-    for i in range(3):
-        asyncio.create_task(_background_logging_worker(f"worker-{i}"))
+    global _background_logging_queue, _background_logging_worker_task, _background_logging_accepting
+    _background_logging_queue = Queue(maxsize=BACKGROUND_LOG_QUEUE_SIZE)
+    _background_logging_accepting = True
 
-async def _background_logging_worker(worker_name: str):
-    """Воркер для обработки фоновых задач логирования"""
-    global _background_logging_queue
-    
+    # Один воркер: пачки сбрасываются последовательно, поэтому обновления
+    # одного и того же LLM запроса применяются в порядке постановки в очередь
+    _background_logging_worker_task = asyncio.create_task(_background_logging_worker())
+
+async def _collect_background_batch() -> list[BackgroundLogTask]:
+    """Ждёт первую задачу и добирает пачку до BATCH_SIZE или до истечения FLUSH_INTERVAL"""
+    batch = [await _background_logging_queue.get()]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + BACKGROUND_LOG_FLUSH_INTERVAL_MS / 1000
+
+    while len(batch) < BACKGROUND_LOG_BATCH_SIZE:
+        try:
+            batch.append(_background_logging_queue.get_nowait())
+            continue
+        except asyncio.QueueEmpty:
+            pass
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        # get_nowait + sleep вместо wait_for(get()): отмена wait_for может потерять элемент очереди
+        await asyncio.sleep(min(remaining, 0.05))
+
+    return batch
+
+async def _background_logging_worker():
+    """Воркер: забирает задачи микропачками и сбрасывает каждую пачку одной транзакцией"""
     while True:
+        batch = await _collect_background_batch()
         try:
-            # Ждем задачу из очереди
-            task: BackgroundLogTask = await _background_logging_queue.get()
-            
-            # Обрабатываем в зависимости от типа
-            if task.task_type == 'anonymous_chat':
-                await _process_anonymous_chat_task(task.data)
-            elif task.task_type == 'llm_request_update':
-                await _process_llm_update_task(task.data)
-            elif task.task_type == 'user_action':
-                await _process_user_action_task(task.data)
-            # Можно добавить другие типы задач
-            
-            _background_logging_queue.task_done()
-            
+            await _flush_background_batch(batch)
         except Exception as e:
-            logging.error(f"Background logging worker {worker_name} error: {e}")
-            await asyncio.sleep(1)
-
-async def _process_anonymous_chat_task(data: Dict[str, Any]):
-    """Обработка задачи анонимного чата"""
-    try:
-        await log_anonymous_chat_message(
-            chat_session=data['chat_session'],
-            message_from=data['message_from'],
-            text=data['text'],
-            message_order=data['message_order']
+            logging.error(f"Background logging flush error: {e}")
+        finally:
+            for _ in batch:
+                _background_logging_queue.task_done()
+
+def _llm_update_values(fields: Dict[str, Any], completed_at: datetime | None) -> Dict[str, Any]:
+    """Поля UPDATE для llm_requests с той же семантикой, что и update_llm_request"""
+    values = {k: v for k, v in fields.items() if v is not None}
+    if 'success' in values:
+        values['completed_at'] = completed_at or datetime.utcnow()
+    return values
+
+def _split_background_batch(batch: list[BackgroundLogTask]) -> tuple[list[dict], list[dict], dict[int, dict], dict[tuple, dict]]:
+    """Раскладывает пачку по таблицам и схлопывает обновления одного request_id / записи кэша"""
+    chat_rows: list[dict] = []
+    action_rows: list[dict] = []
+    llm_updates: dict[int, dict] = {}
+    cache_reuses: dict[tuple, dict] = {}
+
+    for task in batch:
+        data = task.data
+        if task.task_type == 'anonymous_chat':
+            chat_rows.append({
+                'chat_session': data['chat_session'],
+                'message_from': data['message_from'],
+                'text': data['text'],
+                'message_order': data['message_order'],
+                'message_length': len(data['text']),
+                'created_at': task.queued_at,
+            })
+        elif task.task_type == 'user_action':
+            action_rows.append({
+                'user_id': data['user_id'],
+                'action_type': data['action_type'],
+                'action_category': data['action_category'],
+                'meta': data.get('metadata') or {},
+                'session_id': data.get('session_id'),
+                'payment_id': data.get('payment_id'),
+                'referral_id': data.get('referral_id'),
+                'created_at': task.queued_at,
+            })
+        elif task.task_type == 'llm_request_update':
+            request_id = data['request_id']
+            unknown = set(data) - _LLM_UPDATE_FIELDS - {'request_id'}
+            if unknown:
+                logging.warning(f"Ignoring unknown LLM update fields {unknown} for request {request_id}")
+            fields = {k: v for k, v in data.items() if k in _LLM_UPDATE_FIELDS and v is not None}
+            if request_id in llm_updates:
+                _background_logging_stats.coalesced_llm_updates += 1
+                llm_updates[request_id]['fields'].update(fields)
+            else:
+                llm_updates[request_id] = {'fields': fields, 'completed_at': None}
+            if 'success' in fields:
+                llm_updates[request_id]['completed_at'] = task.queued_at
+        elif task.task_type == 'cache_reuse':
+            key = (data['cache_type'], data['record_id'])
+            reuse = cache_reuses.setdefault(key, {'count': 0, 'last_reused_at': task.queued_at})
+            reuse['count'] += 1
+            reuse['last_reused_at'] = max(reuse['last_reused_at'], task.queued_at)
+        else:
+            logging.warning(f"Unknown background log task type: {task.task_type}")
+
+    return chat_rows, action_rows, llm_updates, cache_reuses
+
+def _cache_reuse_statement(cache_type: str, record_id: int, reuse: dict):
+    """UPDATE счётчика переиспользования кэша на накопленное за пачку количество"""
+    model = Transcription if cache_type == 'transcription' else Summary
+    return (
+        update(model)
+        .where(model.id == record_id)
+        .values(
+            reuse_count=func.coalesce(model.reuse_count, 0) + reuse['count'],
+            last_reused_at=reuse['last_reused_at']
         )
-    except Exception as e:
-        logging.error(f"Failed to process anonymous chat task: {e}")
+    )
+
+async def _flush_background_batch(batch: list[BackgroundLogTask]):
+    """
+    Сбрасывает пачку одной транзакцией: multi-row INSERT для чатов и действий,
+    по одному UPDATE на каждый (уже схлопнутый) LLM запрос.
+    При ошибке пачки пишет строки по одной, чтобы одна битая строка не теряла всю пачку.
+    """
+    chat_rows, action_rows, llm_updates, cache_reuses = _split_background_batch(batch)
+    started = time.perf_counter()
 
-async def _process_llm_update_task(data: Dict[str, Any]):
-    """Обработка обновления LLM запроса"""
     try:
-        await update_llm_request(**data)
+        async with async_session() as session:
+            if chat_rows:
+                await session.execute(insert(AnonymousChatMessage), chat_rows)
+            if action_rows:
+                await session.execute(insert(UserAction), action_rows)
+            for request_id, upd in llm_updates.items():
+                values = _llm_update_values(upd['fields'], upd['completed_at'])
+                if values:
+                    await session.execute(
+                        update(LLMRequest).where(LLMRequest.id == request_id).values(**values)
+                    )
+            for (cache_type, record_id), reuse in cache_reuses.items():
+                await session.execute(_cache_reuse_statement(cache_type, record_id, reuse))
+            await session.commit()
     except Exception as e:
-        logging.error(f"Failed to process LLM update task: {e}")
+        logging.error(f"Batch flush of {len(batch)} background log tasks failed, retrying row by row: {e}")
+        await _flush_background_rows_individually(chat_rows, action_rows, llm_updates, cache_reuses)
+
+    flush_ms = (time.perf_counter() - started) * 1000
+    stats = _background_logging_stats
+    stats.flushed_batches += 1
+    stats.flushed_tasks += len(batch)
+    stats.last_batch_size = len(batch)
+    stats.max_batch_size = max(stats.max_batch_size, len(batch))
+    stats.last_flush_ms = round(flush_ms, 1)
+    stats.max_flush_ms = max(stats.max_flush_ms, stats.last_flush_ms)
+    stats.total_flush_ms += flush_ms
+
+async def _flush_background_rows_individually(chat_rows: list[dict], action_rows: list[dict],
+                                              llm_updates: dict[int, dict], cache_reuses: dict[tuple, dict]):
+    """Запасной путь: каждая строка в своей транзакции"""
+    statements = (
+        [insert(AnonymousChatMessage).values(**row) for row in chat_rows]
+        + [insert(UserAction).values(**row) for row in action_rows]
+        + [
+            update(LLMRequest).where(LLMRequest.id == request_id)
+            .values(**_llm_update_values(upd['fields'], upd['completed_at']))
+            for request_id, upd in llm_updates.items()
+            if _llm_update_values(upd['fields'], upd['completed_at'])
+        ]
+        + [
+            _cache_reuse_statement(cache_type, record_id, reuse)
+            for (cache_type, record_id), reuse in cache_reuses.items()
+        ]
+    )
+    for stmt in statements:
+        try:
+            async with async_session() as session:
+                await session.execute(stmt)
+                await session.commit()
+        except Exception as e:
+            _background_logging_stats.failed_rows += 1
+            logging.error(f"Failed to write background log row: {e}")
+
+async def shutdown_background_logging(timeout: float = 10.0):
+    """
+    Останавливает приём задач и сбрасывает всё, что осталось в очереди.
+    Вызывать из shutdown-хука до закрытия соединений с БД.
+    """
+    global _background_logging_accepting, _background_logging_worker_task
+    if _background_logging_queue is None:
+        return
+    _background_logging_accepting = False
 
-async def _process_user_action_task(data: Dict[str, Any]):
-    """Обработка задачи логирования действия пользователя"""
     try:
-        await log_user_action(
-            user_id=data['user_id'],
-            action_type=data['action_type'],
-            action_category=data['action_category'],
-            metadata=data.get('metadata', {}),
-            session_id=data.get('session_id'),
-            payment_id=data.get('payment_id'),
-            referral_id=data.get('referral_id')
-        )
-    except Exception as e:
-        logging.error(f"Failed to process user action task: {e}")
+        await asyncio.wait_for(_background_logging_queue.join(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logging.error(f"Background logging flush on shutdown timed out, "
+                      f"{_background_logging_queue.qsize()} tasks still queued")
+
+    if _background_logging_worker_task:
+        _background_logging_worker_task.cancel()
+        try:
+            await _background_logging_worker_task
+        except asyncio.CancelledError:
+            pass
+        _background_logging_worker_task = None
+
+    # Если воркер не успел — дописываем остаток напрямую
+    leftover = []
+    while not _background_logging_queue.empty():
+        leftover.append(_background_logging_queue.get_nowait())
+        _background_logging_queue.task_done()
+    if leftover:
+        await _flush_background_batch(leftover)
+    logging.info(f"Background logging stopped, flushed {_background_logging_stats.flushed_tasks} tasks in total")
+
+def get_background_logging_stats() -> dict:
+    """Глубина очереди, размер пачек и латентность сброса (для /metrics)"""
+    stats = _background_logging_stats
+    return {
+        'queue_depth': _background_logging_queue.qsize() if _background_logging_queue is not None else 0,
+        'queue_max_size': BACKGROUND_LOG_QUEUE_SIZE,
+        'enqueued': stats.enqueued,
+        'dropped': stats.dropped,
+        'waited_for_space': stats.waited_for_space,
+        'flushed_batches': stats.flushed_batches,
+        'flushed_tasks': stats.flushed_tasks,
+        'failed_rows': stats.failed_rows,
+        'coalesced_llm_updates': stats.coalesced_llm_updates,
+        'last_batch_size': stats.last_batch_size,
+        'max_batch_size': stats.max_batch_size,
+        'avg_batch_size': round(stats.flushed_tasks / stats.flushed_batches, 1) if stats.flushed_batches else 0.0,
+        'last_flush_ms': stats.last_flush_ms,
+        'max_flush_ms': stats.max_flush_ms,
+        'avg_flush_ms': round(stats.total_flush_ms / stats.flushed_batches, 1) if stats.flushed_batches else 0.0,
+    }
 
 async def queue_background_log(task_type: str, data: Dict[str, Any]) -> bool:
     """
     Добавляет задачу логирования в фоновую очередь
     
+    Если очередь переполнена, ждёт до BACKGROUND_LOG_PUT_TIMEOUT_SEC.
+
     Returns:
-        True если задача добавлена, False если очередь переполнена
+        True если задача добавлена, False если очередь так и не освободилась
     """
     global _background_logging_queue
     
     if _background_logging_queue is None:
         logging.error("Background logging not initialized!")
         return False
+    if not _background_logging_accepting:
+        logging.warning(f"Background logging is shutting down, {task_type} task rejected")
+        return False
     
+    task = BackgroundLogTask(task_type=task_type, data=data)
     try:
-        task = BackgroundLogTask(task_type=task_type, data=data)
         _background_logging_queue.put_nowait(task)
-        return True
     except asyncio.QueueFull:
-        logging.warning(f"Background logging queue is full, dropping {task_type} task")
-        return False
+        # Back-pressure: даём воркеру время освободить место, а не теряем задачу сразу
+        _background_logging_stats.waited_for_space += 1
+        try:
+            await asyncio.wait_for(_background_logging_queue.put(task), timeout=BACKGROUND_LOG_PUT_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            _background_logging_stats.dropped += 1
+            logging.error(f"Background logging queue is full, dropping {task_type} task "
+                          f"(dropped total: {_background_logging_stats.dropped})")
+            return False
+    _background_logging_stats.enqueued += 1
+    return True
 
 # Неблокирующие версии функций для критического пути
 async def log_anonymous_chat_message_async(
@@ -257,13 +551,32 @@ async def log_user_action_async(
         'referral_id': referral_id
     })
 
+async def record_cache_reuse_async(cache_type: str, record_id: int) -> bool:
+    """
+    Неблокирующий учёт переиспользования кэша ('transcription' или 'summary').
+    reuse_count/last_reused_at агрегируются в пачке фонового логирования,
+    поэтому попадание в кэш стоит один SELECT вместо SELECT + UPDATE + COMMIT.
+    """
+    return await queue_background_log('cache_reuse', {
+        'cache_type': cache_type,
+        'record_id': record_id
+    })
+
 # Получение пользователя
 async def get_user(telegram_id: str | int = None, user_id: int = None) -> dict | None:
     """
-    Возвращает словарь с данными о пользователе либо None если пользователь не найден
+    Возвращает словарь с данными о пользователе либо None если пользователь не найден.
+    Поиск только по telegram_id обслуживается из in-process кэша (services.user_cache).
     :param telegram_id:
     :return:
     """
+    cacheable = bool(telegram_id) and not user_id
+    if cacheable:
+        cached = user_cache.get(telegram_id)
+        if cached is not None:
+            return cached
+        cache_version = user_cache.begin_read()
+
     async with async_session() as session:
         filters = []
         if telegram_id:
@@ -278,6 +591,8 @@ async def get_user(telegram_id: str | int = None, user_id: int = None) -> dict |
         user = result.scalar_one_or_none()
         if user is not None:
             user_data: dict = _prepare_user_dict(user)
+            if cacheable:
+                user_cache.put(telegram_id, user_data, cache_version)
             return user_data
         return user
 
@@ -304,6 +619,7 @@ def _prepare_user_dict(user: User):
         'download_video': user.download_video,
         'transcription_format': user.transcription_format,
         'is_bot_blocked': user.is_bot_blocked,
+        'platform': user.platform,
     }
 
 
@@ -312,6 +628,7 @@ async def _create_new_user(message=None,
                            active_sub: bool = False,
                            max_user=None) -> dict:
     async with async_session() as session:
+        platform = 'max' if max_user is not None else 'telegram'
         if max_user is not None:
             telegram_id = str(max_user.user_id)
             source = ''
@@ -361,6 +678,7 @@ async def _create_new_user(message=None,
             user.first_name = _first_name
             user.last_name = _last_name
             user.source = source
+            user.platform = platform
         else:
             # Создаем нового пользователя
             user = User(
@@ -372,7 +690,8 @@ async def _create_new_user(message=None,
                 start_date=current_time if not active_sub else None,
                 end_date=end_time if not active_sub else None,
                 source=source,
-                created_at=current_time
+                created_at=current_time,
+                platform=platform
             )
             session.add(user)
 
@@ -393,6 +712,7 @@ async def _create_new_user(message=None,
         await session.commit()
         user_data = _prepare_user_dict(user)
 
+    invalidate_user(telegram_id)
     return user_data
 
 async def create_new_user(message=None, telegram_user=None,
@@ -403,6 +723,18 @@ async def create_new_user(message=None, telegram_user=None,
     return user_data
 
 
+async def set_user_platform(telegram_id: int | str, platform: str):
+    """Запоминает платформу пользователя ('telegram' | 'max'): по ней тик истечения подписок выбирает бота"""
+    telegram_id = str(telegram_id)
+
+    async with async_session() as session:
+        await session.execute(
+            update(User).where(User.telegram_id == telegram_id).values(platform=platform)
+        )
+        await session.commit()
+    invalidate_user(telegram_id)
+
+
 async def add_voice_use(telegram_id: int | str):
     telegram_id = str(telegram_id)
 
@@ -414,6 +746,7 @@ async def add_voice_use(telegram_id: int | str):
         if user:
             user.audio_uses += 1
             await session.commit()
+            invalidate_user(telegram_id)
 
 
 async def add_gpt_use(telegram_id: int | str):
@@ -449,49 +782,69 @@ async def get_all_users() -> list[dict]:
 
         return users
 
+# Материализованные представления админской статистики: models/statistics_rollups.py
+STATISTICS_ROLLUP_REFRESH_MINUTES = int(os.environ.get('STATISTICS_ROLLUP_REFRESH_MINUTES', '10'))
+
+
+async def refresh_statistics_rollups():
+    """
+    Обновляет материализованные представления статистики (по расписанию).
+
+    REFRESH ... CONCURRENTLY не блокирует чтение: админка продолжает видеть прошлый снимок.
+    stats_users_snapshot обновляется последним — его refreshed_at показывается в админке.
+    Задача стоит в обоих ботах; advisory lock не даёт им обновлять одно представление дважды.
+    """
+    for view in STATISTICS_ROLLUP_VIEWS:
+        started = time.monotonic()
+        try:
+            async with engine.begin() as conn:
+                locked = await conn.scalar(
+                    sqlalchemy.text('SELECT pg_try_advisory_xact_lock(hashtext(:view))'), {'view': view}
+                )
+                if not locked:
+                    continue
+                await conn.execute(sqlalchemy.text(f'REFRESH MATERIALIZED VIEW CONCURRENTLY {view}'))
+            logging.debug(f"Refreshed {view} in {time.monotonic() - started:.2f}s")
+        except Exception as e:
+            logging.error(f"Failed to refresh {view}: {e}")
+
+
+@on_replica
+async def get_statistics_refreshed_at() -> datetime | None:
+    """Время (UTC) последнего обновления снимка статистики"""
+    async with read_session() as session:
+        result = await session.execute(sqlalchemy.text('SELECT refreshed_at FROM stats_users_snapshot'))
+        return result.scalar_one_or_none()
+
+
+@on_replica
 async def get_statistics() -> dict:
     """
-    Get system statistics using efficient database aggregation.
-    This is much faster than the previous implementation that loaded all users into memory.
+    Статистика бота из снимка stats_users_snapshot (refresh_statistics_rollups).
+    Живым запросом считаются только активные сессии — по частичному индексу.
     """
-    from sqlalchemy import func, case
-    
-    async with async_session() as session:
-        # Single query to get all statistics at once using SQL aggregation
-        result = await session.execute(
-            select(
-                func.count(User.id).label('users_count'),
-                func.sum(User.audio_uses).label('total_audio_uses'),
-                func.sum(User.gpt_uses).label('total_gpt_uses'),
-                func.sum(case((User.subscription == 'True', 1), else_=0)).label('active_subs'),
-                func.sum(case(((User.subscription == 'True') & (User.subscription_type == 'monthly'), 1), else_=0)).label('monthly_subs'),
-                func.sum(case(((User.subscription == 'True') & (User.subscription_type == 'weekly'), 1), else_=0)).label('weekly_subs'),
-                func.sum(case(((User.subscription == 'True') & (User.subscription_type.in_(['annual', 'yearly'])), 1), else_=0)).label('annual_subs'),
-                func.sum(case(((User.subscription == 'True') & ((User.subscription_type.is_(None)) | (User.subscription_type.in_(['custom', 'manual']))), 1), else_=0)).label('manual_subs'),
-                func.sum(case((User.audio_uses > 0, 1), else_=0)).label('users_with_action'),
-                func.sum(case((User.is_bot_blocked == False, 1), else_=0)).label('unblocked_users_count')
-            )
-        )
-        
-        stats = result.first()
+    async with read_session() as session:
+        result = await session.execute(sqlalchemy.text('SELECT * FROM stats_users_snapshot'))
+        stats = result.mappings().first() or {}
         # Count active (unclosed) processing sessions: final_status IS NULL
         active_sessions_result = await session.execute(
             select(func.count(ProcessingSession.id)).where(ProcessingSession.final_status.is_(None))
         )
         active_sessions = active_sessions_result.scalar() or 0
-        
+
         return {
-            'users_count': stats.users_count or 0,
-            'voice_uses': (stats.total_audio_uses or 0) + 96950,  # Adding the hardcoded base value
-            'gpt_uses': stats.total_gpt_uses or 0,
-            'active_subs': stats.active_subs or 0,
-            'monthly_subs': stats.monthly_subs or 0,
-            'weekly_subs': stats.weekly_subs or 0,
-            'annual_subs': stats.annual_subs or 0,
-            'manual_subs': stats.manual_subs or 0,
-            'users_with_action': stats.users_with_action or 0,
-            'unblocked_users_count': stats.unblocked_users_count or 0,
-            'active_sessions': active_sessions
+            'users_count': stats.get('users_count') or 0,
+            'voice_uses': (stats.get('total_audio_uses') or 0) + 96950,  # Adding the hardcoded base value
+            'gpt_uses': stats.get('total_gpt_uses') or 0,
+            'active_subs': stats.get('active_subs') or 0,
+            'monthly_subs': stats.get('monthly_subs') or 0,
+            'weekly_subs': stats.get('weekly_subs') or 0,
+            'annual_subs': stats.get('annual_subs') or 0,
+            'manual_subs': stats.get('manual_subs') or 0,
+            'users_with_action': stats.get('users_with_action') or 0,
+            'unblocked_users_count': stats.get('unblocked_users_count') or 0,
+            'active_sessions': active_sessions,
+            'refreshed_at': stats.get('refreshed_at')
         }
 
 
@@ -550,104 +903,142 @@ async def db_add_subscription(
         user.end_date = end_date_dt
         user.subscription_autopay = is_autopay_active
         await session.commit()
+        invalidate_user(telegram_id)
 
-        job_id = f"cancel_sub_{telegram_id}_{user.end_date.timestamp()}"
-        try:
-            scheduler.remove_job(job_id)
-            print(f"Removed existing cancellation job for user {telegram_id}")
-        except:
-            pass
-        translator_hub: TranslatorHub = create_translator_hub()
-        i18n = translator_hub.get_translator_by_locale(locale=user.user_language)
-        # Планируем новую задачу отмены подписки
-        scheduler.add_job(
-            cancel_subscription,
-            'date',
-            run_date=user.end_date,
-            args=[str(telegram_id), False, i18n],
-            id=job_id
-        )
-
+        # Отдельная date-задача отмены не нужна: истечение снимает периодический check_subscriptions
         logging.info(f"Subscription for user {telegram_id} updated/added: CP_ID={subscription_id}, Type={subscription_type_str}, End_Date={end_date_dt}")
 
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+# Период тика истечения подписок и параметры рассылки уведомлений
+SUBSCRIPTION_EXPIRY_TICK_MINUTES = int(os.environ.get('SUBSCRIPTION_EXPIRY_TICK_MINUTES', '5'))
+SUBSCRIPTION_EXPIRY_BATCH_SIZE = int(os.environ.get('SUBSCRIPTION_EXPIRY_BATCH_SIZE', '1000'))
+SUBSCRIPTION_NOTIFY_PER_SECOND = int(os.environ.get('SUBSCRIPTION_NOTIFY_PER_SECOND', '20'))
 
-async def check_subscriptions(scheduler: AsyncIOScheduler):
-    logging.info('Starting check_subscriptions.')
-    async with async_session() as session:
-        # Use naive UTC for DB comparisons (TIMESTAMP WITHOUT TIME ZONE)
-        current_time_naive = datetime.utcnow()
-        start_of_day = current_time_naive.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_of_day = start_of_day + timedelta(days=1)
-
-        # Получаем только тех, у кого срок истек или истекает сегодня (сейчас/позже)
-        expired_result = await session.execute(
-            select(User).filter(
+
+async def expire_subscriptions(platform: str = 'telegram', reference_time: datetime = None,
+                               batch_size: int = SUBSCRIPTION_EXPIRY_BATCH_SIZE) -> list[dict]:
+    """
+    Снимает истекшие подписки set-based: UPDATE ... FROM (SELECT ... FOR UPDATE SKIP LOCKED) ... RETURNING.
+
+    Обрабатывает пачками по batch_size, чтобы не держать длинную транзакцию в большие дни продлений.
+    Тик стоит в обоих ботах: каждый процесс забирает только пользователей своей платформы
+    (NULL считается telegram), поэтому уведомление уходит через бота, в котором пользователь пишет.
+    SKIP LOCKED защищает от наложения тиков (например, при перезапуске).
+
+    Returns:
+        Список {'telegram_id', 'user_language', 'was_trial'} для рассылки уведомлений
+    """
+    # Naive UTC: end_date хранится как TIMESTAMP WITHOUT TIME ZONE
+    reference_time = reference_time or datetime.utcnow()
+    expired_users: list[dict] = []
+
+    while True:
+        expired = (
+            select(User.id, User.subscription)
+            .where(
                 User.subscription.in_(['trial', 'True']),
                 User.end_date.isnot(None),
-                User.end_date <= current_time_naive
+                User.end_date <= reference_time,
+                func.coalesce(User.platform, 'telegram') == platform
             )
+            .order_by(User.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+            .cte('expired')
         )
-        expiring_today_result = await session.execute(
-            select(User).filter(
-                User.subscription.in_(['trial', 'True']),
-                User.end_date.isnot(None),
-                User.end_date > current_time_naive,
-                User.end_date < end_of_day
-            )
+        query = (
+            update(User)
+            .where(User.id == expired.c.id)
+            .values(subscription='False', subscription_id=None, start_date=None, end_date=None)
+            .returning(User.telegram_id, User.user_language, (expired.c.subscription == 'trial').label('was_trial'))
+            .execution_options(synchronize_session=False)
         )
+        async with async_session() as session:
+            rows = (await session.execute(query)).mappings().all()
+            await session.commit()
 
-        expired_users = expired_result.scalars().all()
-        expiring_today_users = expiring_today_result.scalars().all()
-
-        # Один hub и кэш переводчиков по языку
-        translator_hub: TranslatorHub = create_translator_hub()
-        i18n_cache: dict[str, TranslatorRunner] = {}
-
-        def get_i18n(lang: str | None) -> TranslatorRunner:
-            lang_code = lang or getattr(config.tg_bot, 'default_lang', 'ru')
-            if lang_code not in i18n_cache:
-                i18n_cache[lang_code] = translator_hub.get_translator_by_locale(locale=lang_code)
-            return i18n_cache[lang_code]
-
-        # Обрабатываем просроченные подписки конкурентно, ограничивая параллелизм
-        import asyncio as _asyncio
-        semaphore = _asyncio.Semaphore(20)
-
-        async def _process_expired(user: User):
-            async with semaphore:
-                if user.end_date is None:
-                    return
-                # Compare naive UTC
-                user_end_date_naive = user.end_date if user.end_date.tzinfo is None else user.end_date.replace(tzinfo=None)
-                if user_end_date_naive <= current_time_naive:
-                    i18n = get_i18n(user.user_language)
-                    try:
-                        await cancel_subscription(user.telegram_id, user.subscription == 'trial', i18n=i18n)
-                    except Exception as e:
-                        logging.error(f"Failed to cancel subscription for {user.telegram_id}: {e}")
+        for row in rows:
+            invalidate_user(row['telegram_id'])
+        expired_users.extend(dict(row) for row in rows)
 
-        if expired_users:
-            await _asyncio.gather(*[_process_expired(u) for u in expired_users])
+        if len(rows) < batch_size:
+            break
+
+    return expired_users
+
+
+async def notify_expired_subscriptions(expired_users: list[dict], platform: str = 'telegram',
+                                       per_second: int = SUBSCRIPTION_NOTIFY_PER_SECOND):
+    """Уведомляет пользователей платформы об окончании подписки не быстрее per_second сообщений в секунду"""
+    translator_hub: TranslatorHub = create_translator_hub()
+    i18n_cache: dict[str, TranslatorRunner] = {}
+
+    def get_i18n(lang: str | None) -> TranslatorRunner:
+        lang_code = lang or getattr(config.tg_bot, 'default_lang', 'ru')
+        if lang_code not in i18n_cache:
+            i18n_cache[lang_code] = translator_hub.get_translator_by_locale(locale=lang_code)
+        return i18n_cache[lang_code]
+
+    # Local imports to avoid circular dependency (и aiogram/maxapi только своего процесса)
+    if platform == 'max':
+        from maxapi.enums.parse_mode import ParseMode
+        from max_keyboards.user_keyboards import subscription_menu
+
+        async def _send(user: dict, text: str, i18n: TranslatorRunner):
+            await get_bot('max').send_message(
+                user_id=int(user['telegram_id']),
+                text=text,
+                attachments=[subscription_menu(i18n)],
+                format=ParseMode.HTML
+            )
+    else:
+        from keyboards.user_keyboards import subscription_menu
+
+        async def _send(user: dict, text: str, i18n: TranslatorRunner):
+            await get_bot().send_message(
+                chat_id=user['telegram_id'],
+                text=text,
+                parse_mode='HTML',
+                reply_markup=subscription_menu(i18n)
+            )
+
+    async def _notify(user: dict) -> bool:
+        i18n = get_i18n(user['user_language'])
+        try:
+            await _send(user, i18n.trial_ended() if user['was_trial'] else i18n.subscription_ended(), i18n)
+            return True
+        except Exception as e:
+            logging.warning(f"Failed to send subscription end notification to {platform} user {user['telegram_id']}: {e}")
+            return False
+
+    sent = 0
+    for offset in range(0, len(expired_users), per_second):
+        batch = expired_users[offset:offset + per_second]
+        results = await asyncio.gather(*[_notify(user) for user in batch])
+        sent += sum(1 for result in results if result)
+        if offset + per_second < len(expired_users):
+            await asyncio.sleep(1)
+    return sent
 
-        # Планируем отмену для тех, у кого подписка заканчивается сегодня
-        for user in expiring_today_users:
-            if user.end_date is None:
-                continue
-            # Keep run_date naive (UTC) to match DB stored values and previous behavior
-            run_dt = user.end_date if user.end_date.tzinfo is None else user.end_date.replace(tzinfo=None)
-            try:
-                i18n = get_i18n(user.user_language)
-                scheduler.add_job(
-                    cancel_subscription,
-                    'date',
-                    run_date=run_dt,
-                    args=[user.telegram_id, user.subscription == 'trial', i18n],
-                    id=f"cancel_sub_{user.telegram_id}_{run_dt.timestamp()}"
-                )
-            except Exception as e:
-                logging.error(f"Failed to schedule cancellation for {user.telegram_id}: {e}")
+
+async def check_subscriptions(platform: str = 'telegram'):
+    """
+    Тик истечения подписок (scheduler, каждые SUBSCRIPTION_EXPIRY_TICK_MINUTES минут).
+
+    Вместо date-задачи на каждого пользователя: одна пачка UPDATE ... RETURNING
+    и отдельная рассылка уведомлений с ограничением скорости.
+    main.py вызывает тик с 'telegram', max_main.py — с 'max'.
+    """
+    try:
+        expired_users = await expire_subscriptions(platform)
+    except Exception as e:
+        logging.error(f"check_subscriptions({platform}): expiry failed: {e}")
+        return
+    if not expired_users:
+        return
+
+    sent = await notify_expired_subscriptions(expired_users, platform)
+    logging.info(f"check_subscriptions({platform}): expired {len(expired_users)} subscriptions, notified {sent}")
 
 async def cancel_subscription(telegram_id: str, was_trial: bool, i18n: TranslatorRunner, force_cancel: bool = False):
     # Local import to avoid circular dependency
@@ -678,6 +1069,7 @@ async def cancel_subscription(telegram_id: str, was_trial: bool, i18n: Translato
             user.start_date = None
             user.end_date = None
             await session.commit()
+            invalidate_user(telegram_id)
             
     if was_trial:
         try:
@@ -740,22 +1132,27 @@ async def update_subscription_details(telegram_id: str,
         if subscription_status:
             user.subscription = subscription_status
         await session.commit()
+        invalidate_user(telegram_id)
         return True
 
         
 
+@on_replica
 async def get_sources():
     """
     Возвращает список источников и количество пользователей из каждого источника
+    (из stats_user_sources, по убыванию количества)
     :return:
     """
 
-    async with async_session() as session:
-        result = await session.execute(
-            select(User.source, count(User.source).label('count')).filter(User.source != '').group_by(User.source)
-        )
-        sorted_sources = sorted(result.fetchall(), key=lambda x: x[1], reverse=True)
-        return sorted_sources
+    async with read_session() as session:
+        result = await session.execute(sqlalchemy.text("""
+            SELECT source, sum(users_count)::bigint AS count
+            FROM stats_user_sources
+            GROUP BY source
+            ORDER BY count DESC, source
+        """))
+        return result.fetchall()
 
 
 async def get_users():
@@ -770,101 +1167,187 @@ async def get_users():
 
         return users_list
 
-async def get_sources_with_subscription(subscription_type: str = None):
+# Колонки, которые iter_users отдаёт по умолчанию: достаточно для рассылки и выгрузок
+USER_SCAN_DEFAULT_COLUMNS = ('id', 'telegram_id', 'username')
+
+
+def _user_scan_conditions(start_id: int | None = None,
+                          end_id: int | None = None,
+                          is_bot_blocked: bool | None = None,
+                          subscribed: bool | None = None,
+                          exclude_ids: Iterable[int] | None = None,
+                          exclude_query=None) -> list:
     """
-    Возвращает список источников пользователей с активной подпиской
-    :return:
+    SQL-условия для iter_users / count_users. None означает "не фильтровать".
+    NULL в is_bot_blocked считается "не заблокирован", NULL в subscription — "без подписки".
+    exclude_query — SELECT с колонкой user_id (например, broadcast_exclusion_query()).
     """
-    async with async_session() as session:
-        if subscription_type is None:
-            source_filter = User.source != '', User.subscription == 'True'
-        else:
-            source_filter = User.source != '', User.subscription == 'True', User.subscription_type == subscription_type
+    from sqlalchemy import Integer, bindparam, exists
+    from sqlalchemy.dialects.postgresql import ARRAY
+
+    conditions = []
+    if start_id is not None:
+        conditions.append(User.id >= start_id)
+    if end_id is not None:
+        conditions.append(User.id <= end_id)
+    if is_bot_blocked is not None:
+        conditions.append(User.is_bot_blocked.is_(True) if is_bot_blocked else User.is_bot_blocked.isnot(True))
+    if subscribed is not None:
+        conditions.append(User.subscription == 'True' if subscribed
+                          else User.subscription.is_distinct_from('True'))
+    if exclude_ids:
+        # Anti-join с unnest(массив): один параметр вместо IN на десятки тысяч литералов
+        excluded = (
+            func.unnest(bindparam('exclude_ids', list(exclude_ids), type_=ARRAY(Integer), unique=True))
+            .table_valued('id')
+            .render_derived(name='excluded_users')
+        )
+        conditions.append(~exists().where(excluded.c.id == User.id))
+    if exclude_query is not None:
+        excluded_query = exclude_query.subquery('excluded_query_users')
+        conditions.append(~exists().where(excluded_query.c.user_id == User.id))
+    return conditions
+
+
+async def iter_users(columns: Sequence[str] = USER_SCAN_DEFAULT_COLUMNS,
+                     *,
+                     start_id: int | None = None,
+                     end_id: int | None = None,
+                     is_bot_blocked: bool | None = None,
+                     subscribed: bool | None = None,
+                     exclude_ids: Iterable[int] | None = None,
+                     exclude_query=None,
+                     page_size: int = 5000,
+                     yield_per: int = 1000) -> AsyncIterator[dict]:
+    """
+    Потоково перебирает пользователей по возрастанию id, не загружая таблицу целиком.
 
-        result = await session.execute(
-            select(User.source, count(User.source).label('count')).filter(*source_filter).group_by(User.source)
+    Фильтры применяются в SQL, возвращаются только запрошенные колонки.
+    Страница читается серверным курсором (yield_per) и сессия закрывается до того,
+    как строки отдаются вызывающему: медленный потребитель (рассылка с паузами)
+    не держит соединение из пула. Следующая страница — keyset по id.
+
+    Args:
+        columns: Имена колонок таблицы users
+        start_id / end_id: Диапазон внутренних id (включительно)
+        is_bot_blocked: Фильтр по блокировке бота
+        subscribed: True — только с подпиской, False — только без
+        exclude_ids: Внутренние id, которые нужно исключить
+        exclude_query: SELECT с колонкой user_id, с которым делается anti-join
+        page_size: Сколько строк держать в памяти одновременно
+        yield_per: Размер выборки серверного курсора
+
+    Yields:
+        dict {колонка: значение}
+    """
+    columns = tuple(columns)
+    selected = tuple(dict.fromkeys(('id', *columns)))
+    table_columns = [User.__table__.c[name] for name in selected]
+    conditions = _user_scan_conditions(start_id, end_id, is_bot_blocked, subscribed, exclude_ids, exclude_query)
+
+    last_id = None
+    while True:
+        stmt = (
+            select(*table_columns)
+            .where(*conditions)
+            .order_by(User.id)
+            .limit(page_size)
+            .execution_options(yield_per=yield_per)
         )
-        sorted_sources = sorted(result.fetchall(), key=lambda x: x[1], reverse=True)
-        return sorted_sources
+        if last_id is not None:
+            stmt = stmt.where(User.id > last_id)
+
+        async with read_session() as session:
+            result = await session.stream(stmt)
+            page = [row async for row in result.mappings()]
 
+        if not page:
+            return
+        last_id = page[-1]['id']
+
+        for row in page:
+            yield {name: row[name] for name in columns}
+
+        if len(page) < page_size:
+            return
 
-from sqlalchemy import func, or_
 
+async def iter_user_batches(batch_size: int,
+                            columns: Sequence[str] = USER_SCAN_DEFAULT_COLUMNS,
+                            **filters) -> AsyncIterator[list[dict]]:
+    """iter_users, сгруппированный в пачки по batch_size (последняя может быть меньше)"""
+    batch = []
+    async for user in iter_users(columns, **filters):
+        batch.append(user)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def count_users(*,
+                      start_id: int | None = None,
+                      end_id: int | None = None,
+                      is_bot_blocked: bool | None = None,
+                      subscribed: bool | None = None,
+                      exclude_ids: Iterable[int] | None = None,
+                      exclude_query=None) -> int:
+    """Количество пользователей под теми же фильтрами, что и iter_users"""
+    conditions = _user_scan_conditions(start_id, end_id, is_bot_blocked, subscribed, exclude_ids, exclude_query)
+    async with read_session() as session:
+        result = await session.execute(select(func.count(User.id)).where(*conditions))
+        return result.scalar_one()
+
+
+@on_replica
+async def get_sources_with_subscription(subscription_type: str = None):
+    """
+    Возвращает список источников пользователей с активной подпиской (из stats_user_sources)
+    :return:
+    """
+    type_filter = 'AND subscription_type = :subscription_type' if subscription_type is not None else ''
+    async with read_session() as session:
+        result = await session.execute(sqlalchemy.text(f"""
+            SELECT source, sum(users_count)::bigint AS count
+            FROM stats_user_sources
+            WHERE subscription = 'True' {type_filter}
+            GROUP BY source
+            ORDER BY count DESC, source
+        """), {'subscription_type': subscription_type})
+        return result.fetchall()
+
+
+@on_replica
 async def get_payments_sources(unique: bool = False, subscription_type: str = None, period_days: int = None):
-    # Импортируем все необходимые функции SQLAlchemy в начале функции
-    from sqlalchemy import func, distinct, or_, and_, select as sqlalchemy_select
-    
-    async with async_session() as session:
-        if unique:
-            # Для уникальных платежей используем подзапрос, который сначала выбирает первый платеж
-            # для каждого пользователя (по времени создания), и только потом применяет фильтры
-            
-            # Подзапрос для получения ID первого платежа каждого пользователя
-            first_payments_subquery = sqlalchemy_select(
-                Payment.id.label('first_payment_id')
-            ).select_from(
-                Payment
-            ).where(
-                Payment.source != ''
-            ).order_by(
-                Payment.user_id,
-                Payment.created_at
-            ).distinct(
-                Payment.user_id
-            ).subquery()
-            
-            # Основной запрос с фильтрами по типу подписки и периоду
-            query = select(
-                Payment.source,
-                func.count(Payment.source).label('count')
-            ).join(
-                first_payments_subquery, 
-                Payment.id == first_payments_subquery.c.first_payment_id
-            )
-            
-            # Добавляем фильтр по типу подписки, если указан
-            if subscription_type == 'weekly':
-                query = query.filter(or_(Payment.amount == 149, Payment.amount == 55, Payment.amount == 249))
-            elif subscription_type == 'monthly':
-                query = query.filter(or_(Payment.amount == 190, Payment.amount == 349, Payment.amount == 549))
-                
-            # Добавляем фильтр по времени, если указан
-            if period_days:
-                start_date = datetime.now(pytz.utc) - timedelta(days=period_days)
-                # Convert to naive datetime for PostgreSQL TIMESTAMP WITHOUT TIME ZONE
-                naive_start_date = start_date.replace(tzinfo=None)
-                query = query.filter(Payment.created_at >= naive_start_date)
-                
-            # Группировка и выполнение запроса
-            result = await session.execute(query.group_by(Payment.source))
-        else:
-            # Для обычных платежей оставляем существующую логику
-            # Build the base query
-            query = select(
-                Payment.source,
-                func.count(Payment.source).label('count')
-            ).filter(Payment.source != '')
-
-            # Add subscription type filter if specified
-            if subscription_type == 'weekly':
-                query = query.filter(or_(Payment.amount == 149, Payment.amount == 55, Payment.amount == 249))
-            elif subscription_type == 'monthly':
-                query = query.filter(or_(Payment.amount == 190, Payment.amount == 349, Payment.amount == 549))
-                
-            # Add time period filter if specified
-            if period_days:
-                start_date = datetime.now(pytz.utc) - timedelta(days=period_days)
-                # Convert to naive datetime for PostgreSQL TIMESTAMP WITHOUT TIME ZONE
-                naive_start_date = start_date.replace(tzinfo=None)
-                query = query.filter(Payment.created_at >= naive_start_date)
-
-            # Complete the query
-            result = await session.execute(query.group_by(Payment.source))
-
-        # Sort the results by count in descending order
-        sorted_sources = sorted(result.fetchall(), key=lambda x: x[1], reverse=True)
-        return sorted_sources
-    
+    """
+    Источники оплат из почасовых бакетов stats_payment_sources_hourly.
+
+    unique=True — только первый платёж каждого пользователя (is_first), тип подписки
+    определяется по сумме платежа (plan), период отсекается с точностью до часа.
+    """
+    conditions = ['true']
+    params = {}
+    if unique:
+        conditions.append('is_first')
+    if subscription_type in ('weekly', 'monthly'):
+        conditions.append('plan = :plan')
+        params['plan'] = subscription_type
+    if period_days:
+        # Naive UTC: created_at хранится как TIMESTAMP WITHOUT TIME ZONE
+        conditions.append("bucket >= date_trunc('hour', CAST(:start_date AS timestamp))")
+        params['start_date'] = datetime.utcnow() - timedelta(days=period_days)
+
+    async with read_session() as session:
+        result = await session.execute(sqlalchemy.text(f"""
+            SELECT source, sum(payments_count)::bigint AS count
+            FROM stats_payment_sources_hourly
+            WHERE {' AND '.join(conditions)}
+            GROUP BY source
+            ORDER BY count DESC, source
+        """), params)
+        return result.fetchall()
+
 async def db_add_payment(telegram_id: int, amount: float, status: str, token: str = None, transaction_id: str = None):
     async with async_session() as session:
         user_result = await session.execute(
@@ -908,6 +1391,7 @@ async def cancel_autopay(telegram_id: int):
         user = user.scalar_one_or_none()
         user.subscription_autopay = False
         await session.commit()
+        invalidate_user(telegram_id)
 
 
 async def get_payments(telegram_id: int, only_successful: bool = False):
@@ -936,6 +1420,7 @@ async def renew_subscription_db(telegram_id: int, subscription_id: str):
         user.subscription_id = subscription_id
         user.subscription_autopay = True
         await session.commit()
+        invalidate_user(telegram_id)
 
 async def give_subscription(i18n: TranslatorRunner, telegram_id: int = None, username: str = None, days: int = 30):
     async with async_session() as session:
@@ -958,6 +1443,7 @@ async def give_subscription(i18n: TranslatorRunner, telegram_id: int = None, use
         user.start_date = datetime.utcnow()
         user.end_date = datetime.utcnow() + timedelta(days=days)
         await session.commit()
+        invalidate_user(user.telegram_id)
         return {'result': True, 'message': i18n.subscription_success_admin(), 'user_id': user.telegram_id}
         
 
@@ -969,6 +1455,7 @@ async def change_user_setting(telegram_id: int, setting_name: str, setting_value
         user = user.scalar_one_or_none()
         setattr(user, setting_name, setting_value)
         await session.commit()
+        invalidate_user(telegram_id)
 
 async def get_user_id_range():
     """
@@ -1064,7 +1551,10 @@ async def update_download_record(
         error_message: Error details if status is ERROR.
     """
     async with async_session() as session:
-        record = await session.get(FileDownload, record_id)
+        # file_downloads партиционирована: первичный ключ (id, created_at), session.get по одному id не работает
+        record = (await session.execute(
+            select(FileDownload).where(FileDownload.id == record_id)
+        )).scalar_one_or_none()
         if not record:
             print(f"Error: Cannot update non-existent download record_id: {record_id}")
             return
@@ -1096,6 +1586,7 @@ async def update_user_blocked_status(telegram_id: int | str, is_blocked: bool):
             for user in users:
                 user.is_bot_blocked = is_blocked
             await session.commit()
+            invalidate_user(telegram_id)
             logging.info(f"Updated {len(users)} users with telegram_id {telegram_id} blocked status to {is_blocked}")
             return True
         logging.warning(f"User {telegram_id} not found when updating blocked status")
@@ -1162,6 +1653,7 @@ async def add_free_days_to_subscription_db(telegram_id: int | str, days: int) ->
             user.subscription_type = 'reward'
         user.subscription = 'True'
         await session.commit()
+    invalidate_user(telegram_id)
     return True
     
 async def confirm_referral_process(referrer_telegram_id: int | str, referral_telegram_id: int | str, success: bool):
@@ -1364,6 +1856,18 @@ async def update_processing_session(session_id: str,
     Returns:
         True если обновление прошло успешно
     """
+    writer = _active_session_writers.get(session_id)
+    if writer is not None:
+        # Сессия ведётся ProcessingSessionWriter: запишется в ближайшей контрольной точке
+        writer.update(
+            completed_at=completed_at, total_duration=total_duration, final_status=final_status,
+            error_stage=error_stage, error_message=error_message, original_file_size=original_file_size,
+            total_download_attempts=total_download_attempts, waiting_message_id=waiting_message_id,
+            notification_status=notification_status, recovery_status=recovery_status,
+            transcription_id=transcription_id
+        )
+        return True
+
     try:
         async with async_session() as session:
             processing_session = await session.execute(
@@ -1511,6 +2015,11 @@ async def increment_download_attempts(session_id: str) -> bool:
     Returns:
         True если успешно обновлено
     """
+    writer = _active_session_writers.get(session_id)
+    if writer is not None:
+        writer.add_download_attempt()
+        return True
+
     try:
         async with async_session() as session:
             processing_session = await session.execute(
@@ -1565,6 +2074,179 @@ async def create_audio_log_with_session(session_id: str, user_id: int) -> int |
         return None
 
 
+# === UNIT OF WORK ДЛЯ ЖИЗНЕННОГО ЦИКЛА СЕССИИ ОБРАБОТКИ ===
+
+# Активные writer'ы по session_id: update_processing_session/increment_download_attempts
+# для этих сессий пишут в буфер writer'а, а не открывают отдельную транзакцию
+_active_session_writers: dict[str, 'ProcessingSessionWriter'] = {}
+
+
+class ProcessingSessionWriter:
+    """
+    Unit of work для одной задачи обработки аудио.
+
+    Переходы состояния копятся в памяти и пишутся в БД в трёх контрольных точках:
+    - start(): INSERT processing_sessions + INSERT audio (одна транзакция)
+    - checkpoint(): один UPDATE накопленных полей (transcription_id, размер, попытки загрузки)
+    - finish(): итоговый статус сессии, аудио лог и счётчик audio_uses (одна транзакция)
+
+    close() вызывается в finally обработки, чтобы writer отмененной задачи не остался в учёте.
+
+    Строка processing_sessions создаётся в start() с final_status = NULL, поэтому
+    восстановление после падения (startup_handle_interrupted_sessions) работает как раньше;
+    теряются только ещё не сброшенные промежуточные поля.
+    """
+
+    def __init__(self, user_id: int,
+                 original_identifier: str,
+                 source_type: str,
+                 specific_source: str | None = None,
+                 waiting_message_id: int | None = None,
+                 user_original_message_id: int | None = None):
+        import uuid
+
+        self.session_id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.audio_log_id: int | None = None
+        self._session_values = {
+            'session_id': self.session_id,
+            'user_id': user_id,
+            'original_identifier': original_identifier,
+            'source_type': source_type,
+            'specific_source': specific_source,
+            'waiting_message_id': waiting_message_id,
+            'user_original_message_id': user_original_message_id,
+        }
+        self._pending: dict = {}
+        self._download_attempts = 0
+        self._started_at = time.time()
+        self._finished = False
+
+    async def start(self) -> bool:
+        """Контрольная точка 1: создаёт сессию и аудио лог. False при ошибке"""
+        try:
+            async with async_session() as session:
+                await session.execute(insert(ProcessingSession).values(**self._session_values))
+                result = await session.execute(
+                    insert(Audio).values(user_id=self.user_id, session_id=self.session_id).returning(Audio.id)
+                )
+                self.audio_log_id = result.scalar_one()
+                await session.commit()
+        except Exception as e:
+            logging.error(f"Error starting processing session for user {self.user_id}: {e}")
+            return False
+
+        self._started_at = time.time()
+        _active_session_writers[self.session_id] = self
+        logging.debug(f"Created processing session: {self.session_id} (audio log {self.audio_log_id}) for user {self.user_id}")
+        return True
+
+    def update(self, **fields) -> None:
+        """Буферизует поля processing_sessions (None-значения игнорируются, как в update_processing_session)"""
+        self._pending.update({key: value for key, value in fields.items() if value is not None})
+
+    def add_download_attempt(self) -> None:
+        self._download_attempts += 1
+
+    def _take_session_values(self) -> dict:
+        values = self._pending
+        self._pending = {}
+        if self._download_attempts and 'total_download_attempts' not in values:
+            values['total_download_attempts'] = (
+                func.coalesce(ProcessingSession.total_download_attempts, 0) + self._download_attempts
+            )
+        self._download_attempts = 0
+        return values
+
+    async def checkpoint(self) -> bool:
+        """Контрольная точка 2: сбрасывает накопленные поля одним UPDATE"""
+        values = self._take_session_values()
+        if not values:
+            return True
+        try:
+            async with async_session() as session:
+                await session.execute(
+                    update(ProcessingSession).where(ProcessingSession.session_id == self.session_id).values(**values)
+                )
+                await session.commit()
+            return True
+        except Exception as e:
+            logging.error(f"Error flushing processing session {self.session_id}: {e}")
+            return False
+
+    async def finish(self, final_status: str,
+                     error_stage: str | None = None,
+                     error_message: str | None = None,
+                     audio_length: float | None = None,
+                     file_size_bytes: int | None = None,
+                     voice_use_telegram_id: int | str | None = None) -> bool:
+        """
+        Контрольная точка 3: итог сессии, аудио лог и (при успехе) счётчик audio_uses в одной транзакции.
+
+        Args:
+            final_status: 'success' или 'failed'
+            error_stage: 'download', 'audio_extraction', 'transcription', 'summary'
+            error_message: Сообщение об ошибке
+            audio_length: Длительность аудио в секундах
+            file_size_bytes: Размер файла в байтах
+            voice_use_telegram_id: telegram_id, которому засчитать использование (add_voice_use)
+        """
+        if self._finished:
+            # Итог уже записан (например, упала отправка уже после успешного finish)
+            return False
+        self._finished = True
+        _active_session_writers.pop(self.session_id, None)
+        duration = time.time() - self._started_at
+        self.update(
+            completed_at=datetime.utcnow(),
+            total_duration=duration,
+            final_status=final_status,
+            error_stage=error_stage,
+            error_message=error_message,
+        )
+        session_values = self._take_session_values()
+        audio_values = {
+            key: value for key, value in {
+                'length': audio_length,
+                'file_size_bytes': file_size_bytes,
+                'processing_duration': duration,
+                'success': final_status == 'success',
+                'error_message': error_message,
+            }.items() if value is not None
+        }
+        try:
+            async with async_session() as session:
+                await session.execute(
+                    update(ProcessingSession).where(ProcessingSession.session_id == self.session_id).values(**session_values)
+                )
+                if self.audio_log_id:
+                    await session.execute(update(Audio).where(Audio.id == self.audio_log_id).values(**audio_values))
+                if voice_use_telegram_id is not None:
+                    await session.execute(
+                        update(User)
+                        .where(User.telegram_id == str(voice_use_telegram_id))
+                        .values(audio_uses=User.audio_uses + 1)
+                    )
+                await session.commit()
+        except Exception as e:
+            logging.error(f"Error finishing processing session {self.session_id}: {e}")
+            return False
+
+        if voice_use_telegram_id is not None:
+            invalidate_user(voice_use_telegram_id)
+        return True
+
+    def close(self) -> None:
+        """Снимает writer с учёта (finally обработки): после отмены задачи finish() не вызывается"""
+        _active_session_writers.pop(self.session_id, None)
+
+
+async def flush_active_session_writers() -> None:
+    """Сбрасывает буферы всех активных сессий (перед пометкой прерванных при выключении)"""
+    for writer in list(_active_session_writers.values()):
+        await writer.checkpoint()
+
+
 # === LLM REQUEST ФУНКЦИИ ===
 
 async def create_llm_request(
@@ -2006,13 +2688,33 @@ async def get_transcript_by_chat_session(chat_session: str) -> str | None:
         logging.error(f"Error getting transcript by chat_session {chat_session}: {e}")
         return None
 
-async def get_transcription_data(session_id: str) -> dict | None:
-    """
-    Получает данные транскрипции по session_id через processing_session.transcription_id.
-    Return:
-        dict with raw_transcript, timecoded_transcript, transcription_id
+async def get_transcript_text(transcription_id: int) -> str | None:
     """
-    try:
+    Получает только transcript_raw по ID транскрипции (без метаданных и таймкодов).
+
+    Args:
+        transcription_id: ID транскрипции
+
+    Returns:
+        Текст транскрипта или None если не найден
+    """
+    try:
+        async with async_session() as session:
+            result = await session.execute(
+                select(Transcription.transcript_raw).where(Transcription.id == transcription_id)
+            )
+            return result.scalar_one_or_none()
+    except Exception as e:
+        logging.error(f"Error getting transcript text for transcription {transcription_id}: {e}")
+        return None
+
+async def get_transcription_data(session_id: str) -> dict | None:
+    """
+    Получает данные транскрипции по session_id через processing_session.transcription_id.
+    Return:
+        dict with raw_transcript, timecoded_transcript, transcription_id
+    """
+    try:
         async with async_session() as session:
             # Находим processing_session
             ps_result = await session.execute(
@@ -2297,6 +2999,8 @@ async def mark_sessions_interrupted_on_shutdown() -> int:
     Returns:
         Количество обновленных строк.
     """
+    # Промежуточные поля активных задач (transcription_id, размер файла) не должны потеряться
+    await flush_active_session_writers()
     try:
         async with async_session() as session:
             stmt = (
@@ -2422,6 +3126,20 @@ async def startup_handle_interrupted_sessions() -> list[dict]:
         return []
 
 
+# Колонки для проверки кэша: без Text-полей транскрипции, которые для
+# многочасовых записей весят мегабайты и нужны только при реальном использовании кэша
+_TRANSCRIPTION_CACHE_META_COLUMNS = (
+    Transcription.id,
+    Transcription.transcription_provider,
+    Transcription.transcription_model,
+    Transcription.language_detected,
+    Transcription.audio_duration,
+    Transcription.file_size_bytes,
+    Transcription.created_at,
+    Transcription.created_by_session_id,
+)
+
+
 async def find_cached_transcription(
     source_type: str,
     original_identifier: str,
@@ -2430,6 +3148,8 @@ async def find_cached_transcription(
     """
     Ищет закэшированную транскрипцию.
     Сначала по source_key, затем по file_hash (если есть).
+    Возвращает только метаданные: тексты транскрипции подгружаются
+    отдельно через load_cached_transcription_texts, когда кэш действительно используется.
 
     Args:
         source_type: Тип источника ('url' или 'telegram')
@@ -2437,7 +3157,7 @@ async def find_cached_transcription(
         file_hash: SHA256 хэш файла (опционально)
 
     Returns:
-        Словарь с данными транскрипции или None
+        Словарь с метаданными транскрипции (_TRANSCRIPTION_CACHE_META_COLUMNS) или None
     """
     from services.cache_normalization import normalize_source_key
 
@@ -2448,47 +3168,25 @@ async def find_cached_transcription(
 
             # Ищем по source_key
             result = await session.execute(
-                select(Transcription).filter(
+                select(*_TRANSCRIPTION_CACHE_META_COLUMNS).filter(
                     Transcription.source_key == source_key
                 )
             )
-            transcription = result.scalar_one_or_none()
+            transcription = result.mappings().one_or_none()
 
             # Если не нашли по source_key и есть file_hash, ищем по нему
             if not transcription and file_hash:
                 result = await session.execute(
-                    select(Transcription).filter(
+                    select(*_TRANSCRIPTION_CACHE_META_COLUMNS).filter(
                         Transcription.file_hash == file_hash
                     )
                 )
-                transcription = result.scalar_one_or_none()
+                transcription = result.mappings().one_or_none()
 
             if transcription:
-                # Обновляем статистику использования
-                await session.execute(
-                    update(Transcription)
-                    .where(Transcription.id == transcription.id)
-                    .values(
-                        reuse_count=Transcription.reuse_count + 1,
-                        last_reused_at=datetime.utcnow()
-                    )
-                )
-                await session.commit()
+                logging.info(f"Cache HIT for transcription: source_key={source_key}, transcription_id={transcription['id']}")
 
-                logging.info(f"Cache HIT for transcription: source_key={source_key}, transcription_id={transcription.id}")
-
-                return {
-                    'id': transcription.id,
-                    'transcript_raw': transcription.transcript_raw,
-                    'transcript_timecoded': transcription.transcript_timecoded,
-                    'transcription_provider': transcription.transcription_provider,
-                    'transcription_model': transcription.transcription_model,
-                    'language_detected': transcription.language_detected,
-                    'audio_duration': transcription.audio_duration,
-                    'file_size_bytes': transcription.file_size_bytes,
-                    'created_at': transcription.created_at,
-                    'created_by_session_id': transcription.created_by_session_id
-                }
+                return dict(transcription)
 
             logging.info(f"Cache MISS for transcription: source_key={source_key}")
             return None
@@ -2507,7 +3205,7 @@ async def find_cached_transcription_by_file_path(file_path: str) -> dict | None:
         file_path: Путь к локальному файлу
 
     Returns:
-        Словарь с данными транскрипции или None
+        Словарь с метаданными транскрипции (_TRANSCRIPTION_CACHE_META_COLUMNS) или None
     """
     try:
         # Генерируем SHA256 хэш файла асинхронно (минимум ресурсов, без блокировки)
@@ -2518,38 +3216,16 @@ async def find_cached_transcription_by_file_path(file_path: str) -> dict | None:
 
         async with async_session() as session:
             result = await session.execute(
-                select(Transcription).filter(
+                select(*_TRANSCRIPTION_CACHE_META_COLUMNS).filter(
                     Transcription.file_hash == file_hash
                 )
             )
-            transcription = result.scalar_one_or_none()
+            transcription = result.mappings().one_or_none()
 
             if transcription:
-                # Обновляем статистику использования
-                await session.execute(
-                    update(Transcription)
-                    .where(Transcription.id == transcription.id)
-                    .values(
-                        reuse_count=Transcription.reuse_count + 1,
-                        last_reused_at=datetime.utcnow()
-                    )
-                )
-                await session.commit()
-
-                logging.info(f"Cache HIT for transcription by file_hash: transcription_id={transcription.id}")
+                logging.info(f"Cache HIT for transcription by file_hash: transcription_id={transcription['id']}")
 
-                return {
-                    'id': transcription.id,
-                    'transcript_raw': transcription.transcript_raw,
-                    'transcript_timecoded': transcription.transcript_timecoded,
-                    'transcription_provider': transcription.transcription_provider,
-                    'transcription_model': transcription.transcription_model,
-                    'language_detected': transcription.language_detected,
-                    'audio_duration': transcription.audio_duration,
-                    'file_size_bytes': transcription.file_size_bytes,
-                    'created_at': transcription.created_at,
-                    'created_by_session_id': transcription.created_by_session_id
-                }
+                return dict(transcription)
 
             logging.info("Cache MISS for transcription by file_hash")
             return None
@@ -2559,6 +3235,37 @@ async def find_cached_transcription_by_file_path(file_path: str) -> dict | None:
         return None
 
 
+async def load_cached_transcription_texts(transcription_id: int) -> dict | None:
+    """
+    Подгружает тексты закэшированной транскрипции и учитывает переиспользование кэша.
+
+    Args:
+        transcription_id: ID транскрипции из find_cached_transcription
+
+    Returns:
+        {'transcript_raw': ..., 'transcript_timecoded': ...} или None, если запись пропала
+    """
+    try:
+        async with async_session() as session:
+            result = await session.execute(
+                select(Transcription.transcript_raw, Transcription.transcript_timecoded)
+                .where(Transcription.id == transcription_id)
+            )
+            texts = result.mappings().one_or_none()
+
+        if not texts:
+            logging.warning(f"Cached transcription {transcription_id} disappeared before its texts were loaded")
+            return None
+
+        # Статистика использования пишется фоном, вне критического пути
+        await record_cache_reuse_async('transcription', transcription_id)
+        return dict(texts)
+
+    except Exception as e:
+        logging.error(f"Error loading cached transcription texts {transcription_id}: {e}")
+        return None
+
+
 async def find_cached_summary(
     transcription_id: int,
     language_code: str,
@@ -2594,16 +3301,8 @@ async def find_cached_summary(
             summary = result.scalar_one_or_none()
 
             if summary:
-                # Обновляем статистику использования
-                await session.execute(
-                    update(Summary)
-                    .where(Summary.id == summary.id)
-                    .values(
-                        reuse_count=Summary.reuse_count + 1,
-                        last_reused_at=datetime.utcnow()
-                    )
-                )
-                await session.commit()
+                # Статистика использования пишется фоном, вне критического пути
+                await record_cache_reuse_async('summary', summary.id)
 
                 logging.info(f"Cache HIT for summary: transcription_id={transcription_id}, summary_id={summary.id}")
 
@@ -2657,60 +3356,41 @@ async def save_transcription_cache(
         ID созданной записи транскрипции
     """
     from services.cache_normalization import normalize_source_key
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
 
     try:
         source_key = normalize_source_key(source_type, original_identifier)
+        values = dict(
+            source_type=source_type,
+            original_identifier=original_identifier,
+            specific_source=specific_source,
+            file_hash=file_hash,
+            file_size_bytes=file_size_bytes,
+            audio_duration=audio_duration,
+            transcript_raw=transcript_raw,
+            transcript_timecoded=transcript_timecoded,
+            transcription_provider=transcription_provider,
+            transcription_model=transcription_model,
+            language_detected=language_detected,
+            created_by_session_id=session_id,
+            created_at=datetime.utcnow(),
+            reuse_count=0,
+            last_reused_at=None
+        )
+        # Один INSERT ... ON CONFLICT (source_key) DO UPDATE: параллельные сохранения одной ссылки
+        # не падают на уникальном ключе, а перезаписывают запись с сохранением id
+        stmt = pg_insert(Transcription).values(source_key=source_key, **values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Transcription.source_key],
+            set_={key: stmt.excluded[key] for key in values}
+        ).returning(Transcription.id)
 
         async with async_session() as session:
-            # Try find existing by source_key
-            result = await session.execute(
-                select(Transcription).filter(Transcription.source_key == source_key)
-            )
-            existing: Transcription | None = result.scalar_one_or_none()
-
-            if existing:
-                # Overwrite fields and keep the same id. Reset provider/model/text per new result
-                existing.source_type = source_type
-                existing.original_identifier = original_identifier
-                existing.specific_source = specific_source
-                existing.file_hash = file_hash
-                existing.file_size_bytes = file_size_bytes
-                existing.audio_duration = audio_duration
-                existing.transcript_raw = transcript_raw
-                existing.transcript_timecoded = transcript_timecoded
-                existing.transcription_provider = transcription_provider
-                existing.transcription_model = transcription_model
-                existing.language_detected = language_detected
-                existing.created_by_session_id = session_id
-                existing.created_at = datetime.utcnow()
-                existing.reuse_count = 0
-                existing.last_reused_at = None
-
-                await session.commit()
-                logging.info(f"Updated transcription cache by source_key: transcription_id={existing.id}, source_key={source_key}")
-                return existing.id
-            else:
-                transcription = Transcription(
-                    source_type=source_type,
-                    original_identifier=original_identifier,
-                    source_key=source_key,
-                    specific_source=specific_source,
-                    file_hash=file_hash,
-                    file_size_bytes=file_size_bytes,
-                    audio_duration=audio_duration,
-                    transcript_raw=transcript_raw,
-                    transcript_timecoded=transcript_timecoded,
-                    transcription_provider=transcription_provider,
-                    transcription_model=transcription_model,
-                    language_detected=language_detected,
-                    created_by_session_id=session_id
-                )
-                session.add(transcription)
-                await session.commit()
-                await session.refresh(transcription)
+            transcription_id = (await session.execute(stmt)).scalar_one()
+            await session.commit()
 
-                logging.info(f"Saved transcription to cache: transcription_id={transcription.id}, source_key={source_key}")
-                return transcription.id
+        logging.info(f"Saved transcription to cache: transcription_id={transcription_id}, source_key={source_key}")
+        return transcription_id
 
     except Exception as e:
         logging.error(f"Error saving transcription cache: {e}")
@@ -2746,52 +3426,39 @@ async def save_summary_cache(
         ID созданной записи саммари
     """
     from services.cache_normalization import generate_prompt_hash
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
 
     try:
         prompt_hash = generate_prompt_hash(system_prompt)
+        values = dict(
+            llm_provider=llm_provider,
+            summary_text=summary_text,
+            generated_title=generated_title,
+            llm_request_id=llm_request_id,
+            created_by_session_id=session_id,
+            created_at=datetime.utcnow(),
+            reuse_count=0,
+            last_reused_at=None
+        )
+        # Ключ кэша саммари закреплён уникальным индексом uq_summaries_cache_key (миграция 0003)
+        stmt = pg_insert(Summary).values(
+            transcription_id=transcription_id,
+            language_code=language_code,
+            llm_model=llm_model,
+            system_prompt_hash=prompt_hash,
+            **values
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Summary.transcription_id, Summary.language_code, Summary.llm_model, Summary.system_prompt_hash],
+            set_={key: stmt.excluded[key] for key in values}
+        ).returning(Summary.id)
 
         async with async_session() as session:
-            # Try find existing summary for this combination
-            result = await session.execute(
-                select(Summary).filter(
-                    Summary.transcription_id == transcription_id,
-                    Summary.language_code == language_code,
-                    Summary.llm_model == llm_model,
-                    Summary.system_prompt_hash == prompt_hash
-                )
-            )
-            existing: Summary | None = result.scalar_one_or_none()
-
-            if existing:
-                existing.llm_provider = llm_provider
-                existing.summary_text = summary_text
-                existing.generated_title = generated_title
-                existing.llm_request_id = llm_request_id
-                existing.created_by_session_id = session_id
-                existing.created_at = datetime.utcnow()
-                existing.reuse_count = 0
-                existing.last_reused_at = None
-                await session.commit()
-                logging.info(f"Updated summary cache: summary_id={existing.id}, transcription_id={transcription_id}")
-                return existing.id
-            else:
-                summary = Summary(
-                    transcription_id=transcription_id,
-                    language_code=language_code,
-                    llm_provider=llm_provider,
-                    llm_model=llm_model,
-                    system_prompt_hash=prompt_hash,
-                    summary_text=summary_text,
-                    generated_title=generated_title,
-                    llm_request_id=llm_request_id,
-                    created_by_session_id=session_id
-                )
-                session.add(summary)
-                await session.commit()
-                await session.refresh(summary)
+            summary_id = (await session.execute(stmt)).scalar_one()
+            await session.commit()
 
-                logging.info(f"Saved summary to cache: summary_id={summary.id}, transcription_id={transcription_id}")
-                return summary.id
+        logging.info(f"Saved summary to cache: summary_id={summary_id}, transcription_id={transcription_id}")
+        return summary_id
 
     except Exception as e:
         logging.error(f"Error saving summary cache: {e}")
@@ -2802,8 +3469,81 @@ async def save_summary_cache(
 # ==================== PAYMENT REMINDERS ====================
 # Функции для системы напоминаний о незавершенных платежах
 
+def _first_reminder_query(
+    reference_time: datetime | None = None,
+    reminder_hours: int = 2,
+    search_window_hours: int = 1
+):
+    """Запрос get_users_for_first_reminder без LIMIT: (query, time_window_start, time_window_end)"""
+    from sqlalchemy import func, exists
+
+    # Динамическое временное окно: от reminder_hours до (reminder_hours + search_window_hours) назад
+    # Например, для reminder_hours=2 и search_window_hours=1: от 3 до 2 часов назад
+    now = reference_time or datetime.utcnow()
+    time_window_start = now - timedelta(hours=reminder_hours + search_window_hours)
+    time_window_end = now - timedelta(hours=reminder_hours)
+
+    if reference_time:
+        logging.debug(f"get_users_for_first_reminder: using reference_time={reference_time}")
+
+    # Подзапрос для нахождения первого действия конверсии для каждого пользователя
+    # в заданном временном окне (ЛЮБОЙ тип, но категория 'conversion')
+    first_action_subq = (
+        select(
+            UserAction.user_id,
+            func.min(UserAction.created_at).label('first_created_at')
+        )
+        .where(
+            UserAction.action_category == 'conversion',  # Любое действие конверсии!
+            UserAction.created_at >= time_window_start,
+            UserAction.created_at <= time_window_end
+        )
+        .group_by(UserAction.user_id)
+        .subquery()
+    )
+
+    # Основной запрос
+    query = (
+        select(
+            User.id.label('user_id'),
+            User.telegram_id,
+            User.user_language,
+            first_action_subq.c.first_created_at
+        )
+        .select_from(User)
+        .join(first_action_subq, User.id == first_action_subq.c.user_id)
+        .where(
+            # У пользователя нет активной подписки
+            User.subscription != 'True',
+            # Первое напоминание еще не отправляли (успешно или с ошибкой)
+            ~exists(
+                select(1)
+                .where(
+                    UserAction.user_id == User.id,
+                    UserAction.action_type.in_([
+                        'conversion_reminder_first_sent',
+                        'conversion_reminder_first_failed'
+                    ])
+                )
+            ),
+            # У пользователя НЕТ успешных транзакций (никогда не оплачивал)
+            ~exists(
+                select(1)
+                .where(
+                    Payment.user_id == User.id,
+                    Payment.status.in_(["completed", "success"])
+                )
+            )
+        )
+    )
+
+    return query, time_window_start, time_window_end
+
+
+@on_replica
 async def get_users_for_first_reminder(
     batch_size: int = 100,
+    after_id: int = 0,
     reminder_hours: int = 2,
     search_window_hours: int = 1,
     reference_time: datetime | None = None
@@ -2825,6 +3565,7 @@ async def get_users_for_first_reminder(
 
     Args:
         batch_size: Максимальное количество пользователей для обработки за раз
+        after_id: Keyset-пагинация внутри прогона: только пользователи с id > after_id, по возрастанию id
         reminder_hours: Через сколько часов после первого действия отправлять напоминание (по умолчанию 2)
         search_window_hours: Ширина временного окна для поиска в часах (по умолчанию 1)
         reference_time: Точка отсчета времени. Если None, используется datetime.utcnow()
@@ -2840,67 +3581,9 @@ async def get_users_for_first_reminder(
         from sqlalchemy import func, exists, and_, text
         from datetime import datetime, timedelta
 
-        async with async_session() as session:
-            # Динамическое временное окно: от reminder_hours до (reminder_hours + search_window_hours) назад
-            # Например, для reminder_hours=2 и search_window_hours=1: от 3 до 2 часов назад
-            now = reference_time or datetime.utcnow()
-            time_window_start = now - timedelta(hours=reminder_hours + search_window_hours)
-            time_window_end = now - timedelta(hours=reminder_hours)
-
-            if reference_time:
-                logging.debug(f"get_users_for_first_reminder: using reference_time={reference_time}")
-
-            # Подзапрос для нахождения первого действия конверсии для каждого пользователя
-            # в заданном временном окне (ЛЮБОЙ тип, но категория 'conversion')
-            first_action_subq = (
-                select(
-                    UserAction.user_id,
-                    func.min(UserAction.created_at).label('first_created_at')
-                )
-                .where(
-                    UserAction.action_category == 'conversion',  # Любое действие конверсии!
-                    UserAction.created_at >= time_window_start,
-                    UserAction.created_at <= time_window_end
-                )
-                .group_by(UserAction.user_id)
-                .subquery()
-            )
-
-            # Основной запрос
-            query = (
-                select(
-                    User.id.label('user_id'),
-                    User.telegram_id,
-                    User.user_language,
-                    first_action_subq.c.first_created_at
-                )
-                .select_from(User)
-                .join(first_action_subq, User.id == first_action_subq.c.user_id)
-                .where(
-                    # У пользователя нет активной подписки
-                    User.subscription != 'True',
-                    # Первое напоминание еще не отправляли (успешно или с ошибкой)
-                    ~exists(
-                        select(1)
-                        .where(
-                            UserAction.user_id == User.id,
-                            UserAction.action_type.in_([
-                                'conversion_reminder_first_sent',
-                                'conversion_reminder_first_failed'
-                            ])
-                        )
-                    ),
-                    # У пользователя НЕТ успешных транзакций (никогда не оплачивал)
-                    ~exists(
-                        select(1)
-                        .where(
-                            Payment.user_id == User.id,
-                            Payment.status.in_(["completed", "success"])
-                        )
-                    )
-                )
-                .limit(batch_size)
-            )
+        async with read_session() as session:
+            query, time_window_start, time_window_end = _first_reminder_query(reference_time, reminder_hours, search_window_hours)
+            query = query.where(User.id > after_id).order_by(User.id).limit(batch_size)
 
             result = await session.execute(query)
             users = result.mappings().all()
@@ -2917,8 +3600,140 @@ async def get_users_for_first_reminder(
         return []
 
 
+def _second_reminder_query(
+    reference_time: datetime | None = None,
+    reminder_hours: int = 24,
+    search_window_hours: int = 1
+):
+    """Запрос get_users_for_second_reminder без LIMIT: (query, time_window_start, time_window_end)"""
+    from sqlalchemy import func, exists
+
+    # Динамическое временное окно
+    now = reference_time or datetime.utcnow()
+    time_window_start = now - timedelta(hours=reminder_hours + search_window_hours + 5)
+    time_window_end = now - timedelta(hours=reminder_hours)
+
+    if reference_time:
+        logging.debug(f"get_users_for_second_reminder: using reference_time={reference_time}")
+
+    # Подзапрос 1: Последнее действие конверсии
+    last_conversion_subq = (
+        select(
+            UserAction.user_id,
+            func.max(UserAction.created_at).label('last_conversion_at')
+        )
+        .where(UserAction.action_category == 'conversion')
+        .group_by(UserAction.user_id)
+        .subquery()
+    )
+
+    # Подзапрос 2: Последняя обработанная сессия
+    last_session_subq = (
+        select(
+            ProcessingSession.user_id,
+            func.max(ProcessingSession.completed_at).label('last_session_at')
+        )
+        .where(ProcessingSession.final_status == 'success')
+        .group_by(ProcessingSession.user_id)
+        .subquery()
+    )
+
+    # Подзапрос 3: Время первого действия конверсии (для метаданных)
+    first_conversion_subq = (
+        select(
+            UserAction.user_id,
+            func.min(UserAction.created_at).label('first_created_at')
+        )
+        .where(UserAction.action_category == 'conversion')
+        .group_by(UserAction.user_id)
+        .subquery()
+    )
+
+    # Подзапрос 4: Объединяем все даты и находим максимальную (последнее действие)
+    last_activity_subq = (
+        select(
+            User.id.label('user_id'),
+            func.greatest(
+                func.coalesce(last_conversion_subq.c.last_conversion_at, datetime(1970, 1, 1)),
+                func.coalesce(last_session_subq.c.last_session_at, datetime(1970, 1, 1))
+            ).label('last_activity_at')
+        )
+        .select_from(User)
+        .outerjoin(last_conversion_subq, User.id == last_conversion_subq.c.user_id)
+        .outerjoin(last_session_subq, User.id == last_session_subq.c.user_id)
+        .subquery()
+    )
+
+    # Подзапрос 5: Последний выбранный метод оплаты
+    # Используем DISTINCT ON для получения последней записи для каждого пользователя
+    last_payment_method_subq = (
+        select(
+            UserAction.user_id,
+            UserAction.meta['payment_method'].astext.label('last_payment_method')
+        )
+        .where(UserAction.action_type == 'conversion_payment_method_selected')
+        .order_by(UserAction.user_id, UserAction.created_at.desc())
+        .distinct(UserAction.user_id)
+        .subquery()
+    )
+
+    # Основной запрос
+    query = (
+        select(
+            User.id.label('user_id'),
+            User.telegram_id,
+            User.user_language,
+            first_conversion_subq.c.first_created_at,
+            last_activity_subq.c.last_activity_at,
+            last_payment_method_subq.c.last_payment_method
+        )
+        .select_from(User)
+        .join(first_conversion_subq, User.id == first_conversion_subq.c.user_id)
+        .join(last_activity_subq, User.id == last_activity_subq.c.user_id)
+        .outerjoin(last_payment_method_subq, User.id == last_payment_method_subq.c.user_id)
+        .where(
+            # У пользователя нет активной подписки
+            User.subscription != 'True',
+            # Последнее действие было в нужном временном окне
+            last_activity_subq.c.last_activity_at >= time_window_start,
+            last_activity_subq.c.last_activity_at <= time_window_end,
+            # Первое напоминание уже было отправлено
+            exists(
+                select(1)
+                .where(
+                    UserAction.user_id == User.id,
+                    UserAction.action_type == 'conversion_reminder_first_sent'
+                )
+            ),
+            # Второе напоминание еще не отправляли (успешно или с ошибкой)
+            ~exists(
+                select(1)
+                .where(
+                    UserAction.user_id == User.id,
+                    UserAction.action_type.in_([
+                        'conversion_reminder_second_sent',
+                        'conversion_reminder_second_failed'
+                    ])
+                )
+            ),
+            # У пользователя НЕТ успешных транзакций (никогда не оплачивал)
+            ~exists(
+                select(1)
+                .where(
+                    Payment.user_id == User.id,
+                    Payment.status.in_(["completed", "success"])
+                )
+            )
+        )
+    )
+
+    return query, time_window_start, time_window_end
+
+
+@on_replica
 async def get_users_for_second_reminder(
     batch_size: int = 100,
+    after_id: int = 0,
     reminder_hours: int = 24,
     search_window_hours: int = 1,
     reference_time: datetime | None = None
@@ -2945,6 +3760,7 @@ async def get_users_for_second_reminder(
 
     Args:
         batch_size: Максимальное количество пользователей для обработки за раз
+        after_id: Keyset-пагинация внутри прогона: только пользователи с id > after_id, по возрастанию id
         reminder_hours: Через сколько часов после последнего действия отправлять напоминание (по умолчанию 24)
         search_window_hours: Ширина временного окна для поиска в часах (по умолчанию 1)
         reference_time: Точка отсчета времени. Если None, используется datetime.utcnow()
@@ -2961,126 +3777,9 @@ async def get_users_for_second_reminder(
         from sqlalchemy import func, exists, and_, text, case
         from datetime import datetime, timedelta
 
-        async with async_session() as session:
-            # Динамическое временное окно
-            now = reference_time or datetime.utcnow()
-            time_window_start = now - timedelta(hours=reminder_hours + search_window_hours + 5)
-            time_window_end = now - timedelta(hours=reminder_hours)
-
-            if reference_time:
-                logging.debug(f"get_users_for_second_reminder: using reference_time={reference_time}")
-
-            # Подзапрос 1: Последнее действие конверсии
-            last_conversion_subq = (
-                select(
-                    UserAction.user_id,
-                    func.max(UserAction.created_at).label('last_conversion_at')
-                )
-                .where(UserAction.action_category == 'conversion')
-                .group_by(UserAction.user_id)
-                .subquery()
-            )
-
-            # Подзапрос 2: Последняя обработанная сессия
-            last_session_subq = (
-                select(
-                    ProcessingSession.user_id,
-                    func.max(ProcessingSession.completed_at).label('last_session_at')
-                )
-                .where(ProcessingSession.final_status == 'success')
-                .group_by(ProcessingSession.user_id)
-                .subquery()
-            )
-
-            # Подзапрос 3: Время первого действия конверсии (для метаданных)
-            first_conversion_subq = (
-                select(
-                    UserAction.user_id,
-                    func.min(UserAction.created_at).label('first_created_at')
-                )
-                .where(UserAction.action_category == 'conversion')
-                .group_by(UserAction.user_id)
-                .subquery()
-            )
-
-            # Подзапрос 4: Объединяем все даты и находим максимальную (последнее действие)
-            last_activity_subq = (
-                select(
-                    User.id.label('user_id'),
-                    func.greatest(
-                        func.coalesce(last_conversion_subq.c.last_conversion_at, datetime(1970, 1, 1)),
-                        func.coalesce(last_session_subq.c.last_session_at, datetime(1970, 1, 1))
-                    ).label('last_activity_at')
-                )
-                .select_from(User)
-                .outerjoin(last_conversion_subq, User.id == last_conversion_subq.c.user_id)
-                .outerjoin(last_session_subq, User.id == last_session_subq.c.user_id)
-                .subquery()
-            )
-
-            # Подзапрос 5: Последний выбранный метод оплаты
-            # Используем DISTINCT ON для получения последней записи для каждого пользователя
-            last_payment_method_subq = (
-                select(
-                    UserAction.user_id,
-                    UserAction.meta['payment_method'].astext.label('last_payment_method')
-                )
-                .where(UserAction.action_type == 'conversion_payment_method_selected')
-                .order_by(UserAction.user_id, UserAction.created_at.desc())
-                .distinct(UserAction.user_id)
-                .subquery()
-            )
-
-            # Основной запрос
-            query = (
-                select(
-                    User.id.label('user_id'),
-                    User.telegram_id,
-                    User.user_language,
-                    first_conversion_subq.c.first_created_at,
-                    last_activity_subq.c.last_activity_at,
-                    last_payment_method_subq.c.last_payment_method
-                )
-                .select_from(User)
-                .join(first_conversion_subq, User.id == first_conversion_subq.c.user_id)
-                .join(last_activity_subq, User.id == last_activity_subq.c.user_id)
-                .outerjoin(last_payment_method_subq, User.id == last_payment_method_subq.c.user_id)
-                .where(
-                    # У пользователя нет активной подписки
-                    User.subscription != 'True',
-                    # Последнее действие было в нужном временном окне
-                    last_activity_subq.c.last_activity_at >= time_window_start,
-                    last_activity_subq.c.last_activity_at <= time_window_end,
-                    # Первое напоминание уже было отправлено
-                    exists(
-                        select(1)
-                        .where(
-                            UserAction.user_id == User.id,
-                            UserAction.action_type == 'conversion_reminder_first_sent'
-                        )
-                    ),
-                    # Второе напоминание еще не отправляли (успешно или с ошибкой)
-                    ~exists(
-                        select(1)
-                        .where(
-                            UserAction.user_id == User.id,
-                            UserAction.action_type.in_([
-                                'conversion_reminder_second_sent',
-                                'conversion_reminder_second_failed'
-                            ])
-                        )
-                    ),
-                    # У пользователя НЕТ успешных транзакций (никогда не оплачивал)
-                    ~exists(
-                        select(1)
-                        .where(
-                            Payment.user_id == User.id,
-                            Payment.status.in_(["completed", "success"])
-                        )
-                    )
-                )
-                .limit(batch_size)
-            )
+        async with read_session() as session:
+            query, time_window_start, time_window_end = _second_reminder_query(reference_time, reminder_hours, search_window_hours)
+            query = query.where(User.id > after_id).order_by(User.id).limit(batch_size)
 
             result = await session.execute(query)
             users = result.mappings().all()
@@ -3123,9 +3822,62 @@ async def main():
 
 # ==================== ONBOARDING REMINDERS ====================
 
+def _onboarding_day1_query(
+    reference_time: datetime | None = None
+):
+    """Запрос get_users_for_onboarding_day1 без LIMIT"""
+    from sqlalchemy import exists
+
+    # Окно поиска: весь предыдущий день (вчера)
+    now = reference_time or datetime.utcnow()
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    yesterday_start = today_start - timedelta(days=1)
+    # Конец окна - начало сегодняшнего дня (не включительно)
+    
+    if reference_time:
+        logging.debug(f"get_users_for_onboarding_day1: using reference_time={reference_time}")
+
+    query = (
+        select(User)
+        .where(
+            User.created_at >= yesterday_start,
+            User.created_at < today_start,
+            User.audio_uses == 0,
+            User.gpt_uses == 0,
+            # Фильтр заблокированных пользователей
+            User.is_bot_blocked == False,
+            # У пользователя нет активной подписки
+            User.subscription != 'True',
+            # Еще не отправляли (успешно или с ошибкой)
+            ~exists(
+                select(1)
+                .where(
+                    UserAction.user_id == User.id,
+                    UserAction.action_type.in_([
+                        'onboarding_reminder_day1_sent',
+                        'onboarding_reminder_day1_failed'
+                    ])
+                )
+            ),
+            # У пользователя НЕТ успешных транзакций (никогда не оплачивал)
+            ~exists(
+                select(1)
+                .where(
+                    Payment.user_id == User.id,
+                    Payment.status.in_(["completed", "success"])
+                )
+            )
+        )
+    )
+
+    return query
+
+
+@on_replica
 async def get_users_for_onboarding_day1(
     batch_size: int = 100,
-    reference_time: datetime | None = None
+    reference_time: datetime | None = None,
+    after_id: int = 0
 ) -> list[dict]:
     """
     Находит пользователей для первого онбординг-напоминания (Day 1).
@@ -3137,6 +3889,7 @@ async def get_users_for_onboarding_day1(
 
     Args:
         batch_size: Максимальное количество пользователей для обработки
+        after_id: Keyset-пагинация внутри прогона: только пользователи с id > after_id, по возрастанию id
         reference_time: Точка отсчета времени. Если None, используется datetime.utcnow()
                        Полезно для предсказания будущих напоминаний
     """
@@ -3144,49 +3897,8 @@ async def get_users_for_onboarding_day1(
         from sqlalchemy import exists
         from datetime import datetime, timedelta
         
-        async with async_session() as session:
-            # Окно поиска: весь предыдущий день (вчера)
-            now = reference_time or datetime.utcnow()
-            today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            yesterday_start = today_start - timedelta(days=1)
-            # Конец окна - начало сегодняшнего дня (не включительно)
-            
-            if reference_time:
-                logging.debug(f"get_users_for_onboarding_day1: using reference_time={reference_time}")
-
-            query = (
-                select(User)
-                .where(
-                    User.created_at >= yesterday_start,
-                    User.created_at < today_start,
-                    User.audio_uses == 0,
-                    User.gpt_uses == 0,
-                    # Фильтр заблокированных пользователей
-                    User.is_bot_blocked == False,
-                    # У пользователя нет активной подписки
-                    User.subscription != 'True',
-                    # Еще не отправляли (успешно или с ошибкой)
-                    ~exists(
-                        select(1)
-                        .where(
-                            UserAction.user_id == User.id,
-                            UserAction.action_type.in_([
-                                'onboarding_reminder_day1_sent',
-                                'onboarding_reminder_day1_failed'
-                            ])
-                        )
-                    ),
-                    # У пользователя НЕТ успешных транзакций (никогда не оплачивал)
-                    ~exists(
-                        select(1)
-                        .where(
-                            Payment.user_id == User.id,
-                            Payment.status.in_(["completed", "success"])
-                        )
-                    )
-                )
-                .limit(batch_size)
-            )
+        async with read_session() as session:
+            query = _onboarding_day1_query(reference_time).where(User.id > after_id).order_by(User.id).limit(batch_size)
             
             result = await session.execute(query)
             users = result.scalars().all()
@@ -3196,9 +3908,82 @@ async def get_users_for_onboarding_day1(
         logging.error(f"Error getting users for onboarding day 1: {e}", exc_info=True)
         return []
 
+def _onboarding_day3_query(
+    reference_time: datetime | None = None
+):
+    """Запрос get_users_for_onboarding_day3 без LIMIT"""
+    from sqlalchemy import exists, func
+
+    # Окно поиска: 2 дня назад
+    now = reference_time or datetime.utcnow()
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    target_day_start = today_start - timedelta(days=2)
+    target_day_end = today_start - timedelta(days=1)
+    
+    if reference_time:
+        logging.debug(f"get_users_for_onboarding_day3: using reference_time={reference_time}")
+
+    # Отсечка по регистрации: фиксированная дата (12 ноября 2025)
+    # Мы не трогаем пользователей, зарегистрировавшихся до этой даты
+    registration_cutoff = datetime(2025, 11, 12, 0, 0, 0)
+
+    # Подзапрос: когда было отправлено первое напоминание
+    first_reminder_subq = (
+        select(
+            UserAction.user_id,
+            func.max(UserAction.created_at).label('sent_at')
+        )
+        .where(UserAction.action_type == 'onboarding_reminder_day1_sent')
+        .group_by(UserAction.user_id)
+        .subquery()
+    )
+    
+    query = (
+        select(User)
+        .join(first_reminder_subq, User.id == first_reminder_subq.c.user_id)
+        .where(
+            # Регистрация не старее 12 ноября 2025.
+            User.created_at > registration_cutoff,
+            # Прошло 2 дня (календарных) с первого напоминания
+            first_reminder_subq.c.sent_at >= target_day_start,
+            first_reminder_subq.c.sent_at < target_day_end,
+            # Пользователь все еще не активен
+            User.audio_uses == 0,
+            User.gpt_uses == 0,
+            # Фильтр заблокированных пользователей
+            User.is_bot_blocked == False,
+            # У пользователя нет активной подписки
+            User.subscription != 'True',
+            # Еще не отправляли второе (успешно или с ошибкой)
+            ~exists(
+                select(1)
+                .where(
+                    UserAction.user_id == User.id,
+                    UserAction.action_type.in_([
+                        'onboarding_reminder_day3_sent',
+                        'onboarding_reminder_day3_failed'
+                    ])
+                )
+            ),
+            # У пользователя НЕТ успешных транзакций (никогда не оплачивал)
+            ~exists(
+                select(1)
+                .where(
+                    Payment.user_id == User.id,
+                    Payment.status.in_(["completed", "success"])
+                )
+            )
+        )
+    )
+
+    return query
+
+
+@on_replica
 async def get_users_for_onboarding_day3(
     batch_size: int = 100,
-    reference_time: datetime | None = None
+    reference_time: datetime | None = None,
+    after_id: int = 0
 ) -> list[dict]:
     """
     Находит пользователей для второго онбординг-напоминания (Day 3).
@@ -3212,75 +3997,15 @@ async def get_users_for_onboarding_day3(
 
     Args:
         batch_size: Максимальное количество пользователей для обработки
+        after_id: Keyset-пагинация внутри прогона: только пользователи с id > after_id, по возрастанию id
         reference_time: Точка отсчета времени. Если None, используется datetime.utcnow()
     """
     try:
         from sqlalchemy import exists, func
         from datetime import datetime, timedelta
         
-        async with async_session() as session:
-            # Окно поиска: 2 дня назад
-            now = reference_time or datetime.utcnow()
-            today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            target_day_start = today_start - timedelta(days=2)
-            target_day_end = today_start - timedelta(days=1)
-            
-            if reference_time:
-                logging.debug(f"get_users_for_onboarding_day3: using reference_time={reference_time}")
-
-            # Отсечка по регистрации: фиксированная дата (12 ноября 2025)
-            # Мы не трогаем пользователей, зарегистрировавшихся до этой даты
-            registration_cutoff = datetime(2025, 11, 12, 0, 0, 0)
-
-            # Подзапрос: когда было отправлено первое напоминание
-            first_reminder_subq = (
-                select(
-                    UserAction.user_id,
-                    func.max(UserAction.created_at).label('sent_at')
-                )
-                .where(UserAction.action_type == 'onboarding_reminder_day1_sent')
-                .group_by(UserAction.user_id)
-                .subquery()
-            )
-            
-            query = (
-                select(User)
-                .join(first_reminder_subq, User.id == first_reminder_subq.c.user_id)
-                .where(
-                    # Регистрация не старее 12 ноября 2025.
-                    User.created_at > registration_cutoff,
-                    # Прошло 2 дня (календарных) с первого напоминания
-                    first_reminder_subq.c.sent_at >= target_day_start,
-                    first_reminder_subq.c.sent_at < target_day_end,
-                    # Пользователь все еще не активен
-                    User.audio_uses == 0,
-                    User.gpt_uses == 0,
-                    # Фильтр заблокированных пользователей
-                    User.is_bot_blocked == False,
-                    # У пользователя нет активной подписки
-                    User.subscription != 'True',
-                    # Еще не отправляли второе (успешно или с ошибкой)
-                    ~exists(
-                        select(1)
-                        .where(
-                            UserAction.user_id == User.id,
-                            UserAction.action_type.in_([
-                                'onboarding_reminder_day3_sent',
-                                'onboarding_reminder_day3_failed'
-                            ])
-                        )
-                    ),
-                    # У пользователя НЕТ успешных транзакций (никогда не оплачивал)
-                    ~exists(
-                        select(1)
-                        .where(
-                            Payment.user_id == User.id,
-                            Payment.status.in_(["completed", "success"])
-                        )
-                    )
-                )
-                .limit(batch_size)
-            )
+        async with read_session() as session:
+            query = _onboarding_day3_query(reference_time).where(User.id > after_id).order_by(User.id).limit(batch_size)
             
             result = await session.execute(query)
             users = result.scalars().all()
@@ -3290,9 +4015,83 @@ async def get_users_for_onboarding_day3(
         logging.error(f"Error getting users for onboarding day 3: {e}", exc_info=True)
         return []
 
+def _first_upload_reminder_query(
+    reference_time: datetime | None = None
+):
+    """Запрос get_users_for_first_upload_reminder без LIMIT"""
+    from sqlalchemy import exists, func
+
+    # Окно поиска: 2 дня назад
+    now = reference_time or datetime.utcnow()
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    target_day_start = today_start - timedelta(days=2)
+    target_day_end = today_start - timedelta(days=1)
+    
+    if reference_time:
+        logging.debug(f"get_users_for_first_upload_reminder: using reference_time={reference_time}")
+
+    # Отсечка по регистрации: фиксированная дата (12 ноября 2025)
+    # Мы не трогаем пользователей, зарегистрировавшихся до этой даты
+    registration_cutoff = datetime(2025, 11, 12, 0, 0, 0)
+
+    # Подзапрос: когда была первая успешная сессия
+    # Используем ProcessingSession так как она точнее отражает "загрузку"
+    first_upload_subq = (
+        select(
+            ProcessingSession.user_id,
+            func.min(ProcessingSession.completed_at).label('first_upload_at')
+        )
+        .where(ProcessingSession.final_status == 'success')
+        .group_by(ProcessingSession.user_id)
+        .subquery()
+    )
+    
+    query = (
+        select(User)
+        .join(first_upload_subq, User.id == first_upload_subq.c.user_id)
+        .where(
+            # Регистрация не старее 2 недель
+            User.created_at > registration_cutoff,
+            # Прошло 48+ часов с первой загрузки
+            first_upload_subq.c.first_upload_at >= target_day_start,
+            first_upload_subq.c.first_upload_at <= target_day_end,
+            # У пользователя ровно 1 использование (или хотя бы 1, но мы хотим таргетировать новичков)
+            # Промпт: "Если пользователь загрузил 1 файл"
+            User.audio_uses == 1,
+            # Фильтр заблокированных пользователей
+            User.is_bot_blocked == False,
+            # У пользователя нет активной подписки
+            User.subscription != 'True',
+            # Еще не отправляли (успешно или с ошибкой)
+            ~exists(
+                select(1)
+                .where(
+                    UserAction.user_id == User.id,
+                    UserAction.action_type.in_([
+                        'onboarding_reminder_first_upload_sent',
+                        'onboarding_reminder_first_upload_failed'
+                    ])
+                )
+            ),
+            # У пользователя НЕТ успешных транзакций (никогда не оплачивал)
+            ~exists(
+                select(1)
+                .where(
+                    Payment.user_id == User.id,
+                    Payment.status.in_(["completed", "success"])
+                )
+            )
+        )
+    )
+
+    return query
+
+
+@on_replica
 async def get_users_for_first_upload_reminder(
     batch_size: int = 100,
-    reference_time: datetime | None = None
+    reference_time: datetime | None = None,
+    after_id: int = 0
 ) -> list[dict]:
     """
     Находит пользователей для напоминания после первой загрузки.
@@ -3305,76 +4104,15 @@ async def get_users_for_first_upload_reminder(
 
     Args:
         batch_size: Максимальное количество пользователей для обработки
+        after_id: Keyset-пагинация внутри прогона: только пользователи с id > after_id, по возрастанию id
         reference_time: Точка отсчета времени. Если None, используется datetime.utcnow()
     """
     try:
         from sqlalchemy import exists, func
         from datetime import datetime, timedelta
         
-        async with async_session() as session:
-            # Окно поиска: 2 дня назад
-            now = reference_time or datetime.utcnow()
-            today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-            target_day_start = today_start - timedelta(days=2)
-            target_day_end = today_start - timedelta(days=1)
-            
-            if reference_time:
-                logging.debug(f"get_users_for_first_upload_reminder: using reference_time={reference_time}")
-
-            # Отсечка по регистрации: фиксированная дата (12 ноября 2025)
-            # Мы не трогаем пользователей, зарегистрировавшихся до этой даты
-            registration_cutoff = datetime(2025, 11, 12, 0, 0, 0)
-
-            # Подзапрос: когда была первая успешная сессия
-            # Используем ProcessingSession так как она точнее отражает "загрузку"
-            first_upload_subq = (
-                select(
-                    ProcessingSession.user_id,
-                    func.min(ProcessingSession.completed_at).label('first_upload_at')
-                )
-                .where(ProcessingSession.final_status == 'success')
-                .group_by(ProcessingSession.user_id)
-                .subquery()
-            )
-            
-            query = (
-                select(User)
-                .join(first_upload_subq, User.id == first_upload_subq.c.user_id)
-                .where(
-                    # Регистрация не старее 2 недель
-                    User.created_at > registration_cutoff,
-                    # Прошло 48+ часов с первой загрузки
-                    first_upload_subq.c.first_upload_at >= target_day_start,
-                    first_upload_subq.c.first_upload_at <= target_day_end,
-                    # У пользователя ровно 1 использование (или хотя бы 1, но мы хотим таргетировать новичков)
-                    # Промпт: "Если пользователь загрузил 1 файл"
-                    User.audio_uses == 1,
-                    # Фильтр заблокированных пользователей
-                    User.is_bot_blocked == False,
-                    # У пользователя нет активной подписки
-                    User.subscription != 'True',
-                    # Еще не отправляли (успешно или с ошибкой)
-                    ~exists(
-                        select(1)
-                        .where(
-                            UserAction.user_id == User.id,
-                            UserAction.action_type.in_([
-                                'onboarding_reminder_first_upload_sent',
-                                'onboarding_reminder_first_upload_failed'
-                            ])
-                        )
-                    ),
-                    # У пользователя НЕТ успешных транзакций (никогда не оплачивал)
-                    ~exists(
-                        select(1)
-                        .where(
-                            Payment.user_id == User.id,
-                            Payment.status.in_(["completed", "success"])
-                        )
-                    )
-                )
-                .limit(batch_size)
-            )
+        async with read_session() as session:
+            query = _first_upload_reminder_query(reference_time).where(User.id > after_id).order_by(User.id).limit(batch_size)
             
             result = await session.execute(query)
             users = result.scalars().all()
@@ -3385,12 +4123,84 @@ async def get_users_for_first_upload_reminder(
         return []
 
 
+# Напоминания, после которых пользователя не трогаем рассылкой в течение окна
+BROADCAST_RECENT_REMINDER_TYPES = (
+    'onboarding_reminder_day1_sent',
+    'onboarding_reminder_day3_sent',
+    'onboarding_reminder_first_upload_sent',
+    'conversion_reminder_first_sent',
+    'conversion_reminder_second_sent',
+)
+
+
+def broadcast_exclusion_query(
+    time_window_hours: int = 24,
+    extended_day3_hours: int = 48,
+    reference_time: datetime | None = None
+):
+    """
+    Отношение (user_id, reason, kind) пользователей, исключаемых из рекламной рассылки.
+
+    Собирается одним UNION ALL из тех же запросов, что и сами напоминания, без LIMIT,
+    поэтому ни одна воронка не обрезается. Используется как anti-join в iter_users /
+    count_users (exclude_query=...) и как CTE для статистики в get_users_to_exclude_from_broadcast.
+
+    kind: 'recent' — получил напоминание за последние time_window_hours,
+          'upcoming' — получит напоминание в ближайшие time_window_hours
+          (Day 3 — в ближайшие extended_day3_hours, т.к. отсчитывается от Day 1).
+
+    Args:
+        time_window_hours: Стандартное временное окно в часах
+        extended_day3_hours: Расширенное окно для Day 3 reminder в часах
+        reference_time: Момент "сейчас"; фиксируется, чтобы подсчёт и отправка видели одно и то же окно
+    """
+    from sqlalchemy import literal_column, union_all
+
+    now = reference_time or datetime.utcnow()
+    past_time = now - timedelta(hours=time_window_hours)
+    standard_future = now + timedelta(hours=time_window_hours)
+    extended_future = now + timedelta(hours=extended_day3_hours)
+
+    logging.debug(f"Broadcast exclusion windows: past={past_time}, standard={standard_future}, extended={extended_future}")
+
+    def _upcoming(query, user_id_column, reason: str):
+        return query.with_only_columns(
+            user_id_column.label('user_id'),
+            literal_column(f"'{reason}'").label('reason'),
+            literal_column("'upcoming'").label('kind'),
+        )
+
+    recent = (
+        select(
+            UserAction.user_id.label('user_id'),
+            UserAction.action_type.label('reason'),
+            literal_column("'recent'").label('kind'),
+        )
+        .where(
+            UserAction.action_type.in_(BROADCAST_RECENT_REMINDER_TYPES),
+            UserAction.created_at >= past_time
+        )
+    )
+    conversion_first, _, _ = _first_reminder_query(standard_future, reminder_hours=2, search_window_hours=1)
+    conversion_second, _, _ = _second_reminder_query(standard_future, reminder_hours=24, search_window_hours=1)
+
+    return union_all(
+        recent,
+        _upcoming(_onboarding_day1_query(standard_future), User.id, 'upcoming_onboarding_day1'),
+        _upcoming(_onboarding_day3_query(extended_future), User.id, 'upcoming_onboarding_day3'),
+        _upcoming(_first_upload_reminder_query(standard_future), User.id, 'upcoming_first_upload_reminder'),
+        _upcoming(conversion_first, User.id, 'upcoming_conversion_first_reminder'),
+        _upcoming(conversion_second, User.id, 'upcoming_conversion_second_reminder'),
+    )
+
+
 async def get_users_to_exclude_from_broadcast(
     time_window_hours: int = 24,
-    extended_day3_hours: int = 48
+    extended_day3_hours: int = 48,
+    reference_time: datetime | None = None
 ) -> dict:
     """
-    Получает пользователей, которых нужно исключить из рекламной рассылки.
+    Статистика пользователей, которых нужно исключить из рекламной рассылки.
 
     Исключаются пользователи, которые:
     1. Получили любое напоминание в последние N часов (по умолчанию 24)
@@ -3400,173 +4210,623 @@ async def get_users_to_exclude_from_broadcast(
     отсчитывается от Day 1 reminder (не от регистрации). Это гарантирует, что мы
     не будем беспокоить пользователей, находящихся в воронке onboarding.
 
+    Сами ID в Python не выгружаются: получатели рассылки отфильтровываются в SQL
+    через anti-join с broadcast_exclusion_query с тем же reference_time.
+    Все числа считаются одним запросом (ROLLUP по kind, reason).
+
     Args:
         time_window_hours: Стандартное временное окно в часах. По умолчанию 24.
         extended_day3_hours: Расширенное окно для Day 3 reminder в часах.
                             По умолчанию 48 (48ч от Day 1 = Day 3).
+        reference_time: Момент "сейчас". Если None, используется datetime.utcnow()
 
     Returns:
         dict с ключами:
-        - 'user_ids': set внутренних ID пользователей для исключения
-        - 'stats': статистика по типам напоминаний
+        - 'reference_time': момент, от которого считались окна (передать в broadcast_exclusion_query)
+        - 'stats': статистика по типам напоминаний (количество уникальных пользователей)
+    """
+    from sqlalchemy import distinct
+
+    reference_time = reference_time or datetime.utcnow()
+    stats = {
+        'total_excluded': 0,
+        'recent_reminders': 0,
+        'upcoming_reminders': 0,
+        'breakdown': {
+            'recent': {},
+            'upcoming': {}
+        }
+    }
+
+    try:
+        exclusions = broadcast_exclusion_query(
+            time_window_hours, extended_day3_hours, reference_time
+        ).cte('broadcast_exclusions')
+
+        # (kind, reason) — разбивка, (kind, NULL) — по kind, (NULL, NULL) — всего уникальных
+        query = (
+            select(
+                exclusions.c.kind,
+                exclusions.c.reason,
+                func.count(distinct(exclusions.c.user_id)).label('users')
+            )
+            .group_by(func.rollup(exclusions.c.kind, exclusions.c.reason))
+        )
+
+        async with read_session() as session:
+            result = await session.execute(query)
+            rows = result.all()
+
+        for kind, reason, users in rows:
+            if kind is None:
+                stats['total_excluded'] = users
+            elif reason is None:
+                stats[f'{kind}_reminders'] = users
+            else:
+                stats['breakdown'][kind][reason] = users
+
+        logging.info(f"Excluded {stats['total_excluded']} users from broadcast: "
+                    f"{stats['recent_reminders']} recent, {stats['upcoming_reminders']} upcoming")
+
+    except Exception as e:
+        logging.error(f"Error getting users to exclude from broadcast: {e}", exc_info=True)
+
+    return {
+        'reference_time': reference_time,
+        'stats': stats
+    }
+
+
+
+# ==================== PARTITION MAINTENANCE ====================
+# Помесячные партиции append-only таблиц (models/partitioning.py, миграция 0004)
+
+# Сколько полных месяцев хранить в БД; старые партиции выгружаются в архив и удаляются
+PARTITION_RETENTION_MONTHS = int(os.environ.get('PARTITION_RETENTION_MONTHS', '12'))
+PARTITION_ARCHIVE_DIR = os.environ.get('PARTITION_ARCHIVE_DIR', 'archives/partitions')
+
+
+async def _archive_partition(table: str, partition: str) -> bool:
+    """
+    Выгружает партицию в gzip CSV, затем отсоединяет и удаляет её одной транзакцией.
+    Партиция удаляется только если число выгруженных строк совпало с count(*).
+    """
+    import gzip
+
+    os.makedirs(PARTITION_ARCHIVE_DIR, exist_ok=True)
+    archive_path = os.path.join(PARTITION_ARCHIVE_DIR, f"{partition}_{datetime.utcnow():%Y%m%d%H%M%S}.csv.gz")
+    tmp_path = archive_path + '.tmp'
+
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        driver = raw.driver_connection  # asyncpg.Connection: COPY идёт потоком, без загрузки в память
+
+        expected_rows = await driver.fetchval(f'SELECT count(*) FROM {partition}')
+        archive = await asyncio.to_thread(gzip.open, tmp_path, 'wb')
+        try:
+            async def _write(chunk: bytes):
+                await asyncio.to_thread(archive.write, chunk)
+
+            status = await driver.copy_from_table(partition, output=_write, format='csv', header=True)
+        finally:
+            await asyncio.to_thread(archive.close)
+
+        copied_rows = int(status.split()[-1]) if status else -1
+        if copied_rows != expected_rows:
+            logging.error(f"Partition {partition} archive mismatch: copied {copied_rows}, expected {expected_rows}")
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, archive_path)
+
+        async with driver.transaction():
+            await driver.execute(f'ALTER TABLE {table} DETACH PARTITION {partition}')
+            await driver.execute(f'DROP TABLE {partition}')
+
+    logging.info(f"Archived partition {partition} ({expected_rows} rows) to {archive_path}")
+    return True
+
+
+async def archive_old_partitions(retention_months: int = PARTITION_RETENTION_MONTHS) -> list[str]:
+    """
+    Архивирует партиции, целиком лежащие старше retention_months полных месяцев
+    (включая legacy-партицию, когда её верхняя граница выходит за окно хранения).
+
+    Returns:
+        Имена архивированных партиций
+    """
+    if retention_months <= 0:
+        return []
+    cutoff = datetime.combine(add_months(month_start(datetime.utcnow()), -retention_months), datetime.min.time())
+
+    archived = []
+    for table in PARTITIONED_TABLES:
+        async with engine.connect() as conn:
+            partitions = await conn.run_sync(list_partitions, table)
+        for partition in partitions:
+            upper_bound = partition['upper_bound']
+            if upper_bound is None or upper_bound > cutoff:
+                continue
+            try:
+                if await _archive_partition(table, partition['name']):
+                    archived.append(partition['name'])
+            except Exception as e:
+                logging.error(f"Failed to archive partition {partition['name']}: {e}")
+    return archived
+
+
+async def maintain_partitions():
+    """
+    Ежедневное обслуживание: партиции на следующие месяцы + архивация старых.
+
+    Задача стоит в обоих ботах; advisory lock (на время всей задачи) пускает только один процесс.
+    """
+    async with engine.connect() as lock_conn:
+        locked = await lock_conn.scalar(
+            sqlalchemy.text('SELECT pg_try_advisory_lock(hashtext(:key))'), {'key': 'partition_maintenance'}
+        )
+        if not locked:
+            return
+        try:
+            async with engine.begin() as conn:
+                created = await conn.run_sync(ensure_partitions)
+            if created:
+                logging.info(f"Created partitions: {', '.join(created)}")
+            archived = await archive_old_partitions()
+            if archived:
+                await send_alert(text=f"Archived partitions: {', '.join(archived)}", topic="SYSTEM", level="INFO")
+        except Exception as e:
+            logging.error(f"Partition maintenance failed: {e}")
+            await send_alert(text=f"Partition maintenance failed: {e}", topic="SYSTEM", level="ERROR")
+        finally:
+            await lock_conn.execute(
+                sqlalchemy.text('SELECT pg_advisory_unlock(hashtext(:key))'), {'key': 'partition_maintenance'}
+            )
+
+
+# ==================== FSM STORAGE ====================
+# Хранилище состояний aiogram в PostgreSQL (services/fsm_storage.py)
+
+async def get_fsm_record(key: str) -> dict | None:
+    """
+    Возвращает {'state', 'data'} записи FSM или None, если записи нет или она истекла.
+    """
+    async with async_session() as session:
+        result = await session.execute(
+            select(FsmState.state, FsmState.data)
+            .where(FsmState.key == key, FsmState.expires_at > datetime.utcnow())
+        )
+        row = result.mappings().one_or_none()
+        return dict(row) if row else None
+
+
+async def save_fsm_record(key: str, ttl_seconds: int, **values) -> None:
+    """
+    UPSERT состояния и/или данных FSM (values: state=..., data=...) с продлением TTL.
+
+    Поле, которое не передано, сохраняется, если запись ещё не истекла, иначе сбрасывается.
+    Запись без состояния и с пустыми данными удаляется, чтобы таблица не росла от idle-пользователей.
     """
+    from sqlalchemy import case, delete
+    from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl_seconds)
+    expired = FsmState.expires_at <= now
+
+    set_values = {'updated_at': now, 'expires_at': expires_at}
+    if 'state' in values:
+        set_values['state'] = values['state']
+    else:
+        set_values['state'] = case((expired, None), else_=FsmState.state)
+    if 'data' in values:
+        set_values['data'] = values['data']
+    else:
+        set_values['data'] = case((expired, sqlalchemy.literal({}, JSONB)), else_=FsmState.data)
+
+    stmt = (
+        pg_insert(FsmState)
+        .values(key=key, state=values.get('state'), data=values.get('data', {}),
+                updated_at=now, expires_at=expires_at)
+        .on_conflict_do_update(index_elements=[FsmState.key], set_=set_values)
+    )
+
+    async with async_session() as session:
+        await session.execute(stmt)
+        await session.execute(
+            delete(FsmState).where(
+                FsmState.key == key,
+                FsmState.state.is_(None),
+                FsmState.data == sqlalchemy.literal({}, JSONB)
+            )
+        )
+        await session.commit()
+
+
+async def purge_expired_fsm_states() -> int:
+    """Удаляет истекшие записи FSM. Возвращает количество удаленных строк"""
+    from sqlalchemy import delete
+
     try:
-        now = datetime.utcnow()
-        past_time = now - timedelta(hours=time_window_hours)
+        async with async_session() as session:
+            result = await session.execute(
+                delete(FsmState).where(FsmState.expires_at <= datetime.utcnow())
+            )
+            await session.commit()
+            if result.rowcount:
+                logging.info(f"Purged {result.rowcount} expired FSM states")
+            return result.rowcount
+    except Exception as e:
+        logging.error(f"Error purging expired FSM states: {e}")
+        return 0
+
+
+
+# Персистентная очередь аудио-обработки (models.model.AudioJob, миграция 0006)
+AUDIO_JOB_LEASE_SECONDS = int(os.environ.get('AUDIO_JOB_LEASE_SECONDS', '300'))
+AUDIO_JOB_MAX_ATTEMPTS = int(os.environ.get('AUDIO_JOB_MAX_ATTEMPTS', '3'))
+AUDIO_JOB_RETENTION_DAYS = int(os.environ.get('AUDIO_JOB_RETENTION_DAYS', '7'))
+
+_AUDIO_JOB_ACTIVE_STATUSES = ('queued', 'running')
+
 
-        # Стандартное окно для большинства напоминаний
-        standard_future = now + timedelta(hours=time_window_hours)
+def _audio_job_lease_until() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=AUDIO_JOB_LEASE_SECONDS)
 
-        # Расширенное окно для Day 3 (отсчитывается от Day 1, не от регистрации)
-        extended_future = now + timedelta(hours=extended_day3_hours)
 
-        # ========== 1. ПОЛЬЗОВАТЕЛИ, ПОЛУЧИВШИЕ НАПОМИНАНИЯ В ПОСЛЕДНИЕ N ЧАСОВ ==========
+async def create_audio_job(platform: str, user_id: int, owner: str | None, status: str = 'queued', **fields) -> int | None:
+    """
+    Записывает принятый файл в audio_jobs.
+
+    status='running' — файл сразу обрабатывается процессом owner (прямой путь без очереди).
+    owner=None — задача для внешних воркеров (audio_worker.py), доступна им сразу.
+    fields: chat_id, message_id, file_id, url, language_code, queue_order, paid, payload.
+
+    Returns:
+        id задачи или None, если записать не удалось (файл обрабатывается только в памяти)
+    """
+    now = datetime.utcnow()
+    try:
+        async with async_session() as session:
+            job_id = await session.scalar(
+                sqlalchemy.insert(AudioJob)
+                .values(
+                    platform=platform,
+                    user_id=user_id,
+                    owner=owner,
+                    status=status,
+                    attempts=1 if status == 'running' else 0,
+                    lease_until=_audio_job_lease_until() if owner else now,
+                    created_at=now,
+                    started_at=now if status == 'running' else None,
+                    **fields
+                )
+                .returning(AudioJob.id)
+            )
+            await session.commit()
+            return job_id
+    except Exception as e:
+        logging.error(f"Error creating audio job for {platform} user {user_id}: {e}")
+        return None
+
 
+async def set_audio_job_queue_message(job_id: int, queue_message_id) -> None:
+    """Запоминает сообщение "в очереди", чтобы убрать его после рестарта"""
+    try:
         async with async_session() as session:
-            # Типы напоминаний для проверки
-            reminder_types = [
-                'onboarding_reminder_day1_sent',
-                'onboarding_reminder_day3_sent',
-                'onboarding_reminder_first_upload_sent',
-                'conversion_reminder_first_sent',
-                'conversion_reminder_second_sent'
-            ]
-
-            # Получаем пользователей с недавними напоминаниями
-            recent_reminders_query = (
-                select(UserAction.user_id, UserAction.action_type)
+            await session.execute(
+                update(AudioJob).where(AudioJob.id == job_id).values(queue_message_id=str(queue_message_id))
+            )
+            await session.commit()
+    except Exception as e:
+        logging.error(f"Error saving queue message for audio job {job_id}: {e}")
+
+
+async def claim_audio_job(job_id: int, owner: str) -> bool:
+    """
+    Переводит задачу владельца из queued в running перед обработкой.
+
+    FOR UPDATE SKIP LOCKED: строку, которую прямо сейчас отменяют или забирают, не ждём.
+    False — задача отменена, уже выполняется или принадлежит другому процессу.
+    При ошибке БД возвращает True: файл обрабатывается, теряется только персистентность.
+    """
+    locked_id = (
+        select(AudioJob.id)
+        .where(AudioJob.id == job_id, AudioJob.owner == owner, AudioJob.status == 'queued')
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    try:
+        async with async_session() as session:
+            claimed = await session.scalar(
+                update(AudioJob)
+                .where(AudioJob.id == locked_id)
+                .values(status='running', started_at=datetime.utcnow(), attempts=AudioJob.attempts + 1,
+                        lease_until=_audio_job_lease_until())
+                .returning(AudioJob.id)
+            )
+            await session.commit()
+            return claimed is not None
+    except Exception as e:
+        logging.error(f"Error claiming audio job {job_id}: {e}")
+        return True
+
+
+async def finish_audio_job(job_id: int, status: str = 'done', error: str | None = None) -> None:
+    """Закрывает задачу: done, failed или cancelled"""
+    try:
+        async with async_session() as session:
+            await session.execute(
+                update(AudioJob)
+                .where(AudioJob.id == job_id, AudioJob.status.in_(_AUDIO_JOB_ACTIVE_STATUSES))
+                .values(status=status, error=error[:1000] if error else None, finished_at=datetime.utcnow())
+            )
+            await session.commit()
+    except Exception as e:
+        logging.error(f"Error finishing audio job {job_id}: {e}")
+
+
+async def cancel_audio_jobs(job_ids: list[int]) -> int:
+    """Отменяет ещё не начатые задачи (кнопка отмены, очистка очереди)"""
+    if not job_ids:
+        return 0
+    try:
+        async with async_session() as session:
+            result = await session.execute(
+                update(AudioJob)
+                .where(AudioJob.id.in_(job_ids), AudioJob.status == 'queued')
+                .values(status='cancelled', finished_at=datetime.utcnow())
+            )
+            await session.commit()
+            return int(result.rowcount or 0)
+    except Exception as e:
+        logging.error(f"Error cancelling audio jobs {job_ids}: {e}")
+        return 0
+
+
+async def adopt_audio_jobs(platform: str, owner: str, limit: int = 200) -> list[dict]:
+    """
+    Забирает осиротевшие задачи платформы — с истёкшей арендой (процесс-владелец
+    остановился или упал) — в процесс owner.
+
+    SELECT ... FOR UPDATE SKIP LOCKED: одновременно стартующие процессы делят задачи,
+    не дожидаясь друг друга. Прерванные running возвращаются в queued; задачи,
+    исчерпавшие AUDIO_JOB_MAX_ATTEMPTS запусков, закрываются как failed.
+
+    Returns:
+        Забранные задачи в порядке поступления
+    """
+    now = datetime.utcnow()
+    try:
+        async with async_session() as session:
+            result = await session.execute(
+                select(AudioJob.id, AudioJob.attempts)
                 .where(
-                    UserAction.action_type.in_(reminder_types),
-                    UserAction.created_at >= past_time
+                    AudioJob.platform == platform,
+                    AudioJob.status.in_(_AUDIO_JOB_ACTIVE_STATUSES),
+                    AudioJob.lease_until < now,
+                    # Свои задачи и так в памяти, даже если продление аренды запоздало
+                    sqlalchemy.or_(AudioJob.owner.is_(None), AudioJob.owner != owner)
                 )
+                .order_by(AudioJob.created_at, AudioJob.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
             )
+            rows = result.all()
+            exhausted = [row.id for row in rows if row.attempts >= AUDIO_JOB_MAX_ATTEMPTS]
+            adopted = [row.id for row in rows if row.attempts < AUDIO_JOB_MAX_ATTEMPTS]
 
-            result = await session.execute(recent_reminders_query)
-            recent_reminders = result.all()
+            if exhausted:
+                await session.execute(
+                    update(AudioJob)
+                    .where(AudioJob.id.in_(exhausted))
+                    .values(status='failed', error='max attempts exceeded', finished_at=now)
+                )
+                logging.warning(f"Audio jobs exceeded {AUDIO_JOB_MAX_ATTEMPTS} attempts: {exhausted}")
 
-            # Статистика по недавним напоминаниям
-            recent_users = {}
-            for user_id, action_type in recent_reminders:
-                if user_id not in recent_users:
-                    recent_users[user_id] = []
-                recent_users[user_id].append(action_type)
+            jobs = []
+            if adopted:
+                result = await session.execute(
+                    update(AudioJob)
+                    .where(AudioJob.id.in_(adopted))
+                    .values(owner=owner, status='queued', lease_until=_audio_job_lease_until())
+                    .returning(*AudioJob.__table__.columns)
+                )
+                jobs = [dict(row) for row in result.mappings().all()]
+            await session.commit()
 
-        # ========== 2. ПОЛЬЗОВАТЕЛИ, КОТОРЫЕ ДОЛЖНЫ ПОЛУЧИТЬ НАПОМИНАНИЯ В СЛЕДУЮЩИЕ N ЧАСОВ ==========
+        jobs.sort(key=lambda job: (job['created_at'], job['id']))
+        return jobs
+    except Exception as e:
+        logging.error(f"Error adopting {platform} audio jobs: {e}")
+        return []
 
-        upcoming_users = {}
 
-        logging.debug(f"Checking upcoming reminders: standard={standard_future}, extended={extended_future}")
+async def claim_next_audio_job(platform: str, owner: str, max_candidates: int = 5) -> dict | None:
+    """
+    Забирает следующую задачу платформы для внешнего воркера (audio_worker.py).
 
-        # --- 2.1. Onboarding Day 1 (стандартное окно +24ч) ---
-        day1_upcoming = await get_users_for_onboarding_day1(
-            batch_size=10000,  # Получаем всех
-            reference_time=standard_future
-        )
-        for user_dict in day1_upcoming:
-            user_id = user_dict['id']
-            if user_id not in upcoming_users:
-                upcoming_users[user_id] = []
-            upcoming_users[user_id].append('upcoming_onboarding_day1')
-
-        # --- 2.2. Onboarding Day 3 (расширенное окно +48ч) ---
-        # Day 3 отсчитывается от Day 1 reminder, поэтому используем extended_future
-        day3_upcoming = await get_users_for_onboarding_day3(
-            batch_size=10000,
-            reference_time=extended_future  # +48h вместо +24h
-        )
-        for user_dict in day3_upcoming:
-            user_id = user_dict['id']
-            if user_id not in upcoming_users:
-                upcoming_users[user_id] = []
-            upcoming_users[user_id].append('upcoming_onboarding_day3')
-
-        # --- 2.3. First Upload Reminder (стандартное окно +24ч) ---
-        first_upload_upcoming = await get_users_for_first_upload_reminder(
-            batch_size=10000,
-            reference_time=standard_future
-        )
-        for user_dict in first_upload_upcoming:
-            user_id = user_dict['id']
-            if user_id not in upcoming_users:
-                upcoming_users[user_id] = []
-            upcoming_users[user_id].append('upcoming_first_upload_reminder')
-
-        # --- 2.4. Conversion First Reminder (стандартное окно +24ч) ---
-        conversion_first_upcoming = await get_users_for_first_reminder(
-            batch_size=10000,
-            reminder_hours=2,
-            search_window_hours=1,
-            reference_time=standard_future
-        )
-        for user_dict in conversion_first_upcoming:
-            user_id = user_dict['user_id']
-            if user_id not in upcoming_users:
-                upcoming_users[user_id] = []
-            upcoming_users[user_id].append('upcoming_conversion_first_reminder')
-
-        # --- 2.5. Conversion Second Reminder (стандартное окно +24ч) ---
-        conversion_second_upcoming = await get_users_for_second_reminder(
-            batch_size=10000,
-            reminder_hours=24,
-            search_window_hours=1,
-            reference_time=standard_future
-        )
-        for user_dict in conversion_second_upcoming:
-            user_id = user_dict['user_id']
-            if user_id not in upcoming_users:
-                upcoming_users[user_id] = []
-            upcoming_users[user_id].append('upcoming_conversion_second_reminder')
-
-        # ========== 3. ОБЪЕДИНЯЕМ ВСЕ ==========
-
-        all_excluded_user_ids = set(recent_users.keys()) | set(upcoming_users.keys())
-
-        # Статистика
-        stats = {
-            'total_excluded': len(all_excluded_user_ids),
-            'recent_reminders': len(recent_users),
-            'upcoming_reminders': len(upcoming_users),
-            'breakdown': {
-                'recent': {},
-                'upcoming': {}
-            }
-        }
+    Кандидат — самая старая задача с истёкшей арендой (новая, отпущенная или
+    брошенная упавшим воркером), у пользователя которой сейчас ничего не выполняется:
+    файлы одного пользователя идут по очереди, разные пользователи — параллельно.
+    Строка блокируется FOR UPDATE SKIP LOCKED, так что воркеры не ждут друг друга;
+    advisory lock на пользователя закрывает гонку двух воркеров за его разные файлы.
 
-        # Подсчет по типам недавних напоминаний
-        for user_id, types in recent_users.items():
-            for reminder_type in types:
-                if reminder_type not in stats['breakdown']['recent']:
-                    stats['breakdown']['recent'][reminder_type] = 0
-                stats['breakdown']['recent'][reminder_type] += 1
+    Returns:
+        Задача (status='running', owner=owner) или None, если брать нечего
+    """
+    running = aliased(AudioJob)
+    skipped: list[int] = []
+    try:
+        for _ in range(max_candidates):
+            now = datetime.utcnow()
+            user_running = (
+                select(running.id)
+                .where(
+                    running.platform == AudioJob.platform,
+                    running.user_id == AudioJob.user_id,
+                    running.status == 'running',
+                    running.lease_until >= now
+                )
+                .exists()
+            )
+            async with async_session() as session:
+                result = await session.execute(
+                    select(AudioJob.id, AudioJob.platform, AudioJob.user_id, AudioJob.attempts)
+                    .where(
+                        AudioJob.platform == platform,
+                        AudioJob.status.in_(_AUDIO_JOB_ACTIVE_STATUSES),
+                        AudioJob.lease_until < now,
+                        AudioJob.id.notin_(skipped),
+                        ~user_running
+                    )
+                    .order_by(AudioJob.created_at, AudioJob.id)
+                    .limit(1)
+                    .with_for_update(skip_locked=True, of=AudioJob)
+                )
+                candidate = result.first()
+                if candidate is None:
+                    return None
+
+                if candidate.attempts >= AUDIO_JOB_MAX_ATTEMPTS:
+                    await session.execute(
+                        update(AudioJob)
+                        .where(AudioJob.id == candidate.id)
+                        .values(status='failed', error='max attempts exceeded', finished_at=now)
+                    )
+                    await session.commit()
+                    logging.warning(f"Audio job {candidate.id} exceeded {AUDIO_JOB_MAX_ATTEMPTS} attempts")
+                    continue
 
-        # Подсчет по типам предстоящих напоминаний
-        for user_id, types in upcoming_users.items():
-            for reminder_type in types:
-                if reminder_type not in stats['breakdown']['upcoming']:
-                    stats['breakdown']['upcoming'][reminder_type] = 0
-                stats['breakdown']['upcoming'][reminder_type] += 1
+                user_key = f'audio_jobs:{candidate.platform}:{candidate.user_id}'
+                locked = await session.scalar(
+                    sqlalchemy.text('SELECT pg_try_advisory_xact_lock(hashtext(:key))'), {'key': user_key}
+                )
+                # Повторная проверка новым снимком: соседний воркер мог только что закоммитить захват
+                busy = locked and await session.scalar(
+                    select(
+                        select(AudioJob.id)
+                        .where(
+                            AudioJob.platform == candidate.platform,
+                            AudioJob.user_id == candidate.user_id,
+                            AudioJob.status == 'running',
+                            AudioJob.lease_until >= now
+                        )
+                        .exists()
+                    )
+                )
+                if not locked or busy:
+                    await session.rollback()
+                    skipped.append(candidate.id)
+                    continue
+
+                result = await session.execute(
+                    update(AudioJob)
+                    .where(AudioJob.id == candidate.id)
+                    .values(status='running', owner=owner, started_at=now, attempts=AudioJob.attempts + 1,
+                            lease_until=_audio_job_lease_until())
+                    .returning(*AudioJob.__table__.columns)
+                )
+                job = dict(result.mappings().one())
+                await session.commit()
+                return job
+        return None
+    except Exception as e:
+        logging.error(f"Error claiming next {platform} audio job: {e}")
+        return None
 
-        logging.info(f"Excluded {len(all_excluded_user_ids)} users from broadcast: "
-                    f"{len(recent_users)} recent, {len(upcoming_users)} upcoming")
 
-        return {
-            'user_ids': all_excluded_user_ids,
-            'stats': stats
-        }
+async def cancel_queued_audio_jobs(platform: str, user_id: int, message_id=None) -> int:
+    """
+    Отменяет ещё не начатые задачи пользователя (все или одну по message_id) прямо в
+    audio_jobs — режим внешних воркеров, где очереди в памяти бота нет.
+    """
+    conditions = [AudioJob.platform == platform, AudioJob.user_id == user_id, AudioJob.status == 'queued']
+    if message_id is not None:
+        conditions.append(AudioJob.message_id == str(message_id))
+    try:
+        async with async_session() as session:
+            result = await session.execute(
+                update(AudioJob).where(*conditions).values(status='cancelled', finished_at=datetime.utcnow())
+            )
+            await session.commit()
+            return int(result.rowcount or 0)
+    except Exception as e:
+        logging.error(f"Error cancelling queued audio jobs for {platform} user {user_id}: {e}")
+        return 0
+
 
+async def count_audio_jobs_ahead(platform: str, job_id: int) -> int:
+    """Сколько задач платформы ждут в audio_jobs перед job_id (позиция в очереди внешних воркеров)"""
+    try:
+        async with async_session() as session:
+            return await session.scalar(
+                select(func.count(AudioJob.id)).where(
+                    AudioJob.platform == platform,
+                    AudioJob.status == 'queued',
+                    AudioJob.id < job_id
+                )
+            ) or 0
     except Exception as e:
-        logging.error(f"Error getting users to exclude from broadcast: {e}", exc_info=True)
-        return {
-            'user_ids': set(),
-            'stats': {
-                'total_excluded': 0,
-                'recent_reminders': 0,
-                'upcoming_reminders': 0,
-                'breakdown': {'recent': {}, 'upcoming': {}}
-            }
-        }
+        logging.error(f"Error counting audio jobs ahead of {job_id}: {e}")
+        return 0
 
 
+async def renew_audio_job_leases(owner: str) -> int:
+    """Продлевает аренду незавершённых задач живого процесса (по расписанию)"""
+    try:
+        async with async_session() as session:
+            result = await session.execute(
+                update(AudioJob)
+                .where(AudioJob.owner == owner, AudioJob.status.in_(_AUDIO_JOB_ACTIVE_STATUSES))
+                .values(lease_until=_audio_job_lease_until())
+            )
+            await session.commit()
+            return int(result.rowcount or 0)
+    except Exception as e:
+        logging.error(f"Error renewing audio job leases: {e}")
+        return 0
+
+
+async def release_audio_jobs(owner: str) -> int:
+    """
+    Отпускает незавершённые задачи процесса при остановке: аренда истекает сразу,
+    и их забирает следующий процесс (adopt_audio_jobs), не дожидаясь таймаута.
+    """
+    try:
+        async with async_session() as session:
+            result = await session.execute(
+                update(AudioJob)
+                .where(AudioJob.owner == owner, AudioJob.status.in_(_AUDIO_JOB_ACTIVE_STATUSES))
+                .values(lease_until=datetime.utcnow())
+            )
+            await session.commit()
+            if result.rowcount:
+                logging.info(f"Released {result.rowcount} audio jobs for the next worker")
+            return int(result.rowcount or 0)
+    except Exception as e:
+        logging.error(f"Error releasing audio jobs: {e}")
+        return 0
+
+
+async def purge_finished_audio_jobs() -> int:
+    """Удаляет завершённые задачи старше AUDIO_JOB_RETENTION_DAYS"""
+    from sqlalchemy import delete
+
+    try:
+        async with async_session() as session:
+            result = await session.execute(
+                delete(AudioJob).where(
+                    AudioJob.finished_at < datetime.utcnow() - timedelta(days=AUDIO_JOB_RETENTION_DAYS)
+                )
+            )
+            await session.commit()
+            if result.rowcount:
+                logging.info(f"Purged {result.rowcount} finished audio jobs")
+            return int(result.rowcount or 0)
+    except Exception as e:
+        logging.error(f"Error purging finished audio jobs: {e}")
+        return 0
+
 if __name__ == '__main__':
     import asyncio
-    print(asyncio.run(get_payments(telegram_id=6194069336, only_successful=True)))
\ No newline at end of file
+    print(asyncio.run(get_payments(telegram_id=6194069336, only_successful=True)))
@@ -0,0 +1,155 @@
+"""
+Помесячное range-партиционирование append-only таблиц.
+
+Общие для миграций (alembic, синхронное соединение) и бота (models.orm через run_sync)
+SQL-хелперы: какие таблицы партиционированы, по какой колонке, как называются партиции
+и как создать недостающие. Партиции: <table>_pYYYYMM на месяц, <table>_default для
+строк вне диапазонов и <table>_legacy — исходная таблица, подключённая миграцией 0004
+как партиция "всё до месяца миграции" (без копирования данных).
+"""
+
+import logging
+import re
+from datetime import date, datetime
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Таблица -> колонка-ключ партиционирования
+PARTITIONED_TABLES = {
+    'user_actions': 'created_at',
+    'llm_requests': 'started_at',
+    'anonymous_chat_messages': 'created_at',
+    'file_downloads': 'created_at',
+    'bot_health_checks': 'started_at',
+}
+
+_TO_BOUND_RE = re.compile(r"TO \('([^']+)'\)")
+
+
+def month_start(value: date | datetime) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(value: date, months: int) -> date:
+    month_index = value.year * 12 + value.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f'{table}_p{month:%Y%m}'
+
+
+def is_partitioned(conn, table: str) -> bool:
+    result = conn.execute(text("""
+        SELECT 1 FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.relname = :table AND c.relnamespace = 'public'::regnamespace
+    """), {'table': table})
+    return result.first() is not None
+
+
+def list_partitions(conn, table: str) -> list[dict]:
+    """Партиции таблицы: [{'name', 'upper_bound' (datetime | None для DEFAULT)}]"""
+    result = conn.execute(text("""
+        SELECT child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound
+        FROM pg_inherits i
+        JOIN pg_class parent ON parent.oid = i.inhparent
+        JOIN pg_class child ON child.oid = i.inhrelid
+        WHERE parent.relname = :table AND parent.relnamespace = 'public'::regnamespace
+        ORDER BY child.relname
+    """), {'table': table})
+    partitions = []
+    for row in result:
+        match = _TO_BOUND_RE.search(row.bound or '')
+        partitions.append({
+            'name': row.name,
+            'upper_bound': datetime.fromisoformat(match.group(1)) if match else None,
+        })
+    return partitions
+
+
+def _default_has_rows(conn, table: str, month: date) -> bool:
+    column = PARTITIONED_TABLES[table]
+    result = conn.execute(text(
+        f"SELECT 1 FROM {table}_default WHERE {column} >= :start AND {column} < :end LIMIT 1"
+    ), {'start': month, 'end': add_months(month, 1)})
+    return result.first() is not None
+
+
+def _create_partition_from_default(conn, table: str, name: str, month: date):
+    """
+    Создаёт партицию месяца, строки которого уже попали в <table>_default.
+
+    CREATE ... PARTITION OF в этом случае падает, поэтому DEFAULT на время отключается,
+    строки месяца переносятся в новую партицию и DEFAULT подключается обратно.
+    Всё в одной транзакции: при ошибке таблица остаётся как была.
+    """
+    column = PARTITIONED_TABLES[table]
+    bounds = {'start': month, 'end': add_months(month, 1)}
+    columns = ', '.join(conn.execute(text("""
+        SELECT quote_ident(attname) FROM pg_attribute
+        WHERE attrelid = CAST(:table AS regclass) AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+    """), {'table': table}).scalars())
+
+    conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {table}_default"))
+    conn.execute(text(
+        f"CREATE TABLE {name} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    ))
+    moved = conn.execute(text(
+        f"INSERT INTO {name} ({columns}) SELECT {columns} FROM {table}_default "
+        f"WHERE {column} >= :start AND {column} < :end"
+    ), bounds).rowcount
+    conn.execute(text(f"DELETE FROM {table}_default WHERE {column} >= :start AND {column} < :end"), bounds)
+    conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {table}_default DEFAULT"))
+    logger.warning(f"Moved {moved} rows from {table}_default into new partition {name}")
+
+
+def ensure_partitions(conn, months_ahead: int = 2, reference: date | None = None) -> list[str]:
+    """
+    Создаёт партиции текущего месяца и months_ahead следующих, плюс DEFAULT.
+
+    Месяцы, уже покрытые legacy-партицией, пропускаются. Таблицы, ещё не
+    переведённые на партиционирование (миграция 0004 не применена), — тоже.
+    Если строки месяца уже лежат в DEFAULT, они переносятся в новую партицию;
+    любая другая ошибка пробрасывается, а не остаётся в логе.
+
+    Returns:
+        Имена созданных партиций
+    """
+    current = month_start(reference or datetime.utcnow())
+    created = []
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(conn, table):
+            logger.warning(f"Table {table} is not partitioned yet, run 'alembic upgrade head'")
+            continue
+
+        existing = list_partitions(conn, table)
+        names = {partition['name'] for partition in existing}
+        covered_until = max(
+            (p['upper_bound'].date() for p in existing if p['upper_bound'] is not None and p['name'].endswith('_legacy')),
+            default=None
+        )
+
+        for offset in range(months_ahead + 1):
+            month = add_months(current, offset)
+            name = partition_name(table, month)
+            if name in names or (covered_until is not None and month < covered_until):
+                continue
+            if f'{table}_default' in names and _default_has_rows(conn, table, month):
+                _create_partition_from_default(conn, table, name, month)
+            else:
+                conn.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+                ))
+            created.append(name)
+
+        if f'{table}_default' not in names:
+            conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+            created.append(f'{table}_default')
+
+    return created
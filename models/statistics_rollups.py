@@ -0,0 +1,97 @@
+"""
+Материализованные представления админской статистики (/statistics и источники).
+
+Общие для миграции 0005 (alembic) и init_models() (базы, созданные через create_all)
+определения: хендлеры читают готовые строки, refresh_statistics_rollups() обновляет их
+по расписанию. Уникальные индексы нужны для REFRESH MATERIALIZED VIEW CONCURRENTLY.
+
+- stats_users_snapshot: одна строка с итогами по users и временем обновления (refreshed_at)
+- stats_user_sources: пользователи по (source, subscription, subscription_type)
+- stats_payment_sources_hourly: платежи по часу, источнику, тарифу (по сумме) и признаку
+  первого платежа пользователя — period_days и unique=True сводятся к сумме по бакетам
+"""
+
+from sqlalchemy import text
+
+# Порядок обновления: stats_users_snapshot последним — его refreshed_at показывается в админке
+STATISTICS_ROLLUP_VIEWS = ('stats_user_sources', 'stats_payment_sources_hourly', 'stats_users_snapshot')
+
+STATISTICS_ROLLUP_DDL = (
+    """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS stats_users_snapshot AS
+    SELECT
+        1 AS id,
+        count(id) AS users_count,
+        coalesce(sum(audio_uses), 0) AS total_audio_uses,
+        coalesce(sum(gpt_uses), 0) AS total_gpt_uses,
+        count(*) FILTER (WHERE subscription = 'True') AS active_subs,
+        count(*) FILTER (WHERE subscription = 'True' AND subscription_type = 'monthly') AS monthly_subs,
+        count(*) FILTER (WHERE subscription = 'True' AND subscription_type = 'weekly') AS weekly_subs,
+        count(*) FILTER (WHERE subscription = 'True' AND subscription_type IN ('annual', 'yearly')) AS annual_subs,
+        count(*) FILTER (WHERE subscription = 'True'
+                         AND (subscription_type IS NULL OR subscription_type IN ('custom', 'manual'))) AS manual_subs,
+        count(*) FILTER (WHERE audio_uses > 0) AS users_with_action,
+        count(*) FILTER (WHERE is_bot_blocked = false) AS unblocked_users_count,
+        (now() AT TIME ZONE 'utc') AS refreshed_at
+    FROM users
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_stats_users_snapshot ON stats_users_snapshot (id)",
+    """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS stats_user_sources AS
+    SELECT
+        source,
+        coalesce(subscription, '') AS subscription,
+        coalesce(subscription_type, '') AS subscription_type,
+        count(*) AS users_count
+    FROM users
+    WHERE source <> ''
+    GROUP BY 1, 2, 3
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_stats_user_sources
+    ON stats_user_sources (source, subscription, subscription_type)
+    """,
+    # Тарифы по сумме платежа — те же списки, что раньше фильтровал get_payments_sources
+    """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS stats_payment_sources_hourly AS
+    WITH ranked AS (
+        SELECT
+            source,
+            created_at,
+            amount,
+            row_number() OVER (PARTITION BY user_id ORDER BY created_at, id) = 1 AS is_first
+        FROM payments
+        WHERE source <> ''
+    )
+    SELECT
+        -- created_at без значения: в "за всё время", но не в окна по периоду
+        coalesce(date_trunc('hour', created_at), 'epoch'::timestamp) AS bucket,
+        source,
+        CASE
+            WHEN amount IN (149, 55, 249) THEN 'weekly'
+            WHEN amount IN (190, 349, 549) THEN 'monthly'
+            ELSE 'other'
+        END AS plan,
+        is_first,
+        count(*) AS payments_count
+    FROM ranked
+    GROUP BY 1, 2, 3, 4
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_stats_payment_sources_hourly
+    ON stats_payment_sources_hourly (bucket, source, plan, is_first)
+    """,
+)
+
+
+def ensure_statistics_rollups(conn):
+    """Создаёт представления и их уникальные индексы, если их ещё нет (идемпотентно)"""
+    # Оба бота вызывают init_models при старте: IF NOT EXISTS не защищает от одновременного CREATE
+    conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('statistics_rollups_ddl'))"))
+    for statement in STATISTICS_ROLLUP_DDL:
+        conn.execute(text(statement))
+
+
+def drop_statistics_rollups(conn):
+    for view in reversed(STATISTICS_ROLLUP_VIEWS):
+        conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {view}"))
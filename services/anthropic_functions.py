@@ -1,15 +1,15 @@
 import asyncio
 import logging
-import httpx
 from anthropic import AsyncAnthropic, APIError
 from fluentogram import TranslatorRunner
 
 
 
 from services.init_bot import config
+from services.http_clients import get_httpx_client
 
-proxies = {'https://': config.proxy.proxy, 'http://': config.proxy.proxy}
-http_client = httpx.AsyncClient(proxies=proxies, timeout=360)
+# Общий пул соединений через прокси (services/http_clients.py)
+http_client = get_httpx_client(proxy=config.proxy.proxy)
 
 client = AsyncAnthropic(
     api_key=config.anthropic.api_key,
@@ -1,12 +1,14 @@
 import logging
+import os
 import aiohttp
 import asyncio
-import aiofiles
 from typing import Optional, Dict, Tuple
 from fluentogram import TranslatorRunner
 
 from services.services import progress_bar, format_time
 from services.init_bot import config
+from services.http_clients import pooled_session
+from services.streaming_upload import FileStream
 
 logger = logging.getLogger(__name__)
 
@@ -24,17 +26,20 @@ class AssemblyAIClient:
             api_key: API ключ AssemblyAI
         """
         self.api_key = api_key
-        self.base_url = "https://api.assemblyai.com/v2"
+        # Переопределяется окружением, например для локального фейкового сервера в тестах
+        self.base_url = os.getenv("ASSEMBLYAI_BASE_URL", "https://api.assemblyai.com/v2")
         self.headers = {
             "Authorization": api_key,
         }
 
-    async def upload_audio(self, audio_bytes: bytes) -> Optional[str]:
+    async def upload_audio(self, audio_bytes: Optional[bytes] = None, file_path: Optional[str] = None) -> Optional[str]:
         """
         Загружает аудио файл в AssemblyAI и возвращает URL для транскрипции.
+        Файл с диска отправляется потоком, без чтения в память.
 
         Args:
-            audio_bytes: Содержимое аудио файла
+            audio_bytes: Содержимое аудио файла (опционально, если передан file_path)
+            file_path: Путь к аудио файлу
 
         Returns:
             Optional[str]: URL загруженного файла или None при ошибке
@@ -44,11 +49,18 @@ class AssemblyAIClient:
         try:
             logger.debug("Uploading audio file to AssemblyAI")
 
-            async with aiohttp.ClientSession() as session:
+            if file_path:
+                body = FileStream(file_path)
+                headers = {**self.headers, **body.headers}
+            else:
+                body = audio_bytes
+                headers = self.headers
+
+            async with pooled_session() as session:
                 async with session.post(
                     endpoint,
-                    headers=self.headers,
-                    data=audio_bytes
+                    headers=headers,
+                    data=body
                 ) as response:
                     if response.status == 200:
                         result = await response.json()
@@ -108,7 +120,7 @@ class AssemblyAIClient:
         try:
             logger.debug(f"Submitting transcription request to AssemblyAI: {payload}")
 
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.post(endpoint, headers=headers, json=payload) as response:
                     if response.status in (200, 201):
                         result = await response.json()
@@ -140,7 +152,7 @@ class AssemblyAIClient:
         endpoint = f"{self.base_url}/transcript/{transcript_id}"
 
         try:
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.get(endpoint, headers=self.headers) as response:
                     if response.status == 200:
                         result = await response.json()
@@ -171,7 +183,7 @@ class AssemblyAIClient:
 
         try:
             logger.debug(f"Fetching sentences for transcript {transcript_id}")
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.get(endpoint, headers=self.headers) as response:
                     if response.status == 200:
                         result = await response.json()
@@ -360,14 +372,8 @@ class AssemblyAIClient:
             Optional[Tuple[str, str]]: (timecoded_text, plain_text) или None при ошибке
         """
         try:
-            # Шаг 0: Получение аудио данных
-            if file_path:
-                logger.debug(f"Reading audio from file: {file_path}")
-                async with aiofiles.open(file_path, 'rb') as f:
-                    buffer_data = await f.read()
-            elif audio_bytes:
-                buffer_data = audio_bytes
-            else:
+            # Шаг 0: Проверка аудио данных (файл с диска не читается, а загружается потоком)
+            if not file_path and not audio_bytes:
                 raise ValueError("Either audio_bytes or file_path must be provided")
 
             # Шаг 1: Загрузка аудио
@@ -379,7 +385,7 @@ class AssemblyAIClient:
                 except:
                     pass
 
-            upload_url = await self.upload_audio(buffer_data)
+            upload_url = await self.upload_audio(audio_bytes=None if file_path else audio_bytes, file_path=file_path)
             if not upload_url:
                 logger.error("Failed to upload audio to AssemblyAI")
                 return None
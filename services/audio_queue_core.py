@@ -0,0 +1,944 @@
+"""
+Платформонезависимое ядро очереди аудио-обработки.
+
+Логика очереди (сериализация файлов пользователя, окно сбора пачки сообщений,
+глобальный допуск audio_governor, позиции в очереди) одна для Telegram и Max.
+Всё, что зависит от платформы, — ответ с кнопкой отмены, правка сообщения о
+позиции, запуск обработки и сообщение об ошибке — делает адаптер
+(QueuePlatformAdapter): services/audio_queue_service.py для aiogram и
+services/max_audio_queue_service.py для maxapi.
+
+Очереди в регуляторе ключуются (платформа, user_id), поэтому ядра обеих
+платформ в одном процессе делят один бюджет допуска и видят очереди друг друга
+при оценке позиции.
+
+Каждый принятый файл дублируется в таблицу audio_jobs (models.orm.*_audio_job*):
+очередь в памяти держит живые Message/FSMContext, а строка — сериализуемое
+описание файла. Процесс продлевает аренду своих задач; после рестарта (или падения
+соседнего процесса) resume_jobs забирает задачи с истёкшей арендой, адаптер
+восстанавливает из строки Message, состояние и i18n, и файлы встают в очередь заново.
+
+С AUDIO_EXTERNAL_WORKERS=true (только платформы с персистентным FSM — Telegram) бот
+сам файлы не обрабатывает: add_to_queue лишь записывает задачу без владельца, а
+выполняют её процессы audio_worker.py (run_job), забирая через claim_next_audio_job.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, Dict, Iterator, Optional
+
+from fluentogram import TranslatorRunner
+
+from models.orm import get_user, create_audio_job, set_audio_job_queue_message, claim_audio_job, finish_audio_job, \
+    cancel_audio_jobs, adopt_audio_jobs, cancel_queued_audio_jobs, count_audio_jobs_ahead
+from services.concurrency_governor import audio_governor
+
+logger = logging.getLogger(__name__)
+
+# Владелец задач audio_jobs: уникален для процесса и для каждого его запуска
+AUDIO_WORKER_ID = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+# Обновление позиций в сообщениях "в очереди": не чаще раза в интервал на пользователя,
+# и только первые AUDIO_QUEUE_POSITION_EDIT_LIMIT сообщений (дальние обновятся, когда подойдут)
+AUDIO_QUEUE_POSITION_UPDATE_SECONDS = float(os.environ.get('AUDIO_QUEUE_POSITION_UPDATE_SECONDS', '3'))
+AUDIO_QUEUE_POSITION_EDIT_LIMIT = int(os.environ.get('AUDIO_QUEUE_POSITION_EDIT_LIMIT', '5'))
+
+# Обработка во внешних процессах audio_worker.py вместо процесса бота
+AUDIO_EXTERNAL_WORKERS = os.environ.get('AUDIO_EXTERNAL_WORKERS', 'false').lower() == 'true'
+
+
+class QueuePlatformAdapter:
+    """Платформенная часть очереди; методы вызываются ядром AudioQueueManager"""
+
+    platform: str = ''
+    # Можно ли отдавать обработку в audio_worker.py: состояние пользователя должно
+    # жить вне процесса бота, иначе воркер не увидит его, а бот — результат
+    supports_external_workers: bool = False
+
+    def __init__(self):
+        # Диспетчер и TranslatorHub нужны для восстановления задач после рестарта (bind при старте бота)
+        self.dispatcher = None
+        self.translator_hub = None
+
+    def bind(self, dispatcher, translator_hub) -> None:
+        self.dispatcher = dispatcher
+        self.translator_hub = translator_hub
+
+    @property
+    def is_bound(self) -> bool:
+        return self.dispatcher is not None and self.translator_hub is not None
+
+    def message_id(self, message) -> Any:
+        """Идентификатор сообщения пользователя (кнопка отмены, remove_from_queue)"""
+        raise NotImplementedError
+
+    def sort_key(self, message) -> Any:
+        """Ключ упорядочивания сообщений, собранных окном сбора"""
+        return self.message_id(message)
+
+    async def reply_queue_message(self, message, text: str, i18n: TranslatorRunner):
+        """Отвечает на сообщение текстом о позиции с кнопкой отмены; возвращает отправленное сообщение"""
+        raise NotImplementedError
+
+    async def edit_queue_message(self, queue_message, text: str, i18n: TranslatorRunner, message_id) -> None:
+        """Обновляет сообщение о позиции (ошибку "не изменено" глотает)"""
+        raise NotImplementedError
+
+    async def process(self, item: dict) -> None:
+        """Запускает обработку элемента очереди (_process_audio_internal платформы)"""
+        raise NotImplementedError
+
+    async def notify_error(self, item: dict) -> None:
+        """Сообщает пользователю, что обработка элемента очереди упала"""
+        raise NotImplementedError
+
+    def describe(self, message) -> dict:
+        """
+        Сериализуемое описание сообщения для audio_jobs:
+        chat_id, message_id, file_id, url, payload (сам Message в JSON)
+        """
+        raise NotImplementedError
+
+    async def restore(self, job: dict) -> dict | None:
+        """
+        Восстанавливает из строки audio_jobs элемент очереди: {'message', 'state', 'i18n'}.
+        Старое сообщение "в очереди" (job['queue_message_id']) убирает — ядро отправит новое.
+        """
+        raise NotImplementedError
+
+
+class UserAudioQueue:
+    """
+    Очередь файлов одного пользователя с индексом по message_id.
+
+    append, popleft, peek и remove — O(1) (OrderedDict). Позиция — O(1): у элемента
+    есть порядковый номер, позиция = номер - номер головы. Отмена из середины
+    оставляет дыру; номера пересобираются один раз при следующем запросе позиции.
+    """
+
+    def __init__(self):
+        self._items: OrderedDict[str, dict] = OrderedDict()
+        self._seq: Dict[str, int] = {}
+        self._head = 0
+        self._next = 0
+        self._has_gaps = False
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __bool__(self) -> bool:
+        return bool(self._items)
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self._items.values())
+
+    def append(self, message_id, item: dict) -> str:
+        key = str(message_id)
+        if key in self._items:
+            key = f"{key}#{item['order']}"
+        item['queue_key'] = key
+        self._items[key] = item
+        self._seq[key] = self._next
+        self._next += 1
+        return key
+
+    def peek(self) -> dict | None:
+        return next(iter(self._items.values()), None)
+
+    def popleft(self) -> dict:
+        key, item = self._items.popitem(last=False)
+        self._pop_seq(key)
+        return item
+
+    def remove(self, message_id) -> dict | None:
+        key = str(message_id)
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._pop_seq(key)
+        return item
+
+    def clear(self) -> list[dict]:
+        items = list(self._items.values())
+        self._items.clear()
+        self._seq.clear()
+        self._head = self._next = 0
+        self._has_gaps = False
+        return items
+
+    def position(self, message_id) -> int | None:
+        """Индекс элемента в очереди (0 — следующий) или None"""
+        key = str(message_id)
+        if key not in self._seq:
+            return None
+        if self._has_gaps:
+            self._seq = {key: index for index, key in enumerate(self._items)}
+            self._head, self._next = 0, len(self._items)
+            self._has_gaps = False
+        return self._seq[key] - self._head
+
+    def _pop_seq(self, key: str):
+        if self._seq.pop(key) == self._head:
+            self._head += 1
+        else:
+            self._has_gaps = True
+
+
+class AudioQueueManager:
+    """Менеджер очередей аудио обработки для пользователей одной платформы"""
+
+    def __init__(self, adapter: QueuePlatformAdapter):
+        self.adapter = adapter
+        self.external_workers = AUDIO_EXTERNAL_WORKERS and adapter.supports_external_workers
+        # Словарь очередей для каждого пользователя: user_id -> UserAudioQueue
+        self.user_queues: Dict[int, UserAudioQueue] = {}
+        # Словарь воркеров для каждого пользователя: user_id -> asyncio.Task
+        self.user_workers: Dict[int, asyncio.Task] = {}
+        # Флаги активной обработки: user_id -> bool
+        self.is_processing: Dict[int, bool] = {}
+        # Блокировки для синхронизации доступа к очередям: user_id -> asyncio.Lock
+        self.user_locks: Dict[int, asyncio.Lock] = {}
+        # Счетчик для упорядочивания сообщений: user_id -> int
+        self.message_counters: Dict[int, int] = {}
+        # Состояние сбора сообщений для батчевой обработки
+        self.collection_active: Dict[int, bool] = {}
+        self.collection_buffers: Dict[int, list] = {}
+        self.collection_tasks: Dict[int, asyncio.Task] = {}
+        # Полоса глобального допуска: user_id -> подписчик ли
+        self.user_paid: Dict[int, bool] = {}
+        # Допуски задач, запущенных напрямую (без очереди): user_id -> Admission
+        self.direct_admissions: Dict[int, object] = {}
+        # Строки audio_jobs задач, запущенных напрямую: user_id -> job_id
+        self.direct_jobs: Dict[int, int] = {}
+        # Отложенные обновления позиций: user_id -> asyncio.Task, время последнего, повторить ли
+        self.position_update_tasks: Dict[int, asyncio.Task] = {}
+        self.position_updated_at: Dict[int, float] = {}
+        self.position_update_pending: set[int] = set()
+        audio_governor.register_backlog_provider(self._backlog)
+
+    # --- Глобальный допуск ---
+
+    def _governor_key(self, user_id: int) -> tuple[str, int]:
+        return self.adapter.platform, user_id
+
+    def _backlog(self) -> Dict[tuple[str, int], tuple[int, bool]]:
+        """Очереди пользователей для оценки глобальной позиции (audio_governor)"""
+        return {self._governor_key(user_id): (len(queue), self.user_paid.get(user_id, False))
+                for user_id, queue in self.user_queues.items() if queue}
+
+    def _estimate_position(self, user_id: int, queue_index: int) -> int:
+        return audio_governor.estimate_position(self._governor_key(user_id), queue_index)
+
+    async def _is_paid(self, user_id: int) -> bool:
+        # Max user_id хранится в той же колонке telegram_id
+        user = await get_user(telegram_id=user_id)
+        return bool(user and user.get('subscription') == 'True')
+
+    def release_admission(self, user_id: int):
+        """Освобождает глобальный слот задачи, запущенной напрямую (идемпотентно)"""
+        admission = self.direct_admissions.pop(user_id, None)
+        if admission is not None:
+            admission.release()
+
+    async def run_admitted(self, user_id: int, coro):
+        """Выполняет задачу, допущенную в add_to_queue без очереди, и освобождает её слот"""
+        job_id = self.direct_jobs.pop(user_id, None)
+        try:
+            result = await coro
+        except asyncio.CancelledError:
+            # Иначе строка останется running, аренда будет продлеваться, а resume_jobs запустит её снова
+            if job_id:
+                await asyncio.shield(finish_audio_job(job_id, 'cancelled'))
+            raise
+        except Exception as e:
+            if job_id:
+                await finish_audio_job(job_id, 'failed', str(e))
+            raise
+        finally:
+            self.release_admission(user_id)
+        if job_id:
+            await finish_audio_job(job_id)
+        return result
+
+    def _ensure_worker(self, user_id: int):
+        if user_id not in self.user_workers or self.user_workers[user_id].done():
+            logger.debug(f"Starting {self.adapter.platform} queue worker for user {user_id}")
+            self.user_workers[user_id] = asyncio.create_task(self._process_queue_worker(user_id))
+
+    # --- Очередь ---
+
+    def _new_item(self, message, state, i18n: TranslatorRunner, language_code: str | None,
+                  media_data: dict | None, order: int, timestamp: float) -> dict:
+        return {
+            'message': message,
+            'state': state,
+            'i18n': i18n,
+            'language_code': language_code,
+            'media_data': media_data,
+            'queue_message': None,
+            'order': order,
+            'timestamp': timestamp,
+            'job_id': None,
+            'shown_position': None
+        }
+
+    def _append(self, user_id: int, item: dict) -> int:
+        """Ставит элемент в конец очереди пользователя; возвращает его индекс"""
+        if user_id not in self.user_queues:
+            self.user_queues[user_id] = UserAudioQueue()
+        queue = self.user_queues[user_id]
+        queue.append(self.adapter.message_id(item['message']), item)
+        return len(queue) - 1
+
+    # --- Персистентность (audio_jobs) ---
+
+    async def _persist(self, user_id: int, item: dict, status: str = 'queued') -> int | None:
+        """Записывает элемент в audio_jobs; None — файл живёт только в памяти процесса"""
+        try:
+            description = self.adapter.describe(item['message'])
+        except Exception as e:
+            logger.error(f"Failed to describe {self.adapter.platform} message for user {user_id}: {e}")
+            return None
+        return await create_audio_job(
+            platform=self.adapter.platform,
+            user_id=user_id,
+            owner=AUDIO_WORKER_ID,
+            status=status,
+            language_code=item['language_code'],
+            queue_order=item['order'],
+            paid=self.user_paid.get(user_id, False),
+            **description
+        )
+
+    async def _remember_queue_message(self, item: dict):
+        if item['job_id'] and item['queue_message'] is not None:
+            queue_message_id = self.adapter.message_id(item['queue_message'])
+            if queue_message_id is not None:
+                await set_audio_job_queue_message(item['job_id'], queue_message_id)
+
+    async def resume_jobs(self) -> int:
+        """
+        Забирает осиротевшие задачи платформы из audio_jobs (после рестарта или падения
+        соседнего процесса) и ставит их в очереди пользователей.
+
+        Returns:
+            Количество восстановленных задач
+        """
+        if self.external_workers:
+            # Осиротевшие задачи забирают сами воркеры (claim_next_audio_job)
+            return 0
+        if not self.adapter.is_bound:
+            logger.warning(f"{self.adapter.platform} queue adapter is not bound, audio jobs are not resumed")
+            return 0
+
+        jobs = await adopt_audio_jobs(self.adapter.platform, AUDIO_WORKER_ID)
+        resumed = 0
+        for job in jobs:
+            try:
+                restored = await self.adapter.restore(job)
+            except Exception as e:
+                logger.error(f"Failed to restore audio job {job['id']}: {e}")
+                restored = None
+            if restored is None:
+                await finish_audio_job(job['id'], 'failed', 'restore failed')
+                continue
+
+            user_id = job['user_id']
+            if user_id not in self.user_locks:
+                self.user_locks[user_id] = asyncio.Lock()
+            self.user_paid[user_id] = job['paid']
+
+            async with self.user_locks[user_id]:
+                self.message_counters[user_id] = self.message_counters.get(user_id, 0) + 1
+
+                i18n = restored['i18n']
+                queue_item = self._new_item(restored['message'], restored['state'], i18n, job['language_code'],
+                                            None, self.message_counters[user_id], time.time())
+                queue_item['job_id'] = job['id']
+                queue_index = self._append(user_id, queue_item)
+
+                position = self._estimate_position(user_id, queue_index)
+                queue_item['shown_position'] = position
+                try:
+                    queue_item['queue_message'] = await self.adapter.reply_queue_message(
+                        queue_item['message'], i18n.audio_added_to_queue(position=position), i18n
+                    )
+                    await self._remember_queue_message(queue_item)
+                except Exception as e:
+                    logger.error(f"Failed to send queue message for resumed job {job['id']}: {e}")
+
+                if not self.is_processing.get(user_id, False):
+                    self._ensure_worker(user_id)
+            resumed += 1
+
+        if resumed:
+            logger.info(f"Resumed {resumed} {self.adapter.platform} audio jobs")
+        return resumed
+
+    async def run_job(self, job: dict) -> bool:
+        """
+        Выполняет задачу audio_jobs, забранную внешним воркером (audio_worker.py).
+
+        Returns:
+            True если обработка завершилась без исключения
+        """
+        try:
+            restored = await self.adapter.restore(job)
+        except Exception as e:
+            logger.error(f"Failed to restore audio job {job['id']}: {e}")
+            restored = None
+        if restored is None:
+            await finish_audio_job(job['id'], 'failed', 'restore failed')
+            return False
+
+        item = self._new_item(restored['message'], restored['state'], restored['i18n'], job['language_code'],
+                              None, job['queue_order'], time.time())
+        item['job_id'] = job['id']
+        try:
+            await self.adapter.process(item)
+        except Exception as e:
+            logger.error(f"Error processing audio job {job['id']} for user {job['user_id']}: {e}")
+            await finish_audio_job(job['id'], 'failed', str(e))
+            try:
+                await self.adapter.notify_error(item)
+            except Exception:
+                pass
+            return False
+
+        await finish_audio_job(job['id'])
+        logger.info(f"Processed audio job {job['id']} for user {job['user_id']}")
+        return True
+
+    async def _enqueue_for_workers(self, user_id: int, message, state, i18n: TranslatorRunner,
+                                   language_code: str | None) -> tuple[bool, Optional[Any]]:
+        """Записывает задачу для внешних воркеров и отвечает позицией в их общей очереди"""
+        self.user_paid[user_id] = await self._is_paid(user_id)
+        self.message_counters[user_id] = self.message_counters.get(user_id, 0) + 1
+        item = self._new_item(message, state, i18n, language_code, None, self.message_counters[user_id], time.time())
+        try:
+            description = self.adapter.describe(message)
+        except Exception as e:
+            logger.error(f"Failed to describe {self.adapter.platform} message for user {user_id}: {e}")
+            description = None
+        if description is not None:
+            item['job_id'] = await create_audio_job(
+                platform=self.adapter.platform,
+                user_id=user_id,
+                owner=None,
+                language_code=language_code,
+                queue_order=item['order'],
+                paid=self.user_paid[user_id],
+                **description
+            )
+        if not item['job_id']:
+            # Записать не удалось — обрабатываем в процессе бота, как без воркеров
+            return False, None
+
+        position = await count_audio_jobs_ahead(self.adapter.platform, item['job_id']) + 1
+        item['queue_message'] = await self.adapter.reply_queue_message(
+            message, i18n.audio_added_to_queue(position=position), i18n
+        )
+        await self._remember_queue_message(item)
+        logger.info(f"Queued audio job {item['job_id']} for external workers, user {user_id}, position: {position}")
+        return True, item['queue_message']
+
+    async def add_to_queue(self, user_id: int, message, state, i18n: TranslatorRunner,
+                           language_code: str | None = None, media_data: dict | None = None) -> tuple[bool, Optional[Any]]:
+        """
+        Добавляет сообщение в очередь пользователя с правильной синхронизацией.
+
+        state — FSMContext (Telegram) или MemoryContext (Max), передаётся в обработку как есть.
+
+        Returns:
+            tuple[bool, Optional[Message]]: (True если добавлено в очередь, queue_message или None)
+        """
+        if self.external_workers:
+            return await self._enqueue_for_workers(user_id, message, state, i18n, language_code)
+
+        # Создаем блокировку для пользователя, если её нет
+        if user_id not in self.user_locks:
+            self.user_locks[user_id] = asyncio.Lock()
+
+        # Инициализируем счетчик сообщений для пользователя
+        if user_id not in self.message_counters:
+            self.message_counters[user_id] = 0
+
+        self.user_paid[user_id] = await self._is_paid(user_id)
+
+        # Используем блокировку для синхронизации доступа
+        async with self.user_locks[user_id]:
+            # Увеличиваем счетчик сообщений для правильного упорядочивания
+            self.message_counters[user_id] += 1
+            message_order = self.message_counters[user_id]
+
+            # Проверяем, обрабатывается ли что-то в данный момент
+            is_currently_processing = self.is_processing.get(user_id, False)
+            queue_not_empty = bool(self.user_queues.get(user_id))
+
+            # Сразу запускаем только при свободном глобальном слоте, иначе файл ждёт допуска в очереди
+            admission = None
+            if not (is_currently_processing or queue_not_empty):
+                admission = audio_governor.try_admit(self._governor_key(user_id), self.user_paid[user_id])
+
+            if admission is None:
+                # Проверяем, нужно ли запустить окно сбора для батчевой обработки
+                collection_needed = (
+                    is_currently_processing and  # Кто-то обрабатывается (значит, это 2+ сообщение)
+                    not self.collection_active.get(user_id, False)  # Сбор еще не активен
+                )
+
+                if collection_needed:
+                    # Запускаем окно сбора сообщений
+                    await self._start_collection_window(user_id, message, state, i18n, language_code, media_data)
+                    return True, None  # Возвращаем True, но без queue_message (он будет отправлен позже)
+                elif self.collection_active.get(user_id, False):
+                    # Добавляем в буфер сбора
+                    self._add_to_collection_buffer(user_id, message, state, i18n, language_code, media_data)
+                    return True, None  # Возвращаем True, но без queue_message (он будет отправлен позже)
+
+                # Обычное добавление в очередь (для случаев без батчевой обработки)
+                queue_item = self._new_item(message, state, i18n, language_code, media_data, message_order, time.time())
+                queue_item['job_id'] = await self._persist(user_id, queue_item)
+                queue_index = self._append(user_id, queue_item)
+
+                # Глобальная позиция среди ожидающих задач всех пользователей
+                position = self._estimate_position(user_id, queue_index)
+                queue_item['shown_position'] = position
+
+                if queue_index == 0 and is_currently_processing:
+                    queue_text = i18n.audio_added_to_queue_first(position=position)
+                else:
+                    queue_text = i18n.audio_added_to_queue(position=position)
+
+                queue_message = await self.adapter.reply_queue_message(message, queue_text, i18n)
+                queue_item['queue_message'] = queue_message
+                await self._remember_queue_message(queue_item)
+
+                # Ничего не обрабатывается — воркер сам дождётся глобального допуска
+                if not is_currently_processing:
+                    self._ensure_worker(user_id)
+
+                logger.info(f"Added audio to {self.adapter.platform} queue for user {user_id}, "
+                            f"position: {position}, order: {message_order}")
+                return True, queue_message
+
+            # Если пользователь не обрабатывает аудио, очередь пуста и есть глобальный слот,
+            # помечаем как обрабатывающего и возвращаем False для прямой обработки (run_admitted)
+            self.direct_admissions[user_id] = admission
+            self.is_processing[user_id] = True
+            direct_item = self._new_item(message, state, i18n, language_code, media_data, message_order, time.time())
+            job_id = await self._persist(user_id, direct_item, status='running')
+            if job_id:
+                self.direct_jobs[user_id] = job_id
+            logger.debug(f"User {user_id} started processing (not queued), order: {message_order}")
+            return False, None
+
+    async def finish_processing(self, user_id: int):
+        """Уведомляет менеджер о завершении обработки текущего файла"""
+        # Используем блокировку для синхронизации
+        if user_id in self.user_locks:
+            async with self.user_locks[user_id]:
+                self._finish_processing(user_id)
+        else:
+            # Fallback для случаев, когда блокировка еще не создана
+            self._finish_processing(user_id)
+
+    def _finish_processing(self, user_id: int):
+        self.is_processing[user_id] = False
+        logger.info(f"Finished processing for user {user_id}")
+
+        # Запускаем воркер для обработки очереди, если есть файлы в очереди
+        if self.user_queues.get(user_id):
+            self._ensure_worker(user_id)
+
+    async def _process_queue_worker(self, user_id: int):
+        """Воркер для обработки очереди пользователя"""
+        try:
+            logger.debug(f"Queue worker started for user {user_id}")
+
+            if user_id not in self.user_queues:
+                return
+            queue = self.user_queues[user_id]
+
+            if user_id not in self.user_locks:
+                self.user_locks[user_id] = asyncio.Lock()
+
+            while queue:
+                queue_item = None
+                admission = None
+                try:
+                    # Помечаем как обрабатывающийся уже на время ожидания допуска
+                    self.is_processing[user_id] = True
+                    admission = await audio_governor.acquire(self._governor_key(user_id), self.user_paid.get(user_id, False))
+                    # Элемент извлекается только после допуска: пока он ждёт слот, его можно
+                    # отменить кнопкой, а сообщение "в очереди" продолжает обновлять позицию
+                    async with self.user_locks[user_id]:
+                        if not queue:
+                            # Всё, что ждало, отменили — слот не нужен
+                            admission.release()
+                            self.is_processing[user_id] = False
+                            continue
+                        queue_item = queue.popleft()
+                    job_id = queue_item.get('job_id')
+                    # Задачу могли отменить или забрать другим процессом, пока она ждала
+                    if job_id and not await claim_audio_job(job_id, AUDIO_WORKER_ID):
+                        admission.release()
+                        self.is_processing[user_id] = False
+                        logger.info(f"Skipped audio job {job_id} for user {user_id}: no longer queued here")
+                        continue
+                    try:
+                        try:
+                            if queue_item['i18n'] and queue:
+                                await self.update_queue_count_in_messages(user_id, queue_item['i18n'])
+                        except Exception as e:
+                            logger.error(f"Error updating queue count in messages for user {user_id}: {e}")
+
+                        await self.adapter.process(queue_item)
+                    finally:
+                        admission.release()
+                    if job_id:
+                        await finish_audio_job(job_id)
+
+                    # Помечаем как завершенный
+                    self.is_processing[user_id] = False
+
+                    logger.info(f"Processed queued audio for user {user_id}")
+
+                except asyncio.CancelledError:
+                    if admission is not None:
+                        admission.release()
+                    # clear_queue отменяет воркер: cancel_audio_jobs закрывает только оставшиеся
+                    # в очереди, а уже извлечённый элемент закрываем здесь
+                    if queue_item is not None and queue_item.get('job_id'):
+                        await asyncio.shield(finish_audio_job(queue_item['job_id'], 'cancelled'))
+                    raise
+
+                except Exception as e:
+                    logger.error(f"Error processing queued audio for user {user_id}: {e}")
+                    if admission is not None:
+                        admission.release()
+                    self.is_processing[user_id] = False
+                    if queue_item is not None and queue_item.get('job_id'):
+                        await finish_audio_job(queue_item['job_id'], 'failed', str(e))
+
+                    # Уведомляем пользователя об ошибке
+                    if queue_item is not None:
+                        try:
+                            await self.adapter.notify_error(queue_item)
+                        except Exception:
+                            pass
+
+        except Exception as e:
+            logger.error(f"Error in queue worker for user {user_id}: {e}")
+        finally:
+            # Очищаем флаг обработки
+            self.is_processing[user_id] = False
+
+    def get_queue_size(self, user_id: int) -> int:
+        """Возвращает размер очереди пользователя"""
+        if user_id in self.user_queues:
+            return len(self.user_queues[user_id])
+        return 0
+
+    def is_user_processing(self, user_id: int) -> bool:
+        """Проверяет, обрабатывает ли пользователь аудио в данный момент"""
+        return self.is_processing.get(user_id, False)
+
+    async def clear_queue(self, user_id: int) -> bool:
+        """
+        Очищает очередь пользователя.
+
+        Returns:
+            bool: True если очередь была непустой, False если была пустой
+        """
+        if self.external_workers:
+            return await cancel_queued_audio_jobs(self.adapter.platform, user_id) > 0
+
+        # Создаем блокировку для пользователя, если её нет
+        if user_id not in self.user_locks:
+            self.user_locks[user_id] = asyncio.Lock()
+
+        async with self.user_locks[user_id]:
+            if user_id not in self.user_queues:
+                return False
+
+            queue = self.user_queues[user_id]
+            was_not_empty = bool(queue)
+
+            # Очищаем очередь
+            await cancel_audio_jobs([item['job_id'] for item in queue.clear() if item.get('job_id')])
+
+            # Удаляем очередь из словаря
+            del self.user_queues[user_id]
+
+            # Останавливаем воркер, если он запущен (ожидание допуска отменяется, слот освобождается)
+            if user_id in self.user_workers and not self.user_workers[user_id].done():
+                self.user_workers[user_id].cancel()
+                del self.user_workers[user_id]
+
+            # Сбрасываем флаг обработки и счетчик
+            self.is_processing[user_id] = False
+            self.message_counters[user_id] = 0
+
+            # Очищаем состояние сбора, если активно
+            if user_id in self.collection_tasks and not self.collection_tasks[user_id].done():
+                self.collection_tasks[user_id].cancel()
+                del self.collection_tasks[user_id]
+
+            self.collection_active[user_id] = False
+            if user_id in self.collection_buffers:
+                del self.collection_buffers[user_id]
+
+            # Обновлять позиции больше нечего
+            update_task = self.position_update_tasks.pop(user_id, None)
+            if update_task is not None and not update_task.done():
+                update_task.cancel()
+            self.position_update_pending.discard(user_id)
+
+            logger.info(f"Cleared queue for user {user_id}, was not empty: {was_not_empty}")
+            return was_not_empty
+
+    async def remove_from_queue(self, user_id: int, message_id) -> bool:
+        """
+        Удаляет конкретный объект из очереди пользователя по message_id.
+
+        Args:
+            user_id: ID пользователя
+            message_id: ID сообщения для удаления (как в кнопке отмены)
+
+        Returns:
+            bool: True если объект был найден и удален, False если не найден
+        """
+        if self.external_workers:
+            return await cancel_queued_audio_jobs(self.adapter.platform, user_id, message_id) > 0
+
+        # Создаем блокировку для пользователя, если её нет
+        if user_id not in self.user_locks:
+            self.user_locks[user_id] = asyncio.Lock()
+
+        async with self.user_locks[user_id]:
+            if user_id not in self.user_queues:
+                logger.debug(f"No queue found for user {user_id}")
+                return False
+
+            item = self.user_queues[user_id].remove(message_id)
+            if item is None:
+                logger.debug(f"Message {message_id} is not in queue for user {user_id}")
+                return False
+
+            if item.get('job_id'):
+                await cancel_audio_jobs([item['job_id']])
+            logger.info(f"Removed message {message_id} from queue for user {user_id}")
+            return True
+
+    def get_queue_items(self, user_id: int) -> list:
+        """
+        Возвращает список элементов в очереди пользователя без их удаления.
+
+        Args:
+            user_id: ID пользователя
+
+        Returns:
+            list: Список элементов очереди
+        """
+        if user_id not in self.user_queues:
+            return []
+        return list(self.user_queues[user_id])
+
+    def get_queue_position(self, user_id: int, message_id) -> int | None:
+        """Индекс файла в очереди пользователя (0 — следующий) или None, если его там нет"""
+        if user_id not in self.user_queues:
+            return None
+        return self.user_queues[user_id].position(message_id)
+
+    async def update_queue_count_in_messages(self, user_id: int, i18n: TranslatorRunner):
+        """
+        Планирует обновление номера позиции в сообщениях пользователя.
+
+        Вызовы сливаются: пока обновление ждёт своего окна
+        (AUDIO_QUEUE_POSITION_UPDATE_SECONDS) или идёт, новые вызовы только
+        помечают, что после него нужен ещё один проход.
+        """
+        # Во внешнем режиме очереди в памяти нет; сообщение убирает воркер при старте задачи
+        if not self.user_queues.get(user_id):
+            return False
+
+        task = self.position_update_tasks.get(user_id)
+        if task is not None and not task.done():
+            self.position_update_pending.add(user_id)
+        else:
+            self.position_update_tasks[user_id] = asyncio.create_task(self._flush_queue_positions(user_id, i18n))
+        return True
+
+    async def _flush_queue_positions(self, user_id: int, i18n: TranslatorRunner):
+        """Правит сообщения "в очереди", у которых изменилась позиция, не чаще раза в интервал"""
+        try:
+            while True:
+                delay = self.position_updated_at.get(user_id, 0.0) + AUDIO_QUEUE_POSITION_UPDATE_SECONDS - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.position_update_pending.discard(user_id)
+                self.position_updated_at[user_id] = time.monotonic()
+
+                queue = self.user_queues.get(user_id)
+                if not queue:
+                    return
+                for index, item in enumerate(list(islice(queue, AUDIO_QUEUE_POSITION_EDIT_LIMIT))):
+                    if not item.get('queue_message'):
+                        continue
+                    position = self._estimate_position(user_id, index)
+                    if item.get('shown_position') == position:
+                        continue
+                    try:
+                        await self.adapter.edit_queue_message(
+                            item['queue_message'],
+                            i18n.audio_added_to_queue(position=position),
+                            i18n,
+                            self.adapter.message_id(item['message'])
+                        )
+                        item['shown_position'] = position
+                    except Exception as e:
+                        logger.warning(f"Failed to edit queue message: {e}")
+
+                if user_id not in self.position_update_pending:
+                    return
+        finally:
+            if self.position_update_tasks.get(user_id) is asyncio.current_task():
+                del self.position_update_tasks[user_id]
+
+    # --- Окно сбора ---
+
+    async def _start_collection_window(self, user_id: int, message, state, i18n: TranslatorRunner,
+                                       language_code: str | None = None, media_data: dict | None = None):
+        """
+        Запускает окно сбора сообщений для батчевой обработки.
+        Собирает сообщения в течение короткого времени, затем сортирует их по message_id.
+        """
+        # Помечаем, что сбор активен
+        self.collection_active[user_id] = True
+        self.collection_buffers[user_id] = []
+
+        # Добавляем текущее сообщение в буфер
+        self._add_to_collection_buffer(user_id, message, state, i18n, language_code, media_data)
+
+        logger.info(f"Started collection window for user {user_id}")
+
+        # Запускаем задачу сбора с таймаутом
+        self.collection_tasks[user_id] = asyncio.create_task(
+            self._collection_window_worker(user_id)
+        )
+
+    async def _collection_window_worker(self, user_id: int):
+        """
+        Воркер окна сбора сообщений. Ждет определенное время, затем обрабатывает собранные сообщения.
+        """
+        initial_delay = 0.1  # 100ms начальная задержка
+        max_total_delay = 0.2  # максимум 200ms общей задержки
+        start_time = time.time()
+
+        try:
+            while time.time() - start_time < max_total_delay:
+                await asyncio.sleep(initial_delay)
+
+                # Проверяем, не добавились ли новые сообщения за последние 50ms
+                if user_id in self.collection_buffers:
+                    buffer = self.collection_buffers[user_id]
+                    if buffer:
+                        latest_timestamp = max(item['timestamp'] for item in buffer)
+                        if time.time() - latest_timestamp < 0.05:  # Последнее сообщение было меньше 50ms назад
+                            continue  # Продолжаем ждать
+
+                # Если новых сообщений нет, завершаем сбор
+                break
+
+            # Обрабатываем собранные сообщения
+            await self._process_collected_messages(user_id)
+
+        except Exception as e:
+            logger.error(f"Error in collection window worker for user {user_id}: {e}")
+            # В случае ошибки все равно обрабатываем то, что собрали
+            await self._process_collected_messages(user_id)
+        finally:
+            # Очищаем состояние сбора
+            self.collection_active[user_id] = False
+            if user_id in self.collection_buffers:
+                del self.collection_buffers[user_id]
+            if user_id in self.collection_tasks:
+                del self.collection_tasks[user_id]
+
+    async def _process_collected_messages(self, user_id: int):
+        """
+        Обрабатывает собранные сообщения: сортирует по message_id и добавляет в очередь.
+        """
+        if user_id not in self.collection_buffers:
+            return
+
+        buffer = self.collection_buffers[user_id]
+        if not buffer:
+            return
+
+        # Сортируем по message_id для правильного порядка
+        buffer.sort(key=lambda x: x['sort_key'])
+
+        logger.info(f"Processing {len(buffer)} collected messages for user {user_id}")
+
+        # Используем блокировку для добавления в очередь
+        async with self.user_locks[user_id]:
+            # Добавляем все сообщения в правильном порядке
+            for item in buffer:
+                self.message_counters[user_id] += 1
+                queue_item = self._new_item(item['message'], item['state'], item['i18n'], item['language_code'],
+                                            item['media_data'], self.message_counters[user_id], item['timestamp'])
+                queue_item['job_id'] = await self._persist(user_id, queue_item)
+                queue_index = self._append(user_id, queue_item)
+
+                # Глобальная позиция среди ожидающих задач всех пользователей
+                position = self._estimate_position(user_id, queue_index)
+                queue_item['shown_position'] = position
+
+                # Отправляем уведомление о позиции в очереди
+                if queue_index == 0:
+                    queue_text = item['i18n'].audio_added_to_queue_first(position=position)
+                else:
+                    queue_text = item['i18n'].audio_added_to_queue(position=position)
+
+                try:
+                    queue_item['queue_message'] = await self.adapter.reply_queue_message(
+                        item['message'], queue_text, item['i18n']
+                    )
+                    await self._remember_queue_message(queue_item)
+                except Exception as e:
+                    logger.error(f"Failed to send queue message for user {user_id}: {e}")
+
+                logger.info(f"Added collected message {item['message_id']} to queue for user {user_id}, position: {position}")
+
+            # Обработка успела завершиться до конца окна сбора — запускаем воркер сами
+            if not self.is_processing.get(user_id, False) and self.user_queues.get(user_id):
+                logger.info(f"Starting queue worker from collection window for user {user_id}")
+                self._ensure_worker(user_id)
+
+    def _add_to_collection_buffer(self, user_id: int, message, state, i18n: TranslatorRunner,
+                                  language_code: str | None = None, media_data: dict | None = None):
+        """
+        Добавляет сообщение в буфер сбора.
+        """
+        if user_id not in self.collection_buffers:
+            self.collection_buffers[user_id] = []
+
+        message_id = self.adapter.message_id(message)
+        self.collection_buffers[user_id].append({
+            'message': message,
+            'state': state,
+            'i18n': i18n,
+            'language_code': language_code,
+            'media_data': media_data,
+            'message_id': message_id,
+            'sort_key': self.adapter.sort_key(message),
+            'timestamp': time.time()
+        })
+        logger.debug(f"Added message {message_id} to collection buffer for user {user_id}")
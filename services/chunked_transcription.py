@@ -0,0 +1,281 @@
+"""
+Параллельная транскрипция длинных записей по частям.
+
+Длинная запись целиком уходит одному провайдеру, и многочасовой файл
+транскрибируется столько, сколько провайдер обрабатывает его целиком. Здесь файл
+режется на части примерно по CHUNKED_STT_CHUNK_SECONDS, и части транскрибируются
+одновременно (не больше CHUNKED_STT_CONCURRENCY):
+
+1. Точки разреза ищутся в паузах: ffmpeg silencedetect, ближайшая к целевой границе
+   тишина в пределах ±CHUNKED_STT_SEARCH_SECONDS; если её нет — режем по границе.
+2. Части вырезаются без перекодирования (ffmpeg -c copy) и перекрываются на
+   CHUNKED_STT_OVERLAP_SECONDS, чтобы слово на жёсткой границе попало в обе части.
+3. Склейка: таймкоды части сдвигаются на её начало; сегмент, начавшийся до границы,
+   остаётся у предыдущей части, а из следующей берутся сегменты, середина которых позже
+   конца уже отданного (перекрытие не дублируется и не теряется). Спикеры следующей
+   части сопоставляются с уже известными по совпадению во времени в зоне перекрытия,
+   иначе сохраняют свою метку.
+
+Результат — строки [start - end] (speaker) text в секундах, которые затем группирует
+transcription_grouper.group_transcription_smart. Сам движок не знает о провайдерах:
+транскрипцию одной части выполняет переданная функция.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import shutil
+import tempfile
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import aiofiles
+
+from services.concurrency_governor import limit_stage
+from services.transcription_grouper import extract_plain_text, group_transcription_smart, parse_timecoded_segments
+
+logger = logging.getLogger(__name__)
+
+CHUNKED_STT_ENABLED = os.environ.get('CHUNKED_STT_ENABLED', 'false').lower() == 'true'
+# Записи длиннее этого транскрибируются по частям
+CHUNKED_STT_MIN_SECONDS = float(os.environ.get('CHUNKED_STT_MIN_SECONDS', '1200'))
+CHUNKED_STT_CHUNK_SECONDS = float(os.environ.get('CHUNKED_STT_CHUNK_SECONDS', '600'))
+CHUNKED_STT_OVERLAP_SECONDS = float(os.environ.get('CHUNKED_STT_OVERLAP_SECONDS', '2'))
+CHUNKED_STT_SEARCH_SECONDS = float(os.environ.get('CHUNKED_STT_SEARCH_SECONDS', '60'))
+CHUNKED_STT_CONCURRENCY = int(os.environ.get('CHUNKED_STT_CONCURRENCY', '6'))
+CHUNKED_STT_SILENCE_DB = float(os.environ.get('CHUNKED_STT_SILENCE_DB', '-35'))
+CHUNKED_STT_SILENCE_SECONDS = float(os.environ.get('CHUNKED_STT_SILENCE_SECONDS', '0.5'))
+CHUNKED_STT_FFMPEG_TIMEOUT_SECONDS = float(os.environ.get('CHUNKED_STT_FFMPEG_TIMEOUT_SECONDS', '600'))
+
+# Контейнеры, которые ffmpeg пишет при -c copy без перекодирования
+_COPY_SUFFIXES = {'.mp3', '.m4a', '.aac', '.ogg', '.oga', '.opus', '.wav', '.flac', '.webm', '.mka'}
+
+_SILENCE_START = re.compile(r'silence_start:\s*(-?\d+(?:\.\d+)?)')
+_SILENCE_END = re.compile(r'silence_end:\s*(-?\d+(?:\.\d+)?)')
+
+
+@dataclass
+class AudioChunk:
+    """Часть записи: [start, end] вырезано в path, own_start/own_end — границы с соседними частями"""
+    index: int
+    start: float
+    end: float
+    own_start: float
+    own_end: float
+    path: str
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+# Транскрипция одной части: (timecoded_text, text) с таймкодами от начала части
+ChunkTranscriber = Callable[[AudioChunk], Awaitable[tuple[str, str]]]
+
+
+def should_chunk(audio_length: float | None) -> bool:
+    return CHUNKED_STT_ENABLED and bool(audio_length) and audio_length > CHUNKED_STT_MIN_SECONDS
+
+
+async def _run_ffmpeg(args: list[str]) -> tuple[int, str]:
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), timeout=CHUNKED_STT_FFMPEG_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+        raise RuntimeError(f'ffmpeg timed out: {" ".join(args[:6])}')
+    return process.returncode, (stderr or b'').decode(errors='ignore')
+
+
+async def detect_silences(file_path: str) -> list[tuple[float, float]]:
+    """Паузы записи (начало, конец) по ffmpeg silencedetect"""
+    rc, stderr = await _run_ffmpeg([
+        'ffmpeg', '-hide_banner', '-nostats', '-i', file_path, '-vn', '-sn', '-dn',
+        '-af', f'silencedetect=noise={CHUNKED_STT_SILENCE_DB}dB:d={CHUNKED_STT_SILENCE_SECONDS}',
+        '-f', 'null', '-',
+    ])
+    if rc != 0:
+        raise RuntimeError(f'ffmpeg silencedetect failed (rc={rc}): {stderr[-500:]}')
+
+    silences = []
+    start = None
+    for line in stderr.splitlines():
+        match = _SILENCE_START.search(line)
+        if match:
+            start = max(float(match.group(1)), 0.0)
+            continue
+        match = _SILENCE_END.search(line)
+        if match and start is not None:
+            silences.append((start, float(match.group(1))))
+            start = None
+    return silences
+
+
+def plan_cuts(duration: float, silences: list[tuple[float, float]],
+              chunk_seconds: float = CHUNKED_STT_CHUNK_SECONDS,
+              search_seconds: float = CHUNKED_STT_SEARCH_SECONDS) -> list[float]:
+    """
+    Точки разреза от 0 до duration включительно. Каждая следующая — середина паузы,
+    ближайшей к previous + chunk_seconds в пределах search_seconds, иначе сама граница.
+    """
+    midpoints = [(start + end) / 2 for start, end in silences]
+    cuts = [0.0]
+    while duration - cuts[-1] > chunk_seconds + search_seconds:
+        target = cuts[-1] + chunk_seconds
+        nearby = [point for point in midpoints if abs(point - target) <= search_seconds and point > cuts[-1]]
+        cuts.append(min(nearby, key=lambda point: abs(point - target)) if nearby else target)
+    cuts.append(duration)
+    return cuts
+
+
+@limit_stage('ffmpeg')
+async def _extract_chunk(file_path: str, start: float, end: float, output_dir: str, index: int) -> str:
+    """Вырезает [start, end] без перекодирования; если контейнер не позволяет — перекодирует в mp3"""
+    suffix = os.path.splitext(file_path)[1].lower()
+    if suffix in _COPY_SUFFIXES:
+        output_path = os.path.join(output_dir, f'chunk_{index:04d}{suffix}')
+        rc, stderr = await _run_ffmpeg([
+            'ffmpeg', '-hide_banner', '-nostats', '-y', '-ss', f'{start:.3f}', '-i', file_path,
+            '-t', f'{end - start:.3f}', '-map', '0:a:0', '-vn', '-c', 'copy', output_path,
+        ])
+        if rc == 0:
+            return output_path
+        logger.warning(f'Stream copy of chunk {index} failed (rc={rc}), re-encoding: {stderr[-300:]}')
+
+    output_path = os.path.join(output_dir, f'chunk_{index:04d}.mp3')
+    rc, stderr = await _run_ffmpeg([
+        'ffmpeg', '-hide_banner', '-nostats', '-y', '-ss', f'{start:.3f}', '-i', file_path,
+        '-t', f'{end - start:.3f}', '-map', '0:a:0', '-vn', '-c:a', 'libmp3lame', '-b:a', '96k', output_path,
+    ])
+    if rc != 0:
+        raise RuntimeError(f'ffmpeg failed to extract chunk {index} (rc={rc}): {stderr[-500:]}')
+    return output_path
+
+
+@limit_stage('ffmpeg')
+async def split_on_silence(file_path: str, duration: float, output_dir: str,
+                           chunk_seconds: float = CHUNKED_STT_CHUNK_SECONDS,
+                           overlap_seconds: float = CHUNKED_STT_OVERLAP_SECONDS,
+                           search_seconds: float = CHUNKED_STT_SEARCH_SECONDS) -> list[AudioChunk]:
+    """Режет запись по паузам на перекрывающиеся части в output_dir"""
+    silences = await detect_silences(file_path)
+    cuts = plan_cuts(duration, silences, chunk_seconds=chunk_seconds, search_seconds=search_seconds)
+    chunks = []
+    for index in range(len(cuts) - 1):
+        start = max(cuts[index] - overlap_seconds, 0.0)
+        end = min(cuts[index + 1] + overlap_seconds, duration)
+        path = await _extract_chunk(file_path, start, end, output_dir, index)
+        chunks.append(AudioChunk(index=index, start=start, end=end,
+                                 own_start=cuts[index], own_end=cuts[index + 1], path=path))
+    logger.info(f'Split {duration:.0f}s recording into {len(chunks)} chunks ({len(silences)} pauses found)')
+    return chunks
+
+
+def _speaker_mapping(previous: list[tuple[float, float, str, str]], current: list[tuple[float, float, str, str]],
+                     window_start: float, window_end: float) -> dict[str, str]:
+    """Метки текущей части -> метки предыдущей по суммарному совпадению сегментов во времени в зоне перекрытия"""
+    overlap: dict[tuple[str, str], float] = {}
+    for start_b, end_b, speaker_b, _ in current:
+        if end_b < window_start or start_b > window_end:
+            continue
+        for start_a, end_a, speaker_a, _ in previous:
+            shared = min(end_a, end_b, window_end) - max(start_a, start_b, window_start)
+            if shared > 0:
+                overlap[(speaker_b, speaker_a)] = overlap.get((speaker_b, speaker_a), 0.0) + shared
+
+    mapping: dict[str, str] = {}
+    for (speaker_b, speaker_a), _ in sorted(overlap.items(), key=lambda item: -item[1]):
+        if speaker_b not in mapping and speaker_a not in mapping.values():
+            mapping[speaker_b] = speaker_a
+    return mapping
+
+
+def stitch_chunks(chunks: list[AudioChunk], results: list[tuple[str, str]]) -> str:
+    """
+    Склеивает результаты частей в сырые строки [start - end] (speaker) text с глобальными
+    таймкодами (секунды от начала записи).
+    """
+    lines = []
+    previous: list[tuple[float, float, str, str]] = []
+    # Конец последнего отданного сегмента
+    emitted_end = float('-inf')
+    for chunk, (timecoded_text, text) in zip(chunks, results):
+        segments = parse_timecoded_segments(timecoded_text)
+        if not any(end > start for start, end, _, _ in segments):
+            # Провайдер не отдал таймкоды: вся часть — один сегмент
+            segments = [(0.0, chunk.duration, segments[0][2] if segments else 'SPEAKER', text.strip())]
+
+        shifted = [(chunk.start + start, chunk.start + end, speaker, segment_text)
+                   for start, end, speaker, segment_text in segments if segment_text]
+        if previous:
+            mapping = _speaker_mapping(previous, shifted, chunk.start, chunk.own_start + CHUNKED_STT_OVERLAP_SECONDS)
+            # Несопоставленная метка, совпавшая с уже занятой, — другой человек: даём ей свою
+            for speaker in {speaker for _, _, speaker, _ in shifted}:
+                if speaker not in mapping and speaker in mapping.values():
+                    mapping[speaker] = f'{speaker}_{chunk.index + 1}'
+            shifted = [(start, end, mapping.get(speaker, speaker), segment_text)
+                       for start, end, speaker, segment_text in shifted]
+
+        own_end = float('inf') if chunk is chunks[-1] else chunk.own_end
+        # Сегмент, начавшийся до границы, целиком принадлежит этой части. Таймкоды соседних частей
+        # в перекрытии расходятся, поэтому отсюда берём только сегменты с серединой после конца
+        # отданных предыдущими частями, а не после самой границы
+        handoff = emitted_end
+        for start, end, speaker, segment_text in shifted:
+            if start < own_end and (start + end) / 2 >= handoff:
+                lines.append(f'[{start:.2f} - {end:.2f}] ({speaker}) {segment_text}')
+                emitted_end = max(emitted_end, end)
+        previous = shifted
+    return '\n'.join(lines)
+
+
+async def transcribe_chunked(transcribe_chunk: ChunkTranscriber, duration: float,
+                             file_path: str | None = None, audio_bytes: bytes | None = None,
+                             session_id: str | None = None) -> tuple[str, str]:
+    """
+    Транскрибирует запись по частям параллельно.
+
+    Returns:
+        tuple[str, str]: (timecoded_text, plain_text), как у функций провайдеров
+    """
+    work_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix='chunked_stt_')
+    try:
+        if not file_path:
+            file_path = os.path.join(work_dir, 'source.mp3')
+            async with aiofiles.open(file_path, 'wb') as f:
+                await f.write(audio_bytes)
+
+        chunks = await split_on_silence(file_path, duration, work_dir)
+        semaphore = asyncio.Semaphore(CHUNKED_STT_CONCURRENCY)
+
+        async def run(chunk: AudioChunk) -> tuple[str, str]:
+            async with semaphore:
+                logger.debug(f'Transcribing chunk {chunk.index + 1}/{len(chunks)} '
+                             f'({chunk.start:.0f}s - {chunk.end:.0f}s). Session: {session_id}')
+                return await transcribe_chunk(chunk)
+
+        # Если какая-то часть не транскрибировалась ни одним провайдером, остальные не нужны
+        tasks = [asyncio.create_task(run(chunk)) for chunk in chunks]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        raw_lines = stitch_chunks(chunks, results)
+        if not raw_lines:
+            raise ValueError(f'Chunked transcription returned empty result. Session: {session_id}')
+
+        timecoded_text = group_transcription_smart(raw_lines, min_block_duration=20.0, max_block_duration=60.0,
+                                                   pause_threshold=2.0)
+        return timecoded_text, extract_plain_text(raw_lines)
+    finally:
+        await asyncio.to_thread(shutil.rmtree, work_dir, True)
@@ -0,0 +1,301 @@
+"""
+Глобальный регулятор параллельности аудио-пайплайна.
+
+AudioQueueManager сериализует задачи одного пользователя, но не ограничивает их
+общее число: 300 одновременных загрузок — это 300 параллельных цепочек
+download + ffmpeg + STT + LLM в одном процессе. Регулятор добавляет поверх него:
+
+1. Допуск задач (admission): одновременно выполняется не больше
+   AUDIO_MAX_CONCURRENT_JOBS пайплайнов. У пользователя не больше одной ожидающей
+   задачи (остальные лежат в его очереди AudioQueueManager), следующая встаёт в конец
+   полосы после завершения текущей — так получается круговое обслуживание между
+   пользователями. Подписчики стоят в приоритетной полосе: на AUDIO_PAID_LANE_WEIGHT
+   допусков из неё приходится один из бесплатной, чтобы бесплатные не голодали.
+2. Лимиты стадий download / ffmpeg / stt / llm: семафоры вокруг соответствующих
+   функций (декоратор limit_stage). Повторный вход в ту же стадию внутри задачи
+   (download_file -> get_audio_from_url) второй слот не занимает.
+3. Оценка глобальной позиции задачи для сообщений audio_added_to_queue: очереди
+   пользователей сообщают менеджеры очередей через register_backlog_provider.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+AUDIO_MAX_CONCURRENT_JOBS = int(os.environ.get('AUDIO_MAX_CONCURRENT_JOBS', '16'))
+AUDIO_PAID_LANE_WEIGHT = int(os.environ.get('AUDIO_PAID_LANE_WEIGHT', '3'))
+
+# Стадия -> максимум одновременных вызовов в процессе
+STAGE_LIMITS = {
+    'download': int(os.environ.get('AUDIO_STAGE_LIMIT_DOWNLOAD', '8')),
+    'ffmpeg': int(os.environ.get('AUDIO_STAGE_LIMIT_FFMPEG', str(os.cpu_count() or 2))),
+    'stt': int(os.environ.get('AUDIO_STAGE_LIMIT_STT', '12')),
+    'llm': int(os.environ.get('AUDIO_STAGE_LIMIT_LLM', '12')),
+}
+
+PAID_LANE = 'paid'
+FREE_LANE = 'free'
+
+# Стадии, уже занятые текущей задачей (наследуется дочерними задачами через контекст)
+_held_stages: ContextVar[frozenset] = ContextVar('held_stages', default=frozenset())
+
+# Провайдер очередей: {ключ пользователя: (задач в очереди пользователя, подписчик ли)}.
+# Ключ — любой hashable; AudioQueueManager использует (платформа, user_id)
+BacklogProvider = Callable[[], dict[Hashable, tuple[int, bool]]]
+
+
+class Admission:
+    """Допуск одной задачи; release() идемпотентен"""
+
+    __slots__ = ('user_id', 'paid', 'admitted_at', '_governor', '_released')
+
+    def __init__(self, governor: 'ConcurrencyGovernor', user_id: int, paid: bool):
+        self.user_id = user_id
+        self.paid = paid
+        self.admitted_at = time.monotonic()
+        self._governor = governor
+        self._released = False
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._governor._release(self)
+
+
+class _Waiter:
+    __slots__ = ('user_id', 'paid', 'future', 'enqueued_at')
+
+    def __init__(self, user_id: int, paid: bool, future: asyncio.Future):
+        self.user_id = user_id
+        self.paid = paid
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class ConcurrencyGovernor:
+    """Допуск задач с круговым обслуживанием пользователей, приоритетом подписчиков и лимитами стадий"""
+
+    def __init__(self, max_jobs: int = AUDIO_MAX_CONCURRENT_JOBS, paid_weight: int = AUDIO_PAID_LANE_WEIGHT,
+                 stage_limits: dict[str, int] = STAGE_LIMITS):
+        self.max_jobs = max(1, max_jobs)
+        self.paid_weight = max(1, paid_weight)
+        self._running: dict[int, int] = {}
+        self._running_total = 0
+        self._lanes: dict[str, deque[_Waiter]] = {PAID_LANE: deque(), FREE_LANE: deque()}
+        self._paid_streak = 0
+        self._backlog_providers: list[BacklogProvider] = []
+
+        self.stage_limits = dict(stage_limits)
+        self._stage_semaphores = {name: asyncio.Semaphore(max(1, limit)) for name, limit in self.stage_limits.items()}
+        self._stage_active = {name: 0 for name in self.stage_limits}
+        self._stage_waiting = {name: 0 for name in self.stage_limits}
+
+        self.admitted_total = 0
+        self.admitted_after_wait = 0
+        self.wait_total_seconds = 0.0
+        self.wait_max_seconds = 0.0
+
+    # --- Допуск ---
+
+    def _waiting_count(self) -> int:
+        return len(self._lanes[PAID_LANE]) + len(self._lanes[FREE_LANE])
+
+    def _grant(self, user_id: int, paid: bool) -> Admission:
+        self._running_total += 1
+        self._running[user_id] = self._running.get(user_id, 0) + 1
+        self.admitted_total += 1
+        return Admission(self, user_id, paid)
+
+    def try_admit(self, user_id: int, paid: bool) -> Admission | None:
+        """Допуск без ожидания: только если есть свободный слот и никто не ждёт"""
+        if self._running_total >= self.max_jobs or self._waiting_count():
+            return None
+        return self._grant(user_id, paid)
+
+    async def acquire(self, user_id: int, paid: bool) -> Admission:
+        """Ждёт допуска задачи пользователя в своей полосе"""
+        admission = self.try_admit(user_id, paid)
+        if admission is not None:
+            return admission
+
+        waiter = _Waiter(user_id, paid, asyncio.get_running_loop().create_future())
+        self._lanes[PAID_LANE if paid else FREE_LANE].append(waiter)
+        try:
+            admission = await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Допуск выдан одновременно с отменой — возвращаем слот
+                waiter.future.result().release()
+            else:
+                lane = self._lanes[PAID_LANE if paid else FREE_LANE]
+                if waiter in lane:
+                    lane.remove(waiter)
+            raise
+
+        waited = time.monotonic() - waiter.enqueued_at
+        self.admitted_after_wait += 1
+        self.wait_total_seconds += waited
+        self.wait_max_seconds = max(self.wait_max_seconds, waited)
+        return admission
+
+    def _next_lane(self, paid_streak: int, paid_waiting: bool, free_waiting: bool) -> str | None:
+        if paid_waiting and (not free_waiting or paid_streak < self.paid_weight):
+            return PAID_LANE
+        if free_waiting:
+            return FREE_LANE
+        return None
+
+    def _release(self, admission: Admission) -> None:
+        self._running_total = max(0, self._running_total - 1)
+        remaining = self._running.get(admission.user_id, 0) - 1
+        if remaining > 0:
+            self._running[admission.user_id] = remaining
+        else:
+            self._running.pop(admission.user_id, None)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._running_total < self.max_jobs:
+            lane_name = self._next_lane(self._paid_streak, bool(self._lanes[PAID_LANE]), bool(self._lanes[FREE_LANE]))
+            if lane_name is None:
+                return
+            self._paid_streak = self._paid_streak + 1 if lane_name == PAID_LANE else 0
+            waiter = self._lanes[lane_name].popleft()
+            if waiter.future.done():
+                continue
+            waiter.future.set_result(self._grant(waiter.user_id, waiter.paid))
+
+    # --- Позиция в очереди ---
+
+    def register_backlog_provider(self, provider: BacklogProvider) -> None:
+        self._backlog_providers.append(provider)
+
+    def estimate_position(self, user_id: int, queue_index: int) -> int:
+        """
+        Глобальная позиция (1 — следующая к запуску) задачи с индексом queue_index в
+        очереди пользователя среди всех ещё не допущенных задач процесса.
+
+        Симулирует диспетчеризацию: полосы с весом подписчиков, после допуска
+        пользователь с остатком очереди встаёт в конец своей полосы.
+        """
+        backlog: dict[int, list] = {}
+        for provider in self._backlog_providers:
+            try:
+                for uid, (count, paid) in provider().items():
+                    entry = backlog.setdefault(uid, [0, paid])
+                    entry[0] += count
+            except Exception as e:
+                logger.warning(f"Backlog provider failed: {e}")
+
+        lanes = {PAID_LANE: deque(), FREE_LANE: deque()}
+        remaining: dict[int, int] = {}
+        for lane_name, lane in self._lanes.items():
+            for waiter in lane:
+                if waiter.future.done() or waiter.user_id in remaining:
+                    continue
+                remaining[waiter.user_id] = 1 + backlog.get(waiter.user_id, [0])[0]
+                lanes[lane_name].append(waiter.user_id)
+        # Пользователи без ожидающей задачи (выполняется текущая) встают в конец после завершения
+        for uid, (count, paid) in backlog.items():
+            if uid in remaining or count <= 0:
+                continue
+            remaining[uid] = count
+            lanes[PAID_LANE if paid else FREE_LANE].append(uid)
+
+        target = queue_index + (1 if any(w.user_id == user_id and not w.future.done()
+                                         for lane in self._lanes.values() for w in lane) else 0)
+        position = 0
+        dispatched_for_user = 0
+        paid_streak = self._paid_streak
+        while True:
+            lane_name = self._next_lane(paid_streak, bool(lanes[PAID_LANE]), bool(lanes[FREE_LANE]))
+            if lane_name is None:
+                # Провайдер ещё не видит задачу (гонка с добавлением) — в конец
+                return position + 1
+            paid_streak = paid_streak + 1 if lane_name == PAID_LANE else 0
+            uid = lanes[lane_name].popleft()
+            position += 1
+            if uid == user_id:
+                if dispatched_for_user == target:
+                    return position
+                dispatched_for_user += 1
+            remaining[uid] -= 1
+            if remaining[uid] > 0:
+                lanes[lane_name].append(uid)
+
+    # --- Стадии ---
+
+    @asynccontextmanager
+    async def stage(self, name: str):
+        """Слот стадии пайплайна; вложенный вход в ту же стадию проходит без ожидания"""
+        held = _held_stages.get()
+        semaphore = self._stage_semaphores.get(name)
+        if semaphore is None or name in held:
+            yield
+            return
+
+        self._stage_waiting[name] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._stage_waiting[name] -= 1
+        self._stage_active[name] += 1
+        token = _held_stages.set(held | {name})
+        try:
+            yield
+        finally:
+            _held_stages.reset(token)
+            self._stage_active[name] -= 1
+            semaphore.release()
+
+    # --- Экспорт ---
+
+    def get_stats(self) -> dict:
+        return {
+            'max_jobs': self.max_jobs,
+            'running': self._running_total,
+            'waiting_paid': len(self._lanes[PAID_LANE]),
+            'waiting_free': len(self._lanes[FREE_LANE]),
+            'admitted_total': self.admitted_total,
+            'admitted_after_wait': self.admitted_after_wait,
+            'wait_avg_seconds': round(self.wait_total_seconds / self.admitted_after_wait, 2)
+            if self.admitted_after_wait else 0.0,
+            'wait_max_seconds': round(self.wait_max_seconds, 2),
+            'stages': {
+                name: {
+                    'limit': self.stage_limits[name],
+                    'active': self._stage_active[name],
+                    'waiting': self._stage_waiting[name],
+                }
+                for name in self.stage_limits
+            },
+        }
+
+
+# Глобальный экземпляр
+audio_governor = ConcurrencyGovernor()
+
+
+def limit_stage(name: str):
+    """Декоратор корутины: выполнение внутри слота стадии name глобального регулятора"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            async with audio_governor.stage(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_audio_governor_stats() -> dict:
+    """Состояние допуска и стадий аудио-пайплайна (отдаётся через /metrics)"""
+    return audio_governor.get_stats()
@@ -14,6 +14,8 @@ import httpx # Added for httpx fallback
 import functools # Added for functools.partial if needed, or general utility
 import aiofiles # For async file operations with httpx
 from services.init_bot import bot
+from services.concurrency_governor import limit_stage
+from services.http_clients import pooled_httpx_client, pooled_session
 from models.orm import get_user, add_download_record, update_download_record, \
     update_processing_session  # Added ORM functions
 from models.model import DownloadStatus # Added Enum
@@ -69,7 +71,7 @@ async def _get_url_size(url: str) -> int | None:
     """Attempts to get the file size from a URL using a HEAD request."""
     try:
         # Try with aiohttp first
-        async with aiohttp.ClientSession() as session:
+        async with pooled_session() as session:
             async with session.head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=10)) as response:
                 if response.status == 200 and 'Content-Length' in response.headers:
                     try:
@@ -94,12 +96,12 @@ async def _get_url_size(url: str) -> int | None:
 
     # Fallback or direct attempt with httpx if aiohttp failed or was skipped for 403
     try:
-        async with httpx.AsyncClient(http2=True, follow_redirects=True, timeout=10.0) as client:
+        async with pooled_httpx_client() as client:
             head_headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
                 'Accept': '*/*',
             }
-            response = await client.head(url, headers=head_headers)
+            response = await client.head(url, headers=head_headers, timeout=10.0, follow_redirects=True)
             if response.status_code == 200 and 'content-length' in response.headers:
                 try:
                     size = int(response.headers['content-length'])
@@ -195,7 +197,7 @@ async def _download_url_content(url: str, destination: str | io.BytesIO, specifi
 
     logger.debug(f"Starting URL download: {url} to {destination_info}")
     try:
-        async with aiohttp.ClientSession() as session:
+        async with pooled_session() as session:
             async with session.get(url, timeout=timeout, headers=headers) as response:
                 response.raise_for_status() # Check for HTTP errors like 4xx, 5xx
                 if isinstance(destination, str): # Path to disk file
@@ -326,8 +328,8 @@ async def _download_url_content_httpx(url: str, destination: str | io.BytesIO, r
     timeout_config = httpx.Timeout(connect=60.0, read=7000.0, write=60.0, pool=None) # total could be implicitly larger
 
     try:
-        async with httpx.AsyncClient(http2=True, headers=request_headers, timeout=timeout_config, follow_redirects=True) as client:
-            async with client.stream('GET', url) as response:
+        async with pooled_httpx_client() as client:
+            async with client.stream('GET', url, headers=request_headers, timeout=timeout_config, follow_redirects=True) as response:
                 response.raise_for_status() # Check for HTTP errors like 4xx, 5xx
 
                 if isinstance(destination, str): # Path to disk file
@@ -460,6 +462,7 @@ def _get_local_file_size_sync(file_path: str) -> int | None:
         return None
 
 
+@limit_stage('download')
 async def download_file(
     source_type: str, # 'url' или 'telegram'
     identifier: str,  # URL или file_id
@@ -748,22 +751,14 @@ async def _download_url_content_httpx_with_proxy(url: str, destination: str | io
     logger.warning(f"Starting Instagram URL download with SOCKS5 proxy (last resort): {url} to {destination_info}")
 
     # SOCKS5 proxy configuration - настройка из test.py
-    proxies = {
-        "all://": "socks5://localhost:9052"
-    }
+    proxy = "socks5://localhost:9052"
     
     # Увеличенный таймаут для туннеля
     timeout_config = httpx.Timeout(connect=60.0, read=120.0, write=60.0, pool=None)
 
     try:
-        async with httpx.AsyncClient(
-            http2=True, 
-            headers=request_headers, 
-            timeout=timeout_config, 
-            follow_redirects=True, 
-            proxies=proxies
-        ) as client:
-            async with client.stream('GET', url) as response:
+        async with pooled_httpx_client(proxy=proxy) as client:
+            async with client.stream('GET', url, headers=request_headers, timeout=timeout_config, follow_redirects=True) as response:
                 response.raise_for_status()
 
                 if isinstance(destination, str):
@@ -0,0 +1,347 @@
+"""
+Телеметрия БД: connection pool и латентность запросов.
+
+Подключается к AsyncEngine из models.orm через события SQLAlchemy:
+- гистограмма латентности по «отпечатку» запроса (SQL без литералов и параметров)
+- распределение времени ожидания соединения из пула
+- журнал медленных запросов (значения параметров не сохраняются — только типы)
+- сколько соединений держит каждая функция-вызывающий и как долго
+
+Всё отдаётся через /metrics (services.internal_metrics).
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+from collections import deque
+from datetime import datetime
+
+from cachetools import LRUCache
+from sqlalchemy import event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+logger = logging.getLogger(__name__)
+
+# Порог медленного запроса и размер журнала
+DB_SLOW_QUERY_MS = float(os.environ.get('DB_SLOW_QUERY_MS', '500'))
+DB_SLOW_QUERY_LOG_SIZE = int(os.environ.get('DB_SLOW_QUERY_LOG_SIZE', '50'))
+# Ограничение числа различных отпечатков (остальные попадают в '<other>')
+DB_TELEMETRY_MAX_FINGERPRINTS = int(os.environ.get('DB_TELEMETRY_MAX_FINGERPRINTS', '500'))
+# Сколько отпечатков отдавать в /metrics (по суммарному времени)
+DB_TELEMETRY_TOP_QUERIES = int(os.environ.get('DB_TELEMETRY_TOP_QUERIES', '30'))
+
+# Верхние границы корзин гистограмм, мс (последняя корзина — всё, что больше)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_OTHER_FINGERPRINT = '<other>'
+_CALLER_UNKNOWN = '<unknown>'
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_PARAM_RE = re.compile(r"\$\d+|%\(\w+\)s|(?<!:):\w+")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE_RE = re.compile(r"\s+")
+_FINGERPRINT_MAX_LEN = 300
+
+
+class LatencyHistogram:
+    """Гистограмма с фиксированными корзинами: O(1) запись, перцентили по границам корзин"""
+
+    __slots__ = ('buckets', 'count', 'total_ms', 'max_ms')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, value_ms: float) -> None:
+        index = len(LATENCY_BUCKETS_MS)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if value_ms <= bound:
+                index = i
+                break
+        self.buckets[index] += 1
+        self.count += 1
+        self.total_ms += value_ms
+        if value_ms > self.max_ms:
+            self.max_ms = value_ms
+
+    def percentile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает q-й перцентиль"""
+        if not self.count:
+            return 0.0
+        threshold = q * self.count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.buckets):
+            cumulative += bucket_count
+            if cumulative >= threshold:
+                return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else round(self.max_ms, 2)
+        return round(self.max_ms, 2)
+
+    def to_dict(self) -> dict:
+        labels = [f'le_{bound}' for bound in LATENCY_BUCKETS_MS] + ['inf']
+        return {
+            'count': self.count,
+            'total_ms': round(self.total_ms, 2),
+            'avg_ms': round(self.total_ms / self.count, 2) if self.count else 0.0,
+            'p50_ms': self.percentile(0.50),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max_ms, 2),
+            'buckets': dict(zip(labels, self.buckets)),
+        }
+
+
+def fingerprint_statement(statement: str) -> str:
+    """SQL без литералов и плейсхолдеров: одинаковые запросы с разными параметрами совпадают"""
+    text = _STRING_RE.sub('?', statement)
+    text = _PARAM_RE.sub('?', text)
+    text = _NUMBER_RE.sub('?', text)
+    text = _IN_LIST_RE.sub('(?...)', text)
+    text = _WHITESPACE_RE.sub(' ', text).strip()
+    if len(text) > _FINGERPRINT_MAX_LEN:
+        text = text[:_FINGERPRINT_MAX_LEN] + '...'
+    return text
+
+
+def _redact_value(value) -> str:
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (str, bytes, list, tuple, dict)):
+        return f'<{type(value).__name__}:{len(value)}>'
+    return f'<{type(value).__name__}>'
+
+
+def redact_parameters(parameters):
+    """Оставляет только типы (и длины) параметров — значения могут содержать персональные данные"""
+    if isinstance(parameters, dict):
+        return {key: _redact_value(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            # executemany: достаточно размера пачки и формы первой строки
+            return {'rows': len(parameters), 'first': redact_parameters(parameters[0])}
+        return [_redact_value(value) for value in parameters]
+    return _redact_value(parameters)
+
+
+def _is_library_frame(filename: str) -> bool:
+    return (
+        'site-packages' in filename
+        or 'sqlalchemy' in filename
+        or filename.startswith('<')
+        or filename == __file__
+    )
+
+
+def current_caller() -> str:
+    """
+    Ближайшая функция приложения, которая сейчас ждёт БД.
+
+    Соединение берётся внутри greenlet SQLAlchemy, где стек кадров обрывается,
+    поэтому идём по цепочке await текущей asyncio-задачи (cr_await) и берём
+    самый глубокий кадр не из библиотек — обычно это функция из models.orm.
+    """
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        return _CALLER_UNKNOWN
+    if task is None:
+        return _CALLER_UNKNOWN
+
+    caller = _CALLER_UNKNOWN
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is not None and not _is_library_frame(frame.f_code.co_filename):
+            caller = f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return caller
+
+
+class DBTelemetry:
+    """Агрегаты телеметрии БД; все хуки синхронные и работают в потоке event loop"""
+
+    def __init__(self):
+        self.queries: dict[str, LatencyHistogram] = {}
+        self.query_errors: dict[str, int] = {}
+        self.pool_wait = LatencyHistogram()
+        self.pool_timeouts = 0
+        self.slow_queries: deque = deque(maxlen=DB_SLOW_QUERY_LOG_SIZE)
+        self.callers: dict[str, dict] = {}
+        self._fingerprints = LRUCache(maxsize=2000)
+        self._engine = None
+        self._replica_engine = None
+
+    # --- Запросы ---
+
+    def _fingerprint(self, statement: str) -> str:
+        fingerprint = self._fingerprints.get(statement)
+        if fingerprint is None:
+            fingerprint = fingerprint_statement(statement)
+            self._fingerprints[statement] = fingerprint
+        if fingerprint not in self.queries and len(self.queries) >= DB_TELEMETRY_MAX_FINGERPRINTS:
+            return _OTHER_FINGERPRINT
+        return fingerprint
+
+    def on_before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('telemetry_query_start', []).append(time.perf_counter())
+
+    def on_after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('telemetry_query_start')
+        if not starts:
+            return
+        elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+        fingerprint = self._fingerprint(statement)
+        histogram = self.queries.get(fingerprint)
+        if histogram is None:
+            histogram = self.queries[fingerprint] = LatencyHistogram()
+        histogram.observe(elapsed_ms)
+
+        if elapsed_ms >= DB_SLOW_QUERY_MS:
+            self.slow_queries.append({
+                'timestamp': datetime.utcnow().isoformat(),
+                'duration_ms': round(elapsed_ms, 2),
+                'fingerprint': fingerprint,
+                'parameters': redact_parameters(parameters),
+                'executemany': executemany,
+                'caller': conn.info.get('telemetry_caller', _CALLER_UNKNOWN),
+            })
+            logger.warning(f"Slow query {elapsed_ms:.0f} ms: {fingerprint[:200]}")
+
+    def on_error(self, exception_context):
+        conn = exception_context.connection
+        if conn is not None:
+            starts = conn.info.get('telemetry_query_start')
+            if starts:
+                starts.pop()
+        statement = exception_context.statement
+        if statement:
+            fingerprint = self._fingerprint(statement)
+            self.query_errors[fingerprint] = self.query_errors.get(fingerprint, 0) + 1
+
+    # --- Пул ---
+
+    def observe_pool_wait(self, elapsed_ms: float, timed_out: bool) -> None:
+        self.pool_wait.observe(elapsed_ms)
+        if timed_out:
+            self.pool_timeouts += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        # connection_record.info — тот же словарь, что Connection.info в хуках запросов
+        caller = current_caller()
+        connection_record.info['telemetry_caller'] = caller
+        connection_record.info['telemetry_checkout_at'] = time.perf_counter()
+        stats = self.callers.get(caller)
+        if stats is None:
+            stats = self.callers[caller] = {'held': 0, 'checkouts': 0, 'hold_total_ms': 0.0, 'hold_max_ms': 0.0}
+        stats['held'] += 1
+        stats['checkouts'] += 1
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        caller = connection_record.info.pop('telemetry_caller', None)
+        checkout_at = connection_record.info.pop('telemetry_checkout_at', None)
+        if caller is None or checkout_at is None:
+            return
+        stats = self.callers.get(caller)
+        if stats is None:
+            return
+        held_ms = (time.perf_counter() - checkout_at) * 1000
+        stats['held'] = max(0, stats['held'] - 1)
+        stats['hold_total_ms'] += held_ms
+        if held_ms > stats['hold_max_ms']:
+            stats['hold_max_ms'] = held_ms
+
+    # --- Экспорт ---
+
+    def get_stats(self) -> dict:
+        top_queries = sorted(self.queries.items(), key=lambda item: item[1].total_ms, reverse=True)
+        queries = []
+        for fingerprint, histogram in top_queries[:DB_TELEMETRY_TOP_QUERIES]:
+            entry = histogram.to_dict()
+            entry['fingerprint'] = fingerprint
+            entry['errors'] = self.query_errors.get(fingerprint, 0)
+            queries.append(entry)
+
+        callers = {}
+        for caller, stats in sorted(self.callers.items(), key=lambda item: item[1]['hold_total_ms'], reverse=True):
+            released = stats['checkouts'] - stats['held']
+            callers[caller] = {
+                'held_now': stats['held'],
+                'checkouts': stats['checkouts'],
+                'hold_avg_ms': round(stats['hold_total_ms'] / released, 2) if released > 0 else 0.0,
+                'hold_max_ms': round(stats['hold_max_ms'], 2),
+            }
+
+        stats = {
+            'slow_query_threshold_ms': DB_SLOW_QUERY_MS,
+            'fingerprints_tracked': len(self.queries),
+            'queries': queries,
+            'pool': {
+                **_pool_state(self._engine),
+                'timeouts': self.pool_timeouts,
+                'wait': self.pool_wait.to_dict(),
+            },
+            'connections_by_caller': callers,
+            'slow_queries': list(self.slow_queries),
+        }
+        if self._replica_engine is not None:
+            stats['replica_pool'] = _pool_state(self._replica_engine)
+        return stats
+
+
+def _pool_state(sync_engine) -> dict:
+    pool = sync_engine.pool if sync_engine is not None else None
+    if not isinstance(pool, AsyncAdaptedQueuePool):
+        return {}
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+    }
+
+
+# Глобальный экземпляр
+db_telemetry = DBTelemetry()
+
+
+class InstrumentedAsyncPool(AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool, измеряющий время ожидания свободного соединения"""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            db_telemetry.observe_pool_wait((time.perf_counter() - started) * 1000, timed_out=True)
+            raise
+        db_telemetry.observe_pool_wait((time.perf_counter() - started) * 1000, timed_out=False)
+        return connection
+
+
+def instrument_engine(engine, replica: bool = False) -> None:
+    """
+    Подключает хуки телеметрии к AsyncEngine (вызывается один раз при создании движка).
+    Запросы реплики попадают в общие гистограммы, её пул отдаётся отдельно (replica_pool).
+    """
+    sync_engine = engine.sync_engine
+    event.listen(sync_engine, 'before_cursor_execute', db_telemetry.on_before_execute)
+    event.listen(sync_engine, 'after_cursor_execute', db_telemetry.on_after_execute)
+    event.listen(sync_engine, 'handle_error', db_telemetry.on_error)
+    # Слушатели пула, повешенные на движок, переживают пересоздание пула в dispose()
+    event.listen(sync_engine, 'checkout', db_telemetry.on_checkout)
+    event.listen(sync_engine, 'checkin', db_telemetry.on_checkin)
+    if replica:
+        db_telemetry._replica_engine = sync_engine
+    else:
+        db_telemetry._engine = sync_engine
+
+
+def get_db_telemetry_stats() -> dict:
+    """Латентность запросов, ожидание пула и удержание соединений (отдаётся через /metrics)"""
+    if db_telemetry._engine is None:
+        return {}
+    return db_telemetry.get_stats()
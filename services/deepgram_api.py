@@ -1,11 +1,12 @@
+import os
 from io import BytesIO
 
-import aiofiles
 import deepgram
 import httpx
 from fluentogram import TranslatorRunner
 
 from services.services import progress_bar, format_time
+from services.streaming_upload import FileStream
 
 deepgram_key = '72432bd1465385df9c3926bf18857dcd5e137159'
 
@@ -15,17 +16,23 @@ async def audio_to_text_deepgram(file_bytes: bytes, waiting_message, i18n: Trans
                                  suppress_progress: bool = False,
                                  ) -> (str, str):
     
-    deepgram_client = deepgram.DeepgramClient(api_key=deepgram_key)
+    # DEEPGRAM_API_URL — другой адрес API, например локальный фейковый сервер в тестах
+    api_url = os.getenv('DEEPGRAM_API_URL')
+    if api_url:
+        deepgram_client = deepgram.DeepgramClient(api_key=deepgram_key,
+                                                  config=deepgram.DeepgramClientOptions(url=api_url))
+    else:
+        deepgram_client = deepgram.DeepgramClient(api_key=deepgram_key)
 
+    # Файл с диска SDK отдаёт в httpx как поток, не читая его целиком
     if file_path:
-        async with aiofiles.open(file_path, 'rb') as f:
-            buffer_data = await f.read()
+        payload: deepgram.FileSource = {
+            "stream": FileStream(file_path),
+        }
     else:
-        buffer_data = file_bytes
-
-    payload: deepgram.FileSource = {
-        "buffer": buffer_data,
-    }
+        payload: deepgram.FileSource = {
+            "buffer": file_bytes,
+        }
 
     # STEP 2: Configure Deepgram options for audio analysis
     if language_code:
@@ -0,0 +1,74 @@
+"""
+Компактный контекст диалога по транскрипции.
+
+В FSM хранится только ссылка на транскрипт (transcript_ref) и реплики чата (context).
+Первое сообщение с полным текстом транскрипта собирается лениво, при обработке вопроса,
+из базы: по transcription_id, session_id (get_transcription_data) или chat_session
+(первое сообщение анонимного чата). Небольшой TTL-кэш избавляет от повторной загрузки
+при нескольких вопросах подряд, оставаясь ограниченным по памяти.
+"""
+
+import logging
+import os
+
+from cachetools import TTLCache
+from fluentogram import TranslatorRunner
+
+from models.orm import get_transcript_by_chat_session, get_transcript_text, get_transcription_data
+
+logger = logging.getLogger(__name__)
+
+DIALOGUE_TRANSCRIPT_CACHE_SIZE = int(os.environ.get('DIALOGUE_TRANSCRIPT_CACHE_SIZE', '32'))
+DIALOGUE_TRANSCRIPT_CACHE_TTL_SECONDS = int(os.environ.get('DIALOGUE_TRANSCRIPT_CACHE_TTL_SECONDS', '600'))
+
+_transcript_cache: TTLCache = TTLCache(maxsize=DIALOGUE_TRANSCRIPT_CACHE_SIZE, ttl=DIALOGUE_TRANSCRIPT_CACHE_TTL_SECONDS)
+
+
+def dialogue_transcript_ref(transcription_id: int | None = None,
+                            session_id: str | None = None,
+                            chat_session: str | None = None) -> dict:
+    """Ссылка на транскрипт для FSM: только заданные идентификаторы"""
+    ref = {'transcription_id': transcription_id, 'session_id': session_id, 'chat_session': chat_session}
+    return {k: v for k, v in ref.items() if v}
+
+
+async def load_dialogue_transcript(transcript_ref: dict | None) -> str | None:
+    """Текст транскрипта по ссылке из FSM (первый найденный источник)"""
+    if not transcript_ref:
+        return None
+
+    cache_key = tuple(sorted(transcript_ref.items()))
+    transcript = _transcript_cache.get(cache_key)
+    if transcript is not None:
+        return transcript
+
+    if transcript_ref.get('transcription_id'):
+        transcript = await get_transcript_text(transcript_ref['transcription_id'])
+    if transcript is None and transcript_ref.get('session_id'):
+        transcription_data = await get_transcription_data(transcript_ref['session_id'])
+        transcript = transcription_data['raw_transcript'] if transcription_data else None
+    if transcript is None and transcript_ref.get('chat_session'):
+        transcript = await get_transcript_by_chat_session(transcript_ref['chat_session'])
+
+    if transcript is None:
+        logger.warning(f"Dialogue transcript not found for ref {transcript_ref}")
+        return None
+
+    _transcript_cache[cache_key] = transcript
+    return transcript
+
+
+async def build_dialogue_context(data: dict, i18n: TranslatorRunner) -> list[dict] | None:
+    """
+    Полный контекст для LLM: сообщение с транскриптом + реплики из FSM.
+
+    Returns:
+        Список сообщений или None, если транскрипт не удалось загрузить
+    """
+    transcript = await load_dialogue_transcript(data.get('transcript_ref'))
+    if transcript is None:
+        return None
+    return [
+        {'role': 'user', 'content': f"{i18n.audio_text_prefix()} {transcript}"},
+        *data.get('context', []),
+    ]
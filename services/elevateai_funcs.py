@@ -13,6 +13,7 @@ import time
 from services.services import progress_bar, format_time
 
 from services.init_bot import config
+from services.http_clients import pooled_session
 
 logger = logging.getLogger(__name__)
 
@@ -182,7 +183,7 @@ class ElevateAIClient:
         try:
             logger.debug(f"Declaring audio interaction to ElevateAI: {payload}")
             
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.post(endpoint, headers=headers, json=payload) as response:
                     if response.status == 201:
                         result = await response.json()
@@ -264,10 +265,9 @@ class ElevateAIClient:
                     logger.debug(f"Uploading audio file (attempt {attempt+1}/{max_retries+1}): {filename} for interaction: {interaction_id}")
 
                     timeout = aiohttp.ClientTimeout(total=900, sock_connect=30, sock_read=600)
-                    connector = aiohttp.TCPConnector(limit=10, force_close=True, enable_cleanup_closed=True)
                     try:
-                        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
-                            async with session.post(endpoint, headers=headers, data=form_data) as response:
+                        async with pooled_session() as session:
+                            async with session.post(endpoint, headers=headers, data=form_data, timeout=timeout) as response:
                                 response_text = await response.text()
                                 if response.status in (200, 201):
                                     logger.debug(f"Successfully uploaded audio file for interaction: {interaction_id}")
@@ -338,7 +338,7 @@ class ElevateAIClient:
             )
             logger.debug(f"Uploading audio buffer as file: {filename} for interaction: {interaction_id}")
             
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.post(endpoint, headers=headers, data=form_data) as response:
                     response_text = await response.text()
                     
@@ -385,7 +385,7 @@ class ElevateAIClient:
         }
         
         try:
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.get(endpoint, headers=headers) as response:
                     if response.status == 200:
                         result = await response.json()
@@ -434,7 +434,7 @@ class ElevateAIClient:
         try:
             logger.debug(f"Requesting punctuated transcript for interaction: {interaction_id}")
             
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.get(endpoint, headers=headers) as response:
                     if response.status == 200:
                         result = await response.json()
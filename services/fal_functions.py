@@ -2,7 +2,6 @@ import asyncio
 import logging
 import os
 
-import aiofiles
 import fal_client
 import base64
 from io import BytesIO
@@ -20,13 +19,13 @@ async def process_audio_fal(audio_bytes: bytes, waiting_message,
                             file_path: str = None) -> tuple[str, str]:
     os.environ['FAL_KEY'] = config.fal.api_key
     
-    # Convert bytes to base64 string (without data URI prefix)
-    if file_path:
-        async with aiofiles.open(file_path, 'rb') as f:
-            audio_bytes = await f.read()
     if not suppress_progress:
         await waiting_message.edit_text(text=i18n.transcribe_audio_progress(progress=progress_bar(39, i18n)))
-    url = await fal_client.upload_async(data=audio_bytes, content_type='audio/wav', file_name='audio.wav')
+    if file_path:
+        # Файл с диска загружает сам fal_client (большие файлы — multipart-частями)
+        url = await fal_client.upload_file_async(file_path)
+    else:
+        url = await fal_client.upload_async(data=audio_bytes, content_type='audio/wav', file_name='audio.wav')
 
     
 
@@ -10,6 +10,8 @@ import mimetypes
 from typing import Optional, Union
 
 from models.orm import save_transcription_cache
+from services.concurrency_governor import limit_stage
+from services.http_clients import pooled_session
 from services.content_downloaders.file_handling import download_file, identify_url_source
 from config_data.config import get_config
 
@@ -93,7 +95,7 @@ async def _poll_convert_result_async(request_id: str, token: str, retry_on_auth_
     poll_count = 0
     while poll_count < 120:
         try:
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.get(url, headers=headers) as response:
                     response.raise_for_status()
                     result = await response.json()
@@ -140,7 +142,7 @@ async def _request_convert_api_fedor_api(buffer: bytes | None, mode: str, token:
     form.add_field('conversion_type', mode)
     # print('mode: ', mode)
     try:
-        async with aiohttp.ClientSession() as session:
+        async with pooled_session() as session:
             async with session.post(url, headers=headers, data=form) as response:
                 # print(response.status)
                 # print(await response.text())
@@ -168,6 +170,7 @@ async def _request_convert_api_fedor_api(buffer: bytes | None, mode: str, token:
             pass
 
 
+@limit_stage('download')
 async def download_file_fedor_api(file_url: str, result_content_type: str = 'audio', user_data: dict | None = None, session_id: str | None = None, destination_type: str = 'disk', add_file_size_to_session: bool = False) -> dict:
     """
     Асинхронно скачивает файл по URL из Fedor API.
@@ -226,7 +229,7 @@ async def _poll_download_result_async(request_id: str, token: str, retry_on_auth
     poll_count = 0
     while poll_count < 120: # 1200 seconds = 20 minutes
         try:
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.get(url, headers=headers) as response:
                     response.raise_for_status()
                     result = await response.json()
@@ -272,7 +275,7 @@ async def _make_download_request_async(file_url: str, result_content_type: str =
     url = "https://trywhisper.xyz/api/v1/media/download/"
 
     try:
-        async with aiohttp.ClientSession() as session:
+        async with pooled_session() as session:
             async with session.post(url, json=body, headers=headers) as response:
                 response.raise_for_status()
                 result = await response.json()
@@ -317,7 +320,7 @@ async def get_token_async(force_refresh: bool = False) -> str:
         }
 
         try:
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.post(url, json=data) as response:
                     response.raise_for_status()
                     result = await response.json()
@@ -397,7 +400,7 @@ async def create_transcription_request_async(audio_url: str, token: str, retry_o
     data = {"user_input": audio_url}
     
     try:
-        async with aiohttp.ClientSession() as session:
+        async with pooled_session() as session:
             async with session.post(url, headers=headers, data=data) as response:
                 logger.debug(f"Ответ сервера: статус {response.status}")
                 
@@ -456,7 +459,7 @@ async def poll_transcription_result_async(
     start_time = time.time()
     poll_count = 0
 
-    async with aiohttp.ClientSession() as session:
+    async with pooled_session() as session:
         while True:
             poll_count += 1
             elapsed_time = time.time() - start_time
@@ -10,6 +10,8 @@ from fluentogram import TranslatorRunner
 
 from services.services import progress_bar, format_time
 from services.init_bot import config
+from services.http_clients import pooled_httpx_client
+from services.streaming_upload import MultipartFileStream
 from services.transcription_grouper import group_transcription_smart, extract_plain_text
 
 
@@ -17,7 +19,8 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-FIREWORKS_API_URL = "https://audio-turbo.api.fireworks.ai/v1/audio/transcriptions"
+# Переопределяется окружением, например для локального фейкового сервера в тестах
+FIREWORKS_API_URL = os.getenv("FIREWORKS_API_URL", "https://audio-turbo.api.fireworks.ai/v1/audio/transcriptions")
 
 
 def _get_fireworks_api_key() -> str:
@@ -214,27 +217,13 @@ async def audio_to_text_fireworks(
     proxy_url = getattr(getattr(config, 'proxy', None), 'proxy', None)
 
     try:
-        transport_kwargs = {}
         if proxy_url:
             logger.debug(f'Fireworks STT: using proxy {proxy_url}')
-            transport_kwargs['proxy'] = proxy_url
 
-        async with httpx.AsyncClient(timeout=httpx.Timeout(360.0, connect=60.0), **transport_kwargs) as client:
+        # Shared keep-alive pool per proxy variant (services/http_clients.py)
+        async with pooled_httpx_client(proxy=proxy_url) as client:
             logger.debug('Fireworks STT: sending POST request via httpx')
 
-            # Build multipart files/data for httpx
-            if file_path:
-                import aiofiles as _af
-                async with _af.open(file_path, 'rb') as f:
-                    file_data = await f.read()
-                fname = os.path.basename(file_path) or "audio.mp3"
-            elif file_bytes:
-                file_data = file_bytes
-                fname = "audio.mp3"
-            else:
-                raise ValueError("No audio data")
-
-            files_dict = {"file": (fname, file_data, _guess_content_type(fname))}
             data_dict = {
                 "model": "whisper-v3-turbo",
                 "temperature": "0",
@@ -243,8 +232,21 @@ async def audio_to_text_fireworks(
                 "response_format": "verbose_json",
                 "timestamp_granularities": "word",
             }
+            timeout = httpx.Timeout(360.0, connect=60.0)
 
-            resp = await client.post(FIREWORKS_API_URL, headers=headers, files=files_dict, data=data_dict)
+            if file_path:
+                # Stream the file from disk instead of reading it into memory
+                fname = os.path.basename(file_path) or "audio.mp3"
+                body = MultipartFileStream(data_dict, "file", file_path, filename=fname,
+                                           content_type=_guess_content_type(fname))
+                resp = await client.post(FIREWORKS_API_URL, headers={**headers, **body.headers}, content=body,
+                                         timeout=timeout)
+            elif file_bytes:
+                files_dict = {"file": ("audio.mp3", file_bytes, _guess_content_type("audio.mp3"))}
+                resp = await client.post(FIREWORKS_API_URL, headers=headers, files=files_dict, data=data_dict,
+                                         timeout=timeout)
+            else:
+                raise ValueError("No audio data")
 
             if resp.status_code != 200:
                 snippet = resp.text[:500]
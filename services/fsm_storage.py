@@ -0,0 +1,189 @@
+"""
+Персистентное FSM-хранилище для Telegram бота.
+
+Бэкенд выбирается переменной окружения FSM_STORAGE:
+- postgres (по умолчанию) — таблица fsm_states в общей базе, переживает рестарты;
+- redis — RedisStorage aiogram по FSM_REDIS_URL (подходит любой Redis-совместимый
+  локальный сервер: Redis, Valkey, KeyDB), требует установленный пакет redis;
+- memory — MemoryStorage aiogram, как раньше.
+
+Во всех персистентных бэкендах у записи есть TTL (FSM_TTL_SECONDS, по умолчанию 48ч):
+состояние idle-пользователя вытесняется само, память процесса не растёт.
+
+Данные сериализуются в JSON. Объекты aiogram (Message и т.п., которые хэндлеры
+кладут в состояние) сохраняются как model_dump и восстанавливаются с привязкой к боту.
+Тексты транскриптов в состояние не кладутся — см. services/dialogue_context.py.
+
+PostgresStorage читает состояние и данные одним SELECT и запоминает запись в пределах
+задачи, обрабатывающей апдейт (не дольше FSM_READ_CACHE_SECONDS): middleware, фильтры
+и хэндлер одного апдейта не ходят в базу за одной и той же записью по нескольку раз.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+import weakref
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from aiogram import Bot, types as aiogram_types
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import TelegramObject
+
+from models.orm import get_fsm_record, save_fsm_record
+
+logger = logging.getLogger(__name__)
+
+FSM_STORAGE = os.environ.get('FSM_STORAGE', 'postgres').lower()
+FSM_REDIS_URL = os.environ.get('FSM_REDIS_URL', 'redis://localhost:6379/0')
+FSM_TTL_SECONDS = int(os.environ.get('FSM_TTL_SECONDS', str(48 * 3600)))
+# Сколько прочитанная запись считается свежей внутри одной задачи (апдейта)
+FSM_READ_CACHE_SECONDS = float(os.environ.get('FSM_READ_CACHE_SECONDS', '1'))
+
+_TYPE_KEY = '__fsm_type__'
+
+
+def _encode(value: Any) -> Any:
+    """Приводит данные FSM к JSON-совместимому виду"""
+    if isinstance(value, TelegramObject):
+        return {_TYPE_KEY: type(value).__name__, 'value': value.model_dump(mode='json', exclude_none=True)}
+    if isinstance(value, datetime):
+        return {_TYPE_KEY: 'datetime', 'value': value.isoformat()}
+    if isinstance(value, dict):
+        return {str(k): _encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [_encode(v) for v in value]
+    return value
+
+
+def _decode(value: Any, bot: Optional[Bot]) -> Any:
+    """Обратное преобразование _encode"""
+    if isinstance(value, list):
+        return [_decode(v, bot) for v in value]
+    if not isinstance(value, dict):
+        return value
+
+    type_name = value.get(_TYPE_KEY)
+    if type_name is None:
+        return {k: _decode(v, bot) for k, v in value.items()}
+    if type_name == 'datetime':
+        return datetime.fromisoformat(value['value'])
+
+    telegram_type = getattr(aiogram_types, type_name, None)
+    if telegram_type is None:
+        logger.warning(f"Unknown FSM value type {type_name}, returning raw data")
+        return value['value']
+    obj = telegram_type.model_validate(value['value'])
+    return obj.as_(bot) if bot else obj
+
+
+def dumps_fsm_data(data: Dict[str, Any]) -> str:
+    return json.dumps(_encode(data), ensure_ascii=False)
+
+
+def loads_fsm_data(raw: str | bytes, bot: Optional[Bot] = None) -> Dict[str, Any]:
+    return _decode(json.loads(raw), bot)
+
+
+def _storage_key(key: StorageKey) -> str:
+    parts = [key.bot_id, key.chat_id, key.user_id, key.thread_id,
+             getattr(key, 'business_connection_id', None), key.destiny]
+    return ':'.join('' if part is None else str(part) for part in parts)
+
+
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх таблицы fsm_states (models.orm.*_fsm_record)"""
+
+    def __init__(self, bot: Optional[Bot] = None, ttl_seconds: int = FSM_TTL_SECONDS):
+        self.bot = bot
+        self.ttl_seconds = ttl_seconds
+        # Задача -> {ключ: (время чтения, запись)}; запись живёт не дольше задачи
+        self._task_records: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def _records(self) -> Optional[dict]:
+        task = asyncio.current_task()
+        if task is None:
+            return None
+        records = self._task_records.get(task)
+        if records is None:
+            records = self._task_records[task] = {}
+        return records
+
+    def _cached(self, records: Optional[dict], storage_key: str) -> Optional[tuple[float, Optional[dict]]]:
+        cached = records.get(storage_key) if records is not None else None
+        if cached is not None and time.monotonic() - cached[0] < FSM_READ_CACHE_SECONDS:
+            return cached
+        return None
+
+    async def _get_record(self, key: StorageKey) -> Optional[dict]:
+        storage_key = _storage_key(key)
+        records = self._records()
+        cached = self._cached(records, storage_key)
+        if cached is not None:
+            return cached[1]
+        record = await get_fsm_record(storage_key)
+        if records is not None:
+            records[storage_key] = (time.monotonic(), record)
+        return record
+
+    async def _save(self, key: StorageKey, **values) -> None:
+        storage_key = _storage_key(key)
+        await save_fsm_record(storage_key, self.ttl_seconds, **values)
+        # Запись в базу обновляет и запомненную запись, иначе следующее чтение вернуло бы старое
+        records = self._records()
+        cached = self._cached(records, storage_key)
+        if cached is not None:
+            record = dict(cached[1] or {'state': None, 'data': {}})
+            record.update(values)
+            records[storage_key] = (cached[0], record)
+        elif records is not None:
+            records.pop(storage_key, None)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self._save(key, state=state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._get_record(key)
+        return record['state'] if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._save(key, data=_encode(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._get_record(key)
+        if not record or not record['data']:
+            return {}
+        return _decode(record['data'], self.bot)
+
+    async def close(self) -> None:
+        pass
+
+
+def create_fsm_storage(bot: Optional[Bot] = None) -> BaseStorage:
+    """Создает FSM-хранилище согласно FSM_STORAGE"""
+    if FSM_STORAGE == 'memory':
+        logger.info("FSM storage: memory (state is lost on restart)")
+        return MemoryStorage()
+
+    if FSM_STORAGE == 'redis':
+        # Опциональная зависимость: нужна только для этого бэкенда
+        from aiogram.fsm.storage.redis import RedisStorage
+
+        logger.info(f"FSM storage: redis ({FSM_REDIS_URL}), ttl={FSM_TTL_SECONDS}s")
+        return RedisStorage.from_url(
+            FSM_REDIS_URL,
+            state_ttl=FSM_TTL_SECONDS,
+            data_ttl=FSM_TTL_SECONDS,
+            json_dumps=dumps_fsm_data,
+            json_loads=lambda raw: loads_fsm_data(raw, bot),
+        )
+
+    if FSM_STORAGE != 'postgres':
+        logger.warning(f"Unknown FSM_STORAGE={FSM_STORAGE}, falling back to postgres")
+    logger.info(f"FSM storage: postgres (fsm_states), ttl={FSM_TTL_SECONDS}s")
+    return PostgresStorage(bot=bot)
@@ -1,4 +1,6 @@
+import asyncio
 import datetime
+from collections import Counter
 from io import BytesIO
 import time
 from fluentogram import TranslatorRunner
@@ -10,6 +12,9 @@ from services.assemblyai_api import process_audio_assemblyai
 from services.fireworks_stt import audio_to_text_fireworks
 from services.payments import groq_functions
 import logging
+from services.concurrency_governor import limit_stage
+from services.stt_router import stt_hedge, stt_router
+from services.chunked_transcription import AudioChunk, should_chunk, transcribe_chunked
 
 from services.private_module_stt import private_stt_client
 from services.services import progress_bar, split_title_and_summary
@@ -142,6 +147,7 @@ async def process_chat_request(context: list[dict], user: dict, i18n: Translator
     return False
 
 
+@limit_stage('llm')
 async def summarise_text(text: str, user: dict, i18n: TranslatorRunner, session_id: str | None = None, transcription_id: int | None = None) -> dict:
     """Создает summary с логированием LLM запроса. Возвращает dict с ключами: 'summary_text', 'generated_title', 'model_provider', 'model_name'"""
     prompt_length = len(text)
@@ -255,10 +261,151 @@ async def summarise_text(text: str, user: dict, i18n: TranslatorRunner, session_
         raise Exception("Models returned empty result. Session: {session_id}")
     
 
+async def _run_stt_attempt(service: str, options: dict, route_length: float | None,
+                           session_id: str, allow_empty: bool = False) -> tuple[str, str]:
+    """
+    Одна попытка транскрипции у провайдера; исход записывается в роутер. Отмена (проигравший хедж)
+    не считается неудачей. allow_empty — для частей записи: тишина или музыка дают пустой
+    результат, и это не ошибка провайдера.
+    """
+    attempt_started = time.monotonic()
+    stt_router.begin(service)
+    try:
+        result = await options['function'](**options['args'])
+        if allow_empty:
+            timecoded_text, text = result or ('', '')
+            timecoded_text, text = timecoded_text or '', text or ''
+        else:
+            timecoded_text, text = result
+            if not (timecoded_text and text):  # Пустой результат — тоже неудача провайдера
+                raise ValueError(f"{service} STT returned empty result. Session: {session_id}")
+            if service == 'fireworks':
+                if len(text.split()) < 5:
+                    raise ValueError(f"Fireworks STT returned small result. Session: {session_id}")
+    except Exception:
+        stt_router.record(service, route_length, time.monotonic() - attempt_started, ok=False)
+        raise
+    stt_router.record(service, route_length, time.monotonic() - attempt_started, ok=True)
+    logger.debug(f'Successfully processed audio with {service}')
+    return timecoded_text, text
+
+
+async def _transcribe_sequential(transcription_options: dict, route_length: float | None,
+                                 session_id: str, allow_empty: bool = False) -> tuple[str, tuple[str, str]]:
+    """Провайдеры по очереди до первого успеха; возвращает (провайдер, (timecoded_text, text))"""
+    last_error = None
+    for service, options in transcription_options.items():
+        try:
+            return service, await _run_stt_attempt(service, options, route_length, session_id, allow_empty)
+        except Exception as e:
+            logger.error(f'Failed to process audio file. Service: {service}. Session: {session_id}. Error: {e}')
+            last_error = e
+    raise last_error or ValueError(f'No transcription services available. Session: {session_id}')
+
+
+async def _transcribe_hedged(transcription_options: dict, route_length: float | None,
+                             session_id: str) -> tuple[str, tuple[str, str]]:
+    """
+    Как _transcribe_sequential, но если текущий провайдер не ответил за выученный p90
+    (stt_router.hedge_delay), параллельно запускается следующий, пока позволяет бюджет
+    хеджей. Берётся первый годный результат, оставшийся запрос отменяется. Один хедж на задачу.
+    """
+    remaining = list(transcription_options.items())
+    running: dict[asyncio.Task, str] = {}
+    hedge_task = None
+    hedge_considered = False
+    last_error = None
+
+    def start_next() -> tuple[asyncio.Task, float]:
+        service, options = remaining.pop(0)
+        task = asyncio.create_task(_run_stt_attempt(service, options, route_length, session_id))
+        running[task] = service
+        return task, time.monotonic() + stt_router.hedge_delay(service, route_length)
+
+    try:
+        hedge_at = None
+        while running or remaining:
+            if not running:
+                _, hedge_at = start_next()
+            timeout = None
+            if not hedge_considered and remaining and len(running) == 1:
+                timeout = max(hedge_at - time.monotonic(), 0)
+            done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                hedge_considered = True
+                if stt_hedge.try_acquire(remaining[0][0], route_length):
+                    hedge_task, _ = start_next()
+                    logger.info(f'Hedging STT request with {running[hedge_task]} after primary stalled. Session: {session_id}')
+                continue
+
+            for task in done:
+                service = running.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    logger.error(f'Failed to process audio file. Service: {service}. Session: {session_id}. Error: {e}')
+                    last_error = e
+                    continue
+                if hedge_task is not None:
+                    stt_hedge.record_outcome(hedge_won=task is hedge_task)
+                return service, result
+
+            # Запрос провайдера упал; пока хедж ещё работает, ждём его, иначе — к следующему по порядку
+            if hedge_task is not None and hedge_task.done() and not running:
+                stt_hedge.record_outcome(hedge_won=None)
+                hedge_task = None
+        raise last_error or ValueError(f'No transcription services available. Session: {session_id}')
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+
+def _chunk_args(args: dict, chunk: AudioChunk) -> dict:
+    """Аргументы функции провайдера для части записи: файл части вместо исходных байтов/файла"""
+    chunk_args = dict(args)
+    for key in ('file_buffer', 'file_bytes', 'audio_bytes'):
+        if key in chunk_args:
+            chunk_args[key] = None
+    chunk_args['file_path'] = chunk.path
+    if 'audio_length' in chunk_args:
+        chunk_args['audio_length'] = chunk.duration
+    chunk_args['suppress_progress'] = True
+    return chunk_args
+
+
+async def _transcribe_in_chunks(transcription_options: dict, duration: float, file_path: str | None,
+                                audio_bytes: bytes | None, session_id: str) -> tuple[str, tuple[str, str]]:
+    """
+    Транскрипция по частям (services/chunked_transcription.py): каждая часть проходит свою
+    цепочку провайдеров в порядке роутера для её длительности. Провайдер в кэше — тот,
+    что транскрибировал больше частей.
+    """
+    providers = []
+
+    async def transcribe_chunk(chunk: AudioChunk) -> tuple[str, str]:
+        chunk_options = {service: {'function': options['function'], 'args': _chunk_args(options['args'], chunk)}
+                         for service, options in transcription_options.items()}
+        order = stt_router.order(list(chunk_options), chunk.duration)
+        # Пустая часть (тишина, музыка) — ноль сегментов, а не неудача провайдеров и всей задачи
+        service, chunk_result = await _transcribe_sequential({service: chunk_options[service] for service in order},
+                                                             chunk.duration, session_id, allow_empty=True)
+        providers.append(service)
+        return chunk_result
+
+    result = await transcribe_chunked(transcribe_chunk, duration, file_path=file_path, audio_bytes=audio_bytes,
+                                      session_id=session_id)
+    return Counter(providers).most_common(1)[0][0], result
+
+
+@limit_stage('stt')
 async def get_transcript(waiting_message, i18n: TranslatorRunner,
                          user_data: dict, language_code: str = None, audio_bytes: bytes | None = None, file_path: str = None,
                         audio_length: int = None, progress_manager=None, session_id: str = None,
-                        file_data: dict = None, use_quality_model: bool = False) -> tuple[str, str, int]:
+                        file_data: dict = None, use_quality_model: bool = False,
+                        audio_file_source_type: str = None) -> tuple[str, str, int]:
     """
     Get transcript from audio file
     file_data: dict = {
@@ -364,47 +511,55 @@ async def get_transcript(waiting_message, i18n: TranslatorRunner,
         else:  # 5 минут или меньше - приоритет deepgram
             priority_order = ['fireworks', 'assemblyai', 'deepgram' , 'openai', 'fal']
             logger.debug(f'Audio length: {audio_length} seconds. Use deepgram. Priority order: {priority_order}')
+    # Статический порядок — стартовая точка: роутер переставляет провайдеров по накопленной
+    # истории (успешность, латентность на минуту аудио, автоматы отключения)
+    route_length = audio_length or (file_data or {}).get('audio_duration')
+    priority_order = stt_router.order(priority_order, route_length)
     logger.info(f'Priority order: {priority_order}')
 
     # Создаем упорядоченный словарь согласно приоритету
     transcription_options = {service: base_options[service] for service in priority_order if service in base_options}
 
-    last_error = None
-    for service, options in transcription_options.items():
+    result = None
+    if should_chunk(route_length):
+        # Длинная запись: части параллельно, при неудаче — целиком, как раньше
         try:
-            timecoded_text, text = await options['function'](**options['args'])
-            if timecoded_text and text:  # Проверяем, что результат не пустой
-                if service == 'fireworks':
-                    if len(text.split()) < 5:
-                        raise ValueError(f"Fireworks STT returned small result. Session: {session_id}")
-                logger.debug(f'Successfully processed audio with {service}')
-
-                transcription_id = None
-                try:
-                    transcription_id = await save_transcription_cache(
-                        source_type=file_data['source_type'],
-                        original_identifier=file_data['original_identifier'],
-                        transcript_raw=text,
-                        transcript_timecoded=timecoded_text,
-                        transcription_provider=service,
-                        session_id=session_id,
-                        specific_source=file_data['specific_source'],
-                        file_hash=file_data.get('file_hash'),
-                        file_size_bytes=file_data['original_file_size'],
-                        audio_duration=file_data['audio_duration']
-                    )
-                    await update_processing_session(
-                    session_id=session_id,
-                    transcription_id=transcription_id
-                    )
-                except Exception as e:
-                    logger.error(f'Failed to save transcription to cache: {e}')
+            result = await _transcribe_in_chunks(transcription_options, route_length, file_path, audio_bytes, session_id)
+        except Exception as e:
+            logger.error(f'Chunked transcription failed, transcribing as a whole. Session: {session_id}. Error: {e}')
 
-                return text, timecoded_text, transcription_id
+    try:
+        if result is None:
+            if stt_hedge.eligible(audio_file_source_type, route_length):
+                result = await _transcribe_hedged(transcription_options, route_length, session_id)
+            else:
+                result = await _transcribe_sequential(transcription_options, route_length, session_id)
+        service, (timecoded_text, text) = result
+    except Exception as e:
+        last_error = e
+    else:
+        transcription_id = None
+        try:
+            transcription_id = await save_transcription_cache(
+                source_type=file_data['source_type'],
+                original_identifier=file_data['original_identifier'],
+                transcript_raw=text,
+                transcript_timecoded=timecoded_text,
+                transcription_provider=service,
+                session_id=session_id,
+                specific_source=file_data['specific_source'],
+                file_hash=file_data.get('file_hash'),
+                file_size_bytes=file_data['original_file_size'],
+                audio_duration=file_data['audio_duration']
+            )
+            await update_processing_session(
+            session_id=session_id,
+            transcription_id=transcription_id
+            )
         except Exception as e:
-            logger.error(f'Failed to process audio file. Service: {service}. Session: {session_id}. Error: {e}')
-            last_error = e
-            continue
+            logger.error(f'Failed to save transcription to cache: {e}')
+
+        return text, timecoded_text, transcription_id
 
     # Если все сервисы не сработали
     error_msg = f'All transcription services failed. Last error: {last_error}'
@@ -451,6 +606,7 @@ async def process_audio(waiting_message, user: dict, i18n: TranslatorRunner,
                                                     session_id=session_id,
                                                     file_data=file_data,
                                                     use_quality_model=use_quality_model,
+                                                    audio_file_source_type=audio_file_source_type,
                                                                       user_data=user)
 
         logger.debug(i18n.text_content(text=text))
@@ -502,6 +658,7 @@ async def process_audio(waiting_message, user: dict, i18n: TranslatorRunner,
         raise
 
 
+@limit_stage('llm')
 async def generate_title(text: str, user: dict, i18n: TranslatorRunner) -> str:
     """
     Генерирует название для транскрипции через OpenAI или Grok.
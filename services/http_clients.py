@@ -0,0 +1,228 @@
+"""
+Общие HTTP-клиенты с пулами соединений.
+
+Интеграции (STT-провайдеры, Fedor API, загрузчик файлов, LLM) создавали новый
+aiohttp.ClientSession или httpx.AsyncClient на каждый запрос — и на каждую итерацию
+опроса — и каждый раз платили за TCP + TLS (и прокси). Реестр держит на процесс:
+
+- одну aiohttp-сессию с keep-alive пулом (HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST);
+  прокси в aiohttp задаётся на запрос (proxy=...), таймауты тоже;
+- httpx-клиенты по варианту (прокси, HTTP/2): клиенты одного варианта делят пул,
+  HTTP/2 согласуется там, где сервер его поддерживает. Таймаут, заголовки и
+  follow_redirects передаются на запрос.
+
+Закрываются клиенты в close_http_clients() из on_shutdown. По хостам считаются запросы,
+ошибки, латентность до заголовков ответа и новые/переиспользованные соединения
+(aiohttp) или версия протокола (httpx); всё это отдаётся через /metrics.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import aiohttp
+import httpx
+
+logger = logging.getLogger(__name__)
+
+HTTP_POOL_LIMIT = int(os.environ.get('HTTP_POOL_LIMIT', '100'))
+HTTP_POOL_LIMIT_PER_HOST = int(os.environ.get('HTTP_POOL_LIMIT_PER_HOST', '20'))
+HTTP_KEEPALIVE_SECONDS = float(os.environ.get('HTTP_KEEPALIVE_SECONDS', '30'))
+# Сколько последних запросов на хост учитывается в латентности
+HTTP_METRICS_WINDOW = int(os.environ.get('HTTP_METRICS_WINDOW', '200'))
+
+# Таймаут по умолчанию для httpx-клиентов; долгие запросы передают свой timeout
+_DEFAULT_HTTPX_TIMEOUT = httpx.Timeout(60.0, connect=30.0)
+
+
+class _HostStats:
+    __slots__ = ('requests', 'errors', 'connections_created', 'connections_reused', 'http2', 'latencies')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.http2 = 0
+        self.latencies: deque[float] = deque(maxlen=HTTP_METRICS_WINDOW)
+
+
+class _MeteredTransport(httpx.AsyncBaseTransport):
+    """Транспорт httpx, который считает запросы и латентность по хостам"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, registry: 'HttpClientRegistry'):
+        self._transport = transport
+        self._registry = registry
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.monotonic()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            self._registry.record(request.url.host, None, error=True)
+            raise
+        self._registry.record(request.url.host, time.monotonic() - started, error=response.status_code >= 500,
+                              http2=response.extensions.get('http_version') == b'HTTP/2')
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class HttpClientRegistry:
+    """Клиенты на процесс: aiohttp-сессия и httpx-клиенты по (прокси, HTTP/2)"""
+
+    def __init__(self):
+        self._session: aiohttp.ClientSession | None = None
+        self._session_loop: asyncio.AbstractEventLoop | None = None
+        self._httpx_clients: dict[tuple[str | None, bool], httpx.AsyncClient] = {}
+        self._hosts: dict[str, _HostStats] = {}
+
+    def _host(self, host: str | None) -> _HostStats:
+        host = host or 'unknown'
+        stats = self._hosts.get(host)
+        if stats is None:
+            stats = self._hosts[host] = _HostStats()
+        return stats
+
+    def record(self, host: str | None, latency: float | None, error: bool = False, http2: bool = False) -> None:
+        stats = self._host(host)
+        stats.requests += 1
+        if error:
+            stats.errors += 1
+        if latency is not None:
+            stats.latencies.append(latency)
+        if http2:
+            stats.http2 += 1
+
+    # --- aiohttp ---
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            ctx.host = params.url.host
+            ctx.started = time.monotonic()
+
+        async def on_request_end(session, ctx, params):
+            self.record(ctx.host, time.monotonic() - ctx.started, error=params.response.status >= 500)
+
+        async def on_request_exception(session, ctx, params):
+            self.record(getattr(ctx, 'host', None), None, error=True)
+
+        async def on_connection_create_end(session, ctx, params):
+            self._host(getattr(ctx, 'host', None)).connections_created += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self._host(getattr(ctx, 'host', None)).connections_reused += 1
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace
+
+    def session(self) -> aiohttp.ClientSession:
+        """Общая aiohttp-сессия текущего цикла событий (создаётся при первом обращении)"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+                enable_cleanup_closed=True,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config()])
+            self._session_loop = loop
+        return self._session
+
+    # --- httpx ---
+
+    def httpx_client(self, proxy: str | None = None, http2: bool = True) -> httpx.AsyncClient:
+        """Общий httpx-клиент варианта (прокси, HTTP/2); можно получать и вне цикла событий"""
+        key = (proxy or None, http2)
+        client = self._httpx_clients.get(key)
+        if client is None or client.is_closed:
+            limits = httpx.Limits(
+                max_connections=HTTP_POOL_LIMIT,
+                max_keepalive_connections=HTTP_POOL_LIMIT_PER_HOST,
+                keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+            )
+            transport = httpx.AsyncHTTPTransport(http2=http2, proxy=proxy or None, limits=limits)
+            client = httpx.AsyncClient(transport=_MeteredTransport(transport, self), timeout=_DEFAULT_HTTPX_TIMEOUT)
+            self._httpx_clients[key] = client
+        return client
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        for client in self._httpx_clients.values():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning(f'Failed to close httpx client: {e}')
+        self._httpx_clients.clear()
+
+    def get_stats(self) -> dict:
+        hosts = {}
+        for host, stats in sorted(self._hosts.items()):
+            latencies = sorted(stats.latencies)
+            hosts[host] = {
+                'requests': stats.requests,
+                'errors': stats.errors,
+                'connections_created': stats.connections_created,
+                'connections_reused': stats.connections_reused,
+                'http2_responses': stats.http2,
+                'latency_avg_ms': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+                'latency_p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1)
+                if latencies else None,
+            }
+        return {
+            'aiohttp_session_open': self._session is not None and not self._session.closed,
+            'httpx_clients': [
+                {'proxy': bool(proxy), 'http2': http2} for proxy, http2 in self._httpx_clients
+            ],
+            'hosts': hosts,
+        }
+
+
+# Глобальный экземпляр
+http_clients = HttpClientRegistry()
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    return http_clients.session()
+
+
+@asynccontextmanager
+async def pooled_session():
+    """
+    Замена `async with aiohttp.ClientSession() as session:` — отдаёт общую сессию и не
+    закрывает её на выходе. Таймауты и прокси передаются в сам запрос.
+    """
+    yield http_clients.session()
+
+
+def get_httpx_client(proxy: str | None = None, http2: bool = True) -> httpx.AsyncClient:
+    return http_clients.httpx_client(proxy=proxy, http2=http2)
+
+
+@asynccontextmanager
+async def pooled_httpx_client(proxy: str | None = None, http2: bool = True):
+    """То же для `async with httpx.AsyncClient(...) as client:`; таймаут, заголовки и follow_redirects — в запрос"""
+    yield http_clients.httpx_client(proxy=proxy, http2=http2)
+
+
+async def close_http_clients() -> None:
+    """Закрывает общие клиенты (on_shutdown)"""
+    await http_clients.close()
+
+
+def get_http_client_stats() -> dict:
+    """Запросы, ошибки, латентность и соединения по хостам (отдаётся через /metrics)"""
+    return http_clients.get_stats()
@@ -7,6 +7,9 @@ Internal Bot Metrics - метрики изнутри процесса бота.
 - Thread count
 - HTTP request timing (если используется aiohttp ClientSession)
 - Object counts
+- User cache hit/miss (services.user_cache)
+- Background logging queue depth / batch size / flush latency
+- DB: латентность запросов по отпечаткам, ожидание пула, медленные запросы (services.db_telemetry)
 
 Использование:
 1. Вызвать start_metrics_collector() при старте бота
@@ -23,6 +26,8 @@ from datetime import datetime
 from typing import Optional, Dict, Any, List
 from collections import deque
 
+from services.user_cache import get_user_cache_stats
+
 logger = logging.getLogger(__name__)
 
 
@@ -312,6 +317,30 @@ class InternalMetricsCollector:
         if result.get('telegram_api_last_check'):
             result['telegram_api_last_check'] = result['telegram_api_last_check'].isoformat()
 
+        # Кэш пользователей (hit/miss)
+        result['user_cache'] = get_user_cache_stats()
+
+        # Фоновое логирование: глубина очереди, размер пачек, латентность сброса
+        # Локальный импорт: models.orm тянет конфиг и движок БД
+        from models.orm import get_background_logging_stats
+        result['background_logging'] = get_background_logging_stats()
+
+        # Телеметрия БД (пул, латентность запросов); движок к этому моменту уже создан models.orm
+        from services.db_telemetry import get_db_telemetry_stats
+        result['database'] = get_db_telemetry_stats()
+
+        # Глобальный допуск аудио-задач и лимиты стадий пайплайна
+        from services.concurrency_governor import get_audio_governor_stats
+        result['audio_governor'] = get_audio_governor_stats()
+
+        # Оценки STT-провайдеров: успешность, латентность на минуту аудио, автоматы
+        from services.stt_router import get_stt_router_stats
+        result['stt_router'] = get_stt_router_stats()
+
+        # Общие HTTP-пулы: запросы, ошибки, латентность и соединения по хостам
+        from services.http_clients import get_http_client_stats
+        result['http_clients'] = get_http_client_stats()
+
         return result
 
     def record_http_request_time(self, duration_ms: float, url: str = "", success: bool = True):
@@ -42,12 +42,16 @@ async def _send_day1_reminders():
     try:
         total_sent = 0
 
+        # Keyset по id: отметки об отправке пишутся в фоне и могут ещё не дойти до базы (или реплики),
+        # поэтому повторный запрос «ещё не получали» вернул бы тех же пользователей
+        last_id = 0
         while True:
-            users = await get_users_for_onboarding_day1(batch_size=100)
+            users = await get_users_for_onboarding_day1(batch_size=100, after_id=last_id)
             if not users:
                 logger.info(f"No more users found for Day 1 onboarding reminder. Total sent: {total_sent}")
                 break
 
+            last_id = users[-1]['id']
             logger.info(f"Found batch of {len(users)} users for Day 1 onboarding reminder.")
             translator_hub = create_translator_hub()
 
@@ -110,12 +114,15 @@ async def _send_day3_reminders():
     """
     try:
         total_sent = 0
+        # Keyset по id, как в _send_day1_reminders
+        last_id = 0
         while True:
-            users = await get_users_for_onboarding_day3(batch_size=100)
+            users = await get_users_for_onboarding_day3(batch_size=100, after_id=last_id)
             if not users:
                 logger.info(f"No more users found for Day 3 onboarding reminder. Total sent: {total_sent}")
                 break
 
+            last_id = users[-1]['id']
             logger.info(f"Found batch of {len(users)} users for Day 3 onboarding reminder.")
             translator_hub = create_translator_hub()
             for user in users:
@@ -172,12 +179,15 @@ async def _send_first_upload_reminders():
     """
     try:
         total_sent = 0
+        # Keyset по id, как в _send_day1_reminders
+        last_id = 0
         while True:
-            users = await get_users_for_first_upload_reminder(batch_size=100)
+            users = await get_users_for_first_upload_reminder(batch_size=100, after_id=last_id)
             if not users:
                 logger.info(f"No more users found for First Upload reminder. Total sent: {total_sent}")
                 break
 
+            last_id = users[-1]['id']
             logger.info(f"Found batch of {len(users)} users for First Upload reminder.")
             translator_hub = create_translator_hub()
             for user in users:
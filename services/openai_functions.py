@@ -1,36 +1,52 @@
+import asyncio
 import io
 from io import BytesIO
 import logging
+import os
+import shutil
+import tempfile
 
 import aiofiles
-import httpx
 import requests
 from fluentogram import TranslatorRunner
 from openai import AsyncOpenAI
 
 from lexicon import lexicon_ru
 from services.init_bot import config
-from services.services import calculate_progress, progress_bar, split_audio, convert_to_mp3, format_time
+from services.chunked_transcription import CHUNKED_STT_SEARCH_SECONDS, split_on_silence
+from services.http_clients import get_httpx_client
+from services.services import calculate_progress, progress_bar, split_audio, convert_to_mp3, format_time, \
+    get_audio_duration
+from services.streaming_upload import MultipartFileStream
 
 
 
-proxies = {'https://': config.proxy.proxy, 'http://': config.proxy.proxy}
-http_client = httpx.AsyncClient(proxies=proxies, timeout=360)
+# Общий пул соединений через прокси (services/http_clients.py)
+http_client = get_httpx_client(proxy=config.proxy.proxy)
 
 client = AsyncOpenAI(
     api_key=config.openai.api_key,
+    timeout=360,
     http_client=http_client,
 )
 
 logger = logging.getLogger(__name__)
 
+OPENAI_TRANSCRIPTIONS_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1').rstrip('/') + '/audio/transcriptions'
+# Лимит размера файла Whisper API
+WHISPER_MAX_UPLOAD_BYTES = 26000000
+# Размер частей при нарезке большого файла (с запасом до лимита)
+WHISPER_CHUNK_TARGET_BYTES = 22000000
+# Форматы, которые Whisper API принимает без конвертации
+_WHISPER_SUFFIXES = {'.mp3', '.mp4', '.mpeg', '.mpga', '.m4a', '.wav', '.webm', '.ogg', '.oga', '.flac'}
 
-def _build_timecoded_text_from_segments(segments: list[dict]) -> str:
-    """Создает текст с таймкодами из segments OpenAI API"""
+
+def _build_timecoded_text_from_segments(segments: list[dict], offset: float = 0.0) -> str:
+    """Создает текст с таймкодами из segments OpenAI API (offset — начало части в записи)"""
     timecoded_parts = []
     for segment in segments:
-        start_time = segment.get('start', 0)
-        end_time = segment.get('end', 0)
+        start_time = segment.get('start', 0) + offset
+        end_time = segment.get('end', 0) + offset
         text = segment.get('text', '').strip()
 
         if text:
@@ -41,60 +57,98 @@ def _build_timecoded_text_from_segments(segments: list[dict]) -> str:
     return ''.join(timecoded_parts).strip()
 
 
+async def _post_transcription(file_bytes: bytes | None = None, file_path: str | None = None) -> dict:
+    """Отправляет одну часть в Whisper API; файл с диска уходит потоком, без чтения в память"""
+    headers = {'Authorization': f'Bearer {config.openai.api_key}'}
+    data = {
+        'model': 'whisper-1',
+        'response_format': 'verbose_json',
+        'timestamp_granularities[]': 'segment'
+    }
+    if file_path:
+        body = MultipartFileStream(data, 'file', file_path)
+        response = await http_client.post(OPENAI_TRANSCRIPTIONS_URL, headers={**headers, **body.headers},
+                                          content=body, timeout=360)
+    else:
+        with io.BytesIO(file_bytes) as audio_file:
+            files = {'file': ('audio.mp3', audio_file, 'audio/mpeg')}
+            response = await http_client.post(OPENAI_TRANSCRIPTIONS_URL, headers=headers, files=files, data=data,
+                                              timeout=360)
+    return response.json()
+
+
+async def _update_progress(waiting_message, i18n: TranslatorRunner, index: int, total_parts: int):
+    progress = calculate_progress(index, total_parts)
+    if progress <= 39:
+        await waiting_message.edit_text(text=i18n.transcribe_audio_progress(progress=progress_bar(progress, i18n)))
+    elif progress == 40:
+        await waiting_message.edit_text(text=i18n.transcribe_audio_progress_extracting(progress=progress_bar(progress, i18n)))
+    elif 45 <= progress <= 79:
+        await waiting_message.edit_text(text=i18n.transcribe_audio_progress_almost_done(progress=progress_bar(progress, i18n)))
+    elif progress >= 80:
+        await waiting_message.edit_text(text=i18n.transcribe_audio_progress_finishing(progress=progress_bar(progress, i18n)))
+
+
+async def _split_file_for_whisper(file_path: str, file_size: int, work_dir: str) -> list[tuple[float, str]]:
+    """Режет файл больше лимита Whisper по паузам на части ~WHISPER_CHUNK_TARGET_BYTES: [(начало, путь)]"""
+    duration = await get_audio_duration(file_path=file_path)
+    # Длительность части по среднему битрейту файла; поиск паузы ограничен, чтобы часть не вышла за лимит
+    chunk_seconds = max(duration * WHISPER_CHUNK_TARGET_BYTES / file_size, 60.0)
+    chunks = await split_on_silence(file_path, duration, work_dir, chunk_seconds=chunk_seconds, overlap_seconds=0.0,
+                                    search_seconds=min(CHUNKED_STT_SEARCH_SECONDS, chunk_seconds * 0.1))
+    return [(chunk.start, chunk.path) for chunk in chunks]
+
+
 async def audio_to_text(file_bytes: bytes, waiting_message, i18n: TranslatorRunner, suppress_progress: bool = False, file_path: str = None) -> tuple[str, str]:
     """
     Транскрибирует аудио через OpenAI Whisper API.
 
+    Файл на диске в поддерживаемом формате отправляется потоком, а больше лимита —
+    нарезается ffmpeg на части на диске, поэтому в память целиком не читается.
+
     Returns:
         tuple[str, str]: (timecoded_text, plain_text)
     """
-    if file_path:
-        async with aiofiles.open(file_path, 'rb') as f:
-            file_bytes = await f.read()
-
-    if len(file_bytes) > 26000000:
-        if not suppress_progress:
-            await waiting_message.edit_text(text=i18n.transcribe_audio_progress(progress=progress_bar(39, i18n)))
-        # Контрольная точка 3.1.1. Разделяем аудио на части, если оно большое
-        files_list: list[bytes] = await split_audio(file_bytes)
+    work_dir = None
+    if file_path and os.path.splitext(file_path)[1].lower() in _WHISPER_SUFFIXES:
+        file_size = os.path.getsize(file_path)
+        if file_size > WHISPER_MAX_UPLOAD_BYTES:
+            if not suppress_progress:
+                await waiting_message.edit_text(text=i18n.transcribe_audio_progress(progress=progress_bar(39, i18n)))
+            work_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix='whisper_')
+            parts: list[tuple[float, str | None, bytes | None]] = [
+                (start, path, None) for start, path in await _split_file_for_whisper(file_path, file_size, work_dir)
+            ]
+        else:
+            parts = [(0.0, file_path, None)]
     else:
-        files_list = [file_bytes]
+        if file_path:
+            async with aiofiles.open(file_path, 'rb') as f:
+                file_bytes = await f.read()
+
+        if len(file_bytes) > 26000000:
+            if not suppress_progress:
+                await waiting_message.edit_text(text=i18n.transcribe_audio_progress(progress=progress_bar(39, i18n)))
+            # Контрольная точка 3.1.1. Разделяем аудио на части, если оно большое
+            files_list: list[bytes] = await split_audio(file_bytes)
+        else:
+            files_list = [file_bytes]
+        parts = [(0.0, None, part) for part in files_list]
 
     all_text = ''
     all_timecoded_text = ''
 
-    # Контрольная точка 3.2. Отправляем по частям. Каждая часть отдельные проценты
-    total_parts = len(files_list)
-    for index, file_bytes in enumerate(files_list):
-        progress = calculate_progress(index, total_parts)
-        if not suppress_progress:
-            if progress <= 39:
-                await waiting_message.edit_text(text=i18n.transcribe_audio_progress(progress=progress_bar(progress, i18n)))
-            elif progress == 40:
-                await waiting_message.edit_text(text=i18n.transcribe_audio_progress_extracting(progress=progress_bar(progress, i18n)))
-            elif 45 <= progress <= 79:
-                await waiting_message.edit_text(text=i18n.transcribe_audio_progress_almost_done(progress=progress_bar(progress, i18n)))
-            elif progress >= 80:
-                await waiting_message.edit_text(text=i18n.transcribe_audio_progress_finishing(progress=progress_bar(progress, i18n)))
-
-        file_bytes: bytes = await convert_to_mp3(file_bytes)
-        with io.BytesIO(file_bytes) as audio_file:
-            audio_file.seek(0)  # Сбрасываем указатель на начало буфера
-            files = {'file': ('audio.mp3', audio_file, 'audio/mpeg')}
-
-            # Использование HTTPX для выполнения запроса с таймкодами
-            response = await http_client.post(
-                'https://api.openai.com/v1/audio/transcriptions',
-                headers={'Authorization': f'Bearer {config.openai.api_key}'},
-                files=files,
-                data={
-                    'model': 'whisper-1',
-                    'response_format': 'verbose_json',
-                    'timestamp_granularities[]': 'segment'
-                }
-            )
-
-            response_data = response.json()
+    try:
+        # Контрольная точка 3.2. Отправляем по частям. Каждая часть отдельные проценты
+        total_parts = len(parts)
+        for index, (offset, part_path, part_bytes) in enumerate(parts):
+            if not suppress_progress:
+                await _update_progress(waiting_message, i18n, index, total_parts)
+
+            if part_path:
+                response_data = await _post_transcription(file_path=part_path)
+            else:
+                response_data = await _post_transcription(file_bytes=await convert_to_mp3(part_bytes))
             logger.debug(f'OpenAI response keys: {response_data.keys()}')
 
             # Получаем plain text
@@ -104,11 +158,14 @@ async def audio_to_text(file_bytes: bytes, waiting_message, i18n: TranslatorRunn
             # Получаем segments и строим timecoded text
             segments = response_data.get('segments', [])
             if segments:
-                timecoded_part = _build_timecoded_text_from_segments(segments)
+                timecoded_part = _build_timecoded_text_from_segments(segments, offset=offset)
                 all_timecoded_text += timecoded_part + '\n\n'
             else:
                 # Fallback если нет segments
                 all_timecoded_text += f'[00:00 - 00:00] SPEAKER\n{plain_text}\n\n'
+    finally:
+        if work_dir:
+            await asyncio.to_thread(shutil.rmtree, work_dir, True)
 
     if not suppress_progress:
         await waiting_message.edit_text(text=i18n.transcribe_audio_progress_finishing(progress=progress_bar(100, i18n)))
@@ -60,10 +60,13 @@ async def send_first_payment_reminder() -> dict:
 
         logger.info(f"Starting first payment reminder check (after {reminder_hours}h)...")
 
-        # Обрабатываем пользователей батчами до тех пор, пока они есть
+        # Обрабатываем пользователей батчами до тех пор, пока они есть. Keyset по id: отметки
+        # об отправке пишутся в фоне и могут ещё не дойти до базы (или реплики)
+        last_id = 0
         while True:
             users = await get_users_for_first_reminder(
                 batch_size=100,
+                after_id=last_id,
                 reminder_hours=reminder_hours,
                 search_window_hours=search_window
             )
@@ -75,6 +78,7 @@ async def send_first_payment_reminder() -> dict:
                 )
                 break
 
+            last_id = users[-1]['user_id']
             logger.info(f"Found batch of {len(users)} users for first payment reminder ({reminder_hours}h)")
             stats['found'] += len(users)
 
@@ -144,10 +148,12 @@ async def send_second_payment_reminder() -> dict:
 
         logger.info(f"Starting second payment reminder check (after {reminder_hours}h from last activity)...")
 
-        # Обрабатываем пользователей батчами до тех пор, пока они есть
+        # Обрабатываем пользователей батчами до тех пор, пока они есть (keyset по id)
+        last_id = 0
         while True:
             users = await get_users_for_second_reminder(
                 batch_size=100,
+                after_id=last_id,
                 reminder_hours=reminder_hours,
                 search_window_hours=search_window
             )
@@ -159,6 +165,7 @@ async def send_second_payment_reminder() -> dict:
                 )
                 break
 
+            last_id = users[-1]['user_id']
             logger.info(f"Found batch of {len(users)} users for second payment reminder ({reminder_hours}h)")
             stats['found'] += len(users)
 
@@ -1,15 +1,15 @@
 import logging
 import os
 
-import httpx
 from fluentogram import TranslatorRunner
 from groq import AsyncGroq
 
 from services.init_bot import config
+from services.http_clients import get_httpx_client
 logger = logging.getLogger(__name__)
 
-_proxies = {'https://': config.proxy.proxy, 'http://': config.proxy.proxy}
-_groq_http_client = httpx.AsyncClient(proxies=_proxies, timeout=360)
+# Общий пул соединений через прокси (services/http_clients.py)
+_groq_http_client = get_httpx_client(proxy=config.proxy.proxy)
 
 # client = Groq(
 #     api_key=os.environ.get("GROQ_API_KEY"),
@@ -29,7 +29,7 @@ _groq_http_client = httpx.AsyncClient(proxies=_proxies, timeout=360)
 
 
 async def summarise_text(text: str, i18n: TranslatorRunner) -> str:
-    client = AsyncGroq(api_key=config.grok.api_key, http_client=_groq_http_client)
+    client = AsyncGroq(api_key=config.grok.api_key, timeout=360, http_client=_groq_http_client)
 
     message = i18n.summarise_text_system_prompt_gpt_oss() + '\n' +i18n.text_prompt(text=text)
     response = await client.chat.completions.create(
@@ -57,7 +57,7 @@ async def generate_title_grok(text: str, i18n: TranslatorRunner) -> str:
     Returns:
         str: Сгенерированное название
     """
-    client = AsyncGroq(api_key=config.grok.api_key, http_client=_groq_http_client)
+    client = AsyncGroq(api_key=config.grok.api_key, timeout=360, http_client=_groq_http_client)
     
     message = i18n.generate_title_system_prompt() + '\n' + i18n.title_prompt(text=text)
     
@@ -89,7 +89,7 @@ async def generate_title_grok(text: str, i18n: TranslatorRunner) -> str:
 
 
 async def chat_function(context: list[dict], i18n: TranslatorRunner) -> str | bool:
-    client = AsyncGroq(api_key=config.grok.api_key, http_client=_groq_http_client)
+    client = AsyncGroq(api_key=config.grok.api_key, timeout=360, http_client=_groq_http_client)
     if context[0]['role'] != 'system':
         context.insert(0, {'role': 'system', 'content': i18n.chat_system_prompt_gpt_oss()})
     try:
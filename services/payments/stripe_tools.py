@@ -12,7 +12,7 @@ from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime, timedelta
 
 from services.init_bot import config
-from models.orm import get_user, db_add_subscription, async_session
+from models.orm import get_user, db_add_subscription, read_session, on_replica
 from sqlalchemy import select
 from models.model import User
 from utils.i18n import create_translator_hub
@@ -199,6 +199,7 @@ async def validate_and_sync_subscription(telegram_id: str) -> bool:
         logger.error(f"Error validating subscription for user {telegram_id}: {e}")
         return False
 
+@on_replica
 async def check_all_stripe_subscriptions() -> Dict[str, Any]:
     """
     Проверяет все подписки Stripe в базе данных
@@ -212,7 +213,7 @@ async def check_all_stripe_subscriptions() -> Dict[str, Any]:
     - count_missing_in_db: Количество подписок, которые есть в Stripe, но отсутствуют в БД
     - issues: Список проблемных подписок
     """
-    async with async_session() as session:
+    async with read_session() as session:
         # Находим всех пользователей с подписками Stripe
         result = await session.execute(
             select(User).filter(User.subscription_id.isnot(None))
@@ -415,6 +416,7 @@ async def check_all_stripe_subscriptions() -> Dict[str, Any]:
             'issues': issues
         }
 
+@on_replica
 async def sync_stripe_subscriptions(fix_issues: bool = False) -> Dict[str, Any]:
     """
     Синхронизирует все подписки Stripe между базой данных и Stripe
@@ -436,7 +438,7 @@ async def sync_stripe_subscriptions(fix_issues: bool = False) -> Dict[str, Any]:
     results = []
     
     # Собираем информацию о существующих подписках Stripe в БД
-    async with async_session() as session:
+    async with read_session() as session:
         # Поиск всех subscription_id в БД
         result = await session.execute(
             select(User.subscription_id, User.telegram_id).filter(
@@ -1079,6 +1081,7 @@ async def get_stripe_customer_metadata(customer_id: str) -> Dict[str, Any]:
             'details': str(e)
         }
 
+@on_replica
 async def update_all_customers_metadata() -> Dict[str, Any]:
     """
     Массовое обновление метаданных всех клиентов Stripe, 
@@ -1099,7 +1102,7 @@ async def update_all_customers_metadata() -> Dict[str, Any]:
     }
     
     # Шаг 1: Получаем всех пользователей с подписками Stripe из базы данных
-    async with async_session() as session:
+    async with read_session() as session:
         result = await session.execute(
             select(User).filter(User.subscription_id.isnot(None))
         )
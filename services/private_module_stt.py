@@ -5,7 +5,6 @@ import aiohttp
 import asyncio
 import os
 from typing import Optional, Union
-import aiofiles
 from fluentogram import TranslatorRunner
 import subprocess
 import json
@@ -15,6 +14,8 @@ from services.services import progress_bar
 from services.telegram_alerts import send_alert
 from services.transcription_grouper import extract_plain_text, group_transcription_smart
 from services.init_bot import config
+from services.http_clients import pooled_session
+from services.streaming_upload import FileStream
 logger = logging.getLogger(__name__)
 
 
@@ -44,18 +45,19 @@ class PrivateSTTClient:
         self.api_url = api_url
         self.api_key = api_key
 
-    def get_audio_duration(self, file_bytes: bytes) -> Optional[float]:
+    def get_audio_duration(self, file_bytes: Optional[bytes] = None, file_path: Optional[str] = None) -> Optional[float]:
         """
-        Получает длительность аудио файла в секундах с помощью ffprobe.
+        Получает длительность аудио файла в секундах с помощью mutagen.
         
         Args:
-            file_path: Путь к аудио файлу
+            file_bytes: Содержимое аудио файла
+            file_path: Путь к аудио файлу (читаются только заголовки)
             
         Returns:
             float: Длительность в секундах или None при ошибке
         """
         try:
-            audio = File(io.BytesIO(file_bytes))
+            audio = File(file_path) if file_path else File(io.BytesIO(file_bytes))
             return audio.info.length
         except Exception as e:
             logger.error(f"Exception while getting audio duration: {e}")
@@ -96,7 +98,7 @@ class PrivateSTTClient:
         try:
             headers = {"x-api-key": self.api_key} if self.api_key else {}
             payload = {"job_ids": job_ids, 'check_failed_jobs': True}
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                     async with session.post(self.api_url, headers=headers, json=payload) as response:
                         if response.status == 200:
                             data = await response.json()
@@ -123,7 +125,7 @@ class PrivateSTTClient:
         try:
             headers = {"x-api-key": self.api_key} if self.api_key else {}
             payload = {"job_id": job_id, "cancel_job": True}
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.post(self.api_url, headers=headers, json=payload) as response:
                     if response.status == 200:
                         data = await response.json()
@@ -150,7 +152,7 @@ class PrivateSTTClient:
             headers = {"x-api-key": self.api_key} if self.api_key else {}
             payload = {"file_name": file_name}
 
-            async with aiohttp.ClientSession() as session:
+            async with pooled_session() as session:
                 async with session.post(self.api_url, headers=headers, json=payload) as response:
                     if response.status == 200:
                         # Ответ может быть уже JSON с нужными полями или обёрнут в { body: "{...}" }
@@ -211,33 +213,23 @@ class PrivateSTTClient:
 
             logger.debug(f"Uploading audio file: {file_path} ({file_size:,} bytes)")
             
-            # Read file and get duration
-            async with aiofiles.open(file_path, 'rb') as file:
-                file_content = await file.read()
-                duration: Optional[float] = self.get_audio_duration(file_content)
+            # Длительность по заголовкам, файл целиком в память не читается
+            duration: Optional[float] = self.get_audio_duration(file_path=file_path)
             
             # Retry loop with exponential backoff
             for attempt in range(1, MAX_UPLOAD_RETRIES + 1):
                 try:
                     logger.debug(f"Upload attempt {attempt}/{MAX_UPLOAD_RETRIES}...")
                     
-                    headers = {"Content-Type": "application/octet-stream"}
+                    body = FileStream(file_path, CHUNK_SIZE)
+                    headers = {"Content-Type": "application/octet-stream", **body.headers}
                     timeout = aiohttp.ClientTimeout(
                         sock_connect=CONNECT_TIMEOUT,
                         sock_read=READ_TIMEOUT
                     )
                     
-                    async with aiohttp.ClientSession(timeout=timeout) as session:
-                        # Create chunked data generator
-                        async def file_sender():
-                            async with aiofiles.open(file_path, 'rb') as f:
-                                while True:
-                                    chunk = await f.read(CHUNK_SIZE)
-                                    if not chunk:
-                                        break
-                                    yield chunk
-                        
-                        async with session.put(upload_url, data=file_sender(), headers=headers) as response:
+                    async with pooled_session() as session:
+                        async with session.put(upload_url, data=body, headers=headers, timeout=timeout) as response:
                             # Only 200 or 204 mean success
                             if response.status in (200, 204):
                                 logger.info(f"✅ Upload succeeded on attempt {attempt}")
@@ -303,7 +295,7 @@ class PrivateSTTClient:
                         sock_read=READ_TIMEOUT
                     )
                     
-                    async with aiohttp.ClientSession(timeout=timeout) as session:
+                    async with pooled_session() as session:
                         # Create chunked data generator
                         async def buffer_sender():
                             offset = 0
@@ -312,7 +304,7 @@ class PrivateSTTClient:
                                 yield chunk
                                 offset += CHUNK_SIZE
                         
-                        async with session.put(upload_url, data=buffer_sender(), headers=headers) as response:
+                        async with session.put(upload_url, data=buffer_sender(), headers=headers, timeout=timeout) as response:
                             # Only 200 or 204 mean success
                             if response.status in (200, 204):
                                 logger.info(f"✅ Upload succeeded on attempt {attempt}")
@@ -393,7 +385,7 @@ class PrivateSTTClient:
                     await self.cancel_job(job_id)
                     raise TimeoutError(f"Failed to get transcript after {max_attempts} attempts ({timeout_seconds}s timeout)")
                 
-                async with aiohttp.ClientSession() as session:
+                async with pooled_session() as session:
                     async with session.get(download_url) as response:
                         if response.status == 200:
                             transcript_text = await response.text()
@@ -14,6 +14,7 @@ from datetime import datetime
 from aiogram.types import BufferedInputFile
 from pydub import AudioSegment
 from fluentogram import TranslatorRunner
+from services.concurrency_governor import limit_stage
 
 from services.word_service import create_enhanced_transcript_docx, create_simple_transcript_docx
 from services.init_bot import config
@@ -340,6 +341,7 @@ async def create_two_input_files_from_text(full_transcript: str,
 
 
 @async_log_decorator
+@limit_stage('ffmpeg')
 async def split_audio(audio_data: bytes, chunk_size_ms: int = 600000, i18n: TranslatorRunner = None) -> list:
     """
     Split audio into parts of specified size.
@@ -413,6 +415,7 @@ async def split_audio(audio_data: bytes, chunk_size_ms: int = 600000, i18n: Tran
 
 
 @async_log_decorator
+@limit_stage('ffmpeg')
 async def extract_audio_from_video(
     i18n: TranslatorRunner,
     video_buffer: io.BytesIO | None = None,
@@ -661,6 +664,7 @@ async def get_audio_duration(audio_bytes: bytes | None = None, file_path: str |
 
 
 @async_log_decorator
+@limit_stage('ffmpeg')
 async def convert_to_mp3(
     input_audio: bytes | None = None,
     file_path: str | None = None,
@@ -830,6 +834,13 @@ def sources_to_str_paginated(sources: list[tuple[str, int]], page: int, per_page
     
     return formatted_sources, total_pages, has_previous, has_next
 
+
+def statistics_refreshed_str(refreshed_at: datetime | None, i18n: TranslatorRunner) -> str:
+    """Строка "данные обновлены" для админской статистики (пустая, если снимка ещё нет)"""
+    if refreshed_at is None:
+        return ''
+    return '\n\n' + i18n.statistics_refreshed_at(refreshed_at=refreshed_at.strftime('%d.%m.%Y %H:%M'))
+
 @async_log_decorator
 async def delete_file(file_path: str):
     logger.debug(f"Attempting to delete file: {file_path}")
@@ -1385,3 +1396,31 @@ def split_long_message(text: str, max_length: int = 4000) -> list[str]:
         messages.append(current_message.strip())
     
     return messages
+
+
+def spam_target_filters(state_data: dict) -> dict:
+    """
+    Фильтры models.orm.iter_users / count_users для аудитории рассылки из данных FSM.
+
+    Args:
+        state_data: Данные состояния админа (start_id, end_id, spam_type,
+                    exclusion_reference_time, exclude_ids)
+
+    Returns:
+        dict с keyword-аргументами фильтров
+    """
+    from models.orm import broadcast_exclusion_query
+
+    filters = {
+        'start_id': state_data.get('start_id') or None,
+        'end_id': state_data.get('end_id') or None,
+        'is_bot_blocked': False,
+        'subscribed': {'spam_subscribed': True, 'spam_unsubscribed': False}.get(state_data.get('spam_type')),
+        'exclude_ids': state_data.get('exclude_ids', []),
+    }
+    # Напоминания исключаются anti-join'ом в SQL с тем же окном, по которому считалась статистика
+    if state_data.get('exclusion_reference_time'):
+        filters['exclude_query'] = broadcast_exclusion_query(
+            reference_time=datetime.fromisoformat(state_data['exclusion_reference_time'])
+        )
+    return filters
@@ -0,0 +1,87 @@
+"""
+Потоковая отправка аудиофайлов провайдерам.
+
+Клиенты STT читали файл целиком (aiofiles.read / bytes) перед отправкой, а иногда
+ещё раз копировали его в multipart-тело: на подкасте в 500 МБ это несколько полных
+копий в памяти на задачу. Здесь тела запросов читаются с диска кусками по
+UPLOAD_CHUNK_BYTES, поэтому память на загрузку не зависит от размера файла:
+
+- FileStream — «сырое» тело (AssemblyAI upload, Deepgram, PUT в private STT);
+- MultipartFileStream — multipart/form-data с полями формы и одним файлом
+  (Fireworks, OpenAI).
+
+Оба — async-iterable и отдают Content-Length, поэтому подходят и для httpx
+(content=...), и для aiohttp (data=...), и итерируются заново при повторной попытке.
+"""
+
+import os
+import uuid
+
+import aiofiles
+
+UPLOAD_CHUNK_BYTES = int(os.environ.get('UPLOAD_CHUNK_BYTES', str(1024 * 1024)))
+
+
+class FileStream:
+    """Тело запроса из файла на диске, читается кусками по chunk_size"""
+
+    def __init__(self, path: str, chunk_size: int = UPLOAD_CHUNK_BYTES):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(path)
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return {'Content-Length': str(self.size)}
+
+    async def __aiter__(self):
+        async with aiofiles.open(self.path, 'rb') as f:
+            while True:
+                chunk = await f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+def _quote(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '%22').replace('\r', '%0D').replace('\n', '%0A')
+
+
+class MultipartFileStream:
+    """multipart/form-data: текстовые поля fields и файл path в поле file_field"""
+
+    def __init__(self, fields: dict, file_field: str, path: str, filename: str | None = None,
+                 content_type: str = 'application/octet-stream', chunk_size: int = UPLOAD_CHUNK_BYTES):
+        self.boundary = uuid.uuid4().hex
+        self._file = FileStream(path, chunk_size)
+
+        parts = []
+        for name, value in fields.items():
+            if value is None:
+                continue
+            parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{_quote(str(name))}"\r\n\r\n'
+                f'{value}\r\n'.encode()
+            )
+        filename = filename or os.path.basename(path) or 'audio'
+        parts.append(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{_quote(file_field)}"; '
+            f'filename="{_quote(filename)}"\r\nContent-Type: {content_type}\r\n\r\n'.encode()
+        )
+        self._preamble = b''.join(parts)
+        self._epilogue = f'\r\n--{self.boundary}--\r\n'.encode()
+        self.size = len(self._preamble) + self._file.size + len(self._epilogue)
+
+    @property
+    def content_type(self) -> str:
+        return f'multipart/form-data; boundary={self.boundary}'
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return {'Content-Type': self.content_type, 'Content-Length': str(self.size)}
+
+    async def __aiter__(self):
+        yield self._preamble
+        async for chunk in self._file:
+            yield chunk
+        yield self._epilogue
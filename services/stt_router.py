@@ -0,0 +1,367 @@
+"""
+Адаптивный выбор STT-провайдера для get_transcript.
+
+Раньше get_transcript перебирал провайдеров в жёстком порядке: деградировавший
+провайдер каждый раз съедал свой таймаут, прежде чем задача переходила к следующему.
+Роутер запоминает исходы попыток и переставляет кандидатов:
+
+1. Для каждой пары (провайдер, корзина длительности) хранится скользящее окно из
+   STT_ROUTER_WINDOW попыток: успех/неудача и секунды обработки на минуту аудио.
+   Корзины: short (до 2 минут), medium (до 15 минут), long.
+2. Оценка провайдера — ожидаемое время до готовой транскрипции: медианная латентность
+   с учётом доли неудач (неудачная попытка тоже тратит время), плюс опционально
+   стоимость минуты с весом STT_ROUTER_COST_WEIGHT. Пока данных мало, оценка
+   сглаживается априорными значениями, поэтому на холодном старте сохраняется
+   статический порядок из get_transcript.
+3. Автомат (circuit breaker) на провайдера: после STT_ROUTER_BREAKER_FAILURES неудач
+   подряд провайдер уходит в конец списка на STT_ROUTER_BREAKER_COOLDOWN_SECONDS,
+   затем получает одну пробную попытку.
+
+4. Хеджирование коротких голосовых (STT_HEDGE_ENABLED): если основной провайдер не
+   ответил за выученный p90 своей корзины, get_transcript параллельно запускает
+   следующего и берёт первый годный результат. Лишние расходы ограничены бюджетом
+   STT_HEDGE_BUDGET_PER_HOUR, исходы хеджей считаются в HedgeController.
+
+Состояние живёт в памяти процесса; оценки отдаются через /metrics (get_stt_router_stats).
+"""
+
+import logging
+import os
+import time
+from collections import deque
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+STT_ROUTER_WINDOW = int(os.environ.get('STT_ROUTER_WINDOW', '50'))
+# Сколько успешных попыток нужно, чтобы латентность опиралась только на наблюдения
+STT_ROUTER_MIN_SAMPLES = int(os.environ.get('STT_ROUTER_MIN_SAMPLES', '5'))
+STT_ROUTER_BREAKER_FAILURES = int(os.environ.get('STT_ROUTER_BREAKER_FAILURES', '3'))
+STT_ROUTER_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('STT_ROUTER_BREAKER_COOLDOWN_SECONDS', '120'))
+# Секунд ожидания, которые стоит один доллар; 0 — выбирать только по времени
+STT_ROUTER_COST_WEIGHT = float(os.environ.get('STT_ROUTER_COST_WEIGHT', '0'))
+# Априорная латентность (секунд на минуту аудио) для провайдера без истории
+STT_ROUTER_PRIOR_SECONDS_PER_MINUTE = float(os.environ.get('STT_ROUTER_PRIOR_SECONDS_PER_MINUTE', '6'))
+
+# Хеджирование: только для этих типов источника и не длиннее STT_HEDGE_MAX_AUDIO_SECONDS
+STT_HEDGE_ENABLED = os.environ.get('STT_HEDGE_ENABLED', 'false').lower() == 'true'
+STT_HEDGE_SOURCE_TYPES = frozenset(
+    source.strip() for source in os.environ.get('STT_HEDGE_SOURCE_TYPES', 'voice,video_note').split(',') if source.strip()
+)
+STT_HEDGE_MAX_AUDIO_SECONDS = float(os.environ.get('STT_HEDGE_MAX_AUDIO_SECONDS', '300'))
+# Задержка хеджа, пока у провайдера меньше min_samples успехов в корзине; и нижняя граница выученной
+STT_HEDGE_DEFAULT_DELAY_SECONDS = float(os.environ.get('STT_HEDGE_DEFAULT_DELAY_SECONDS', '10'))
+STT_HEDGE_MIN_DELAY_SECONDS = float(os.environ.get('STT_HEDGE_MIN_DELAY_SECONDS', '2'))
+# Долларов в час на дополнительные (хеджирующие) запросы
+STT_HEDGE_BUDGET_PER_HOUR = float(os.environ.get('STT_HEDGE_BUDGET_PER_HOUR', '0.5'))
+
+# Стоимость минуты аудио в долларах; переопределяется STT_COST_PER_MINUTE_<PROVIDER>
+_DEFAULT_COST_PER_MINUTE = {
+    'fireworks': 0.0009,
+    'assemblyai': 0.0062,
+    'deepgram': 0.0043,
+    'openai': 0.006,
+    'fal': 0.0011,
+    'elevateai': 0.002,
+    'private_stt': 0.0,
+}
+STT_COST_PER_MINUTE = {
+    provider: float(os.environ.get(f'STT_COST_PER_MINUTE_{provider.upper()}', str(cost)))
+    for provider, cost in _DEFAULT_COST_PER_MINUTE.items()
+}
+
+# Верхние границы корзин длительности, секунды
+DURATION_BUCKETS = (('short', 120), ('medium', 900), ('long', None))
+# Типичная длительность корзины, для которой в /metrics показывается оценка
+_BUCKET_REFERENCE_SECONDS = {'short': 60, 'medium': 600, 'long': 1800}
+
+# Вес априорной доли успеха (в «виртуальных попытках») и её значение
+_PRIOR_ATTEMPTS = 4
+_PRIOR_SUCCESS_RATE = 0.9
+
+
+def duration_bucket(audio_length: float | None) -> str:
+    """Корзина длительности; неизвестная длительность считается средней"""
+    if not audio_length:
+        return 'medium'
+    for name, limit in DURATION_BUCKETS:
+        if limit is None or audio_length <= limit:
+            return name
+    return DURATION_BUCKETS[-1][0]
+
+
+def _percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class _ProviderWindow:
+    """Скользящее окно попыток провайдера в одной корзине"""
+
+    __slots__ = ('samples', 'attempts_total', 'failures_total')
+
+    def __init__(self, size: int):
+        # (успех, секунды попытки, секунды на минуту аудио или None)
+        self.samples: deque[tuple[bool, float, float | None]] = deque(maxlen=size)
+        self.attempts_total = 0
+        self.failures_total = 0
+
+    def add(self, ok: bool, seconds: float, per_minute: float | None) -> None:
+        self.samples.append((ok, seconds, per_minute))
+        self.attempts_total += 1
+        if not ok:
+            self.failures_total += 1
+
+    def success_rate(self) -> float:
+        successes = sum(1 for ok, _, _ in self.samples if ok)
+        return (successes + _PRIOR_ATTEMPTS * _PRIOR_SUCCESS_RATE) / (len(self.samples) + _PRIOR_ATTEMPTS)
+
+    def latencies(self) -> list[float]:
+        return [per_minute for ok, _, per_minute in self.samples if ok and per_minute is not None]
+
+    def success_seconds(self) -> list[float]:
+        return [seconds for ok, seconds, _ in self.samples if ok]
+
+    def failure_seconds(self) -> float | None:
+        spent = [seconds for ok, seconds, _ in self.samples if not ok]
+        return sum(spent) / len(spent) if spent else None
+
+
+class _Breaker:
+    __slots__ = ('consecutive_failures', 'opened_until', 'opened_total')
+
+    def __init__(self):
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self.opened_total = 0
+
+
+class SttRouter:
+    """Оценка STT-провайдеров по истории попыток и порядок их перебора"""
+
+    def __init__(self, window: int = STT_ROUTER_WINDOW, min_samples: int = STT_ROUTER_MIN_SAMPLES,
+                 breaker_failures: int = STT_ROUTER_BREAKER_FAILURES,
+                 breaker_cooldown: float = STT_ROUTER_BREAKER_COOLDOWN_SECONDS,
+                 cost_weight: float = STT_ROUTER_COST_WEIGHT,
+                 cost_per_minute: dict[str, float] | None = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.window = window
+        self.min_samples = min_samples
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.cost_weight = cost_weight
+        self.cost_per_minute = dict(STT_COST_PER_MINUTE if cost_per_minute is None else cost_per_minute)
+        self._clock = clock
+        self._windows: dict[tuple[str, str], _ProviderWindow] = {}
+        self._breakers: dict[str, _Breaker] = {}
+
+    def _window(self, provider: str, bucket: str) -> _ProviderWindow:
+        key = (provider, bucket)
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = _ProviderWindow(self.window)
+        return window
+
+    def _breaker(self, provider: str) -> _Breaker:
+        breaker = self._breakers.get(provider)
+        if breaker is None:
+            breaker = self._breakers[provider] = _Breaker()
+        return breaker
+
+    def _breaker_state(self, provider: str) -> str:
+        breaker = self._breakers.get(provider)
+        if breaker is None or breaker.consecutive_failures < self.breaker_failures:
+            return 'closed'
+        if self._clock() < breaker.opened_until:
+            return 'open'
+        return 'half_open'
+
+    def _seconds_per_minute(self, window: _ProviderWindow, quantile: float) -> float:
+        """Квантиль латентности, сглаженная априорным значением, пока успехов меньше min_samples"""
+        latencies = window.latencies()
+        if not latencies:
+            return STT_ROUTER_PRIOR_SECONDS_PER_MINUTE
+        observed = _percentile(latencies, quantile)
+        if len(latencies) >= self.min_samples:
+            return observed
+        weight = len(latencies) / self.min_samples
+        return observed * weight + STT_ROUTER_PRIOR_SECONDS_PER_MINUTE * (1 - weight)
+
+    def expected_seconds(self, provider: str, audio_length: float | None) -> float:
+        """
+        Ожидаемое время до успешной транскрипции у провайдера: успешная попытка стоит
+        медианной латентности, неудачная — среднего времени неудач, и до успеха в среднем
+        нужно 1 / success_rate попыток. Плюс стоимость минуты с весом cost_weight.
+        """
+        window = self._window(provider, duration_bucket(audio_length))
+        minutes = max((audio_length or 60) / 60, 1 / 60)
+        latency = self._seconds_per_minute(window, 0.5) * minutes
+        failure = window.failure_seconds()
+        if failure is None:
+            failure = latency
+        rate = window.success_rate()
+        expected = (rate * latency + (1 - rate) * failure) / rate
+        if self.cost_weight:
+            expected += self.cost_weight * self.cost_per_minute.get(provider, 0.0) * minutes
+        return expected
+
+    def hedge_delay(self, provider: str, audio_length: float | None) -> float:
+        """Через сколько секунд без ответа провайдера стоит хеджировать: p90 успешных попыток корзины"""
+        seconds = self._window(provider, duration_bucket(audio_length)).success_seconds()
+        if len(seconds) < self.min_samples:
+            return STT_HEDGE_DEFAULT_DELAY_SECONDS
+        return max(_percentile(seconds, 0.9), STT_HEDGE_MIN_DELAY_SECONDS)
+
+    def order(self, candidates: list[str], audio_length: float | None = None) -> list[str]:
+        """
+        Кандидаты по возрастанию ожидаемого времени; при равенстве — в исходном порядке.
+        Провайдеры с открытым автоматом идут последними: если откажут все остальные,
+        их всё равно попробуют.
+        """
+        def key(item):
+            rank, provider = item
+            is_open = self._breaker_state(provider) == 'open'
+            return is_open, round(self.expected_seconds(provider, audio_length), 3), rank
+
+        ordered = [provider for _, provider in sorted(enumerate(candidates), key=key)]
+        if ordered != list(candidates):
+            logger.info(f'STT router reordered providers for {duration_bucket(audio_length)} audio: {ordered}')
+        return ordered
+
+    def begin(self, provider: str) -> None:
+        """
+        Отмечает начало попытки. В полуоткрытом состоянии пробная попытка одна: до её
+        исхода (но не дольше ещё одного cooldown, если задачу отменили) автомат снова открыт.
+        """
+        if self._breaker_state(provider) == 'half_open':
+            self._breaker(provider).opened_until = self._clock() + self.breaker_cooldown
+
+    def record(self, provider: str, audio_length: float | None, seconds: float, ok: bool) -> None:
+        """Исход попытки: обновляет окно корзины и автомат провайдера"""
+        per_minute = seconds / (audio_length / 60) if audio_length else None
+        self._window(provider, duration_bucket(audio_length)).add(ok, seconds, per_minute)
+
+        breaker = self._breaker(provider)
+        if ok:
+            breaker.consecutive_failures = 0
+            return
+        breaker.consecutive_failures += 1
+        if breaker.consecutive_failures >= self.breaker_failures:
+            breaker.opened_until = self._clock() + self.breaker_cooldown
+            breaker.opened_total += 1
+            logger.warning(f'STT provider {provider} failed {breaker.consecutive_failures} times in a row, '
+                           f'circuit open for {self.breaker_cooldown:.0f}s')
+
+    def get_stats(self) -> dict:
+        providers: dict[str, dict] = {}
+        for (provider, bucket), window in sorted(self._windows.items()):
+            if not window.attempts_total:
+                continue
+            latencies = window.latencies()
+            entry = providers.setdefault(provider, {
+                'circuit': self._breaker_state(provider),
+                'consecutive_failures': self._breaker(provider).consecutive_failures,
+                'circuit_opened_total': self._breaker(provider).opened_total,
+                'cost_per_minute': self.cost_per_minute.get(provider),
+                'buckets': {},
+            })
+            entry['buckets'][bucket] = {
+                'attempts_total': window.attempts_total,
+                'failures_total': window.failures_total,
+                'window': len(window.samples),
+                'success_rate': round(window.success_rate(), 3),
+                'p50_seconds_per_minute': round(_percentile(latencies, 0.5), 2) if latencies else None,
+                'p95_seconds_per_minute': round(_percentile(latencies, 0.95), 2) if latencies else None,
+                'score_seconds': round(self.expected_seconds(provider, _BUCKET_REFERENCE_SECONDS[bucket]), 1),
+            }
+        return {
+            'window': self.window,
+            'breaker_failures': self.breaker_failures,
+            'breaker_cooldown_seconds': self.breaker_cooldown,
+            'cost_weight': self.cost_weight,
+            'providers': providers,
+        }
+
+
+class HedgeController:
+    """Решение о хедже для задачи, бюджет на дополнительные запросы и счётчики исходов"""
+
+    def __init__(self, router: SttRouter, enabled: bool = STT_HEDGE_ENABLED,
+                 source_types: frozenset = STT_HEDGE_SOURCE_TYPES,
+                 max_audio_seconds: float = STT_HEDGE_MAX_AUDIO_SECONDS,
+                 budget_per_hour: float = STT_HEDGE_BUDGET_PER_HOUR,
+                 clock: Callable[[], float] = time.monotonic):
+        self.router = router
+        self.enabled = enabled
+        self.source_types = source_types
+        self.max_audio_seconds = max_audio_seconds
+        self.budget_per_hour = budget_per_hour
+        self._clock = clock
+        # (момент, долларов) по запущенным хеджам за последний час
+        self._spend: deque[tuple[float, float]] = deque()
+        self.fired = 0
+        self.wins = 0
+        self.losses = 0
+        self.both_failed = 0
+        self.budget_denied = 0
+        self.spent_total = 0.0
+
+    def eligible(self, audio_file_source_type: str | None, audio_length: float | None) -> bool:
+        return (self.enabled and audio_file_source_type in self.source_types
+                and bool(audio_length) and audio_length <= self.max_audio_seconds)
+
+    def _spent_last_hour(self) -> float:
+        horizon = self._clock() - 3600
+        while self._spend and self._spend[0][0] < horizon:
+            self._spend.popleft()
+        return sum(cost for _, cost in self._spend)
+
+    def try_acquire(self, provider: str, audio_length: float | None) -> bool:
+        """
+        Резервирует бюджет на хеджирующий запрос к provider. Стоимость считается целиком:
+        отменённый запрос провайдер, скорее всего, уже тарифицировал.
+        """
+        cost = self.router.cost_per_minute.get(provider, 0.0) * max((audio_length or 60) / 60, 1 / 60)
+        if self._spent_last_hour() + cost > self.budget_per_hour:
+            self.budget_denied += 1
+            return False
+        self._spend.append((self._clock(), cost))
+        self.spent_total += cost
+        self.fired += 1
+        return True
+
+    def record_outcome(self, hedge_won: bool | None) -> None:
+        """Исход запущенного хеджа: True — первым успел хедж, False — основной, None — оба неудачны"""
+        if hedge_won is None:
+            self.both_failed += 1
+        elif hedge_won:
+            self.wins += 1
+        else:
+            self.losses += 1
+
+    def get_stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'source_types': sorted(self.source_types),
+            'fired': self.fired,
+            'wins': self.wins,
+            'losses': self.losses,
+            'both_failed': self.both_failed,
+            'budget_denied': self.budget_denied,
+            'budget_per_hour': self.budget_per_hour,
+            'spent_last_hour': round(self._spent_last_hour(), 4),
+            'spent_total': round(self.spent_total, 4),
+        }
+
+
+# Глобальные экземпляры
+stt_router = SttRouter()
+stt_hedge = HedgeController(stt_router)
+
+
+def get_stt_router_stats() -> dict:
+    """Оценки STT-провайдеров по корзинам длительности и счётчики хеджей (отдаётся через /metrics)"""
+    stats = stt_router.get_stats()
+    stats['hedging'] = stt_hedge.get_stats()
+    return stats
@@ -269,6 +269,62 @@ def group_transcription_smart(transcription_text: str,
     return '\n\n'.join(grouped_blocks)
 
 
+_TIMECODE_HEADER = re.compile(r'\[\s*(\d+(?::\d+)*(?:\.\d+)?)\s*-\s*(\d+(?::\d+)*(?:\.\d+)?)\s*\]\s*(.*)')
+
+
+def _timecode_to_seconds(value: str) -> float:
+    """'36.02', '01:23.45' или '01:02:03.45' -> секунды"""
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def normalize_speaker_label(label: str) -> str:
+    """Метка спикера, пригодная для формата (speaker): 'SPEAKER: 0' -> 'SPEAKER_0'"""
+    return re.sub(r'[()\s:]+', '_', label.strip()).strip('_') or 'SPEAKER'
+
+
+def parse_timecoded_segments(transcription_text: str) -> List[Tuple[float, float, str, str]]:
+    """
+    Разбирает транскрипцию любого STT-провайдера в сегменты (start, end, speaker, text).
+
+    Понимает оба формата, которые отдают провайдеры:
+    - однострочный [start - end] (speaker) text (сырой или после group_transcription_smart);
+    - заголовок [start - end] SPEAKER: 0 и текст на следующих строках (deepgram, openai, assemblyai...).
+    Время — секунды, MM:SS.ss или HH:MM:SS.ss.
+
+    Args:
+        transcription_text: Таймкодированная транскрипция
+
+    Returns:
+        Список сегментов в порядке следования
+    """
+    segments = []
+    current = None
+    for line in (transcription_text or '').split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        match = _TIMECODE_HEADER.match(line)
+        if match:
+            if current and current[3]:
+                segments.append((current[0], current[1], current[2], ' '.join(current[3])))
+            rest = match.group(3).strip()
+            inline = re.match(r'\(([^)]*)\)\s*(.*)', rest)
+            if inline:
+                speaker, texts = inline.group(1), [inline.group(2)] if inline.group(2) else []
+            else:
+                speaker, texts = rest, []
+            current = (_timecode_to_seconds(match.group(1)), _timecode_to_seconds(match.group(2)),
+                       normalize_speaker_label(speaker), texts)
+        elif current:
+            current[3].append(line)
+    if current and current[3]:
+        segments.append((current[0], current[1], current[2], ' '.join(current[3])))
+    return segments
+
+
 # Пример использования
 if __name__ == "__main__":
     # Тестовые данные
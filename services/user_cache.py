@@ -0,0 +1,105 @@
+"""
+In-process read-through кэш пользователей перед models.orm.get_user.
+
+Каждый апдейт проходит через UserMiddleware, который вызывает get_user,
+а _process_audio_internal повторяет тот же запрос. Кэш хранит словари
+из _prepare_user_dict по telegram_id, чтобы большинство апдейтов
+обслуживалось без обращения к БД.
+
+Принцип работы:
+1. get_user сначала смотрит в кэш (get), при промахе читает БД и кладёт результат (put)
+2. Все функции models.orm, меняющие поля пользователя, вызывают invalidate()
+3. TTL ограничивает устаревание при изменениях из других процессов
+   (например, платежные вебхуки в payments_handlers.py)
+"""
+
+import logging
+import os
+from typing import Optional
+
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# TTL небольшой: изменения из соседних процессов (платежный сервис, второй бот)
+# не инвалидируют этот кэш и становятся видны не позже чем через TTL
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS', 15))
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE', 10000))
+
+
+class UserCache:
+    """
+    TTL/LRU кэш словарей пользователей по telegram_id.
+
+    Отдаёт копии словарей, так как вызывающий код их модифицирует
+    (например, middleware добавляет ключ 'new_user').
+    """
+
+    def __init__(self, ttl_seconds: float = USER_CACHE_TTL_SECONDS, max_size: int = USER_CACHE_MAX_SIZE):
+        self._cache: TTLCache = TTLCache(maxsize=max_size, ttl=ttl_seconds)
+        # Версия растёт при каждой инвалидации: чтение из БД, начавшееся до
+        # инвалидации, не должно положить в кэш устаревшие данные
+        self._version = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(telegram_id: str | int) -> str:
+        return str(telegram_id)
+
+    def get(self, telegram_id: str | int) -> Optional[dict]:
+        user = self._cache.get(self._key(telegram_id))
+        if user is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(user)
+
+    def begin_read(self) -> int:
+        """Возвращает токен версии, который нужно передать в put() после чтения из БД"""
+        return self._version
+
+    def put(self, telegram_id: str | int, user: dict, version: int) -> None:
+        if version != self._version:
+            # Между началом чтения и записью была инвалидация — данные могли устареть
+            return
+        self._cache[self._key(telegram_id)] = dict(user)
+
+    def invalidate(self, telegram_id: str | int) -> None:
+        self._version += 1
+        self.invalidations += 1
+        self._cache.pop(self._key(telegram_id), None)
+
+    def clear(self) -> None:
+        self._version += 1
+        self._cache.clear()
+
+    def get_stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._cache),
+            'max_size': self._cache.maxsize,
+            'ttl_seconds': self._cache.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': round(self.hits / total * 100, 1) if total else 0.0,
+        }
+
+
+# Глобальный экземпляр
+user_cache = UserCache()
+
+
+def invalidate_user(telegram_id: str | int | None) -> None:
+    """Удаляет пользователя из кэша. Вызывать после любого изменения строки users."""
+    if telegram_id is None:
+        return
+    user_cache.invalidate(telegram_id)
+
+
+def get_user_cache_stats() -> dict:
+    """Счётчики hit/miss для мониторинга (отдаются через /metrics)"""
+    return user_cache.get_stats()
@@ -17,6 +17,7 @@ from yarl import URL
 
 from services.content_downloaders.fastsaver import download_video_via_fastsaver
 from services.init_bot import config
+from services.concurrency_governor import limit_stage
 from services.content_downloaders.file_handling import download_file, identify_url_source
 from services.content_downloaders.vimeo_downloader import download_vimeo_video
 from services.content_downloaders.vk_services import all_media_downloader_api
@@ -109,6 +110,7 @@ async def get_content_from_url(url: str, user_data: dict, download_mode: str = '
                 logger.error(f'Ошибка при загрузке через rapidapi: {traceback.format_exc()}')
                 raise Exception(f"Все методы загрузки не удались для URL: {url}")
 
+@limit_stage('download')
 async def get_audio_from_url(url: str, user_data: dict, session_id: str | None = None) -> bytes | str | None:
     """
     Получает аудио из видео по URL, пробуя различные методы загрузки.